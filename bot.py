@@ -2,15 +2,26 @@
 # bot.py
 # python-telegram-bot v20+
 import asyncio
+from array import array
+from collections import OrderedDict, deque
+import contextlib
+import contextvars
 import random
 import json
 import logging
+import math
 import os
 import re
+import secrets
+import heapq
 import html
+import sqlite3
+import sys
+import threading
 from datetime import datetime, timedelta, timezone
 import time
 from typing import Optional
+from urllib.parse import urlparse
 
 from telegram import (
     Update,
@@ -20,13 +31,18 @@ from telegram import (
 )
 from telegram import InputMediaPhoto, LabeledPrice
 from telegram import InputMediaPhoto
-from telegram.error import BadRequest
+from telegram import InputMediaAudio, InputMediaDocument, InputMediaVideo
+from telegram.error import BadRequest, Forbidden, InvalidToken, NetworkError, RetryAfter
 from telegram.ext import (
     ApplicationBuilder,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
+    ExtBot,
     CommandHandler,
     CallbackQueryHandler,
     PreCheckoutQueryHandler,
     MessageHandler,
+    TypeHandler,
     ContextTypes,
     filters,
 )
@@ -42,6 +58,29 @@ COURIERS_FILE = "couriers.json"
 EARNINGS_FILE = "earnings.json"
 MENU_FILE = "menu.json"
 USERS_INFO_FILE = "users_info.json"
+# Buyurtma o'zgarishlari jurnali (ORDERS_FILE snapshot ustiga qo'shiladi)
+ORDERS_JOURNAL_FILE = "orders.journal"
+# Foydalanuvchi sessiyalari (savat, checkout holati) — user_id bo'yicha qo'shib boriladigan jurnal
+USER_DATA_FILE = "user_data.log"
+# Karta orqali to'lov uchun yuborilgan invoyslar (payload bo'yicha)
+INVOICES_FILE = "invoices.json"
+# To'lanmagan invoys shu muddatdan keyin (soniya) yaroqsiz bo'ladi
+INVOICE_TTL = float(os.getenv('INVOICE_TTL', '1800'))
+# Bot yuborgan xabarlar id'lari (/start tozalashi uchun) qayta ishga tushganda saqlanadi; bo'sh qiymat — saqlanmaydi
+TRACK_MESSAGES_FILE = os.getenv('TRACK_MESSAGES_FILE', 'bot_messages.json')
+TRACK_MESSAGES = os.getenv('TRACK_MESSAGES', '1') != '0'
+# sqlite:///delivery_bot.db -> SQLite saqlash; bo'sh bo'lsa JSON fayllar ishlatiladi
+DATABASE_URL = os.getenv('DATABASE_URL', '')
+# Davom ettiriladigan e'lon (broadcast) holati
+BROADCAST_CHECKPOINT_FILE = "broadcast.checkpoint.json"
+# Super-admin hisobotlari (audit hodisalari) JSON qatorlar ko'rinishida
+AUDIT_LOG_FILE = "audit.log"
+# Telegram: ~30 xabar/soniya umumiy limit; zaxira bilan 25
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '8'))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', '5'))
+# "Oxirgi N kunda buyurtma berganlar" segmenti uchun N
+BROADCAST_RECENT_DAYS = int(os.getenv('BROADCAST_RECENT_DAYS', '30'))
 
 # Buyurtmalar kanalining chat ID (o'zgartirdingiz):
 BUYURTMALAR_CHANNEL_ID = -1003357292759
@@ -50,6 +89,14 @@ SUPERADMIN_CHANNEL_ID = -1003401946836  # Super admin hisobot kanali ID
 SUGGESTIONS_CHANNEL_ID = -1003394437912  # Taklif va shikoyatlar kanali
 PAYMENT_PROVIDER_TOKEN = os.getenv('PAYMENT_PROVIDER_TOKEN', '')
 PAYMENTS_CHANNEL_ID = -1003105969871  # Manat o'tovlar kanali
+# Webhook rejimi: WEBHOOK_URL Telegram'ga ro'yxatdan o'tkaziladi; faqat WEBHOOK_PORT bo'lsa — lokal sinov
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '0') or 0)
+# WEBHOOK_URL bo'lmasa (lokal sinov) faqat 127.0.0.1 da tinglanadi
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN') or ('0.0.0.0' if WEBHOOK_URL else '127.0.0.1')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+# Bir vaqtda qayta ishlanadigan update'lar (bitta foydalanuvchiniki ketma-ket)
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '64'))
 
 # ========== LOGGING ==========
 logging.basicConfig(
@@ -59,30 +106,205 @@ logging.basicConfig(
 log = logging.getLogger("dostavka_bot")
 
 # Track all bot-sent messages per private chat so we can purge on /start
-bot_messages_by_chat: dict[int, list[dict]] = {}
+class MessageTracker:
+    """Ids of bot-sent messages per private chat, so /start can purge them.
+
+    Each chat keeps its ids in an `array('q')` (8 bytes per id, no per-message
+    objects) trimmed to the newest `per_chat` ids; the buffer may grow to twice
+    that before it is trimmed, so appends stay amortized O(1). Chats are kept in
+    LRU order and the least recently active ones are evicted once more than
+    `max_chats` are tracked. `save()`/`load()` keep the ids across a restart.
+    """
 
-def _record_bot_message(chat_id: int, message_id: int):
-    try:
+    def __init__(self, per_chat: int = 300, max_chats: int = 20000):
+        self.per_chat = per_chat
+        self.max_chats = max_chats
+        self._chats: OrderedDict[int, array] = OrderedDict()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._chats)
+
+    def record(self, chat_id: int, message_id: int):
         if chat_id is None or message_id is None:
             return
-        lst = bot_messages_by_chat.setdefault(int(chat_id), [])
-        lst.append({'chat_id': int(chat_id), 'message_id': int(message_id)})
-        if len(lst) > 300:
-            del lst[: len(lst) - 300]
-    except Exception:
-        pass
+        chat_id = int(chat_id)
+        ids = self._chats.get(chat_id)
+        if ids is None:
+            ids = self._chats[chat_id] = array('q')
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+                self.evicted += 1
+        else:
+            self._chats.move_to_end(chat_id)
+        ids.append(int(message_id))
+        if len(ids) >= 2 * self.per_chat:
+            del ids[:len(ids) - self.per_chat]
 
-async def _delete_all_bot_messages_for_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
-    try:
-        arr = bot_messages_by_chat.pop(int(chat_id), [])
-        for m in arr:
+    def pop(self, chat_id: int) -> list[int]:
+        ids = self._chats.pop(int(chat_id), None)
+        return ids[-self.per_chat:].tolist() if ids else []
+
+    def stats(self) -> dict:
+        return {'chats': len(self._chats), 'ids': sum(len(a) for a in self._chats.values()), 'evicted': self.evicted}
+
+    def save(self, path: str):
+        # compact JSON (no indent): this file can hold millions of ids
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({str(c): ids[-self.per_chat:].tolist() for c, ids in self._chats.items()}, f, separators=(",", ":"))
+            os.replace(tmp, path)
+        except Exception as e:
+            log.error(f"Faylni saqlashda xatolik ({path}): {e}")
+
+    def load(self, path: str):
+        data = load_json(path, {})
+        for chat_id, ids in (data.items() if isinstance(data, dict) else ()):
+            try:
+                for mid in ids:
+                    self.record(int(chat_id), mid)
+            except (TypeError, ValueError):
+                continue
+
+
+message_tracker = MessageTracker(
+    per_chat=int(os.getenv('TRACK_MESSAGES_PER_CHAT', '300')),
+    max_chats=int(os.getenv('TRACK_MESSAGES_MAX_CHATS', '20000')),
+)
+
+
+# Javoblari xabar (yoki xabarlar ro'yxati) bo'lgan Bot API metodlari
+RECORDED_ENDPOINTS = frozenset({
+    'sendMessage', 'sendPhoto', 'sendDocument', 'sendSticker', 'sendVideo', 'sendAudio', 'sendVoice',
+    'sendAnimation', 'sendVideoNote', 'sendLocation', 'sendVenue', 'sendContact', 'sendPoll', 'sendDice',
+    'sendInvoice', 'sendMediaGroup', 'forwardMessage', 'forwardMessages', 'copyMessage', 'copyMessages',
+})
+
+
+class RecordingBot(ExtBot):
+    """ExtBot that records every message it sends into a private chat in
+    `message_tracker`, for all send/forward/copy methods at once.
+
+    The hook sits in `_do_post`, after the rate limiter, and works on the raw
+    JSON result, so there is no extra coroutine per call and no Message parsing.
+    Private chats are recognised by a positive `chat_id`; channel and group
+    traffic (negative ids) is skipped before anything else. `record_messages=False`
+    turns recording off entirely.
+    """
+
+    __slots__ = ('record_messages',)
+
+    def __init__(self, *args, record_messages: bool = True, **kwargs):
+        super().__init__(*args, **kwargs)
+        with self._unfrozen():
+            self.record_messages = record_messages
+
+    async def _do_post(self, endpoint: str, data: dict, **kwargs):
+        result = await super()._do_post(endpoint, data, **kwargs)
+        if self.record_messages and endpoint in RECORDED_ENDPOINTS:
+            try:
+                chat_id = int(data.get('chat_id'))
+            except (TypeError, ValueError):
+                return result
+            if chat_id > 0:
+                for m in result if isinstance(result, list) else (result,):
+                    if isinstance(m, dict) and m.get('message_id'):
+                        message_tracker.record(chat_id, m['message_id'])
+        return result
+
+class MessageCleaner:
+    """Background bulk deletion of bot messages.
+
+    `schedule()` returns immediately; the ids are removed with `deleteMessages`
+    (up to 100 per call) in a background task, several chats at a time (bounded by
+    `max_chats`). Only if a batch call fails does it fall back to deleting (or
+    blanking) those messages one by one. Inside `deferred()` scheduling is held
+    back until the block exits, so a handler can send its new panel first and
+    let the old messages disappear afterwards.
+    """
+
+    BATCH = 100
+
+    def __init__(self, max_chats: int = 4):
+        self.max_chats = max_chats
+        self._sem: Optional[asyncio.Semaphore] = None
+        self._tasks: set = set()
+        # per-task list of (bot, chat_id, ids) held back by deferred()
+        self._held: contextvars.ContextVar = contextvars.ContextVar('cleanup_held', default=None)
+        self.metrics = {'messages': 0, 'batch_calls': 0, 'fallbacks': 0}
+
+    def schedule(self, bot, chat_id, message_ids) -> Optional[asyncio.Task]:
+        ids = sorted({int(m) for m in message_ids if m})
+        if chat_id is None or not ids:
+            return None
+        held = self._held.get()
+        if held is not None:
+            held.append((bot, int(chat_id), ids))
+            return None
+        task = asyncio.create_task(self.delete(bot, int(chat_id), ids))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def schedule_refs(self, bot, refs):
+        """Schedule [{'chat_id', 'message_id'}, ...] grouped per chat."""
+        by_chat: dict[int, list] = {}
+        for m in refs:
+            if m and m.get('chat_id') is not None and m.get('message_id'):
+                by_chat.setdefault(m['chat_id'], []).append(m['message_id'])
+        for chat_id, ids in by_chat.items():
+            self.schedule(bot, chat_id, ids)
+
+    @contextlib.contextmanager
+    def deferred(self):
+        held = []
+        token = self._held.set(held)
+        try:
+            yield
+        finally:
+            self._held.reset(token)
+            for bot, chat_id, ids in held:
+                self.schedule(bot, chat_id, ids)
+
+    async def delete(self, bot, chat_id: int, ids: list):
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.max_chats)
+        async with self._sem:
+            for i in range(0, len(ids), self.BATCH):
+                chunk = ids[i:i + self.BATCH]
+                self.metrics['batch_calls'] += 1
+                try:
+                    await bot.delete_messages(chat_id=chat_id, message_ids=chunk)
+                    self.metrics['messages'] += len(chunk)
+                except Exception as e:
+                    log.warning(f"{chat_id} chatida {len(chunk)} ta xabarni o'chirish muvaffaqiyatsiz: {e}; bittalab urinib ko'riladi")
+                    await self._fallback(bot, chat_id, chunk)
+
+    async def _fallback(self, bot, chat_id: int, ids: list):
+        for mid in ids:
+            self.metrics['fallbacks'] += 1
             try:
-                await context.bot.delete_message(chat_id=m.get('chat_id'), message_id=m.get('message_id'))
+                await bot.delete_message(chat_id=chat_id, message_id=mid)
+                self.metrics['messages'] += 1
             except Exception:
                 try:
-                    await context.bot.edit_message_text(chat_id=m.get('chat_id'), message_id=m.get('message_id'), text='\u200b')
+                    await bot.edit_message_text(chat_id=chat_id, message_id=mid, text='\u200b')
                 except Exception:
                     pass
+
+    async def stop(self, timeout: float = 5.0):
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=timeout)
+        log.info(f"Xabarlarni tozalash statistikasi: {self.metrics}")
+
+
+message_cleaner = MessageCleaner(max_chats=int(os.getenv('CLEANUP_CONCURRENCY', '4')))
+
+
+async def _delete_all_bot_messages_for_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    try:
+        message_cleaner.schedule(context.bot, chat_id, message_tracker.pop(chat_id))
     except Exception:
         pass
 
@@ -97,49 +319,1231 @@ def load_json(fname, default):
     return default
 
 def save_json(fname, data):
+    write_text(fname, json.dumps(data, ensure_ascii=False, indent=2))
+
+def write_text(fname, text: str):
+    """Atomically replace `fname` with already serialized `text`."""
     tmp = fname + ".tmp"
     try:
         with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.write(text)
         os.replace(tmp, fname)
     except Exception as e:
         log.error(f"Faylni saqlashda xatolik ({fname}): {e}")
 
-# Foydalanuvchilar va buyurtmalarni fayldan yuklash
-_users_data = load_json(USERS_FILE, [])
-users = set(int(x) for x in _users_data)
 
-_orders_data = load_json(ORDERS_FILE, [])
-orders = _orders_data if isinstance(_orders_data, list) else []
+class OrderJournal:
+    """Append-only journal of order mutations on top of the `orders.json` snapshot.
+
+    Each persisted change appends the full changed order as one JSON line, so the
+    cost of a write depends on the size of that order rather than on the whole
+    history. Lines are fsynced in batches and the journal is periodically folded
+    back into the snapshot (compaction). On startup the snapshot is loaded and
+    the journal replayed over it; the last write for an order_number wins.
+    """
+
+    def __init__(self, snapshot_file: str, journal_file: str, compact_every: int = 500,
+                 fsync_every: int = 20, fsync_interval: float = 2.0):
+        self.snapshot_file = snapshot_file
+        self.journal_file = journal_file
+        self.compact_every = compact_every
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._fh = None
+        self._entries = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def load(self) -> list[dict]:
+        data = load_json(self.snapshot_file, [])
+        by_number: dict[int, dict] = {}
+        for o in data if isinstance(data, list) else []:
+            try:
+                by_number[int(o.get("order_number", -1))] = o
+            except Exception:
+                continue
+        self._entries = 0
+        try:
+            if os.path.exists(self.journal_file):
+                with open(self.journal_file, "r", encoding="utf-8") as f:
+                    for lineno, line in enumerate(f, 1):
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            o = json.loads(line)
+                            by_number[int(o["order_number"])] = o
+                            self._entries += 1
+                        except Exception as e:
+                            # a torn last line after a crash is expected; anything after it is not trusted
+                            log.warning(f"Buyurtmalar jurnalida buzilgan qator ({self.journal_file}:{lineno}): {e}")
+                            break
+        except Exception as e:
+            log.warning(f"Buyurtmalar jurnalini o'qishda xatolik ({self.journal_file}): {e}")
+        return list(by_number.values())
+
+    def _open(self):
+        if self._fh is None:
+            self._fh = open(self.journal_file, "a", encoding="utf-8")
+        return self._fh
+
+    @staticmethod
+    def dumps(order: dict) -> str:
+        return json.dumps(order, ensure_ascii=False, separators=(",", ":"))
+
+    def append(self, order: dict):
+        self.append_line(self.dumps(order))
+
+    def append_line(self, line: str):
+        """Append one order already serialized with `dumps()`."""
+        try:
+            fh = self._open()
+            fh.write(line + "\n")
+            fh.flush()
+            self._entries += 1
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+                self.sync()
+        except Exception as e:
+            log.error(f"Buyurtmalar jurnaliga yozishda xatolik ({self.journal_file}): {e}")
+
+    def sync(self):
+        try:
+            if self._fh is not None and self._unsynced:
+                os.fsync(self._fh.fileno())
+        except Exception as e:
+            log.warning(f"Jurnalni fsync qilishda xatolik: {e}")
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def needs_compaction(self) -> bool:
+        return self._entries >= self.compact_every
+
+    def compact(self, all_orders):
+        self.compact_text(json.dumps(list(all_orders), ensure_ascii=False, indent=2))
+
+    def compact_text(self, snapshot: str):
+        """Write a fresh (serialized) snapshot and truncate the journal.
+        The snapshot is replaced atomically before the journal is emptied, so a crash
+        in between only means the (idempotent) journal is replayed once more.
+        """
+        write_text(self.snapshot_file, snapshot)
+        try:
+            self.close()
+            with open(self.journal_file, "w", encoding="utf-8"):
+                pass
+            self._entries = 0
+        except Exception as e:
+            log.error(f"Jurnalni tozalashda xatolik ({self.journal_file}): {e}")
+
+    def close(self):
+        if self._fh is not None:
+            try:
+                self.sync()
+                self._fh.close()
+            except Exception:
+                pass
+            self._fh = None
+
+
+class UserDataLog:
+    """Append-only store for per-user `context.user_data`.
+
+    Every save appends one `<user_id>\\t<json>` line. On open only the user ids at
+    the start of each line are read to build an in-memory offset index, so startup
+    cost does not depend on how large the carts and sessions are; a user's JSON is
+    parsed the first time that user sends an update. Superseded lines are dropped
+    by compaction once they outnumber the live ones.
+    """
+
+    def __init__(self, path: str, compact_min: int = 1000):
+        self.path = path
+        self.compact_min = compact_min
+        self._lock = threading.Lock()   # writer thread vs. lazy loads on the event loop
+        self._index: dict[int, int] = {}
+        self._lines = 0
+        self._fh = None
+        self._scan()
+
+    def _scan(self):
+        self._index.clear()
+        self._lines = 0
+        if not os.path.exists(self.path):
+            return
+        try:
+            torn = None
+            with open(self.path, "rb") as f:
+                offset = 0
+                for line in f:
+                    uid, sep, rest = line.partition(b"\t")
+                    try:
+                        uid = int(uid)
+                    except ValueError:
+                        sep = b""
+                    if not sep or not line.endswith(b"\n"):
+                        # a torn last line after a crash; cut it off so new lines start clean
+                        log.warning(f"user_data jurnalida buzilgan qator ({self.path}, offset {offset})")
+                        torn = offset
+                        break
+                    if rest.strip():
+                        self._index[uid] = offset
+                    else:
+                        self._index.pop(uid, None)
+                    self._lines += 1
+                    offset += len(line)
+            if torn is not None:
+                os.truncate(self.path, torn)
+        except Exception as e:
+            log.warning(f"user_data jurnalini o'qishda xatolik ({self.path}): {e}")
+
+    def _read_at(self, f, offset: int) -> bytes:
+        f.seek(offset)
+        return f.readline().partition(b"\t")[2]
+
+    def get(self, uid: int) -> Optional[dict]:
+        with self._lock:
+            offset = self._index.get(uid)
+            if offset is None:
+                return None
+            try:
+                if self._fh is not None:
+                    self._fh.flush()
+                with open(self.path, "rb") as f:
+                    return json.loads(self._read_at(f, offset))
+            except Exception as e:
+                log.warning(f"user_data o'qishda xatolik ({uid}): {e}")
+                return None
+
+    def items(self):
+        with self._lock:
+            index = dict(self._index)
+        if not index:
+            return
+        with open(self.path, "rb") as f:
+            for uid, offset in index.items():
+                yield uid, json.loads(self._read_at(f, offset))
+
+    def write(self, rows: dict):
+        """`rows` maps user_id -> serialized JSON, or '' to drop the user."""
+        with self._lock:
+            if self._fh is None:
+                self._fh = open(self.path, "ab")
+            for uid, data in rows.items():
+                offset = self._fh.tell()
+                self._fh.write(f"{int(uid)}\t{data}\n".encode("utf-8"))
+                self._lines += 1
+                if data:
+                    self._index[int(uid)] = offset
+                else:
+                    self._index.pop(int(uid), None)
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            if self._lines >= self.compact_min and self._lines > 2 * len(self._index):
+                self._compact()
+
+    def _compact(self):
+        tmp = self.path + ".tmp"
+        index = {}
+        with open(self.path, "rb") as src, open(tmp, "wb") as dst:
+            for uid, offset in self._index.items():
+                index[uid] = dst.tell()
+                dst.write(f"{uid}\t".encode("utf-8") + self._read_at(src, offset))
+            dst.flush()
+            os.fsync(dst.fileno())
+        self._fh.close()
+        self._fh = None
+        os.replace(tmp, self.path)
+        self._index = index
+        self._lines = len(index)
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                try:
+                    self._fh.close()
+                except Exception:
+                    pass
+                self._fh = None
+
+
+# Buyurtma holatlari va ruxsat etilgan o'tishlar:
+# Kutilyapti -> Kanalda -> Qabul qilingan -> Yetkazib berildi; bekor qilish va qaytarish (Qabul qilingan -> Kanalda)
+ORDER_TRANSITIONS = {
+    'Kutilyapti': {'Kanalda', 'Bekor qilindi'},
+    'Kanalda': {'Qabul qilingan', 'Bekor qilindi'},
+    'Qabul qilingan': {'Yetkazib berildi', 'Kanalda', 'Bekor qilindi'},
+    'Yetkazib berildi': set(),
+    'Bekor qilindi': set(),
+}
+
+# set_status_<n>_<eski holat>_<yangi holat> tugmasi bilan admin bajarishi mumkin bo'lgan o'tishlar.
+# Qabul qilish va yetkazib berish kuryer oqimida qoladi (accept_, delivered_: OTP kodi, daromad),
+# bekor qilish — cancel_order_ orqali.
+ADMIN_STATUS_EDGES = {('Kutilyapti', 'Kanalda')}
+
+
+class OrderStore:
+    """In-memory order collection with constant-time lookups.
+
+    Orders are kept in insertion order behind a primary index by order_number,
+    plus secondary indexes by user_id, courier_id and status. Indexed fields must
+    be changed through `update()` (and new orders added through `add()`);
+    `persist_orders()` also calls `touch()` as a safety net for direct edits.
+    """
+
+    _INDEXED = ('user_id', 'courier_id', 'status')
+
+    def __init__(self, items=()):
+        self._by_number: dict[int, dict] = {}
+        # order_number -> (user_id, courier_id, status) as last indexed
+        self._keys: dict[int, tuple] = {}
+        # field -> value -> {order_number: None} (dicts used as ordered sets)
+        self._index: dict[str, dict] = {f: {} for f in self._INDEXED}
+        # user_id -> timestamp of their latest order (broadcast segments)
+        self._last_order_at: dict[int, float] = {}
+        for o in items:
+            self.add(o)
+
+    def __iter__(self):
+        return iter(list(self._by_number.values()))
+
+    def __len__(self):
+        return len(self._by_number)
+
+    def get(self, order_number) -> Optional[dict]:
+        try:
+            return self._by_number.get(int(order_number))
+        except (TypeError, ValueError):
+            return None
+
+    def add(self, order: dict):
+        num = int(order.get('order_number', -1))
+        self._by_number[num] = order
+        self.touch(order)
+        uid = order.get('user_id')
+        if uid is not None:
+            try:
+                ts = datetime.fromisoformat(order.get('dt')).timestamp()
+            except Exception:
+                ts = time.time()
+            if ts > self._last_order_at.get(uid, 0.0):
+                self._last_order_at[uid] = ts
+
+    def update(self, order: dict, **fields):
+        """Set fields on `order` and refresh the indexes; a value of None removes the field."""
+        for k, v in fields.items():
+            if v is None:
+                order.pop(k, None)
+            else:
+                order[k] = v
+        self.touch(order)
+
+    def transition(self, order_number, expected, new_status: str, by=None, **fields) -> Optional[dict]:
+        """Compare-and-set status change: move the order to `new_status` only if its
+        current status is `expected` (a status, a tuple of statuses, or None for any)
+        and ORDER_TRANSITIONS allows it. `fields` are set in the same step and a
+        {'from', 'to', 'at', 'by'} entry is appended to `status_history`. Returns the
+        order, or None if the transition is stale or not allowed; the caller persists.
+        """
+        order = self.get(order_number)
+        if order is None:
+            return None
+        current = order.get('status')
+        if expected is not None and current not in ((expected,) if isinstance(expected, str) else expected):
+            log.info(f"Eskirgan o'tish rad etildi #{order_number}: {current} (kutilgan {expected}) -> {new_status}")
+            return None
+        if new_status not in ORDER_TRANSITIONS.get(current, ()):
+            log.info(f"Ruxsat etilmagan o'tish rad etildi #{order_number}: {current} -> {new_status}")
+            return None
+        history = list(order.get('status_history') or [])
+        history.append({'from': current, 'to': new_status, 'at': datetime.now(timezone.utc).isoformat(), 'by': by})
+        self.update(order, status=new_status, status_history=history, **fields)
+        return order
+
+    def touch(self, order: dict):
+        num = int(order.get('order_number', -1))
+        new_keys = tuple(order.get(f) for f in self._INDEXED)
+        old_keys = self._keys.get(num, (None,) * len(self._INDEXED))
+        if num in self._keys and old_keys == new_keys:
+            return
+        for f, old, new in zip(self._INDEXED, old_keys, new_keys):
+            if old == new:
+                continue
+            idx = self._index[f]
+            if old is not None:
+                bucket = idx.get(old)
+                if bucket is not None:
+                    bucket.pop(num, None)
+                    if not bucket:
+                        idx.pop(old, None)
+            if new is not None:
+                idx.setdefault(new, {})[num] = None
+        self._keys[num] = new_keys
+
+    def _lookup(self, field: str, value) -> list[dict]:
+        bucket = self._index[field].get(value)
+        if not bucket:
+            return []
+        return [self._by_number[n] for n in sorted(bucket)]
+
+    def by_user(self, user_id) -> list[dict]:
+        return self._lookup('user_id', user_id)
+
+    def by_courier(self, courier_id) -> list[dict]:
+        return self._lookup('courier_id', courier_id)
+
+    def by_status(self, status: str) -> list[dict]:
+        return self._lookup('status', status)
+
+    def couriers_in(self, status: str) -> set:
+        """courier_ids holding an order in `status` (from the status index, unsorted)."""
+        bucket = self._index['status'].get(status) or {}
+        return {self._by_number[n].get('courier_id') for n in bucket} - {None}
+
+    def max_number(self) -> int:
+        return max(self._by_number.keys(), default=0)
+
+    def customers_since(self, ts: float) -> list[int]:
+        """User ids whose latest order was placed at or after `ts`."""
+        return [uid for uid, last in self._last_order_at.items() if last >= ts]
+
+
+class InvoiceStore:
+    """Card invoices sent to users, keyed by their `invoice_payload`.
+
+    An invoice is created when the invoice is sent and carries the pending order,
+    the exact amount and an expiry. Pre-checkout validates against it and the
+    successful payment finalizes it with a single lookup. The charge id index
+    makes finalization idempotent when Telegram redelivers the payment message.
+    Expired unpaid invoices and old paid ones are pruned by `prune()`.
+    """
+
+    def __init__(self, items=(), ttl: float = 1800.0, keep_paid: float = 7 * 86400.0):
+        self.ttl = ttl
+        self.keep_paid = keep_paid
+        self._by_payload: dict[str, dict] = {}
+        self._by_charge: dict[str, str] = {}   # telegram_payment_charge_id -> payload
+        for inv in items:
+            self._by_payload[inv['payload']] = inv
+            if inv.get('charge_id'):
+                self._by_charge[inv['charge_id']] = inv['payload']
+
+    def __len__(self):
+        return len(self._by_payload)
+
+    def items(self) -> dict[str, dict]:
+        return self._by_payload
+
+    def create(self, user_id: int, pending_order: dict, amount: int, currency: str) -> dict:
+        now = time.time()
+        inv = {
+            'payload': f"inv_{user_id}_{int(now * 1000)}_{random.randint(0, 0xffff):04x}",
+            'user_id': user_id,
+            'amount': int(amount),
+            'currency': currency,
+            'pending_order': pending_order,
+            'status': 'pending',
+            'created_at': now,
+            'expires_at': now + self.ttl,
+        }
+        self._by_payload[inv['payload']] = inv
+        return inv
+
+    def get(self, payload) -> Optional[dict]:
+        return self._by_payload.get(payload)
+
+    def by_charge(self, charge_id) -> Optional[dict]:
+        payload = self._by_charge.get(charge_id)
+        return self._by_payload.get(payload) if payload else None
+
+    def mark_paid(self, inv: dict, charge_id: Optional[str], order_number: int):
+        inv.update(status='paid', charge_id=charge_id, order_number=order_number, paid_at=time.time())
+        if charge_id:
+            self._by_charge[charge_id] = inv['payload']
+
+    def prune(self, now: Optional[float] = None) -> list[str]:
+        """Drop unpaid invoices past their expiry and paid ones older than `keep_paid`;
+        returns the removed payloads."""
+        now = time.time() if now is None else now
+        gone = [
+            p for p, inv in self._by_payload.items()
+            if (inv.get('status') != 'paid' and inv.get('expires_at', 0) < now)
+            or (inv.get('status') == 'paid' and inv.get('paid_at', 0) + self.keep_paid < now)
+        ]
+        for p in gone:
+            inv = self._by_payload.pop(p)
+            if inv.get('charge_id'):
+                self._by_charge.pop(inv['charge_id'], None)
+        return gone
+
+
+class JsonStorage:
+    """Default backend: one JSON file per collection, orders journaled via OrderJournal.
+    The `changed` hints are accepted for interface parity with SqliteStorage but the
+    small collections are still rewritten whole.
+
+    Every `dump_*` serializes its collection right away (on the event loop) and
+    returns a function that only writes the finished text, which the
+    PersistenceWorker thread runs later.
+    """
+
+    def __init__(self):
+        self.orders_journal = OrderJournal(
+            ORDERS_FILE, ORDERS_JOURNAL_FILE,
+            compact_every=int(os.getenv('ORDERS_JOURNAL_COMPACT_EVERY', '500')),
+            fsync_every=int(os.getenv('ORDERS_JOURNAL_FSYNC_EVERY', '20')),
+        )
+        self.user_data_log = UserDataLog(USER_DATA_FILE)
+
+    def load_users(self) -> set[int]:
+        return set(int(x) for x in load_json(USERS_FILE, []))
+
+    def load_orders(self) -> list[dict]:
+        return self.orders_journal.load()
+
+    def load_couriers(self) -> set[int]:
+        return set(int(x) for x in load_json(COURIERS_FILE, []))
+
+    def load_earnings(self) -> dict[int, dict]:
+        d = load_json(EARNINGS_FILE, {})
+        return {int(k): v for k, v in d.items()} if isinstance(d, dict) else {}
+
+    def load_users_info(self) -> dict[int, dict]:
+        d = load_json(USERS_INFO_FILE, {})
+        return {int(k): v for k, v in d.items()} if isinstance(d, dict) else {}
+
+    def load_menu(self) -> Optional[dict]:
+        d = load_json(MENU_FILE, None)
+        return d if isinstance(d, dict) else None
+
+    def load_invoices(self) -> list[dict]:
+        d = load_json(INVOICES_FILE, [])
+        return d if isinstance(d, list) else []
+
+    @staticmethod
+    def _file_writer(fname: str, data):
+        text = json.dumps(data, ensure_ascii=False, indent=2)
+        return lambda: write_text(fname, text)
+
+    def dump_users(self, all_users, changed=None):
+        return self._file_writer(USERS_FILE, list(all_users))
+
+    def dump_orders(self, all_orders, changed=None):
+        journal = self.orders_journal
+        lines = [] if changed is None else [journal.dumps(o) for o in changed]
+        snapshot = None
+        if changed is None or journal.needs_compaction():
+            snapshot = json.dumps(list(all_orders), ensure_ascii=False, indent=2)
+
+        def write():
+            for line in lines:
+                journal.append_line(line)
+            if snapshot is not None:
+                journal.compact_text(snapshot)
+        return write
+
+    def dump_couriers(self, all_couriers, changed=None):
+        return self._file_writer(COURIERS_FILE, list(all_couriers))
+
+    def dump_earnings(self, all_earnings, changed=None):
+        # convert keys to str for JSON
+        return self._file_writer(EARNINGS_FILE, {str(k): v for k, v in all_earnings.items()})
+
+    def dump_users_info(self, all_info, changed=None):
+        return self._file_writer(USERS_INFO_FILE, {str(k): v for k, v in all_info.items()})
+
+    def dump_menu(self, menu: dict):
+        return self._file_writer(MENU_FILE, menu)
+
+    def dump_invoices(self, all_invoices: dict, changed=None):
+        return self._file_writer(INVOICES_FILE, list(all_invoices.values()))
+
+    def load_user_data(self, user_id: int) -> Optional[dict]:
+        return self.user_data_log.get(user_id)
+
+    def iter_user_data(self):
+        return self.user_data_log.items()
+
+    def save_user_data(self, rows: dict):
+        self.user_data_log.write(rows)
+
+    def close(self):
+        self.orders_journal.close()
+        self.user_data_log.close()
+
+
+class SqliteStorage:
+    """SQLite backend in WAL mode. Every collection is a table with one row per
+    user/courier/order/product, so `persist_*(id)` becomes a row-level upsert
+    through a cached prepared statement instead of a whole-file rewrite.
+    As in JsonStorage, `dump_*` builds the rows on the event loop and returns a
+    function that only runs the statements."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS couriers (user_id INTEGER PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS users_info (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS earnings (courier_id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS invoices (payload TEXT PRIMARY KEY, user_id INTEGER, status TEXT, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS orders (
+            order_number INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            courier_id INTEGER,
+            status TEXT,
+            dt TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS orders_user_id ON orders (user_id);
+        CREATE INDEX IF NOT EXISTS orders_courier_id ON orders (courier_id);
+        CREATE INDEX IF NOT EXISTS orders_status ON orders (status);
+        CREATE TABLE IF NOT EXISTS menu_categories (name TEXT PRIMARY KEY, position INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS menu_products (
+            category TEXT NOT NULL,
+            name TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (category, name)
+        );
+    """
+    UPSERT_ORDER = "INSERT OR REPLACE INTO orders (order_number, user_id, courier_id, status, dt, data) VALUES (?, ?, ?, ?, ?, ?)"
+    UPSERT_USER_INFO = "INSERT OR REPLACE INTO users_info (user_id, data) VALUES (?, ?)"
+    UPSERT_EARNING = "INSERT OR REPLACE INTO earnings (courier_id, data) VALUES (?, ?)"
+    UPSERT_USER_DATA = "INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)"
+    UPSERT_INVOICE = "INSERT OR REPLACE INTO invoices (payload, user_id, status, data) VALUES (?, ?, ?, ?)"
+
+    def __init__(self, path: str):
+        self.path = path
+        # Writes come from the PersistenceWorker thread, startup loads from the main
+        # thread: that connection is only used under _lock. Per-user session reads run
+        # in asyncio.to_thread workers on a second connection (WAL lets it read while
+        # a write transaction is open), guarded by _read_lock.
+        self._lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self.SCHEMA)
+        self._reader = sqlite3.connect(path, check_same_thread=False)
+
+    def _select(self, sql: str, params=()) -> list:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    @staticmethod
+    def _dumps(v) -> str:
+        return json.dumps(v, ensure_ascii=False, separators=(",", ":"))
+
+    def load_users(self) -> set[int]:
+        return {r[0] for r in self._select("SELECT user_id FROM users")}
+
+    def load_orders(self) -> list[dict]:
+        return [json.loads(r[0]) for r in self._select("SELECT data FROM orders ORDER BY order_number")]
+
+    def load_couriers(self) -> set[int]:
+        return {r[0] for r in self._select("SELECT user_id FROM couriers")}
+
+    def load_earnings(self) -> dict[int, dict]:
+        return {r[0]: json.loads(r[1]) for r in self._select("SELECT courier_id, data FROM earnings")}
+
+    def load_users_info(self) -> dict[int, dict]:
+        return {r[0]: json.loads(r[1]) for r in self._select("SELECT user_id, data FROM users_info")}
+
+    def load_menu(self) -> Optional[dict]:
+        cats = self._select("SELECT name FROM menu_categories ORDER BY position")
+        if not cats:
+            return None
+        menu = {c[0]: {} for c in cats}
+        for cat, name, data in self._select("SELECT category, name, data FROM menu_products ORDER BY category, position"):
+            menu.setdefault(cat, {})[name] = json.loads(data)
+        return menu
+
+    def _id_set_writer(self, table: str, all_ids, changed):
+        full = None if changed is not None else [(int(i),) for i in all_ids]
+        keep = [] if changed is None else [(int(i),) for i in changed if i in all_ids]
+        drop = [] if changed is None else [(int(i),) for i in changed if i not in all_ids]
+
+        def write():
+            with self._lock, self._conn:
+                if full is not None:
+                    self._conn.execute(f"DELETE FROM {table}")
+                    self._conn.executemany(f"INSERT OR IGNORE INTO {table} (user_id) VALUES (?)", full)
+                    return
+                self._conn.executemany(f"INSERT OR IGNORE INTO {table} (user_id) VALUES (?)", keep)
+                self._conn.executemany(f"DELETE FROM {table} WHERE user_id = ?", drop)
+        return write
+
+    def dump_users(self, all_users, changed=None):
+        return self._id_set_writer("users", all_users, changed)
+
+    def dump_couriers(self, all_couriers, changed=None):
+        return self._id_set_writer("couriers", all_couriers, changed)
+
+    def dump_orders(self, all_orders, changed=None):
+        rows = [
+            (int(o.get('order_number', -1)), o.get('user_id'), o.get('courier_id'), o.get('status'), o.get('dt'), self._dumps(o))
+            for o in (all_orders if changed is None else changed)
+        ]
+
+        def write():
+            with self._lock, self._conn:
+                self._conn.executemany(self.UPSERT_ORDER, rows)
+        return write
+
+    def _keyed_writer(self, table: str, key: str, upsert: str, all_items: dict, changed):
+        keys = list(all_items.keys()) if changed is None else list(changed)
+        upserts = [(int(k), self._dumps(all_items[k])) for k in keys if k in all_items]
+        deletes = [(int(k),) for k in keys if k not in all_items]
+
+        def write():
+            with self._lock, self._conn:
+                if changed is None:
+                    self._conn.execute(f"DELETE FROM {table}")
+                self._conn.executemany(upsert, upserts)
+                self._conn.executemany(f"DELETE FROM {table} WHERE {key} = ?", deletes)
+        return write
+
+    def dump_earnings(self, all_earnings, changed=None):
+        return self._keyed_writer("earnings", "courier_id", self.UPSERT_EARNING, all_earnings, changed)
+
+    def dump_users_info(self, all_info, changed=None):
+        return self._keyed_writer("users_info", "user_id", self.UPSERT_USER_INFO, all_info, changed)
+
+    def dump_menu(self, menu: dict):
+        categories = [(c, i) for i, c in enumerate(menu.keys())]
+        products = [(c, n, i, self._dumps(info)) for c, prods in menu.items() for i, (n, info) in enumerate(prods.items())]
+
+        def write():
+            with self._lock, self._conn:
+                self._conn.execute("DELETE FROM menu_categories")
+                self._conn.execute("DELETE FROM menu_products")
+                self._conn.executemany("INSERT INTO menu_categories (name, position) VALUES (?, ?)", categories)
+                self._conn.executemany("INSERT INTO menu_products (category, name, position, data) VALUES (?, ?, ?, ?)", products)
+        return write
+
+    def load_invoices(self) -> list[dict]:
+        return [json.loads(r[0]) for r in self._select("SELECT data FROM invoices")]
+
+    def dump_invoices(self, all_invoices: dict, changed=None):
+        keys = list(all_invoices.keys()) if changed is None else list(changed)
+        upserts = [
+            (p, inv.get('user_id'), inv.get('status'), self._dumps(inv))
+            for p, inv in ((p, all_invoices.get(p)) for p in keys) if inv is not None
+        ]
+        deletes = [(p,) for p in keys if p not in all_invoices]
+
+        def write():
+            with self._lock, self._conn:
+                if changed is None:
+                    self._conn.execute("DELETE FROM invoices")
+                self._conn.executemany(self.UPSERT_INVOICE, upserts)
+                self._conn.executemany("DELETE FROM invoices WHERE payload = ?", deletes)
+        return write
+
+    def load_user_data(self, user_id: int) -> Optional[dict]:
+        with self._read_lock:
+            row = self._reader.execute("SELECT data FROM user_data WHERE user_id = ?", (int(user_id),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def iter_user_data(self):
+        with self._read_lock:
+            rows = self._reader.execute("SELECT user_id, data FROM user_data").fetchall()
+        for uid, data in rows:
+            yield uid, json.loads(data)
+
+    def save_user_data(self, rows: dict):
+        with self._lock, self._conn:
+            self._conn.executemany(self.UPSERT_USER_DATA, [(int(k), v) for k, v in rows.items() if v])
+            self._conn.executemany("DELETE FROM user_data WHERE user_id = ?", [(int(k),) for k, v in rows.items() if not v])
+
+    def close(self):
+        for conn in (self._reader, self._conn):
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+def sqlite_path(url: str) -> str:
+    """`sqlite:///delivery_bot.db` -> `delivery_bot.db`, `sqlite:////abs/x.db` -> `/abs/x.db`."""
+    return url[len("sqlite:///"):]
+
+
+def open_storage(url: str):
+    if url.startswith("sqlite:///"):
+        try:
+            return SqliteStorage(sqlite_path(url))
+        except Exception as e:
+            log.error(f"SQLite bazasini ochishda xatolik ({url}): {e}; JSON fayllardan foydalaniladi")
+    elif url:
+        log.warning(f"Qo'llab-quvvatlanmaydigan DATABASE_URL: {url}; JSON fayllardan foydalaniladi")
+    return JsonStorage()
+
+
+def migrate_json_to_sqlite(url: str):
+    """One-shot import of the JSON data files into the SQLite database at `url`."""
+    src = JsonStorage()
+    dst = SqliteStorage(sqlite_path(url))
+    try:
+        migrated_orders = src.load_orders()
+        writes = [
+            dst.dump_users(src.load_users()),
+            dst.dump_couriers(src.load_couriers()),
+            dst.dump_users_info(src.load_users_info()),
+            dst.dump_earnings(src.load_earnings()),
+            dst.dump_orders(migrated_orders),
+            dst.dump_invoices({inv['payload']: inv for inv in src.load_invoices()}),
+        ]
+        menu = src.load_menu()
+        if menu is not None:
+            writes.append(dst.dump_menu(menu))
+        for write in writes:
+            write()
+        dst.save_user_data({uid: dst._dumps(data) for uid, data in src.iter_user_data()})
+        log.info(f"JSON ma'lumotlar {url} ga ko'chirildi: {len(migrated_orders)} ta buyurtma")
+    finally:
+        dst.close()
+
+
+class PersistenceWorker:
+    """Background writer thread behind the persist_* helpers.
+
+    Handlers only mark a collection dirty (optionally with the changed keys) and
+    return immediately. Each collection is written at most once per its debounce
+    window (`windows`, falling back to `interval`); `critical=True` marks are
+    written as soon as the worker wakes up. When a collection is due the thread
+    asks the event loop to serialize it (`writers[name](changed)` runs there and
+    returns a write function holding only the finished text or rows), so the
+    live objects are never read while handlers change them; the thread then runs
+    the queued writes in order. Until `start()` is called (CLI, imports) marks
+    are written synchronously. `stop()` drains everything and is called on
+    shutdown from the event loop.
+    """
+
+    def __init__(self, writers: dict, interval: float = 1.0, windows: Optional[dict] = None):
+        self.writers = writers
+        self.interval = interval
+        self.windows = windows or {}
+        self._lock = threading.Lock()      # guards _dirty, _due, _requested and counters
+        self._io_lock = threading.Lock()   # one drain at a time (worker vs. shutdown flush)
+        self._dirty: dict[str, Optional[set]] = {}   # None = whole collection
+        self._due: dict[str, float] = {}             # monotonic deadline per dirty collection
+        self._queue: deque = deque()                 # (name, write) serialized on the loop
+        self._requested = False                      # a collect is scheduled on the loop
+        self._marks: dict[str, int] = {}
+        self._writes: dict[str, int] = {}
+        self._wake = threading.Event()
+        self._stopping = False
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Called from the event loop that owns the persisted objects."""
+        if self._thread is None:
+            self._loop = asyncio.get_running_loop()
+            self._thread = threading.Thread(target=self._run, name="persistence", daemon=True)
+            self._thread.start()
+
+    def mark(self, name: str, key=None, critical: bool = False):
+        now = time.monotonic()
+        with self._lock:
+            self._marks[name] = self._marks.get(name, 0) + 1
+            if key is None:
+                self._dirty[name] = None
+            elif name not in self._dirty:
+                self._dirty[name] = {key}
+            elif self._dirty[name] is not None:
+                self._dirty[name].add(key)
+            due = now if critical else self._due.get(name, now + self.windows.get(name, self.interval))
+            self._due[name] = min(due, self._due.get(name, due))
+        if self._thread is None:
+            self.flush()
+        else:
+            self._wake.set()
+
+    def _next_timeout(self) -> Optional[float]:
+        if self._queue:
+            return 0.0
+        with self._lock:
+            if not self._due or self._requested:
+                return None
+            return max(0.0, min(self._due.values()) - time.monotonic())
+
+    def _run(self):
+        while True:
+            self._wake.wait(self._next_timeout())
+            self._wake.clear()
+            self._drain()
+            if self._stopping:
+                break
+            now = time.monotonic()
+            with self._lock:
+                ask = not self._requested and any(d <= now for d in self._due.values())
+                if ask:
+                    self._requested = True
+            if ask:
+                try:
+                    self._loop.call_soon_threadsafe(self._collect)
+                except RuntimeError:
+                    break   # loop closed; stop() writes the rest
+
+    def _collect(self, only_due: bool = True):
+        """On the event loop: serialize the due collections and queue their writes."""
+        now = time.monotonic()
+        with self._lock:
+            self._requested = False
+            names = [n for n, d in self._due.items() if not only_due or d <= now]
+            pending = {n: self._dirty.pop(n, None) for n in names}
+            for n in names:
+                self._due.pop(n, None)
+        for name, keys in pending.items():
+            try:
+                self._queue.append((name, self.writers[name](None if keys is None else list(keys))))
+            except Exception as e:
+                log.error(f"{name} ni saqlashga tayyorlashda xatolik: {e}")
+        self._wake.set()
+
+    def _drain(self):
+        with self._io_lock:
+            while self._queue:
+                name, write = self._queue.popleft()
+                try:
+                    write()
+                    with self._lock:
+                        self._writes[name] = self._writes.get(name, 0) + 1
+                except Exception as e:
+                    log.error(f"{name} ni saqlashda xatolik: {e}")
+
+    def flush(self):
+        """Serialize and write every dirty collection now, in the calling thread."""
+        self._collect(only_due=False)
+        self._drain()
+
+    def stats(self) -> dict:
+        """Per collection: persist requests, actual writes and writes avoided by coalescing."""
+        with self._lock:
+            queued = {n for n, _ in list(self._queue)}
+            out = {}
+            for n, m in self._marks.items():
+                written = self._writes.get(n, 0)
+                pending = 1 if n in self._due or n in queued else 0
+                out[n] = {'requested': m, 'written': written, 'pending': pending, 'avoided': m - written - pending}
+            return out
+
+    def stop(self):
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        self.flush()
+        log.info(f"Saqlash statistikasi: {self.stats()}")
+
+
+# Foydalanuvchilar va buyurtmalarni yuklash (JSON fayllar yoki DATABASE_URL dagi SQLite)
+storage = open_storage(DATABASE_URL)
+persistence = PersistenceWorker({
+    'users': lambda changed: storage.dump_users(users, changed),
+    'orders': lambda changed: storage.dump_orders(orders, None if changed is None else [o for o in map(orders.get, changed) if o]),
+    'couriers': lambda changed: storage.dump_couriers(couriers, changed),
+    'earnings': lambda changed: storage.dump_earnings(earnings, changed),
+    'users_info': lambda changed: storage.dump_users_info(users_info, changed),
+    'menu': lambda changed: storage.dump_menu(menu_data),
+    'user_data': lambda changed: user_sessions.dump(changed),
+    'invoices': lambda changed: storage.dump_invoices(invoices.items(), changed),
+}, interval=float(os.getenv('PERSIST_INTERVAL', '1.0')), windows={
+    # e.g. PERSIST_WINDOW_ORDERS=0.5, PERSIST_WINDOW_MENU=5
+    name: float(os.environ[f'PERSIST_WINDOW_{name.upper()}'])
+    for name in ('users', 'orders', 'couriers', 'earnings', 'users_info', 'menu', 'user_data', 'invoices')
+    if os.getenv(f'PERSIST_WINDOW_{name.upper()}')
+})
+users = storage.load_users()
+orders = OrderStore(storage.load_orders())
+invoices = InvoiceStore(storage.load_invoices(), ttl=INVOICE_TTL)
 
 # Couriers
-_couriers_data = load_json(COURIERS_FILE, [])
-couriers = set(int(x) for x in _couriers_data)
+couriers = storage.load_couriers()
 
 # Earnings per courier
-_earnings_data = load_json(EARNINGS_FILE, {})
-earnings = {int(k): v for k, v in _earnings_data.items()} if isinstance(_earnings_data, dict) else {}
+earnings = storage.load_earnings()
+
+order_counter = orders.max_number()
+
+class UserSessions:
+    """Lazy per-user persistence of `context.user_data` (cart, checkout and
+    conversation state, pending order/invoice).
+
+    Nothing is read at startup: `load` runs before every other handler and fills
+    a user's user_data from storage on that user's first update after a restart.
+    `touch` runs after the handlers and only marks the user dirty, so the
+    PersistenceWorker coalesces a burst of updates into one write; sessions whose
+    JSON did not change since the last write are skipped. A user whose load
+    failed is neither marked nor written, so the stored session survives.
+    """
+
+    def __init__(self):
+        self._data = {}                     # app.user_data once bound
+        self._loaded: set[int] = set()
+        self._written: dict[int, str] = {}  # last JSON written per user
+
+    def bind(self, app):
+        self._data = app.user_data
+
+    @staticmethod
+    def _dumps(ud) -> str:
+        return json.dumps(ud, ensure_ascii=False, separators=(",", ":")) if ud else ''
+
+    async def load(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        if user is None or user.id in self._loaded:
+            return
+        try:
+            stored = await asyncio.to_thread(storage.load_user_data, user.id)
+        except Exception as e:
+            # not marked loaded: the stored session is never overwritten and the
+            # load is retried on the user's next update
+            log.warning(f"user_data yuklashda xatolik ({user.id}): {e}")
+            return
+        if stored:
+            ud = context.user_data
+            for k, v in stored.items():
+                ud.setdefault(k, v)
+            self._written[user.id] = self._dumps(stored)
+        self._loaded.add(user.id)
+
+    async def touch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        if user is not None and user.id in self._loaded:
+            persistence.mark('user_data', user.id)
+
+    def dump(self, changed=None):
+        """Serialize the changed sessions now; the returned function only writes them."""
+        rows = {}
+        for uid in (list(self._data.keys()) if changed is None else changed):
+            if uid not in self._loaded:
+                continue
+            try:
+                data = self._dumps(self._data.get(uid))
+            except TypeError as e:
+                log.warning(f"user_data saqlab bo'lmadi ({uid}): {e}")
+                continue
+            if data != self._written.get(uid, ''):
+                rows[uid] = data
+        self._written.update(rows)
+        return lambda: storage.save_user_data(rows) if rows else None
 
-order_counter = max((o.get("order_number", 0) for o in orders), default=0)
 
-# Xotiradagi taymer vazifalari
-expiry_tasks: dict[int, asyncio.Task] = {}
+user_sessions = UserSessions()
+
 # Track last category message shown to each chat so we can update listings when availability changes
 last_category_messages: dict[tuple[int, str], int] = {}
 # Track admin "active orders" sessions: map admin_id -> list of sent message dicts
 admin_orders_sessions: dict[int, list[dict]] = {}
 
 # Per-user info (name, phone, other profile data)
-_users_info = load_json(USERS_INFO_FILE, {})
-users_info = {int(k): v for k, v in _users_info.items()} if isinstance(_users_info, dict) else {}
+users_info = storage.load_users_info()
 
-def persist_users_info():
-    try:
-        save_json(USERS_INFO_FILE, {str(k): v for k, v in users_info.items()})
-    except Exception:
-        pass
+def persist_users_info(uid: Optional[int] = None):
+    persistence.mark('users_info', uid)
  
 
+# ========== QULFLAR ==========
+class KeyedLocks:
+    """asyncio locks created on demand per key (user, order, ...) and dropped as
+    soon as nobody holds or waits for them, so the registry only ever contains
+    keys with work in flight. Waiters acquire in arrival order."""
+
+    def __init__(self):
+        # key -> [lock, number of tasks holding or waiting for it]
+        self._locks: dict = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._locks.pop(key, None)
+
+
+# Buyurtma bo'yicha o'zgarishlar (qabul, yetkazish, qaytarish, bekor qilish, kanalga chiqarish) ketma-ket
+order_locks = KeyedLocks()
+
+
+def order_number_in(arg) -> Optional[int]:
+    """Leading order number of a callback argument ('12', '12_Kanalda', '12_0')."""
+    m = re.match(r"\d+", str(arg))
+    return int(m.group()) if m else None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Concurrent update processing that keeps each user's updates in order.
+
+    Updates of different users run in parallel (up to `max_concurrent_updates`);
+    updates of the same user (falling back to the chat for updates without a
+    user) wait for each other in arrival order, so conversation states, carts
+    and checkout steps never interleave. An update queues on its user's lock
+    before it takes a concurrency slot, so one user sending a burst of updates
+    occupies at most one slot and cannot starve everybody else.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks = KeyedLocks()
+
+    @staticmethod
+    def _key(update: object):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user is not None:
+            return update.effective_user.id
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        return None
+
+    # BaseUpdateProcessor.process_update (marked @final for type checkers only)
+    # takes the semaphore before do_process_update; here the user lock comes first
+    async def process_update(self, update: object, coroutine):
+        key = self._key(update)
+        if key is None:
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+            return
+        async with self._locks.hold(key):
+            async with self._semaphore:
+                await self.do_process_update(update, coroutine)
+
+    async def do_process_update(self, update: object, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+# ========== SUHBAT HOLATI ==========
+# Holat shu vaqtdan (soniya) ortiq o'zgarmasa eskirgan hisoblanadi va tozalanadi
+STATE_TIMEOUT = float(os.getenv('STATE_TIMEOUT', '1800'))
+
+
+def set_state(ud: dict, name: str, data=True):
+    """Make `name` the user's single current conversation state.
+
+    The state is a plain dict in user_data (`ud['state']`), so it is persisted and
+    restored together with the rest of user_data; `data` must be JSON-serializable.
+    """
+    if data is None:
+        clear_state(ud, name)
+        return
+    ud['state'] = {'name': name, 'data': data, 'at': time.time()}
+
+
+def state_data(ud: dict, name: str):
+    """The data of state `name` if it is the current (unexpired) state, otherwise None."""
+    st = conversation.current(ud)
+    if st and st.get('name') == name:
+        return st.get('data')
+    return None
+
+
+def clear_state(ud: dict, name: Optional[str] = None, default=None):
+    """Leave the current state (only if it is `name`, when given) and return its data."""
+    st = ud.get('state')
+    if not st or (name is not None and st.get('name') != name):
+        return default
+    ud.pop('state', None)
+    return st.get('data', default)
+
+
+class ConversationStates:
+    """Declarative text_handler dispatch: one state per user plus reply-keyboard buttons.
+
+    `state(name)` registers the handler for a conversation state and `button(*labels)`
+    the handler for a reply-keyboard label; both are found with a single dict
+    lookup. Buttons take precedence over the current state (so "🔙 Chiqish" always
+    works), except for `sticky` states, which see every message first. A state
+    handler returning False did not consume the message. States older than their
+    timeout are dropped when the next message arrives. For `order_lock` states the
+    state data is an order number and the handler runs under that order's lock.
+    """
+
+    ROLES = {
+        'admin': lambda uid: uid in admins,
+        'courier': lambda uid: uid in couriers,
+        'user': lambda uid: uid not in admins,
+    }
+
+    def __init__(self, timeout: float = STATE_TIMEOUT):
+        self.timeout = timeout
+        # name -> (handler, role, sticky, timeout, order_lock)
+        self._states: dict[str, tuple] = {}
+        # (role, label) -> handler
+        self._buttons: dict[tuple, object] = {}
+
+    def state(self, name: str, role: Optional[str] = None, sticky: bool = False, timeout: Optional[float] = None,
+              order_lock: bool = False):
+        def register(handler):
+            self._states[name] = (handler, role, sticky, timeout or self.timeout, order_lock)
+            return handler
+        return register
+
+    def button(self, *labels: str, role: str = 'user'):
+        def register(handler):
+            for label in labels:
+                self._buttons[(role, label)] = handler
+            return handler
+        return register
+
+    def current(self, ud: dict) -> Optional[dict]:
+        st = ud.get('state')
+        if not st:
+            return None
+        spec = self._states.get(st.get('name'))
+        if spec is None or time.time() - st.get('at', 0) > spec[3]:
+            log.info(f"Eskirgan holat tozalandi: {st.get('name')}")
+            ud.pop('state', None)
+            return None
+        return st
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, text: str, ud: dict) -> bool:
+        st = self.current(ud)
+        spec = self._states[st['name']] if st else None
+        if spec and spec[1] and not self.ROLES[spec[1]](uid):
+            spec = None
+        if spec and spec[2]:
+            if await self._run_state(spec, update, context, uid, text, ud, st.get('data')) is not False:
+                return True
+        button = self._buttons.get(('admin' if uid in admins else 'user', text))
+        if button is not None:
+            await button(update, context, uid, text, ud)
+            return True
+        if spec and not spec[2]:
+            if await self._run_state(spec, update, context, uid, text, ud, st.get('data')) is not False:
+                return True
+        return False
+
+    @staticmethod
+    async def _run_state(spec, update, context, uid, text, ud, data):
+        order_num = order_number_in(data) if spec[4] else None
+        if order_num is None:
+            return await spec[0](update, context, uid, text, ud, data)
+        async with order_locks.hold(order_num):
+            return await spec[0](update, context, uid, text, ud, data)
+
+
+conversation = ConversationStates()
+
+
 async def clear_admin_session(uid: int, context: ContextTypes.DEFAULT_TYPE, ud: Optional[dict] = None):
     """Centralized helper to remove stored admin prompts, session messages and transient state.
     Best-effort: deletes stored bot messages referenced in `admin_orders_sessions` and
@@ -150,12 +1554,7 @@ async def clear_admin_session(uid: int, context: ContextTypes.DEFAULT_TYPE, ud:
             ud = context.user_data
         # delete single last prompt if present
         try:
-            lp = ud.pop('amenu_last_prompt', None)
-            if lp:
-                try:
-                    await context.bot.delete_message(chat_id=lp.get('chat_id'), message_id=lp.get('message_id'))
-                except Exception:
-                    pass
+            message_cleaner.schedule_refs(context.bot, [ud.pop('amenu_last_prompt', None)])
         except Exception:
             pass
 
@@ -171,7 +1570,8 @@ async def clear_admin_session(uid: int, context: ContextTypes.DEFAULT_TYPE, ud:
             pass
 
         # clear common transient admin/user_data keys
-        for k in ('amenu_add_product_step','amenu_add_product_cat','amenu_new_name','amenu_new_price','amenu_new_desc','amenu_new_photo','amenu_edit_price','amenu_edit_desc','amenu_edit_photo','amenu_adding_category','want_broadcast','want_add_admin','want_remove_admin','want_add_courier','want_remove_courier','last_prompt_msg'):
+        clear_state(ud)
+        for k in ('amenu_add_product_cat','amenu_new_name','amenu_new_price','amenu_new_desc','amenu_new_photo','last_prompt_msg'):
             try:
                 ud.pop(k, None)
             except Exception:
@@ -184,95 +1584,20 @@ async def clear_admin_session(uid: int, context: ContextTypes.DEFAULT_TYPE, ud:
 async def clear_user_session(uid: int, context: ContextTypes.DEFAULT_TYPE, ud: Optional[dict] = None):
     """Delete best-effort any transient messages we stored for a regular user session.
     This includes keys: history_messages, menu_messages, welcome_msg, suggest_prompt, last_prompt_msg.
-    Fall back to editing text if deletion isn't allowed.
+    The keys are cleared right away; the messages are removed in the background by
+    `message_cleaner`. Returns the id of the first history message, if any.
     """
     prompt_mid = None
     try:
         if ud is None:
             ud = context.user_data
-        # delete history messages
-        try:
-            hist = ud.pop('history_messages', [])
-            for idx, m in enumerate(hist):
-                cid = m.get('chat_id'); mid = m.get('message_id')
-                try:
-                    await context.bot.delete_message(chat_id=cid, message_id=mid)
-                    if idx == 0:
-                        prompt_mid = mid
-                except Exception as e:
-                    log.warning(f"Failed to delete user history message {mid} in chat {cid}: {e}")
-                    try:
-                        await context.bot.edit_message_text(chat_id=cid, message_id=mid, text='‎')
-                        if idx == 0:
-                            prompt_mid = mid
-                    except Exception as e2:
-                        log.warning(f"Failed to edit-to-blank user history message {mid} in chat {cid}: {e2}")
-        except Exception:
-            pass
-
-        # delete menu messages
-        try:
-            menu_msgs = ud.pop('menu_messages', [])
-            for m in menu_msgs:
-                cid = m.get('chat_id'); mid = m.get('message_id')
-                try:
-                    await context.bot.delete_message(chat_id=cid, message_id=mid)
-                except Exception as e:
-                    log.warning(f"Failed to delete user menu message {mid} in chat {cid}: {e}")
-                    try:
-                        await context.bot.edit_message_text(chat_id=cid, message_id=mid, text='‎')
-                    except Exception as e2:
-                        log.warning(f"Failed to edit-to-blank user menu message {mid} in chat {cid}: {e2}")
-        except Exception:
-            pass
-
-        # delete suggest prompt
-        try:
-            sp = ud.pop('suggest_prompt', None)
-            if sp:
-                cid = sp.get('chat_id'); mid = sp.get('message_id')
-                try:
-                    await context.bot.delete_message(chat_id=cid, message_id=mid)
-                except Exception as e:
-                    log.warning(f"Failed to delete suggest_prompt {mid} in chat {cid}: {e}")
-                    try:
-                        await context.bot.edit_message_text(chat_id=cid, message_id=mid, text='‎')
-                    except Exception as e2:
-                        log.warning(f"Failed to edit-to-blank suggest_prompt {mid} in chat {cid}: {e2}")
-        except Exception:
-            pass
-
-        # delete last_prompt_msg
-        try:
-            lp = ud.pop('last_prompt_msg', None)
-            if lp:
-                cid = lp.get('chat_id'); mid = lp.get('message_id')
-                try:
-                    await context.bot.delete_message(chat_id=cid, message_id=mid)
-                except Exception as e:
-                    log.warning(f"Failed to delete last_prompt_msg {mid} in chat {cid}: {e}")
-                    try:
-                        await context.bot.edit_message_text(chat_id=cid, message_id=mid, text='‎')
-                    except Exception as e2:
-                        log.warning(f"Failed to edit-to-blank last_prompt_msg {mid} in chat {cid}: {e2}")
-        except Exception:
-            pass
-
-        # delete stored welcome message
-        try:
-            wm = ud.pop('welcome_msg', None)
-            if wm:
-                cid = wm.get('chat_id'); mid = wm.get('message_id')
-                try:
-                    await context.bot.delete_message(chat_id=cid, message_id=mid)
-                except Exception as e:
-                    log.warning(f"Failed to delete welcome_msg {mid} in chat {cid}: {e}")
-                    try:
-                        await context.bot.edit_message_text(chat_id=cid, message_id=mid, text='‎')
-                    except Exception as e2:
-                        log.warning(f"Failed to edit-to-blank welcome_msg {mid} in chat {cid}: {e2}")
-        except Exception:
-            pass
+        refs = list(ud.pop('history_messages', None) or [])
+        if refs:
+            prompt_mid = refs[0].get('message_id')
+        refs += ud.pop('menu_messages', None) or []
+        for key in ('suggest_prompt', 'last_prompt_msg', 'welcome_msg'):
+            refs.append(ud.pop(key, None))
+        message_cleaner.schedule_refs(context.bot, refs)
     except Exception:
         pass
     return prompt_mid
@@ -285,23 +1610,97 @@ menu_data = {
 }
 
 # Load persisted menu if exists
-_loaded_menu = load_json(MENU_FILE, None)
+_loaded_menu = storage.load_menu()
 if isinstance(_loaded_menu, dict):
     menu_data = _loaded_menu
 
-def persist_menu():
-    try:
-        save_json(MENU_FILE, menu_data)
-    except Exception as e:
-        log.warning(f"Menyuni saqlashda xato: {e}")
+class CatalogIndex:
+    """Product name -> {'category', 'price', 'available', 'photo'} over `menu_data`.
 
+    The index is rebuilt lazily, on the first lookup after `invalidate()`, which
+    `persist_menu()` calls after every menu edit; in between lookups are single
+    dict hits. `version` grows with every invalidation, so derived caches can be
+    keyed on it. When a name occurs in several categories the first one wins.
+    """
 
-def _track_menu_message(ud: dict, msg):
-    """Helper: record a sent message into user's `menu_messages` list
-    so it can be cleaned up when the user exits the menu."""
-    try:
-        if ud is None:
-            return
+    def __init__(self, source):
+        self._source = source        # callable returning the current menu dict
+        self._products: dict[str, dict] = {}
+        self._built = -1
+        self.version = 0
+
+    def invalidate(self):
+        self.version += 1
+
+    def _index(self) -> dict[str, dict]:
+        if self._built != self.version:
+            products = {}
+            for cat, prods in self._source().items():
+                for name, info in prods.items():
+                    products.setdefault(name, {
+                        'category': cat,
+                        'price': info.get('price', 0),
+                        'available': info.get('available', True),
+                        'photo': info.get('photo'),
+                    })
+            self._products = products
+            self._built = self.version
+        return self._products
+
+    def get(self, name: str) -> Optional[dict]:
+        return self._index().get(name)
+
+    def price(self, name: str) -> int:
+        entry = self._index().get(name)
+        return entry['price'] if entry else 0
+
+
+catalog = CatalogIndex(lambda: menu_data)
+
+
+def persist_menu():
+    catalog.invalidate()
+    persistence.mark('menu')
+
+
+class KeyboardCache:
+    """LRU of built InlineKeyboardMarkup objects (immutable in PTB 20+, so one
+    instance can be sent to any number of users). Entries belong to one catalog
+    version: the first lookup after a menu edit drops them all."""
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._items: OrderedDict = OrderedDict()
+        self._version = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        if self._version != catalog.version:
+            self._items.clear()
+            self._version = catalog.version
+        kb = self._items.get(key)
+        if kb is not None:
+            self._items.move_to_end(key)
+            self.hits += 1
+            return kb
+        self.misses += 1
+        kb = self._items[key] = build()
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+        return kb
+
+
+catalog_keyboards = KeyboardCache(maxsize=256)
+quantity_keyboards = KeyboardCache(maxsize=512)
+
+
+def _track_menu_message(ud: dict, msg):
+    """Helper: record a sent message into user's `menu_messages` list
+    so it can be cleaned up when the user exits the menu."""
+    try:
+        if ud is None:
+            return
         menu_msgs = ud.setdefault('menu_messages', [])
         menu_msgs.append({'chat_id': msg.chat_id, 'message_id': msg.message_id})
     except Exception:
@@ -336,6 +1735,10 @@ def admin_panel_kb() -> InlineKeyboardMarkup:
     ])
 
 def category_menu_kb() -> InlineKeyboardMarkup:
+    return catalog_keyboards.get(('categories',), _build_category_menu_kb)
+
+
+def _build_category_menu_kb() -> InlineKeyboardMarkup:
     # build category buttons dynamically from current `menu_data` so admin-added categories are visible to users
     rows = []
     try:
@@ -359,6 +1762,8 @@ def courier_panel_kb() -> InlineKeyboardMarkup:
 
 # ... boshqa klaviatura funksiyalari o'zgarishsiz ...
 def product_list_kb(category: str):
+    return catalog_keyboards.get(('products', category), lambda: _build_product_list_kb(category))
+def _build_product_list_kb(category: str):
     # For regular users, only show products that are marked available (default True)
     rows = []
     for name, info in menu_data.get(category, {}).items():
@@ -368,12 +1773,13 @@ def product_list_kb(category: str):
         rows.append([InlineKeyboardButton(f"{name} — {info['price']} so‘m", callback_data=f"prod_{category}|{name}")])
     rows.append([InlineKeyboardButton("◀️ Ortga", callback_data="back_categories"), InlineKeyboardButton("🛒 Savat", callback_data="view_cart")])
     return InlineKeyboardMarkup(rows)
-def quantity_kb(category: str, product: str, qty: int): return InlineKeyboardMarkup([ [InlineKeyboardButton("➖", callback_data=f"qty_{category}|{product}|dec"), InlineKeyboardButton(str(qty), callback_data="noop"), InlineKeyboardButton("➕", callback_data=f"qty_{category}|{product}|inc")], [InlineKeyboardButton("🛒 Savatga qo‘shish", callback_data=f"add_{product}|{qty}")], [InlineKeyboardButton("◀️ Menyuga qaytish", callback_data="back_categories")]])
+def quantity_kb(category: str, product: str, qty: int): return quantity_keyboards.get((category, product, qty), lambda: _build_quantity_kb(category, product, qty))
+def _build_quantity_kb(category: str, product: str, qty: int): return InlineKeyboardMarkup([ [InlineKeyboardButton("➖", callback_data=f"qty_{category}|{product}|dec"), InlineKeyboardButton(str(qty), callback_data="noop"), InlineKeyboardButton("➕", callback_data=f"qty_{category}|{product}|inc")], [InlineKeyboardButton("🛒 Savatga qo‘shish", callback_data=f"add_{product}|{qty}")], [InlineKeyboardButton("◀️ Menyuga qaytish", callback_data="back_categories")]])
 def cart_text_and_total(cart: dict):
     if not cart: return "🛒 Savat bo‘sh.", 0
-    lines, total, price_map = [], 0, {p: info["price"] for c in menu_data.values() for p, info in c.items()}
+    lines, total = [], 0
     for name, qty in cart.items():
-        summa = price_map.get(name, 0) * qty
+        summa = catalog.price(name) * qty
         total += summa; lines.append(f"• {name} x{qty} — {summa} so‘m")
     return "🛒 Savat:\n" + "\n".join(lines) + f"\n\nJami: {total} so‘m", total
 def cart_menu_kb(has_items: bool):
@@ -381,67 +1787,301 @@ def cart_menu_kb(has_items: bool):
     if has_items: rows.insert(0, [InlineKeyboardButton("🧹 Tozalash", callback_data="clear_cart"), InlineKeyboardButton("✅ Buyurtma berish", callback_data="checkout")])
     return InlineKeyboardMarkup(rows)
 
+# ========== BUYURTMA TARKIBI ==========
+# Order lines are dicts: {'product', 'name', 'price', 'qty'}. The menu is keyed by
+# product name, so `product` (the catalog key) starts out equal to `name`; `name`
+# and the unit `price` are snapshots taken when the line was added. The order's
+# `total` (and `proposed_total` for an admin edit) is computed when the lines
+# change and stored next to them; display strings are rendered when needed.
+def line_item(name: str, qty: int, price: Optional[int] = None) -> dict:
+    if price is None:
+        price = catalog.price(name)
+    return {'product': name, 'name': name, 'price': int(price), 'qty': int(qty)}
+
+
+def parse_item(item) -> dict:
+    """Line item from a legacy "Name xN" string; item dicts are returned as is."""
+    if isinstance(item, dict):
+        return item
+    name, sep, qty = str(item).rpartition(' x')
+    if not sep or not qty.isdigit():
+        name, qty = str(item), 1
+    return line_item(name, int(qty))
+
+
+def cart_items(cart: dict) -> list[dict]:
+    return [line_item(name, qty) for name, qty in cart.items()]
+
+
+def item_label(item: dict) -> str:
+    return f"{item['name']} x{item['qty']}"
+
+
+def items_text(items, sep: str = ', ') -> str:
+    return sep.join(item_label(it) for it in items)
+
+
+def items_total(items) -> int:
+    return sum(it['price'] * it['qty'] for it in items)
+
+
+def set_order_items(order: dict, items: list[dict], proposed: bool = False):
+    """Replace the order's lines (or the pending admin edit's) and store their total."""
+    if proposed:
+        order['proposed_items'] = items
+        order['proposed_total'] = items_total(items)
+    else:
+        order['items'] = items
+        order['total'] = items_total(items)
+
+
+def migrate_order_items(order: dict) -> bool:
+    """Convert legacy "Name xN" strings in `items`/`proposed_items` in place.
+    Stored totals are kept as they were quoted. Returns True if anything changed."""
+    changed = False
+    for field in ('items', 'proposed_items'):
+        items = order.get(field)
+        if items and any(not isinstance(it, dict) for it in items):
+            order[field] = [parse_item(it) for it in items]
+            changed = True
+    return changed
+
+
+def migrate_stored_items():
+    """One-off startup pass over orders and pending invoices saved before line items."""
+    migrated = [o for o in orders if migrate_order_items(o)]
+    for o in migrated:
+        persist_orders(o)
+    inv_count = 0
+    for payload, inv in invoices.items().items():
+        if migrate_order_items(inv.get('pending_order') or {}):
+            persist_invoice(payload)
+            inv_count += 1
+    if migrated or inv_count:
+        log.info(f"Buyurtma tarkibi yangi formatga o'tkazildi: {len(migrated)} ta buyurtma, {inv_count} ta invoys")
+
+
 # ========== YORDAMCHI FUNKSIYALAR ==========
-def persist_users(): save_json(USERS_FILE, list(users))
-def persist_orders(): save_json(ORDERS_FILE, orders)
-def persist_couriers(): save_json(COURIERS_FILE, list(couriers))
-def persist_earnings():
-    # convert keys to str for JSON
-    save_json(EARNINGS_FILE, {str(k): v for k, v in earnings.items()})
+def persist_users(uid: Optional[int] = None): persistence.mark('users', uid)
+def persist_orders(order: Optional[dict] = None, critical: bool = False):
+    """Queue a single changed order (journal line / row upsert); without an order
+    the whole collection is written (snapshot compaction / full upsert).
+    `critical` skips the debounce window (payments, deliveries)."""
+    if order is None:
+        persistence.mark('orders', critical=critical)
+        return
+    orders.touch(order)
+    persistence.mark('orders', int(order.get('order_number', -1)), critical=critical)
+def persist_couriers(cid: Optional[int] = None): persistence.mark('couriers', cid)
+def persist_invoice(payload: Optional[str] = None): persistence.mark('invoices', payload, critical=True)
+def persist_earnings(cid: Optional[int] = None): persistence.mark('earnings', cid, critical=True)
 def load_earnings():
     global earnings
-    _d = load_json(EARNINGS_FILE, {})
-    earnings = {int(k): v for k, v in _d.items()} if isinstance(_d, dict) else {}
-def find_order(order_number: int): return next((o for o in orders if int(o.get("order_number", -1)) == int(order_number)), None)
+    earnings = storage.load_earnings()
+def find_order(order_number: int): return orders.get(order_number)
 
 
 async def _safe_delete_session_messages(context: ContextTypes.DEFAULT_TYPE, uid: int, sent: list[dict]):
     """Helper: delete only messages that were sent into the admin/user private chat `uid`.
     Avoids attempting to delete channel posts or cross-chat message ids which produce many 400 errors.
-    Best-effort: try delete, then fallback to edit-to-blank, and log failures.
+    Best-effort and in the background (see `message_cleaner`).
     """
     try:
         if not sent:
             return
-        sent_local = [m for m in sent if m and m.get('chat_id') == uid and m.get('message_id')]
-        for m in sent_local:
-            cid = m.get('chat_id'); mid = m.get('message_id')
-            try:
-                await context.bot.delete_message(chat_id=cid, message_id=mid)
-            except Exception as e:
-                log.warning(f"Failed to delete session message {mid} in chat {cid}: {e}")
-                try:
-                    await context.bot.edit_message_text(chat_id=cid, message_id=mid, text='‎')
-                except Exception as e2:
-                    log.warning(f"Failed to edit-to-blank session message {mid} in chat {cid}: {e2}")
+        message_cleaner.schedule(context.bot, uid, [m.get('message_id') for m in sent if m and m.get('chat_id') == uid])
     except Exception:
         pass
 
+class AuditQueue:
+    """Super-admin reports as queued audit events.
+
+    `put()` only queues the event (its kind and order number are given by the
+    caller); nothing is written or sent on the caller's path. A consumer task
+    collects events for up to `batch_window` seconds, appends them to
+    AUDIT_LOG_FILE (one JSON line each, written off the event loop) and posts
+    them as digest messages (split at the Telegram text limit) to
+    SUPERADMIN_CHANNEL_ID, at most one message per `min_interval` seconds. A
+    digest that cannot be delivered is retried a few times and then dropped;
+    the audit log still has every event. Events of the last unfinished batch
+    are written on `stop()`.
+    """
 
-async def report_superadmin(bot, text: str):
-    """Yagona helper: super-admin kanaliga xabar yuboradi (xatolikni loglaydi)."""
-    try:
-        await bot.send_message(chat_id=SUPERADMIN_CHANNEL_ID, text=text, parse_mode="HTML", disable_web_page_preview=True)
-    except Exception as e:
-        log.warning(f"Superadminga yuborishda xato: {e}")
+    MAX_TEXT = 4000
+    SEPARATOR = "\n\n— — —\n\n"
+
+    def __init__(self, log_file: str, batch_window: float = 2.0, min_interval: float = 3.0,
+                 max_attempts: int = 5):
+        self.log_file = log_file
+        self.batch_window = batch_window
+        self.min_interval = min_interval
+        self.max_attempts = max_attempts
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._fh = None
+        self._fh_lock = threading.Lock()
+        self._bot = None
+        self._last_sent = 0.0
+        # texts taken off the queue whose digest has not been sent yet
+        self._batch: list[str] = []
+        # JSON lines of queued events not yet appended to the audit log
+        self._unlogged: list[str] = []
+
+    def put(self, kind: str, order_number: Optional[int], text: str, **fields):
+        event = {
+            'ts': datetime.now(timezone.utc).isoformat(),
+            'kind': kind,
+            'order_number': order_number,
+            **fields,
+            'text': text,
+        }
+        self._unlogged.append(json.dumps(event, ensure_ascii=False))
+        self._queue.put_nowait(text)
+
+    def _write(self, lines: list[str]):
+        with self._fh_lock:
+            try:
+                if self._fh is None:
+                    self._fh = open(self.log_file, "a", encoding="utf-8")
+                self._fh.write("".join(line + "\n" for line in lines))
+                self._fh.flush()
+            except Exception as e:
+                log.warning(f"Audit logga yozishda xato ({len(lines)} ta hodisa): {e}")
+
+    async def _flush_log(self):
+        lines, self._unlogged = self._unlogged, []
+        if lines:
+            await asyncio.to_thread(self._write, lines)
+
+    def start(self, bot):
+        self._bot = bot
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 5.0):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # last chance for whatever is still queued
+        lines, self._unlogged = self._unlogged, []
+        if lines:
+            self._write(lines)
+        texts = self._batch + [self._queue.get_nowait() for _ in range(self._queue.qsize())]
+        self._batch = []
+        if self._bot is not None and texts:
+            try:
+                await asyncio.wait_for(self._send_digests(texts, attempts=1), timeout=timeout)
+            except Exception:
+                log.warning(f"Superadminga {len(texts)} ta hisobot yuborilmadi (audit logda saqlangan)")
+        with self._fh_lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+    def _digests(self, texts: list[str]) -> list[str]:
+        out, cur = [], ""
+        for t in texts:
+            t = t if len(t) <= self.MAX_TEXT else t[:self.MAX_TEXT - 1] + "…"
+            if cur and len(cur) + len(self.SEPARATOR) + len(t) > self.MAX_TEXT:
+                out.append(cur)
+                cur = ""
+            cur = cur + self.SEPARATOR + t if cur else t
+        if cur:
+            out.append(cur)
+        return out
+
+    async def _send_digests(self, texts: list[str], attempts: Optional[int] = None):
+        for digest in self._digests(texts):
+            for attempt in range(attempts or self.max_attempts):
+                wait = self._last_sent + self.min_interval - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                self._last_sent = time.monotonic()
+                try:
+                    await self._bot.send_message(chat_id=SUPERADMIN_CHANNEL_ID, text=digest, parse_mode="HTML", disable_web_page_preview=True)
+                    break
+                except BadRequest:
+                    # a truncated report can leave broken HTML; send it as plain text
+                    try:
+                        await self._bot.send_message(chat_id=SUPERADMIN_CHANNEL_ID, text=digest, disable_web_page_preview=True)
+                    except Exception as e:
+                        log.warning(f"Superadminga yuborishda xato: {e}")
+                    break
+                except Exception as e:
+                    log.warning(f"Superadminga yuborishda xato (urinish {attempt + 1}): {e}")
+                    await asyncio.sleep(min(60.0, self.min_interval * (2 ** attempt)))
+
+    async def _run(self):
+        while True:
+            self._batch = [await self._queue.get()]
+            deadline = time.monotonic() + self.batch_window
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    self._batch.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+            await self._flush_log()
+            await self._send_digests(self._batch)
+            self._batch = []
+
+
+audit_queue = AuditQueue(
+    AUDIT_LOG_FILE,
+    batch_window=float(os.getenv('AUDIT_BATCH_WINDOW', '2')),
+    min_interval=float(os.getenv('AUDIT_MIN_INTERVAL', '3')),
+)
+
+
+async def report_superadmin(bot, kind: str, order_number: Optional[int], text: str, **fields):
+    """Yagona helper: super-admin hisobotini navbatga qo'yadi (audit logga yoziladi va
+    kanalga jamlangan holda keyinroq yuboriladi) va darhol qaytadi."""
+    audit_queue.put(kind, order_number, text, **fields)
+
+
+def invoice_problem(inv: Optional[dict], user_id: int, total_amount: int, currency: str) -> Optional[str]:
+    """Reason (shown to the user) why a pre-checkout for `inv` must be rejected, or None."""
+    if inv is None or inv.get('user_id') != user_id:
+        return "To'lov varaqasi topilmadi. Iltimos, buyurtmani qaytadan rasmiylashtiring."
+    if inv.get('status') == 'paid':
+        return "Bu to'lov varaqasi allaqachon to'langan."
+    if inv.get('expires_at', 0) < time.time():
+        return "To'lov varaqasining muddati tugagan. Iltimos, buyurtmani qaytadan rasmiylashtiring."
+    if total_amount != inv.get('amount') or currency != inv.get('currency'):
+        return "To'lov summasi buyurtmaga mos kelmaydi."
+    for item in (inv.get('pending_order') or {}).get('items', []):
+        info = catalog.get(item['product'])
+        if info is None or not info['available']:
+            return f"«{item['name']}» hozircha mavjud emas. Iltimos, savatni yangilang."
+    return None
 
 
 async def precheckout_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Answer Telegram pre-checkout queries. We accept valid payloads.
-    This is a lightweight check — we accept and let successful_payment handler finalize.
-    """
+    """Answer Telegram pre-checkout queries: the payload must name a pending,
+    unexpired invoice of this user with the same amount and currency, and every
+    product in it must still be available."""
     try:
         pcq = update.pre_checkout_query
-        # For now we accept all pre-checkout queries. If you want to validate payloads,
-        # compare pcq.invoice_payload with stored pending invoices.
-        await pcq.answer(ok=True)
+        problem = invoice_problem(invoices.get(pcq.invoice_payload), pcq.from_user.id, pcq.total_amount, pcq.currency)
+        if problem:
+            log.info(f"PreCheckoutQuery rad etildi ({pcq.invoice_payload}): {problem}")
+            await pcq.answer(ok=False, error_message=problem)
+        else:
+            await pcq.answer(ok=True)
     except Exception as e:
         log.warning(f"PreCheckoutQuery handling failed: {e}")
 
 
 async def successful_payment_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle successful payments delivered by Telegram (Message.successful_payment).
-    Create the real order from stored `pending_invoice` in `context.user_data`.
+    Create the real order from the invoice stored under the payment's payload;
+    a repeated `telegram_payment_charge_id` is ignored.
     """
     try:
         msg = update.message
@@ -449,92 +2089,229 @@ async def successful_payment_handler(update: Update, context: ContextTypes.DEFAU
         if not successful:
             return
         invoice_payload = getattr(successful, 'invoice_payload', None) or getattr(successful, 'payload', None)
-        pending = context.user_data.pop('pending_invoice', None)
-        if pending and pending.get('payload') == invoice_payload:
-            pending_order = pending.get('pending_order')
-            # create order record (paid)
-            global order_counter
-            order_counter += 1
-            order_number = order_counter
-            order = {
-                'order_number': order_number,
-                'user_id': msg.chat_id,
-                'user_name': msg.chat.full_name if msg.chat else '',
-                'user_username': msg.chat.username if msg.chat else '',
-                'user': f"{msg.chat.full_name} (id: {msg.chat_id})",
-                'items': pending_order.get('items', []),
-                'total': pending_order.get('total', 0),
-                'phone': pending_order.get('phone', ''),
-                'loc': pending_order.get('loc', ''),
-                'dt': pending_order.get('dt') or datetime.now(timezone.utc).isoformat(),
-                'status': 'Kutilyapti',
-                'user_msg': None,
-                'admin_msgs': [],
-                'original_text': pending_order.get('original_text',''),
-                'payment': 'card',
-                'paid': True,
-                'payment_info': {
-                    'provider_payment_charge_id': getattr(successful, 'provider_payment_charge_id', None),
-                    'telegram_payment_charge_id': getattr(successful, 'telegram_payment_charge_id', None),
-                    'currency': successful.currency,
-                    'total_amount': successful.total_amount,
-                }
+        charge_id = getattr(successful, 'telegram_payment_charge_id', None)
+        if charge_id and invoices.by_charge(charge_id) is not None:
+            log.info(f"To'lov allaqachon qayta ishlangan: charge_id={charge_id}")
+            return
+        inv = invoices.get(invoice_payload)
+        if inv is None or inv.get('status') == 'paid':
+            # money arrived without an order to attach it to: make sure a human sees it
+            log.warning(f"Successful payment received but no pending invoice matched: payload={invoice_payload}")
+            await report_superadmin(context.bot, "TO'LOV", None, (
+                f"[TO'LOV] {datetime.now(timezone.utc).isoformat()}\n"
+                f"⚠️ Invoys topilmadi: {invoice_payload}\n"
+                f"Mijoz: {msg.chat.full_name if msg.chat else ''} (id: {msg.chat_id})\n"
+                f"Summa: {successful.total_amount} {successful.currency}\n"
+                f"charge_id: {charge_id}\n"
+            ))
+            return
+        pending_order = inv.get('pending_order') or {}
+        # create order record (paid)
+        global order_counter
+        order_counter += 1
+        order_number = order_counter
+        order = {
+            'order_number': order_number,
+            'user_id': msg.chat_id,
+            'user_name': msg.chat.full_name if msg.chat else '',
+            'user_username': msg.chat.username if msg.chat else '',
+            'user': f"{msg.chat.full_name} (id: {msg.chat_id})",
+            'items': pending_order.get('items', []),
+            'total': pending_order.get('total', 0),
+            'phone': pending_order.get('phone', ''),
+            'loc': pending_order.get('loc', ''),
+            'dt': pending_order.get('dt') or datetime.now(timezone.utc).isoformat(),
+            'status': 'Kutilyapti',
+            'user_msg': None,
+            'admin_msgs': [],
+            'original_text': pending_order.get('original_text',''),
+            'payment': 'card',
+            'paid': True,
+            'payment_info': {
+                'invoice_payload': invoice_payload,
+                'provider_payment_charge_id': getattr(successful, 'provider_payment_charge_id', None),
+                'telegram_payment_charge_id': charge_id,
+                'currency': successful.currency,
+                'total_amount': successful.total_amount,
             }
-            orders.append(order)
-            persist_orders()
-            # generate OTP for card-paid orders so courier can verify on delivery
-            try:
-                otp = generate_otp()
-                order['otp'] = otp
-                persist_orders()
-                exit_kb = ReplyKeyboardMarkup([[KeyboardButton('🔙 Chiqish')]], resize_keyboard=True, one_time_keyboard=True)
-                await context.bot.send_message(chat_id=msg.chat_id, text=f"Sizning buyurtmangiz uchun tasdiq kodi (OTP): {otp}. Ushbu kodni yetkazib beruvchiga yetkazilganda berishingiz kerak.", reply_markup=exit_kb)
-            except Exception:
-                pass
-            # schedule expiry as usual
-            t = asyncio.create_task(handle_order_expiry(order_number, context.bot))
-            expiry_tasks[order_number] = t
-            # notify user
-            try:
-                await context.bot.send_message(chat_id=msg.chat_id, text=f"✅ To'lov muvaffaqiyatli. Buyurtmangiz #{order_number} qabul qilindi.\n\n{order.get('original_text','')}")
-            except Exception:
-                pass
-            # optionally notify super-admin
-            try:
-                sa_text = (
-                    f"[TO'LOV] {datetime.now(timezone.utc).isoformat()}\n"
-                    f"Mijoz: {order.get('user')} (id: {order.get('user_id')})\n"
-                    f"Buyurtma: #{order_number}\n"
-                    f"Jami: {order.get('total')} {order['payment_info'].get('currency')}\n"
-                )
-                await report_superadmin(context.bot, sa_text)
-            except Exception:
-                pass
-        else:
-            # No matching pending invoice; log and accept
-            log.info(f"Successful payment received but no pending invoice matched: payload={invoice_payload}")
+        }
+        # generate OTP for card-paid orders so courier can verify on delivery
+        otp = generate_otp()
+        order['otp'] = otp
+        order['expires_at'] = time.time() + ORDER_CANCEL_WINDOW
+        orders.add(order)
+        invoices.mark_paid(inv, charge_id, order_number)
+        # paid order: write through right away instead of waiting for the debounce window
+        persist_orders(order, critical=True)
+        persist_invoice(invoice_payload)
+        context.user_data.pop('pending_order', None)
+        try:
+            exit_kb = ReplyKeyboardMarkup([[KeyboardButton('🔙 Chiqish')]], resize_keyboard=True, one_time_keyboard=True)
+            await context.bot.send_message(chat_id=msg.chat_id, text=f"Sizning buyurtmangiz uchun tasdiq kodi (OTP): {otp}. Ushbu kodni yetkazib beruvchiga yetkazilganda berishingiz kerak.", reply_markup=exit_kb)
+        except Exception:
+            pass
+        # schedule expiry as usual
+        schedule_order_expiry(order)
+        # notify user
+        try:
+            await context.bot.send_message(chat_id=msg.chat_id, text=f"✅ To'lov muvaffaqiyatli. Buyurtmangiz #{order_number} qabul qilindi.\n\n{order.get('original_text','')}")
+        except Exception:
+            pass
+        # optionally notify super-admin
+        try:
+            sa_text = (
+                f"[TO'LOV] {datetime.now(timezone.utc).isoformat()}\n"
+                f"Mijoz: {order.get('user')} (id: {order.get('user_id')})\n"
+                f"Buyurtma: #{order_number}\n"
+                f"Jami: {order.get('total')} {order['payment_info'].get('currency')}\n"
+            )
+            await report_superadmin(context.bot, "TO'LOV", order_number, sa_text)
+        except Exception:
+            pass
     except Exception as e:
         log.exception(f"Error handling successful payment: {e}")
 
 
-async def api_call_with_retry(callable_func, *args, retries: int = 3, initial_delay: float = 1.0, **kwargs):
-    """Call a coroutine function with simple exponential backoff retries.
-    callable_func should be an async callable (e.g., bot.send_message).
+def retry_after_seconds(e: RetryAfter) -> float:
+    ra = e.retry_after
+    return ra.total_seconds() if isinstance(ra, timedelta) else float(ra)
+
+
+class OutboundLimiter(BaseRateLimiter):
+    """Every Bot API request (except getUpdates) goes through this limiter.
+
+    - at most `max_concurrency` requests are in flight at once
+    - requests to the same chat run one at a time, in call order (FIFO)
+    - RetryAfter waits the time Telegram asks for (up to `max_retry_after`)
+    - network errors / timeouts are retried with full-jitter exponential backoff
+    - after `breaker_threshold` consecutive network failures the circuit opens
+      for `breaker_cooldown` seconds and calls fail fast; after the cooldown
+      calls go through again and a single further failure reopens it
+    Counters are available from `snapshot()` and logged every `metrics_interval`.
+    Callers that handle flood control themselves pass
+    `rate_limit_args={'max_retries': 0}` to get errors back immediately.
     """
-    delay = initial_delay
-    last_exc = None
-    for attempt in range(1, retries + 1):
+
+    def __init__(self, max_concurrency: int = 32, max_retries: int = 3, base_delay: float = 0.5,
+                 max_delay: float = 10.0, max_retry_after: float = 60.0, breaker_threshold: int = 5,
+                 breaker_cooldown: float = 30.0, metrics_interval: float = 300.0):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.metrics_interval = metrics_interval
+        self._sem: Optional[asyncio.Semaphore] = None
+        # chat_id -> [lock, number of requests holding or waiting for it]
+        self._chat_locks: dict = {}
+        self._failures = 0
+        self._open_until = 0.0
+        self._metrics_task: Optional[asyncio.Task] = None
+        self.metrics = {
+            'requests': 0, 'retries': 0, 'failures': 0,
+            'retry_after_waits': 0, 'retry_after_seconds': 0.0,
+            'queue_wait_seconds': 0.0, 'circuit_opened': 0, 'circuit_rejected': 0,
+        }
+
+    async def initialize(self):
+        self._sem = asyncio.Semaphore(self.max_concurrency)
+        if self.metrics_interval and self._metrics_task is None:
+            self._metrics_task = asyncio.create_task(self._log_metrics())
+
+    async def shutdown(self):
+        if self._metrics_task is not None:
+            self._metrics_task.cancel()
+            self._metrics_task = None
+        log.info(f"Chiquvchi so'rovlar statistikasi: {self.snapshot()}")
+
+    def snapshot(self) -> dict:
+        snap = dict(self.metrics)
+        snap['retry_after_seconds'] = round(snap['retry_after_seconds'], 1)
+        snap['queue_wait_seconds'] = round(snap['queue_wait_seconds'], 1)
+        snap['circuit_open'] = time.monotonic() < self._open_until
+        snap['chats_queued'] = len(self._chat_locks)
+        return snap
+
+    async def _log_metrics(self):
+        while True:
+            await asyncio.sleep(self.metrics_interval)
+            log.info(f"Chiquvchi so'rovlar statistikasi: {self.snapshot()}")
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def _record_failure(self):
+        self._failures += 1
+        if self._failures >= self.breaker_threshold and time.monotonic() >= self._open_until:
+            self._open_until = time.monotonic() + self.breaker_cooldown
+            self.metrics['circuit_opened'] += 1
+            log.warning(f"Telegram API javob bermayapti: {self.breaker_cooldown:.0f}s davomida so'rovlar to'xtatildi")
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        self.metrics['requests'] += 1
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.max_concurrency)
+        chat_id = data.get('chat_id')
+        max_retries = (rate_limit_args or {}).get('max_retries', self.max_retries)
+        if chat_id is None:
+            return await self._call(callback, args, kwargs, endpoint, max_retries)
+        entry = self._chat_locks.setdefault(chat_id, [asyncio.Lock(), 0])
+        entry[1] += 1
         try:
-            return await callable_func(*args, **kwargs)
-        except Exception as e:
-            last_exc = e
-            log.warning(f"API call failed (attempt {attempt}/{retries}): {e}")
-            if attempt == retries:
-                raise
-            await asyncio.sleep(delay)
-            delay *= 2
-    if last_exc:
-        raise last_exc
+            async with entry[0]:
+                return await self._call(callback, args, kwargs, endpoint, max_retries)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._chat_locks.pop(chat_id, None)
+
+    async def _call(self, callback, args, kwargs, endpoint, max_retries: int):
+        attempt = 0
+        while True:
+            if time.monotonic() < self._open_until and self._failures >= self.breaker_threshold:
+                self.metrics['circuit_rejected'] += 1
+                raise NetworkError(f"Telegram API vaqtincha mavjud emas ({endpoint})")
+            queued = time.monotonic()
+            async with self._sem:
+                self.metrics['queue_wait_seconds'] += time.monotonic() - queued
+                try:
+                    result = await callback(*args, **kwargs)
+                except RetryAfter as e:
+                    wait = retry_after_seconds(e)
+                    if wait > self.max_retry_after or attempt >= max_retries:
+                        raise
+                    self.metrics['retry_after_waits'] += 1
+                    self.metrics['retry_after_seconds'] += wait
+                    # a little jitter so queued chats don't all resume in the same tick
+                    wait += random.uniform(0, 0.5)
+                except (BadRequest, InvalidToken):
+                    raise
+                except NetworkError as e:
+                    # TimedOut is a NetworkError too
+                    self._record_failure()
+                    if attempt >= max_retries:
+                        self.metrics['failures'] += 1
+                        raise
+                    wait = self._backoff(attempt)
+                    log.warning(f"{endpoint} muvaffaqiyatsiz ({attempt + 1}/{max_retries + 1}): {e}; {wait:.1f}s dan keyin qayta")
+                else:
+                    self._failures = 0
+                    return result
+            # waits happen outside the semaphore so other chats keep going
+            attempt += 1
+            self.metrics['retries'] += 1
+            await asyncio.sleep(wait)
+
+
+
+outbound_limiter = OutboundLimiter(
+    max_concurrency=int(os.getenv('OUTBOUND_CONCURRENCY', '32')),
+    breaker_threshold=int(os.getenv('OUTBOUND_BREAKER_THRESHOLD', '5')),
+    breaker_cooldown=float(os.getenv('OUTBOUND_BREAKER_COOLDOWN', '30')),
+    metrics_interval=float(os.getenv('OUTBOUND_METRICS_INTERVAL', '300')),
+)
 
 
 def normalize_phone(phone: str) -> str:
@@ -566,13 +2343,6 @@ def generate_otp(length: int = 5) -> str:
     return ''.join(str(random.randint(0, 9)) for _ in range(length))
 
 
-def product_price(name: str) -> int:
-    for cat in menu_data.values():
-        if name in cat:
-            return cat[name]['price']
-    return 0
-
-
 def build_superadmin_order_text(order: dict) -> str:
     parts = []
     parts.append(f"📝 Buyurtma #{order['order_number']} — {order.get('status')}")
@@ -581,7 +2351,7 @@ def build_superadmin_order_text(order: dict) -> str:
     parts.append("")
     items = order.get('items', [])
     for i, it in enumerate(items):
-        parts.append(f"{i+1}. {html.escape(it)}")
+        parts.append(f"{i+1}. {html.escape(item_label(it))}")
     parts.append("")
     parts.append(f"💰 Jami: {order.get('total',0)} so'm")
     parts.append(f"📍 Manzil: https://www.google.com/maps/search/?api=1&query={html.escape(order.get('loc',''))}")
@@ -594,7 +2364,7 @@ def build_superadmin_kb(order: dict) -> InlineKeyboardMarkup:
     for idx, it in enumerate(items):
         rows.append([
             InlineKeyboardButton("➖", callback_data=f"sa_dec_{order['order_number']}_{idx}"),
-            InlineKeyboardButton(f"{it}", callback_data="noop"),
+            InlineKeyboardButton(item_label(it), callback_data="noop"),
             InlineKeyboardButton("➕", callback_data=f"sa_inc_{order['order_number']}_{idx}")
         ])
     rows.append([
@@ -612,7 +2382,7 @@ def build_admin_edit_kb(order: dict) -> InlineKeyboardMarkup:
     for idx, it in enumerate(items):
         rows.append([
             InlineKeyboardButton("➖", callback_data=f"ae_dec_{order['order_number']}_{idx}"),
-            InlineKeyboardButton(f"{it}", callback_data="noop"),
+            InlineKeyboardButton(item_label(it), callback_data="noop"),
             InlineKeyboardButton("➕", callback_data=f"ae_inc_{order['order_number']}_{idx}")
         ])
     rows.append([
@@ -629,7 +2399,7 @@ async def send_superadmin_order_report(bot, order: dict):
         kb = build_superadmin_kb(order)
         msg = await bot.send_message(chat_id=SUPERADMIN_CHANNEL_ID, text=text, reply_markup=kb, parse_mode="HTML", disable_web_page_preview=True)
         order['superadmin_msg'] = {'chat_id': msg.chat_id, 'message_id': msg.message_id}
-        persist_orders()
+        persist_orders(order)
     except Exception as e:
         log.warning(f"Superadminga buyurtma hisobotini yuborishda xato: {e}")
 
@@ -647,9 +2417,7 @@ def generate_admin_order_kb(order: dict, show_cancel: bool = True, show_edit: bo
     # (so couriers can accept). When showing the keyboard to admins, set include_accept=False.
     if status == 'Kanalda' and include_accept:
         buttons.append(InlineKeyboardButton("📥 Qabul qilish", callback_data=f"accept_{order_num}"))
-    elif status == 'Qabul qilingan':
-        # agar kuryer allaqachon qabul qilgan bo'lsa, admin uchun yetkazildi tugmasi
-        buttons.append(InlineKeyboardButton("✅ Yetkazib berildi", callback_data=f"set_status_{order_num}_Yetkazib berildi"))
+    # 'Qabul qilingan': yetkazib berilganini kuryer tasdiqlaydi (OTP kodi, daromad) — admin tugmasi yo'q
 
     # Har doim bekor qilish tugmasi mavjud (agar yetkazilmagan bo'lsa) — lekin faqat show_cancel True bo'lsa
     if show_cancel and status != 'Yetkazib berildi':
@@ -658,2164 +2426,2555 @@ def generate_admin_order_kb(order: dict, show_cancel: bool = True, show_edit: bo
     return InlineKeyboardMarkup([buttons])
 
 # ========== BUYURTMA TAYMERI VAZIFASI ==========
-async def handle_order_expiry(order_number: int, bot):
-    """Buyurtma uchun 30 soniyalik taymerni boshqaradi; tugagach buyurtma kanalga yuboriladi."""
-    try:
-        # 30 soniya kutish
-        await asyncio.sleep(30)
+# Foydalanuvchi buyurtmani bekor qilishi mumkin bo'lgan vaqt (soniya)
+ORDER_CANCEL_WINDOW = 30
 
-        order = find_order(order_number)
-        if not order or order["status"] != "Kutilyapti": return
 
-        # Vaqt tugagach buyurtma kanalga yuboriladi va foydalanuvchi bekor qila olmaydi
-        order["status"] = "Kanalda"
-        persist_orders()
+class ExpiryScheduler:
+    """One asyncio task that drives the cancel-window expiry of every pending order.
 
-        # yuborish uchun kanal matni (telefonni + bilan ko'rsatish)
-        kanal_text = (
-            f"🆕 Yangi buyurtma #{order_number}!\n\n{order.get('original_text', '')}\n\n"
-            f"👤 {order.get('user')}\n📞 {normalize_phone(order.get('phone'))}\n"
-            f"📍 https://www.google.com/maps/search/?api=1&query={order.get('loc')}"
-        )
-        try:
-            msg = await api_call_with_retry(
-                bot.send_message,
-                chat_id=BUYURTMALAR_CHANNEL_ID,
-                text=kanal_text,
-                reply_markup=generate_admin_order_kb(order, show_cancel=False),
-            )
-            order["admin_msgs"] = [{"admin_id": BUYURTMALAR_CHANNEL_ID, "chat_id": msg.chat_id, "message_id": msg.message_id, "text": order.get('original_text','')}]
-            persist_orders()
+    Due times sit in a min-heap of (due_ts, order_number). `cancel()` drops the live
+    entry from a dict and the stale heap entry is skipped when it surfaces (the
+    heap is rebuilt once stale entries dominate). Due times are wall-clock
+    timestamps persisted on the order as `expires_at`, so orders that became due
+    while the bot was down fire right after a restart.
+    """
 
-            # Report to super-admin that order was auto-posted to channel
+    def __init__(self):
+        self._heap: list[tuple[float, int]] = []
+        self._live: dict[int, float] = {}
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._callback = None
+        self._running: set[asyncio.Task] = set()
+
+    def schedule(self, order_number: int, due_ts: float):
+        order_number = int(order_number)
+        self._live[order_number] = due_ts
+        heapq.heappush(self._heap, (due_ts, order_number))
+        self._wake.set()
+
+    def cancel(self, order_number: int) -> bool:
+        found = self._live.pop(int(order_number), None) is not None
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._live):
+            self._heap = [(d, n) for d, n in self._heap if self._live.get(n) == d]
+            heapq.heapify(self._heap)
+        return found
+
+    def __len__(self):
+        return len(self._live)
+
+    def start(self, callback):
+        """`callback(order_number)` is a coroutine function run for each due order."""
+        self._callback = callback
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
             try:
-                sa_text = (
-                    f"[E'LON QILINDI] {datetime.now(timezone.utc).isoformat()}\n"
-                    f"Kanalga yuborilgan buyurtma: #{order_number}\n"
-                    f"Mijoz: {order.get('user')} (id: {order.get('user_id')})\n"
-                    f"Telefon: {phone_html_link(order.get('phone'))}\n"
-                    f"Jami: {order.get('total')} so'm\n"
-                    f"Mahsulotlar: {', '.join(order.get('items', []))}\n"
-                    f"Manzil: https://www.google.com/maps/search/?api=1&query={order.get('loc')}"
-                )
-                await report_superadmin(bot, sa_text)
-            except Exception as e:
-                log.warning(f"Superadminga publish hisobotini yuborishda xato: {e}")
-                # structured superadmin report (allows inline editing)
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            # drop entries that were cancelled or rescheduled
+            while self._heap and self._live.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            self._wake.clear()
+            if not self._heap:
+                await self._wake.wait()
+                continue
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
                 try:
-                    await send_superadmin_order_report(bot, order)
-                except Exception:
+                    await asyncio.wait_for(self._wake.wait(), timeout=delay)
+                except asyncio.TimeoutError:
                     pass
-        except Exception as e:
-            log.warning(f"Kanalga buyurtma yuborishda xato (expiry): {e}")
-
-        # Bildirish: foydalanuvchiga buyurtma kanalda e'lon qilindi haqida xabar berish
-        um = order.get("user_msg")
-        if um:
-            final_txt = (
-                f"✅ Buyurtma #{order_number} kanalda e'lon qilindi. Yetkazib beruvchilar qabul qilishini kuting.\n\n"
-                f"{order.get('original_text', '')}"
-            )
-            # Try to edit the previous user message and send a follow-up; retry on transient errors.
-            try:
-                try:
-                    await api_call_with_retry(
-                        bot.edit_message_text,
-                        chat_id=um["chat_id"],
-                        message_id=um["message_id"],
-                        text=final_txt,
-                    )
-                except Exception as e:
-                    log.warning(f"Foydalanuvchi xabarini tahrirlash muvaffaqiyatsiz (order #{order_number}): {e}")
-                        # Vaqt tugagach buyurtma kanalga yuboriladi va foydalanuvchi bekor qila olmaydi
-                    await api_call_with_retry(
-                        bot.send_message,
-                        chat_id=um["chat_id"],
-                        text="30 soniya o'tdi — buyurtmani endi bekor qila olmaysiz.",
-                    )
-                except Exception as e:
-                    log.warning(f"Foydalanuvchiga xabar yuborishda xato (order #{order_number}): {e}")
-            except BadRequest:
-                pass
-    except asyncio.CancelledError: return
-    except Exception as e: log.exception(f"Taymerda xatolik (buyurtma #{order_number}): {e}")
-    finally: expiry_tasks.pop(order_number, None)
+                continue
+            _, order_number = heapq.heappop(self._heap)
+            self._live.pop(order_number, None)
+            t = asyncio.create_task(self._callback(order_number))
+            self._running.add(t)
+            t.add_done_callback(self._running.discard)
 
-# ========== HANDLERLAR ==========
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # Start handler: ensure admins see only the admin panel (no extra greetings/messages)
-    user = update.effective_user; user_id = user.id; first_name = user.first_name or "Foydalanuvchi"
-    if user_id not in users:
-        users.add(user_id); persist_users()
-    ud = context.user_data
-    # Determine role early for correct cleanup ordering
-    is_admin = user_id in admins
-    # Best-effort: delete any prior bot messages/prompts for a clean start
-    try:
-        # For admins, clear admin prompts first (before wiping user_data)
-        if is_admin:
-            try:
-                await clear_admin_session(user_id, context, ud)
-            except Exception:
-                pass
-        # Clear user session messages (menus, history, prompts)
-        try:
-            await clear_user_session(user_id, context, ud)
-        except Exception:
-            pass
-        # Delete ANY bot-sent messages recorded for this chat (photos, texts, keyboards, etc.)
-        try:
-            await _delete_all_bot_messages_for_chat(context, user_id)
-        except Exception:
-            pass
-        # Also delete any cached category-view messages for this chat
-        try:
-            for (chat_id, cat), mid in list(last_category_messages.items()):
-                if chat_id == user_id:
-                    try:
-                        await context.bot.delete_message(chat_id=chat_id, message_id=mid)
-                    except Exception:
-                        # fallback: try to blank it if deletion fails
-                        try:
-                            await context.bot.edit_message_text(chat_id=chat_id, message_id=mid, text='\u200b')
-                        except Exception:
-                            pass
-                    finally:
-                        try:
-                            last_category_messages.pop((chat_id, cat), None)
-                        except Exception:
-                            pass
-        except Exception:
-            pass
-        # Optionally delete the user's /start command message to keep chat clean
+
+expiry_scheduler = ExpiryScheduler()
+
+
+def schedule_order_expiry(order: dict):
+    """Schedule (or, after a restart, re-schedule) the end of an order's cancel window."""
+    due = order.get('expires_at')
+    if due is None:
         try:
-            if update.message:
-                await update.message.delete()
+            created = datetime.fromisoformat(order.get('dt')).timestamp()
         except Exception:
-            pass
-    except Exception:
-        pass
-    # Now reset per-user state
-    ud.clear(); ud["cart"] = {}
+            created = time.time()
+        due = created + ORDER_CANCEL_WINDOW
+    expiry_scheduler.schedule(order['order_number'], float(due))
 
-    # Admins: send only the admin panel and nothing else
-    if is_admin:
-        # Admin panel after cleanup
-        try:
-            await context.bot.send_message(chat_id=user_id, text="🔑 Admin panelga xush kelibsiz!", reply_markup=admin_panel_kb())
-        except Exception as e:
-            log.warning(f"Admin panelni yuborishda xato: {e}")
-        return
 
-    # For non-admins, show user greeting/menu as before
-    try:
-        await context.bot.send_message(chat_id=user_id, text=f"Salom, {first_name}! 👋\nSizning Telegram ID raqamingiz: `{user_id}`", parse_mode="Markdown")
-    except Exception as e:
-        log.warning(f"ID xabarini yuborishda xato: {e}")
+class PublicationOutbox:
+    """Durable outbox for posting orders to BUYURTMALAR_CHANNEL_ID.
 
-    # Couriers see courier panel instead of regular user menu
-    if user_id in couriers:
-        await context.bot.send_message(chat_id=user_id, text="🚚 Yetkazib beruvchi paneli:", reply_markup=courier_panel_kb())
-        return
+    The job lives on the order itself (`order['publish_job']`), so it is written
+    in the same journal line / row as the "Kanalda" status change. A single
+    worker drains due jobs one at a time with exponential backoff; a job whose
+    order already carries a channel message is simply cleared, which keeps the
+    worker idempotent per order_number (delivery is at-least-once).
+    """
 
-    # Regular users: show a simple reply-keyboard with top-level actions (not categories)
-    try:
-        # If we don't have stored profile info for this user, start a short questionnaire
-        if user_id not in users_info:
-            # ask for full name first
-            ud = context.user_data
-            ud['profile_setup'] = 'name'
+    def __init__(self, publish, base_delay: float = 2.0, max_delay: float = 60.0):
+        self._publish = publish
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._pending: dict[int, float] = {}
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._bot = None
+
+    def enqueue(self, order_number: int, delay: float = 0.0):
+        self._pending[int(order_number)] = time.time() + delay
+        self._wake.set()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def start(self, bot):
+        self._bot = bot
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
             try:
-                await context.bot.send_message(chat_id=user_id, text="Assalomu alaykum! Iltimos, to'liq ismingizni kiriting:")
-            except Exception:
+                await self._task
+            except asyncio.CancelledError:
                 pass
-            return
+            self._task = None
 
-        user_kb = ReplyKeyboardMarkup([
-            [KeyboardButton("🍔 Menyu"), KeyboardButton("Taklif va shikoyatlar")],
-            [KeyboardButton("🧾 Buyurtmalar tarixi")]
-        ], resize_keyboard=True, one_time_keyboard=False)
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            if not self._pending:
+                await self._wake.wait()
+                continue
+            order_number, due = min(self._pending.items(), key=lambda kv: kv[1])
+            delay = due - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._pending.pop(order_number, None)
+            async with order_locks.hold(order_number):
+                await self._attempt(order_number)
+
+    async def _attempt(self, order_number: int):
+        order = find_order(order_number)
+        job = order.get('publish_job') if order else None
+        if not job:
+            return
+        if order.get('status') != 'Kanalda' or channel_message(order):
+            # cancelled meanwhile, or already posted before a crash
+            withdraw_offers(order, self._bot)
+            orders.update(order, publish_job=None)
+            persist_orders(order, critical=True)
+            return
         try:
-            sent_w = await context.bot.send_message(chat_id=user_id, text="🍔 Fast Food botiga xush kelibsiz! Quyidagi tugmalardan foydalaning:", reply_markup=user_kb)
-            # store welcome message id so we can delete/restore it when entering/exiting menu
-            try:
-                ud['welcome_msg'] = {'chat_id': sent_w.chat_id, 'message_id': sent_w.message_id, 'text': "🍔 Fast Food botiga xush kelibsiz! Quyidagi tugmalardan foydalaning:"}
-            except Exception:
-                pass
+            await self._publish(order, self._bot)
         except Exception as e:
-            log.warning(f"Foydalanuvchi uchun boshlang'ich klaviatura yuborishda xato: {e}")
+            attempts = int(job.get('attempts', 0)) + 1
+            delay = min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+            orders.update(order, publish_job={**job, 'attempts': attempts, 'last_error': str(e)[:200]})
+            persist_orders(order)
+            log.warning(f"Kanalga buyurtma yuborishda xato (#{order_number}, urinish {attempts}), {delay:.0f}s dan keyin qayta: {e}")
+            self.enqueue(order_number, delay)
+
+
+def channel_message(order: dict) -> Optional[dict]:
+    """The order's post in BUYURTMALAR_CHANNEL_ID, if it has been published."""
+    for m in order.get('admin_msgs') or []:
+        if m.get('admin_id') == BUYURTMALAR_CHANNEL_ID and m.get('message_id'):
+            return m
+    return None
+
+
+def channel_text(order: dict) -> str:
+    """Kanal posti matni (telefon + bilan); qaytarilgan buyurtmalar uchun ogohlantirish bilan."""
+    text = (
+        f"🆕 Yangi buyurtma #{order['order_number']}!\n\n{order.get('original_text', '')}\n\n"
+        f"👤 {order.get('user')}\n📞 {normalize_phone(order.get('phone'))}\n"
+        f"📍 https://www.google.com/maps/search/?api=1&query={order.get('loc')}"
+    )
+    if order.get('returned_count', 0) > 0:
+        # mark returned status visibly in channel post to avoid double-prep
+        text += (f"\n⚠️ DIQQAT: Bu buyurtma {order.get('returned_count')} marta qaytarilgan. So'nggi qaytarish: {order.get('last_returned_at')}"
+                 f"\nYetkazib beruvchi ID: {order.get('last_returned_by')}")
+    return text
+
+
+async def publish_order(order: dict, bot):
+    """Kanalga buyurtmani yuboradi; xato bo'lsa istisno ko'tariladi (outbox qayta urinadi).
+    A job with reason 'return' (a courier gave the order back) is only reposted:
+    the customer and the super-admin were already told when it was first published."""
+    order_number = order['order_number']
+    reason = (order.get('publish_job') or {}).get('reason')
+    msg = await bot.send_message(
+        chat_id=BUYURTMALAR_CHANNEL_ID,
+        text=channel_text(order),
+        reply_markup=generate_admin_order_kb(order, show_cancel=False),
+    )
+    withdraw_offers(order, bot)
+    # the channel message and the cleared job land in one write
+    orders.update(
+        order,
+        admin_msgs=[{"admin_id": BUYURTMALAR_CHANNEL_ID, "chat_id": msg.chat_id, "message_id": msg.message_id, "text": order.get('original_text','')}],
+        publish_job=None,
+    )
+    persist_orders(order, critical=True)
+    if reason == 'return':
+        return
+
+    # Report to super-admin that order was auto-posted to channel
+    try:
+        sa_text = (
+            f"[E'LON QILINDI] {datetime.now(timezone.utc).isoformat()}\n"
+            f"Kanalga yuborilgan buyurtma: #{order_number}\n"
+            f"Mijoz: {order.get('user')} (id: {order.get('user_id')})\n"
+            f"Telefon: {phone_html_link(order.get('phone'))}\n"
+            f"Jami: {order.get('total')} so'm\n"
+            f"Mahsulotlar: {items_text(order.get('items', []))}\n"
+            f"Manzil: https://www.google.com/maps/search/?api=1&query={order.get('loc')}"
+        )
+        await report_superadmin(bot, "E'LON QILINDI", order_number, sa_text)
     except Exception as e:
-        log.warning(f"Foydalanuvchi uchun boshlang'ich klaviatura yuborishda xato: {e}")
+        log.warning(f"Superadminga publish hisobotini yuborishda xato: {e}")
+
+    # Bildirish: foydalanuvchiga buyurtma kanalda e'lon qilindi haqida xabar berish
+    # (after a courier offer the customer already knows the cancel window is over)
+    await notify_customer_status(
+        order, bot,
+        f"✅ Buyurtma #{order_number} kanalda e'lon qilindi. Yetkazib beruvchilar qabul qilishini kuting.",
+        window_closed=not order.get('dispatch'),
+    )
+
+
+async def notify_customer_status(order: dict, bot, headline: str, window_closed: bool = True):
+    """Edit the customer's order message to `headline` (this also removes its cancel
+    button) and, with `window_closed`, tell them the order can no longer be cancelled."""
+    um = order.get("user_msg")
+    if not um:
+        return
+    order_number = order['order_number']
+    # Edit the previous user message and send a follow-up (transient errors are retried by outbound_limiter).
+    try:
+        await bot.edit_message_text(
+            chat_id=um["chat_id"],
+            message_id=um["message_id"],
+            text=f"{headline}\n\n{order.get('original_text', '')}",
+        )
+    except Exception as e:
+        log.warning(f"Foydalanuvchi xabarini tahrirlash muvaffaqiyatsiz (order #{order_number}): {e}")
+    if not window_closed:
+        return
+    try:
+        await bot.send_message(
+            chat_id=um["chat_id"],
+            text="30 soniya o'tdi — buyurtmani endi bekor qila olmaysiz.",
+        )
+    except Exception as e:
+        log.warning(f"Foydalanuvchiga xabar yuborishda xato (order #{order_number}): {e}")
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE): await update.message.reply_text("Buyruqlar:\n/start — Boshlash\n/help — Yordam")
 
-async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query; await query.answer(); data = query.data or ""; uid = update.effective_user.id
-    ud = context.user_data; ud.setdefault("cart", {})
-    global order_counter
+publication_outbox = PublicationOutbox(publish_order)
 
-    # ADMIN FUNKSIONALI
-    if uid in admins:
-        if data == 'admin_panel':
-            # Cleanup any transient admin prompts and states when returning to the panel
-            try:
-                await clear_admin_session(uid, context, ud)
-            except Exception:
-                pass
-            try:
-                await query.edit_message_text("🔑 Admin panelga xush kelibsiz!", reply_markup=admin_panel_kb())
-            except Exception:
-                pass
-            return
-        # Admin reply-to-suggestion button pressed: set up reply state
-        if data.startswith('reply_sug_'):
-            # format: reply_sug_<user_id>_<channel_msg_id>
-            parts = data.split('_')
-            try:
-                target_user = int(parts[2])
-                channel_msg_id = int(parts[3]) if len(parts) > 3 else None
-            except Exception:
-                await query.answer('Noto‘g‘ri parametrlar', show_alert=True); return
-            # set admin's user_data so their next message will be forwarded to target_user
-            ud['want_reply_to'] = {'target_user': target_user, 'channel_msg_id': channel_msg_id}
-            # prompt admin to type the reply
-            try:
-                exit_kb = ReplyKeyboardMarkup([[KeyboardButton('🔙 Chiqish')]], resize_keyboard=True, one_time_keyboard=True)
-                prompt = await context.bot.send_message(chat_id=uid, text=f"Mijoz (id: {target_user}) ga yuboriladigan javob matnini yoki media-xabarni yuboring.\n(Yuborilgach, men xabaringizni mijozga jo‘nataman.)", reply_markup=exit_kb)
-                # record prompt so we can clear it on exit
-                admin_orders_sessions[uid] = admin_orders_sessions.get(uid, []) + [{'chat_id': prompt.chat_id, 'message_id': prompt.message_id}]
-                # forward the original suggestion message from the suggestions channel into admin private chat
-                try:
-                    if channel_msg_id:
-                        fwd = await context.bot.forward_message(chat_id=uid, from_chat_id=SUGGESTIONS_CHANNEL_ID, message_id=channel_msg_id)
-                        admin_orders_sessions[uid] = admin_orders_sessions.get(uid, []) + [{'chat_id': fwd.chat_id, 'message_id': fwd.message_id}]
-                except Exception:
-                    pass
-            except Exception:
-                pass
-            try:
-                await query.answer('Iltimos javobni yozing...')
-            except Exception:
-                pass
-            return
-        if data == "admin_orders":
-            # Faol (admin tomonidan boshqariladigan) buyurtmalar: faqat kanalga e'lon qilinganlar
-            published = [o for o in orders if o.get("status") == "Kanalda"]
-            if not published:
-                await query.edit_message_text("📭 Hozir kanalda e'lon qilingan buyurtmalar yo'q.", reply_markup=admin_panel_kb())
-                return
-            # Replace admin panel buttons with a reply keyboard exit button while listing orders
-            try:
-                await query.edit_message_text("📣 Kanalda e'lon qilingan buyurtmalar:")
-            except Exception:
-                pass
-            exit_kb = ReplyKeyboardMarkup([[KeyboardButton("🔙 Chiqish")]], resize_keyboard=True, one_time_keyboard=True)
-            # We'll collect all messages we send here (header, prompt and individual order messages)
-            sent_msgs = []
-            # include the edited header message (so it can be deleted later) —
-            # only record messages that were actually sent to the admin's private chat
-            try:
-                if query.message.chat_id == uid:
-                    sent_msgs.append({'chat_id': query.message.chat_id, 'message_id': query.message.message_id})
-            except Exception:
-                pass
-            try:
-                prompt_msg = await context.bot.send_message(chat_id=uid, text="🔙 Chiqish tugmasini bosing:", reply_markup=exit_kb)
-                sent_msgs.append({'chat_id': prompt_msg.chat_id, 'message_id': prompt_msg.message_id})
-            except Exception:
-                pass
-            for o in reversed(published):
-                dt_str = datetime.fromisoformat(o.get("dt")).strftime('%Y-%m-%d %H:%M')
-                order_text = (
-                    f"#{o['order_number']} — **{o['status'].upper()}**\n"
-                    f"👤 {o['user']}\n📞 {normalize_phone(o.get('phone'))}\n"
-                    f"🛒 {', '.join(o.get('items', []))}\n💰 {o['total']} so‘m\n"
-                    f"📍 https://www.google.com/maps/search/?api=1&query={o['loc']}\n"
-                    f"🕒 {dt_str}"
-                )
-                try:
-                    msg = await context.bot.send_message(chat_id=uid, text=order_text, reply_markup=generate_admin_order_kb(o, show_cancel=True, include_accept=False), parse_mode="Markdown")
-                    sent_msgs.append({'chat_id': msg.chat_id, 'message_id': msg.message_id})
-                except Exception:
-                    # If sending fails, continue
-                    continue
-            # store session so we can delete these messages when admin exits
-            admin_orders_sessions[uid] = sent_msgs
-            return
-        
-        # Note: 'clear all orders' function removed per admin request
-            
-        if data.startswith("set_status_"):
-            try: _, _, order_num_str, new_status = data.split("_"); order_num = int(order_num_str)
-            except (ValueError, IndexError): await query.answer("Noto'g'ri buyruq", show_alert=True); return
 
+async def handle_order_expiry(order_number: int, bot):
+    """Buyurtmaning bekor qilish vaqti tugaganda chaqiriladi; buyurtma kanalga yuboriladi."""
+    try:
+        async with order_locks.hold(order_number):
+            # Vaqt tugagach buyurtma kanalga yuboriladi va foydalanuvchi bekor qila olmaydi.
+            # The publish job is written together with the status change.
+            order = orders.transition(order_number, 'Kutilyapti', 'Kanalda', by='expiry',
+                                      publish_job={'created': time.time(), 'attempts': 0})
+            if not order: return
+            persist_orders(order, critical=True)
+            # the nearest idle couriers get it first; the channel post waits for their answer
+            delay = await offer_to_nearest(order, bot)
+        publication_outbox.enqueue(order_number, delay)
+    except asyncio.CancelledError: return
+    except Exception as e: log.exception(f"Taymerda xatolik (buyurtma #{order_number}): {e}")
 
+# ========== YAQIN KURYERGA TAKLIF (DISPATCH) ==========
+# Yangi buyurtma avval eng yaqin DISPATCH_K ta bo'sh kuryerga shaxsan taklif qilinadi (0 — darhol kanalga)
+DISPATCH_K = int(os.getenv('DISPATCH_K', '3'))
+# Taklifni qabul qilish uchun vaqt (soniya); hech kim olmasa buyurtma kanalga chiqadi
+DISPATCH_TIMEOUT = float(os.getenv('DISPATCH_TIMEOUT', '60'))
+DISPATCH_RADIUS_KM = float(os.getenv('DISPATCH_RADIUS_KM', '10'))
+# Shuncha vaqt (soniya) yangilanmagan kuryer joylashuvi hisobga olinmaydi
+COURIER_LOCATION_TTL = float(os.getenv('COURIER_LOCATION_TTL', '900'))
 
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
 
-            order = find_order(order_num)
-            if not order: await query.answer("Buyurtma topilmadi", show_alert=True); return
 
-            order['status'] = new_status
-            persist_orders()
+def parse_latlon(loc) -> Optional[tuple[float, float]]:
+    """(lat, lon) from an order's "lat,lon" string."""
+    try:
+        lat, lon = (float(x) for x in str(loc).split(','))
+    except (TypeError, ValueError):
+        return None
+    return lat, lon
 
-            # If admin marked it as accepted (Qabul qilingan), remove the user's confirmation message to avoid chat clutter
-            try:
-                if new_status == 'Qabul qilingan' and order.get('user_msg'):
-                    um = order.pop('user_msg', None)
-                    if um:
-                        try:
-                            await context.bot.delete_message(chat_id=um['chat_id'], message_id=um['message_id'])
-                        except Exception:
-                            pass
-            except Exception:
-                pass
 
-            await query.edit_message_text(query.message.text + f"\n\n✅ Status \"{new_status}\" ga o'zgartirildi.", reply_markup=generate_admin_order_kb(order))
+def distance_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
 
-            try:
-                await context.bot.send_message(chat_id=order['user_id'], text=f"🔔 Sizning #{order_num} buyurtmangizning holati \"{new_status}\" ga o'zgardi.")
-            except Exception as e:
-                log.warning(f"Foydalanuvchiga status o'zgarishi haqida yuborishda xato: {e}")
 
-            # Report to super-admin channel about status change
-            try:
-                sa_text = (
-                    f"[HOLAT] {datetime.now(timezone.utc).isoformat()}\n"
-                    f"Admin: {uid} ({update.effective_user.full_name})\n"
-                    f"Buyurtma: #{order_num} — Holat: {new_status}\n"
-                    f"Mijoz: {order.get('user')} (id: {order.get('user_id')})\n"
-                    f"Telefon: {phone_html_link(order.get('phone'))}\n"
-                    f"Jami: {order.get('total')} so'm\n"
-                    f"Mahsulotlar: {', '.join(order.get('items', []))}\n"
-                    f"Manzil: https://www.google.com/maps/search/?api=1&query={order.get('loc')}"
-                )
-                await report_superadmin(context.bot, sa_text)
-            except Exception as e:
-                log.warning(f"Superadminga status hisobotini yuborishda xato: {e}")
+class CourierGeoIndex:
+    """Last known courier positions bucketed in a uniform lat/lon grid.
 
-            return
-            
-        # ... (broadcast, add/remove admin o'zgarishsiz)
-        if data == "admin_broadcast":
-            ud["want_broadcast"] = True
-            # Edit the panel message and send a prompt with an exit keyboard so admin can cancel
-            try:
-                await query.edit_message_text("📢 Yuboriladigan xabarni yozing:")
-            except Exception:
-                pass
-            exit_kb = ReplyKeyboardMarkup([[KeyboardButton("🔙 Chiqish")]], resize_keyboard=True, one_time_keyboard=True)
-            try:
-                prompt_msg = await context.bot.send_message(chat_id=uid, text="📢 Yuboriladigan xabarni yozing:", reply_markup=exit_kb)
-                # store only the prompt message for cleanup
-                admin_orders_sessions[uid] = [{'chat_id': prompt_msg.chat_id, 'message_id': prompt_msg.message_id}]
-                # delete the original inline admin message to avoid duplicate text
-                try:
-                    await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
-                except Exception:
-                    pass
-            except Exception:
-                pass
-            return
-        if data == "admin_add":
-            ud["want_add_admin"] = True
-            # Prompt admin to enter new admin ID with an exit button (like broadcast flow)
-            try:
-                await query.edit_message_text("➕ Yangi admin ID raqamini kiriting:")
-            except Exception:
-                pass
-            exit_kb = ReplyKeyboardMarkup([[KeyboardButton("🔙 Chiqish")]], resize_keyboard=True, one_time_keyboard=True)
-            try:
-                prompt_msg = await context.bot.send_message(chat_id=uid, text="➕ Yangi admin ID raqamini kiriting:", reply_markup=exit_kb)
-                # store only the prompt message for cleanup on exit
-                admin_orders_sessions[uid] = [{'chat_id': prompt_msg.chat_id, 'message_id': prompt_msg.message_id}]
-                # delete the original inline admin message to avoid duplicate text
-                try:
-                    await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
-                except Exception:
-                    pass
-            except Exception:
-                pass
-            return
-        if data == "admin_remove":
-            ud["want_remove_admin"] = True
-            try:
-                await query.edit_message_text("❌ O'chiriladigan admin ID raqamini kiriting:")
-            except Exception:
-                pass
-            exit_kb = ReplyKeyboardMarkup([[KeyboardButton("🔙 Chiqish")]], resize_keyboard=True, one_time_keyboard=True)
-            try:
-                prompt_msg = await context.bot.send_message(chat_id=uid, text="❌ O'chiriladigan admin ID raqamini kiriting:", reply_markup=exit_kb)
-                admin_orders_sessions[uid] = [{'chat_id': prompt_msg.chat_id, 'message_id': prompt_msg.message_id}]
-                try:
-                    await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
-                except Exception:
-                    pass
-            except Exception:
-                pass
-            return
-        if data == "admin_add_courier":
-            ud["want_add_courier"] = True
-            try:
-                await query.edit_message_text("➕ Yetkazib beruvchi ID raqamini kiriting:")
-            except Exception:
-                pass
-            exit_kb = ReplyKeyboardMarkup([[KeyboardButton("🔙 Chiqish")]], resize_keyboard=True, one_time_keyboard=True)
-            try:
-                prompt_msg = await context.bot.send_message(chat_id=uid, text="➕ Yetkazib beruvchi ID raqamini kiriting:", reply_markup=exit_kb)
-                admin_orders_sessions[uid] = [{'chat_id': prompt_msg.chat_id, 'message_id': prompt_msg.message_id}]
-                try:
-                    await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
-                except Exception:
-                    pass
-            except Exception:
-                pass
-            return
-        if data == "admin_remove_courier":
-            ud["want_remove_courier"] = True
-            try:
-                await query.edit_message_text("❌ O'chiriladigan yetkazib beruvchi ID raqamini kiriting:")
-            except Exception:
-                pass
-            exit_kb = ReplyKeyboardMarkup([[KeyboardButton("🔙 Chiqish")]], resize_keyboard=True, one_time_keyboard=True)
-            try:
-                prompt_msg = await context.bot.send_message(chat_id=uid, text="❌ O'chiriladigan yetkazib beruvchi ID raqamini kiriting:", reply_markup=exit_kb)
-                admin_orders_sessions[uid] = [{'chat_id': prompt_msg.chat_id, 'message_id': prompt_msg.message_id}]
-                try:
-                    await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
-                except Exception:
-                    pass
-            except Exception:
-                pass
-            return
-        # Admin: mark a product as out-of-stock / back-in-stock
-        if data == "admin_mark_product":
-            # show categories (admin view — includes all products and their availability)
-            rows = [[InlineKeyboardButton(cat, callback_data=f"amark_cat_{cat}")] for cat in menu_data.keys()]
-            rows.append([InlineKeyboardButton('◀️ Bekor', callback_data='admin_panel')])
-            try:
-                await query.edit_message_text('Kategoriya tanlang (mahsulotni tugadi/bor qilib belgilash):', reply_markup=InlineKeyboardMarkup(rows))
-            except Exception:
-                pass
-            await query.answer(); return
-        
-        # Admin: Menyuni tahrirlash -- open categories and product editor
-        if data == "admin_edit_menu":
-            rows = []
-            for cat in menu_data.keys():
-                rows.append([
-                    InlineKeyboardButton(cat, callback_data=f"amenu_cat_{cat}"),
-                    InlineKeyboardButton("🗑️", callback_data=f"amenu_delete_cat_{cat}")
-                ])
-            rows.append([InlineKeyboardButton("➕ Kategoriya qo'shish", callback_data="amenu_add_category")])
-            rows.append([InlineKeyboardButton('◀️ Bekor', callback_data='admin_panel')])
-            try:
-                await query.edit_message_text('Menyuni tahrirlash — kategoriya tanlang:', reply_markup=InlineKeyboardMarkup(rows))
-            except Exception:
-                pass
-            await query.answer(); return
+    The grid is a fixed-precision geohash with integer (row, col) cell keys, so
+    the neighbours of a cell are plain index offsets. `nearest()` scans rings of
+    cells outwards from the query point and stops as soon as the k best matches
+    are closer than the radius the scanned rings already cover, so a lookup only
+    visits the cells around the order. Positions older than `ttl` seconds (live
+    location stopped) are skipped and dropped.
+    """
 
-        if data.startswith('amenu_cat_'):
-            cat = data.split('_', 2)[2]
-            rows = [[InlineKeyboardButton(f"{name} — {info.get('price',0)} so'm", callback_data=f"amenu_prod_{cat}|{name}")] for name, info in menu_data.get(cat, {}).items()]
-            rows.append([InlineKeyboardButton("➕ Mahsulot qo'shish", callback_data=f"amenu_add_product_{cat}")])
-            rows.append([InlineKeyboardButton('◀️ Orqaga', callback_data='admin_edit_menu'), InlineKeyboardButton('🔙 Admin panel', callback_data='admin_panel')])
-            try:
-                await query.edit_message_text(f"{cat} — mahsulotlarni tanlang:", reply_markup=InlineKeyboardMarkup(rows))
-            except Exception:
-                pass
-            await query.answer(); return
+    def __init__(self, cell: float = 0.01, ttl: float = 900.0):
+        self.cell = cell            # degrees; 0.01 is about 1.1 km
+        self.ttl = ttl
+        self._pos: dict[int, tuple[float, float, float]] = {}
+        self._cells: dict[tuple[int, int], set[int]] = {}
 
-        if data.startswith('amenu_prod_'):
-            rest = data.split('_', 2)[2]
-            if '|' not in rest:
-                await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
-            cat, prod = rest.split('|', 1)
-            info = menu_data.get(cat, {}).get(prod)
-            if not info:
-                await query.answer('Mahsulot topilmadi', show_alert=True); return
-            kb = InlineKeyboardMarkup([
-                [InlineKeyboardButton("✏️ Narxni tahrirlash", callback_data=f"amenu_edit_price_{cat}|{prod}"), InlineKeyboardButton("✏️ Tavsifni tahrirlash", callback_data=f"amenu_edit_desc_{cat}|{prod}")],
-                [InlineKeyboardButton("🖼️ Rasmni tahrirlash", callback_data=f"amenu_edit_photo_{cat}|{prod}" )],
-                [InlineKeyboardButton("🗑️ O'chirish", callback_data=f"amenu_delete_{cat}|{prod}"), InlineKeyboardButton('◀️ Orqaga', callback_data=f'amenu_cat_{cat}')]
-            ])
-            text = f"{prod}\n\nNarx: {info.get('price',0)} so'm\n\n{info.get('desc','')}"
-            try:
-                await query.edit_message_text(text, reply_markup=kb)
-            except Exception:
-                pass
-            await query.answer(); return
+    def __len__(self):
+        return len(self._pos)
 
-        if data.startswith('amenu_delete_') and not data.startswith('amenu_delete_cat_'):
-            rest = data.split('amenu_delete_',1)[1]
-            if '|' not in rest:
-                await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
-            cat, prod = rest.split('|',1)
-            if cat in menu_data and prod in menu_data[cat]:
-                try:
-                    del menu_data[cat][prod]
-                    persist_menu()
-                except Exception:
-                    pass
-                try:
-                    refresh_category_views(context, cat)
-                except Exception:
-                    pass
-                try:
-                    await query.edit_message_text(f"✅ '{prod}' o'chirildi.", reply_markup=admin_panel_kb())
-                except Exception:
-                    pass
-                await query.answer(); return
-            else:
-                await query.answer('Mahsulot topilmadi', show_alert=True); return
-
-        if data.startswith('amenu_delete_cat_'):
-            # Show confirmation prompt before deleting a category
-            cat_to_delete = data.split('amenu_delete_cat_', 1)[1]
-            kb = InlineKeyboardMarkup([
-                [
-                    InlineKeyboardButton("✅ Ha, o'chirish", callback_data=f"amenu_confirm_delete_cat_{cat_to_delete}_yes"),
-                    InlineKeyboardButton("❌ Yo'q, bekor", callback_data=f"amenu_confirm_delete_cat_{cat_to_delete}_no"),
-                ]
-            ])
-            try:
-                await query.edit_message_text(
-                    f"Kategoriya '{cat_to_delete}' va ichidagi barcha mahsulotlar o'chirilsinmi?",
-                    reply_markup=kb,
-                )
-            except Exception:
-                pass
-            await query.answer(); return
+    def _key(self, lat: float, lon: float) -> tuple[int, int]:
+        return math.floor(lat / self.cell), math.floor(lon / self.cell)
 
-        if data.startswith('amenu_confirm_delete_cat_'):
-            # Handle confirmation for deleting a category: yes/no
-            rest = data.split('amenu_confirm_delete_cat_', 1)[1]
-            try:
-                cat_name, decision = rest.rsplit('_', 1)
-            except Exception:
-                await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
+    def update(self, courier_id: int, lat: float, lon: float, now: Optional[float] = None):
+        self.remove(courier_id)
+        self._pos[courier_id] = (lat, lon, time.time() if now is None else now)
+        self._cells.setdefault(self._key(lat, lon), set()).add(courier_id)
 
-            def _render_category_list_kb():
-                rows_local = []
-                for cat in menu_data.keys():
-                    rows_local.append([
-                        InlineKeyboardButton(cat, callback_data=f"amenu_cat_{cat}"),
-                        InlineKeyboardButton("🗑️", callback_data=f"amenu_delete_cat_{cat}")
-                    ])
-                rows_local.append([InlineKeyboardButton("➕ Kategoriya qo'shish", callback_data="amenu_add_category")])
-                rows_local.append([InlineKeyboardButton('◀️ Bekor', callback_data='admin_panel')])
-                return InlineKeyboardMarkup(rows_local)
+    def remove(self, courier_id: int):
+        old = self._pos.pop(courier_id, None)
+        if old is None:
+            return
+        key = self._key(old[0], old[1])
+        bucket = self._cells.get(key)
+        if bucket is not None:
+            bucket.discard(courier_id)
+            if not bucket:
+                del self._cells[key]
+
+    @staticmethod
+    def _ring(ci: int, cj: int, r: int):
+        if r == 0:
+            yield ci, cj
+            return
+        for d in range(-r, r + 1):
+            yield ci - r, cj + d
+            yield ci + r, cj + d
+        for d in range(-r + 1, r):
+            yield ci + d, cj - r
+            yield ci + d, cj + r
+
+    def nearest(self, lat: float, lon: float, k: int, radius_km: float, accept=None,
+                now: Optional[float] = None) -> list[tuple[float, int]]:
+        """Up to `k` (distance_km, courier_id) pairs within `radius_km`, closest first;
+        `accept(courier_id)` filters candidates (e.g. idle couriers only)."""
+        now = time.time() if now is None else now
+        ci, cj = self._key(lat, lon)
+        # a cell is narrowest along the longitude; after ring r everything within
+        # r cell widths of the query point has been seen
+        cell_km = self.cell * KM_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01)
+        max_ring = math.ceil(radius_km / cell_km)
+        found, stale = [], []
+        for r in range(max_ring + 1):
+            for key in self._ring(ci, cj, r):
+                for cid in self._cells.get(key, ()):
+                    c_lat, c_lon, ts = self._pos[cid]
+                    if ts + self.ttl < now:
+                        stale.append(cid)
+                        continue
+                    if accept is not None and not accept(cid):
+                        continue
+                    d = distance_km(lat, lon, c_lat, c_lon)
+                    if d <= radius_km:
+                        found.append((d, cid))
+            if len(found) >= k:
+                found.sort()
+                if found[k - 1][0] <= r * cell_km:
+                    break
+        for cid in stale:
+            self.remove(cid)
+        found.sort()
+        return found[:k]
+
+
+courier_geo = CourierGeoIndex(ttl=COURIER_LOCATION_TTL)
+
+
+async def offer_to_nearest(order: dict, bot) -> float:
+    """Send the order privately to the DISPATCH_K nearest idle couriers, each with an
+    accept button. The offers are recorded in `order['dispatch']` and the publish job
+    gets a `not_before`; returns the delay before the channel fallback (0 if nobody
+    was offered). The customer is told the order is being offered, since it is
+    already 'Kanalda' but not in the channel yet. Called under the order lock."""
+    point = parse_latlon(order.get('loc'))
+    if DISPATCH_K <= 0 or point is None or not courier_geo:
+        return 0.0
+    order_number = order['order_number']
+    # idle = a courier without an accepted order; read once from the status index
+    busy = orders.couriers_in('Qabul qilingan')
+    nearest = courier_geo.nearest(point[0], point[1], DISPATCH_K, DISPATCH_RADIUS_KM,
+                                  accept=lambda cid: cid in couriers and cid not in busy)
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("📥 Qabul qilish", callback_data=f"accept_{order_number}")]])
+    offered, messages = [], []
+    for dist, cid in nearest:
+        text = (
+            f"🆕 Buyurtma #{order_number} — sizdan {dist:.1f} km.\n\n{order.get('original_text', '')}\n\n"
+            f"📍 https://www.google.com/maps/search/?api=1&query={order.get('loc')}\n\n"
+            f"⏳ {DISPATCH_TIMEOUT:.0f} soniya ichida qabul qilmasangiz, buyurtma kanalga chiqariladi."
+        )
+        try:
+            msg = await bot.send_message(chat_id=cid, text=text, reply_markup=kb)
+        except Exception as e:
+            log.warning(f"Kuryerga taklif yuborilmadi (#{order_number}, {cid}): {e}")
+            continue
+        offered.append({'courier_id': cid, 'km': round(dist, 2)})
+        messages.append({'chat_id': msg.chat_id, 'message_id': msg.message_id})
+    if not offered:
+        return 0.0
+    until = time.time() + DISPATCH_TIMEOUT
+    orders.update(order, dispatch={'offered': offered, 'messages': messages, 'until': until},
+                  publish_job={**(order.get('publish_job') or {}), 'not_before': until})
+    persist_orders(order, critical=True)
+    log.info(f"Buyurtma #{order_number} {len(offered)} ta yaqin kuryerga taklif qilindi")
+    await notify_customer_status(
+        order, bot,
+        f"⏳ Buyurtma #{order_number} yaqin atrofdagi yetkazib beruvchilarga taklif qilindi. "
+        f"{DISPATCH_TIMEOUT:.0f} soniya ichida hech kim olmasa, kanalda e'lon qilinadi.",
+    )
+    return DISPATCH_TIMEOUT
+
+
+def withdraw_offers(order: dict, bot):
+    """Delete the private offers once the order is accepted or goes to the channel."""
+    dispatch = order.get('dispatch')
+    if dispatch and dispatch.get('messages'):
+        message_cleaner.schedule_refs(bot, dispatch['messages'])
+        orders.update(order, dispatch={**dispatch, 'messages': []})
+
+
+async def courier_location_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """A courier's shared location; live location updates arrive as edited messages."""
+    msg = update.effective_message
+    if msg is None or msg.location is None:
+        return
+    courier_geo.update(update.effective_user.id, msg.location.latitude, msg.location.longitude)
+    if update.message is not None:
+        hint = "📍 Joylashuvingiz qabul qilindi. Yangi buyurtmalar sizga yaqinligingizga qarab taklif qilinadi."
+        if not msg.location.live_period:
+            hint += "\nJoylashuv doimiy yangilanib turishi uchun «jonli joylashuv» (live location) ulashing."
+        try:
+            await msg.reply_text(hint)
+        except Exception:
+            pass
 
-            if decision == 'yes':
-                if cat_name in menu_data:
-                    try:
-                        del menu_data[cat_name]
-                        persist_menu()
-                    except Exception as e:
-                        log.warning(f"Kategoriyani o'chirishda xato: {e}")
-                        await query.answer('Kategoriyani o\'chirishda xatolik', show_alert=True)
-                        return
-                    # Try refresh user category views tied to this category
-                    try:
-                        refresh_category_views(context, cat_name)
-                    except Exception:
-                        pass
-                    # Delete confirmation message and send fresh list
-                    try:
-                        await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
-                    except Exception:
-                        pass
-                    try:
-                        await context.bot.send_message(chat_id=uid, text="Menyuni tahrirlash — kategoriya tanlang:", reply_markup=_render_category_list_kb())
-                    except Exception:
-                        # fallback: edit same message if delete failed
-                        try:
-                            await query.edit_message_text("Menyuni tahrirlash — kategoriya tanlang:", reply_markup=_render_category_list_kb())
-                        except Exception:
-                            pass
-                    await query.answer('✅ Kategoriya o\'chirildi')
-                    return
-                else:
-                    await query.answer('Kategoriya topilmadi', show_alert=True)
+# ========== E'LON (BROADCAST) ==========
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursts up to `capacity`.
+
+    Waiters are served FIFO (acquire holds a lock while it sleeps), and
+    `pause()` blocks everyone until a RetryAfter from Telegram has elapsed.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._stamp = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
                     return
-            elif decision == 'no':
-                # Delete confirmation message and return to list without changes
-                try:
-                    await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
-                except Exception:
-                    pass
-                try:
-                    await context.bot.send_message(chat_id=uid, text="Menyuni tahrirlash — kategoriya tanlang:", reply_markup=_render_category_list_kb())
-                except Exception:
-                    # fallback to editing
-                    try:
-                        await query.edit_message_text("Menyuni tahrirlash — kategoriya tanlang:", reply_markup=_render_category_list_kb())
-                    except Exception:
-                        pass
-                await query.answer('Bekor qilindi')
-                return
-            else:
-                await query.answer('Noto\'g\'ri tanlov', show_alert=True)
-                return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
 
-        if data.startswith('amenu_add_category'):
-            ud['amenu_adding_category'] = True
-            try:
-                # remember this inline prompt so we can delete it when the admin finishes/cancels
-                ud['amenu_last_prompt'] = {'chat_id': query.message.chat_id, 'message_id': query.message.message_id}
-                await query.edit_message_text('Yangi kategoriya nomini yuboring: (masalan: Ichimliklar)')
-            except Exception:
-                pass
-            await query.answer(); return
 
-        if data.startswith('amenu_add_product_'):
-            cat = data.split('amenu_add_product_',1)[1]
-            # Start step-by-step product creation: ask for name first
-            ud['amenu_add_product_step'] = 'name'
-            ud['amenu_add_product_cat'] = cat
-            # record the prompt message so we can delete/edit it later
-            try:
-                # store the message we will edit (query.message) as last prompt
-                ud['amenu_last_prompt'] = {'chat_id': query.message.chat_id, 'message_id': query.message.message_id}
-                await query.edit_message_text("Iltimos, mahsulot nomini yuboring:")
-            except Exception:
-                pass
-            await query.answer(); return
+broadcast_bucket = TokenBucket(BROADCAST_RATE)
 
-        if data.startswith('amenu_edit_price_'):
-            rest = data.split('amenu_edit_price_',1)[1]
-            if '|' not in rest:
-                await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
-            cat, prod = rest.split('|',1)
-            ud['amenu_edit_price'] = (cat, prod)
-            try:
-                ud['amenu_last_prompt'] = {'chat_id': query.message.chat_id, 'message_id': query.message.message_id}
-                await query.edit_message_text('Yangi narxni yuboring (son bilan, faqat raqam):')
-            except Exception:
-                pass
-            await query.answer(); return
+BROADCAST_SEGMENTS = {
+    'all': "👥 Hammaga",
+    'recent': f"🛍 Oxirgi {BROADCAST_RECENT_DAYS} kunda buyurtma berganlar",
+    'couriers': "🚚 Faqat kuryerlar",
+}
+_MEDIA_KINDS = ('photo', 'video', 'animation', 'document', 'audio', 'voice')
+_ALBUM_MEDIA = {'photo': InputMediaPhoto, 'video': InputMediaVideo, 'document': InputMediaDocument, 'audio': InputMediaAudio}
 
-        if data.startswith('amenu_edit_desc_'):
-            rest = data.split('amenu_edit_desc_',1)[1]
-            if '|' not in rest:
-                await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
-            cat, prod = rest.split('|',1)
-            ud['amenu_edit_desc'] = (cat, prod)
-            try:
-                ud['amenu_last_prompt'] = {'chat_id': query.message.chat_id, 'message_id': query.message.message_id}
-                await query.edit_message_text('Yangi tavsif matnini yuboring:')
-            except Exception:
-                pass
-            await query.answer(); return
 
-        if data.startswith('amenu_edit_photo_'):
-            rest = data.split('amenu_edit_photo_',1)[1]
-            if '|' not in rest:
-                await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
-            cat, prod = rest.split('|',1)
-            # set state so text_handler (photo) will handle next photo message
-            ud['amenu_edit_photo'] = (cat, prod)
-            try:
-                ud['amenu_last_prompt'] = {'chat_id': query.message.chat_id, 'message_id': query.message.message_id}
-                await query.edit_message_text('Iltimos, yangi rasmini yuboring (rasm yuboring):')
-            except Exception:
-                try:
-                    # fallback: send prompt
-                    sent = await context.bot.send_message(chat_id=uid, text='Iltimos, yangi rasmini yuboring (rasm yuboring):')
-                    ud['amenu_last_prompt'] = {'chat_id': sent.chat_id, 'message_id': sent.message_id}
-                except Exception:
-                    pass
-            await query.answer(); return
+def broadcast_segment_kb() -> InlineKeyboardMarkup:
+    rows = [[InlineKeyboardButton(label, callback_data=f"bc_seg_{key}")] for key, label in BROADCAST_SEGMENTS.items()]
+    rows.append([InlineKeyboardButton("◀️ Orqaga", callback_data="admin_panel")])
+    return InlineKeyboardMarkup(rows)
 
-        if data.startswith('amark_cat_'):
-            # pick category -> show all products (including unavailable) with status
-            cat = data.split('_', 2)[2]
-            rows = []
-            for name, info in menu_data.get(cat, {}).items():
-                status = "(Tugadi)" if not info.get('available', True) else "(Bor)"
-                rows.append([InlineKeyboardButton(f"{name} {status}", callback_data=f"amark_prod_{cat}|{name}")])
-            rows.append([InlineKeyboardButton('◀️ Orqaga', callback_data='admin_mark_product'), InlineKeyboardButton('🔙 Admin panel', callback_data='admin_panel')])
-            try:
-                await query.edit_message_text(f"{cat} — mahsulotlarni tanlang:", reply_markup=InlineKeyboardMarkup(rows))
-            except Exception:
-                pass
-            await query.answer(); return
 
-        if data.startswith('amark_prod_'):
-            # show product with buttons to mark available/unavailable
-            rest = data.split('amark_prod_',1)[1]
-            if '|' not in rest:
-                await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
-            cat, prod = rest.split('|',1)
-            if cat not in menu_data or prod not in menu_data[cat]:
-                await query.answer('Mahsulot topilmadi', show_alert=True); return
-            info = menu_data[cat][prod]
-            current_status = "Bor" if info.get('available', True) else "Tugadi"
-            kb = InlineKeyboardMarkup([
-                [InlineKeyboardButton('✅ Bor', callback_data=f'amark_set_{cat}|{prod}_available'), InlineKeyboardButton('❌ Tugadi', callback_data=f'amark_set_{cat}|{prod}_unavailable')],
-                [InlineKeyboardButton('◀️ Orqaga', callback_data=f'amark_cat_{cat}')]
-            ])
-            try:
-                await query.edit_message_text(f"{prod}\n\nJoriy holat: {current_status}\n\nMahsulotni bor yoki tugadi deb belgilang:", reply_markup=kb)
-            except Exception:
-                pass
-            await query.answer(); return
+def broadcast_audience(segment: str, exclude: Optional[int] = None) -> list[int]:
+    """Recipients of a segment, read from the in-memory sets (no scan over orders)."""
+    if segment == 'couriers':
+        ids = set(couriers)
+    elif segment == 'recent':
+        ids = set(orders.customers_since(time.time() - BROADCAST_RECENT_DAYS * 86400))
+    else:
+        ids = set(users)
+    ids.discard(exclude)
+    return sorted(ids)
+
+
+def broadcast_payload(message) -> dict:
+    """Describe an admin message by its file_ids/text so it can be re-sent without
+    forwarding (no "forwarded from" header, independent of the original message)."""
+    for kind in _MEDIA_KINDS:
+        media = getattr(message, kind, None)
+        if media:
+            file_id = media[-1].file_id if kind == 'photo' else media.file_id
+            return {'type': kind, 'file_id': file_id, 'caption': message.caption_html if message.caption else None}
+    if message.text:
+        return {'type': 'text', 'text': message.text_html}
+    # stickers, polls, contacts, ... are copied as-is
+    return {'type': 'copy', 'from_chat_id': message.chat_id, 'message_id': message.message_id}
+
+
+async def send_broadcast_payload(bot, chat_id: int, payload: dict, **extra):
+    kind = payload.get('type')
+    if kind == 'text':
+        return await bot.send_message(chat_id=chat_id, text=payload['text'], parse_mode='HTML', **extra)
+    if kind == 'album':
+        media = [
+            _ALBUM_MEDIA[item['type']](media=item['file_id'], caption=item.get('caption'), parse_mode='HTML' if item.get('caption') else None)
+            for item in payload['items']
+        ]
+        return await bot.send_media_group(chat_id=chat_id, media=media, **extra)
+    if kind in _MEDIA_KINDS:
+        send = getattr(bot, f"send_{kind}")
+        return await send(chat_id, payload['file_id'], caption=payload.get('caption'), parse_mode='HTML' if payload.get('caption') else None, **extra)
+    return await bot.copy_message(chat_id=chat_id, from_chat_id=payload['from_chat_id'], message_id=payload['message_id'], **extra)
+
+
+class BroadcastJob:
+    """Background send of one admin message (or album) to a list of chats.
+
+    Targets are sent in batches of concurrent requests under `broadcast_bucket`;
+    after each batch the cursor is advanced and, every BROADCAST_PROGRESS_INTERVAL
+    seconds, checkpointed to BROADCAST_CHECKPOINT_FILE and shown in the admin's
+    progress message. A restart resumes from the checkpoint, re-sending at most
+    one batch. Users who blocked the bot are dropped from `users`.
+    """
 
-        if data.startswith('amark_set_'):
-            rest = data.split('amark_set_',1)[1]
-            action = None
-            if rest.endswith('_available'):
-                action = 'available'; core = rest[:-len('_available')]
-            elif rest.endswith('_unavailable'):
-                action = 'unavailable'; core = rest[:-len('_unavailable')]
-            else:
-                await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
-            if '|' not in core:
-                await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
-            cat, prod = core.split('|',1)
-            if cat not in menu_data or prod not in menu_data[cat]: await query.answer('Mahsulot topilmadi', show_alert=True); return
-            menu_data[cat][prod]['available'] = (action == 'available')
-            persist_menu()
-            # Update any recent category messages we know about so users see the change immediately
-            try:
-                for (chat_id, c), msg_id in list(last_category_messages.items()):
-                    if c == cat:
-                        try:
-                            await context.bot.edit_message_text(chat_id=chat_id, message_id=msg_id, text=f"📋 {cat} menyusi:", reply_markup=product_list_kb(cat))
-                        except Exception:
-                            # ignore failures (message deleted or no permission)
-                            try:
-                                # if editing failed, remove mapping to avoid repeated failures
-                                last_category_messages.pop((chat_id, c), None)
-                            except Exception:
-                                pass
-            except Exception:
-                pass
-            # Notify admin and go back to category view
-            try:
-                state_text = '✅ Mahsulot bor qilib belgilandi.' if action == 'available' else '✅ Mahsulot tugadi deb belgilandi.'
-                await query.edit_message_text(state_text, reply_markup=admin_panel_kb())
-            except Exception:
-                pass
-            await query.answer(); return
-    # Payment callbacks (user finishing checkout)
-    if data == 'pay_cash' or data == 'pay_card':
-        is_cash = (data == 'pay_cash')
-        pending = context.user_data.get('pending_order')
-        if not pending:
-            await query.answer("Hech qanday buyurtma topilmadi.", show_alert=True); return
-
-        # If user chose card and we have a provider token, send Telegram Invoice
-        if (not is_cash) and PAYMENT_PROVIDER_TOKEN:
-            try:
-                payload = f"pay_pending_{update.effective_user.id}_{int(time.time())}"
-                prices = [LabeledPrice("Buyurtma", int(pending['total']))]
-                # store pending invoice so successful_payment handler can create order
-                context.user_data['pending_invoice'] = {'payload': payload, 'pending_order': pending}
-                await context.bot.send_invoice(
-                    chat_id=update.effective_user.id,
-                    title=f"Buyurtma — {pending.get('original_text','')[:64]}",
-                    description=(pending.get('original_text','') or 'Buyurtma to‘lovi'),
-                    payload=payload,
-                    provider_token=PAYMENT_PROVIDER_TOKEN,
-                    currency='UZS',
-                    prices=prices,
-                )
-                try:
-                    await query.edit_message_text("✅ To'lov varaqasi yuborildi. Iltimos, to'lovni tugating.")
-                    # also provide a reply keyboard with an exit button so user can easily close the flow
-                    try:
-                        exit_kb = ReplyKeyboardMarkup([[KeyboardButton('🔙 Chiqish')]], resize_keyboard=True, one_time_keyboard=True)
-                        await context.bot.send_message(chat_id=update.effective_user.id, text="Agar tugatsangiz, '🔙 Chiqish' tugmasini bosing.", reply_markup=exit_kb)
-                    except Exception:
-                        pass
-                except Exception:
-                    pass
-                return
-            except Exception as e:
-                log.warning(f"Invoice yuborishda xato: {e}")
-                # fallback to create order as unpaid card order below
+    def __init__(self, state: dict):
+        self.state = state
+        self._last_report = 0.0
+
+    @classmethod
+    def create(cls, admin_id: int, payload: dict, targets: list[int], segment: str = 'all') -> "BroadcastJob":
+        return cls({
+            'id': f"{int(time.time())}-{admin_id}",
+            'admin_id': admin_id,
+            'payload': payload,
+            'segment': segment,
+            'targets': list(targets),
+            'cursor': 0,
+            'sent': 0, 'failed': 0, 'pruned': 0,
+            'progress_msg': None,
+        })
+
+    def progress_text(self) -> str:
+        st = self.state
+        return (
+            f"📣 Xabar yuborilmoqda: {st['cursor']}/{len(st['targets'])}\n"
+            f"Muvaffaqiyatli: {st['sent']}\nXatolik: {st['failed']}\nBloklaganlar: {st['pruned']}"
+        )
 
-        # Fallback / cash flow: create order immediately (existing behavior)
-        # remove pending_order from user_data now that we will persist as an order
-        context.user_data.pop('pending_order', None)
-        order_counter += 1; order_number = order_counter
-        order = {
-            'order_number': order_number,
-            'user_id': update.effective_user.id,
-            'user_name': update.effective_user.full_name,
-            'user_username': update.effective_user.username or '',
-            'user': f"{update.effective_user.full_name} (id: {update.effective_user.id})",
-            'items': pending['items'],
-            'total': pending['total'],
-            'phone': pending['phone'],
-            'loc': pending['loc'],
-            'dt': pending['dt'],
-            'status': 'Kutilyapti',
-            'user_msg': None,
-            'admin_msgs': [],
-            'original_text': pending.get('original_text',''),
-            'payment': 'cash' if is_cash else 'card',
-            'paid': False,
-        }
-        # If cash or card (we require OTP confirmation at delivery), generate OTP
-        if True:
-            otp = generate_otp()
-            order['otp'] = otp
-        orders.append(order)
+    async def checkpoint(self):
+        await asyncio.to_thread(save_json, BROADCAST_CHECKPOINT_FILE, dict(self.state))
 
-        cancel_kb = InlineKeyboardMarkup([[InlineKeyboardButton(f"❌ Bekor qilish #{order_number}", callback_data=f"cancel_order_{order_number}")]])
-        sent = await query.message.reply_text(f"✅ Buyurtmangiz #{order_number} qabul qilindi!\n\n{order.get('original_text')}\n\n⏳ Bekor qilish uchun 30 soniyangiz bor.", reply_markup=cancel_kb)
-        order['user_msg'] = {'chat_id': sent.chat_id, 'message_id': sent.message_id}
+    async def _report(self, bot):
+        pm = self.state.get('progress_msg')
+        if not pm:
+            return
         try:
-            await query.edit_message_text("Buyurtma qabul qilindi. Kanalga e'lon qilish 30s ichida amalga oshiriladi.")
+            await bot.edit_message_text(chat_id=pm['chat_id'], message_id=pm['message_id'], text=self.progress_text())
+        except RetryAfter as e:
+            broadcast_bucket.pause(retry_after_seconds(e))
         except Exception:
             pass
 
-        persist_orders()
-        t = asyncio.create_task(handle_order_expiry(order_number, context.bot))
-        expiry_tasks[order_number] = t
+    async def _send_one(self, bot, chat_id: int) -> str:
+        st = self.state
+        # checkpoints written before payloads existed carry the source message only
+        payload = st.get('payload') or {'type': 'copy', 'from_chat_id': st['from_chat_id'], 'message_id': st['message_id']}
+        for attempt in range(3):
+            await broadcast_bucket.acquire()
+            try:
+                await send_broadcast_payload(bot, chat_id, payload, rate_limit_args={'max_retries': 0})
+                return 'sent'
+            except RetryAfter as e:
+                broadcast_bucket.pause(retry_after_seconds(e))
+            except Forbidden:
+                return 'pruned'
+            except BadRequest as e:
+                if 'chat not found' in str(e).lower():
+                    return 'pruned'
+                log.warning(f"Broadcastda xato ({chat_id}): {e}")
+                return 'failed'
+            except Exception as e:
+                log.warning(f"Broadcastda xato ({chat_id}, urinish {attempt + 1}): {e}")
+                await asyncio.sleep(2 ** attempt)
+        return 'failed'
 
-        # Send OTP to user (for both cash and card flows we generate OTP)
-        try:
-            exit_kb = ReplyKeyboardMarkup([[KeyboardButton('🔙 Chiqish')]], resize_keyboard=True, one_time_keyboard=True)
-            await context.bot.send_message(chat_id=order['user_id'], text=f"Sizning buyurtmangiz uchun tasdiq kodi (OTP): {order['otp']}. Ushbu kodni yetkazib beruvchiga yetkazilganda berishingiz kerak.", reply_markup=exit_kb)
-        except Exception as e:
-            log.warning(f"OTP yuborishda xato: {e}")
-        return
+    async def run(self, bot):
+        st = self.state
+        sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
 
-    # --- Super-admin inline tahrir callbacklari ---
-    if data.startswith('sa_inc_') or data.startswith('sa_dec_') or data.startswith('sa_add_') or data.startswith('sa_done_') or data.startswith('sa_canceledit_'):
-        if uid not in admins:
-            await query.answer('Sizda ruxsat yo\'q', show_alert=True); return
-
-        parts = data.split('_')
-        # format: sa_inc_<order>_<idx>
-        action = parts[1] if len(parts) > 1 else ''
-        if action in ('inc', 'dec'):
-            try:
-                order_num = int(parts[2]); idx = int(parts[3])
-            except Exception:
-                await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
-            order = find_order(order_num)
-            if not order: await query.answer('Buyurtma topilmadi', show_alert=True); return
-            items = list(order.get('items', []))
-            if idx < 0 or idx >= len(items): await query.answer('Indeks xato', show_alert=True); return
-            it = items[idx]
-            if ' x' in it:
-                name, qty_str = it.rsplit(' x', 1)
-                try: qty = int(qty_str)
-                except Exception: qty = 1
-            else:
-                name = it; qty = 1
-            if action == 'inc': qty += 1
-            else: qty = max(1, qty - 1)
-            items[idx] = f"{name} x{qty}"
-            # recompute total
-            total = 0
-            for it2 in items:
-                if ' x' in it2:
-                    nm, q = it2.rsplit(' x', 1); q = int(q)
-                else:
-                    nm = it2; q = 1
-                total += product_price(nm) * q
-            order['items'] = items
-            order['total'] = total
-            persist_orders()
-            # update superadmin message
-            sam = order.get('superadmin_msg')
-            if sam:
-                try:
-                    await context.bot.edit_message_text(chat_id=sam['chat_id'], message_id=sam['message_id'], text=build_superadmin_order_text(order), reply_markup=build_superadmin_kb(order), parse_mode='HTML')
-                except Exception:
-                    pass
-            await query.answer('Yangilandi')
-            return
-
-        if action == 'add':
-            try: order_num = int(parts[2])
-            except Exception: await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
-            # prompt admin to send product as: Name | qty
-            context.user_data['sa_adding_order'] = order_num
-            await query.answer('Iltimos, mahsulot nomi va miqdorini "Nomi | miqdor" formatida yuboring.')
-            try: await query.edit_message_text('Mahsulot qo\'shish uchun nom va miqdorni yuboring (masalan: Lavash | 1)')
-            except Exception: pass
-            return
-
-        if action == 'done':
-            try: order_num = int(parts[2])
-            except Exception: await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
-            order = find_order(order_num)
-            if not order: await query.answer('Buyurtma topilmadi', show_alert=True); return
-            # post to channel
-            order['status'] = 'Kanalda'
-            try:
-                kanal_text = f"🆕 Yangi buyurtma #{order_num}!\n\n{order.get('original_text','')}\n\n👤 {order.get('user')}\n📞 {normalize_phone(order.get('phone'))}\n📍 https://www.google.com/maps/search/?api=1&query={order.get('loc')}"
-                msg = await context.bot.send_message(chat_id=BUYURTMALAR_CHANNEL_ID, text=kanal_text, reply_markup=generate_admin_order_kb(order, show_cancel=False, show_edit=False))
-                order['admin_msgs'] = [{'admin_id': BUYURTMALAR_CHANNEL_ID, 'chat_id': msg.chat_id, 'message_id': msg.message_id, 'text': order.get('original_text','')}]
-                persist_orders()
-            except Exception as e:
-                log.warning(f"Kanalga yuborishda xato (sa_done): {e}")
-            # update superadmin message to indicate done
-            sam = order.get('superadmin_msg')
-            if sam:
-                try:
-                    await context.bot.edit_message_text(chat_id=sam['chat_id'], message_id=sam['message_id'], text=build_superadmin_order_text(order) + "\n\n✅ Kanalga yuborildi.")
-                except Exception:
-                    pass
-            await query.answer('Buyurtma kanalga yuborildi')
-            return
-
-        if action == 'canceledit':
-            try: order_num = int(parts[2])
-            except Exception: await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
-            order = find_order(order_num)
-            if not order: await query.answer('Buyurtma topilmadi', show_alert=True); return
-            sam = order.get('superadmin_msg')
-            if sam:
-                try:
-                    await context.bot.edit_message_text(chat_id=sam['chat_id'], message_id=sam['message_id'], text=build_superadmin_order_text(order) + "\n\n❌ Tahrirlash bekor qilindi.")
-                except Exception:
-                    pass
-            order.pop('superadmin_msg', None)
-            persist_orders()
-            await query.answer('Tahrirlash bekor qilindi')
-            return
-
-        # Admin-triggered item-level edit flow (opens inline editor)
-        if data.startswith('admin_edit_'):
-            try:
-                order_num = int(data.split('_')[-1])
-            except Exception:
-                await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
-            order = find_order(order_num)
-            if not order:
-                await query.answer('Buyurtma topilmadi', show_alert=True); return
-            log.info(f"admin_edit callback received for order {order_num} by admin {uid}")
-            # prepare proposed_items copy
-            order['proposed_items'] = list(order.get('items', []))
-            # compute proposed total
-            total = 0
-            for it in order['proposed_items']:
-                if ' x' in it:
-                    nm, q = it.rsplit(' x', 1); q = int(q)
-                else:
-                    nm = it; q = 1
-                total += product_price(nm) * q
-            order['proposed_total'] = total
-            order['proposed_by_admin'] = uid
-            persist_orders()
-            # send editor to admin
-            try:
-                txt = f"✏️ Buyurtma #{order_num} tahriri (admin tomonidan).\n\nJoriy mahsulotlar:\n" + "\n".join(order['proposed_items']) + f"\n\nJami: {order['proposed_total']} so'm"
-                msg = await context.bot.send_message(chat_id=uid, text=txt, reply_markup=build_admin_edit_kb(order))
-                order['admin_edit_msg'] = {'chat_id': msg.chat_id, 'message_id': msg.message_id}
-                persist_orders()
-                await query.answer('Tahrirlash oynasi ochildi')
-            except Exception as e:
-                log.warning(f"Admin edit window send failed for order {order_num}: {e}")
-                # fallback: notify admin and show alert
-                try:
-                    await context.bot.send_message(chat_id=uid, text=f"Tahrirlash oynasi ochilmadi (order #{order_num}). Iltimos /start ni bosing yoki admin panelni tekshiring.")
-                except Exception:
-                    pass
-                await query.answer('Tahrirlash oynasi ochilmadi – adminga xabar yuborildi', show_alert=True)
-            return
-        
-            # --- Admin edit (ae_) callbacks: inc/dec/add/done/cancel and pick product ---
-            if data.startswith('ae_inc_') or data.startswith('ae_dec_') or data.startswith('ae_add_') or data.startswith('ae_done_') or data.startswith('ae_cancel_') or data.startswith('ae_pick_'):
-                if uid not in admins:
-                    await query.answer('Sizda ruxsat yo\'q', show_alert=True); return
-                parts = data.split('_')
-                # inc/dec format: ae_inc_<order>_<idx>
-                if parts[1] in ('inc','dec'):
-                    try:
-                        order_num = int(parts[2]); idx = int(parts[3])
-                    except Exception:
-                        await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
-                    order = find_order(order_num)
-                    if not order or 'proposed_items' not in order:
-                        await query.answer('No edit session', show_alert=True); return
-                    items = list(order['proposed_items'])
-                    if idx < 0 or idx >= len(items): await query.answer('Indeks xato', show_alert=True); return
-                    it = items[idx]
-                    if ' x' in it:
-                        name, qty_str = it.rsplit(' x', 1)
-                        try: qty = int(qty_str)
-                        except Exception: qty = 1
-                    else:
-                        name = it; qty = 1
-                    if parts[1] == 'inc': qty += 1
-                    else: qty = max(1, qty - 1)
-                    items[idx] = f"{name} x{qty}"
-                    # recompute total
-                    total = 0
-                    for it2 in items:
-                        if ' x' in it2:
-                            nm, q = it2.rsplit(' x', 1); q = int(q)
-                        else:
-                            nm = it2; q = 1
-                        total += product_price(nm) * q
-                    order['proposed_items'] = items
-                    order['proposed_total'] = total
-                    persist_orders()
-                    # update admin edit message
-                    ae_msg = order.get('admin_edit_msg')
-                    txt = f"✏️ Buyurtma #{order_num} tahriri (admin tomonidan).\n\nJoriy mahsulotlar:\n" + "\n".join(order['proposed_items']) + f"\n\nJami: {order['proposed_total']} so'm"
-                    try:
-                        if ae_msg:
-                            await context.bot.edit_message_text(chat_id=ae_msg['chat_id'], message_id=ae_msg['message_id'], text=txt, reply_markup=build_admin_edit_kb(order))
-                        else:
-                            await query.edit_message_text(txt, reply_markup=build_admin_edit_kb(order))
-                    except Exception:
-                        pass
-                    await query.answer('Yangilandi')
-                    return
+        async def one(chat_id):
+            async with sem:
+                return chat_id, await self._send_one(bot, chat_id)
 
-                # add product -> show categories
-                if parts[1] == 'add':
-                    try: order_num = int(parts[2])
-                    except Exception: await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
-                    # build categories kb
-                    rows = [[InlineKeyboardButton(cat, callback_data=f"ae_pick_{order_num}_cat_{cat}")] for cat in menu_data.keys()]
-                    rows.append([InlineKeyboardButton('◀️ Bekor', callback_data=f'ae_cancel_{order_num}')])
-                    try:
-                        await query.edit_message_text('Kategoriya tanlang:', reply_markup=InlineKeyboardMarkup(rows))
-                    except Exception:
-                        pass
-                    await query.answer(); return
+        batch_size = BROADCAST_CONCURRENCY * 4
+        try:
+            while st['cursor'] < len(st['targets']):
+                batch = st['targets'][st['cursor']:st['cursor'] + batch_size]
+                for chat_id, result in await asyncio.gather(*(one(c) for c in batch)):
+                    st[result] += 1
+                    if result == 'pruned' and chat_id in users:
+                        users.discard(chat_id); persist_users(chat_id)
+                st['cursor'] += len(batch)
+                if time.monotonic() - self._last_report >= BROADCAST_PROGRESS_INTERVAL:
+                    self._last_report = time.monotonic()
+                    await self.checkpoint()
+                    await self._report(bot)
+        except asyncio.CancelledError:
+            await self.checkpoint()
+            raise
+        await self._report(bot)
+        try:
+            os.remove(BROADCAST_CHECKPOINT_FILE)
+        except FileNotFoundError:
+            pass
+        try:
+            await bot.send_message(
+                chat_id=st['admin_id'],
+                text=f"✅ Xabar yuborildi.\nMuvaffaqiyatli: {st['sent']}\nXatolik: {st['failed']}\nBloklaganlar: {st['pruned']}",
+                reply_markup=admin_panel_kb(),
+            )
+        except Exception:
+            pass
 
-                # pick callbacks (category -> products, or product select)
-                if parts[1] == 'pick':
-                    # format: ae_pick_<order>_cat_<cat>  OR ae_pick_<order>_prod_<cat>|<prod>
-                    try:
-                        order_num = int(parts[2])
-                    except Exception:
-                        await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
-                    sub = parts[3]
-                    order = find_order(order_num)
-                    if not order: await query.answer('Buyurtma topilmadi', show_alert=True); return
-                    if sub == 'cat':
-                        cat = '_'.join(parts[4:])
-                        # build products list
-                        rows = [[InlineKeyboardButton(f"{name} — {info['price']} so'm", callback_data=f"ae_pick_{order_num}_prod_{cat}|{name}")] for name, info in menu_data.get(cat, {}).items()]
-                        rows.append([InlineKeyboardButton('◀️ Orqaga', callback_data=f"ae_add_{order_num}")])
-                        try: await query.edit_message_text(f"{cat} menyusi:", reply_markup=InlineKeyboardMarkup(rows))
-                        except Exception: pass
-                        await query.answer(); return
-                    if sub == 'prod':
-                        rest = '_'.join(parts[4:])
-                        # rest is like <cat>|<name>
-                        if '|' not in rest:
-                            await query.answer('Noto\'g\'ri format', show_alert=True); return
-                        cat, prod = rest.split('|',1)
-                        # append product x1
-                        items = list(order.get('proposed_items', []))
-                        items.append(f"{prod} x1")
-                        total = 0
-                        for it2 in items:
-                            if ' x' in it2:
-                                nm, q = it2.rsplit(' x', 1); q = int(q)
-                            else:
-                                nm = it2; q = 1
-                            total += product_price(nm) * q
-                        order['proposed_items'] = items
-                        order['proposed_total'] = total
-                        persist_orders()
-                        ae_msg = order.get('admin_edit_msg')
-                        txt = f"✏️ Buyurtma #{order_num} tahriri (admin tomonidan).\n\nJoriy mahsulotlar:\n" + "\n".join(order['proposed_items']) + f"\n\nJami: {order['proposed_total']} so'm"
-                        try:
-                            if ae_msg:
-                                await context.bot.edit_message_text(chat_id=ae_msg['chat_id'], message_id=ae_msg['message_id'], text=txt, reply_markup=build_admin_edit_kb(order))
-                            else:
-                                await query.edit_message_text(txt, reply_markup=build_admin_edit_kb(order))
-                        except Exception:
-                            pass
-                        await query.answer('Mahsulot qo\'shildi')
-                        return
-
-                # done -> send confirmation to user
-                if parts[1] == 'done':
-                    try: order_num = int(parts[2])
-                    except Exception: await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
-                    order = find_order(order_num)
-                    if not order or 'proposed_items' not in order: await query.answer('No edit session', show_alert=True); return
-                    # send to user for confirmation
-                    user_id = order.get('user_id')
-                    confirm_txt = (
-                        f"📣 Buyurtmangiz uchun tahrir taklifi mavjud.\n\nOldingi: \n" + "\n".join(order.get('items', [])) + f"\n\nYangi: \n" + "\n".join(order['proposed_items']) + f"\n\nJami: {order['proposed_total']} so'm\n\nAgar rozisiz, 'Qabul qilaman' tugmasini bosing.")
-                    kb = InlineKeyboardMarkup([[InlineKeyboardButton('✅ Qabul qilaman', callback_data=f'ae_user_confirm_{order_num}_approve'), InlineKeyboardButton('❌ Rad etaman', callback_data=f'ae_user_confirm_{order_num}_reject')]])
-                    try:
-                        await context.bot.send_message(chat_id=user_id, text=confirm_txt, reply_markup=kb)
-                        await query.edit_message_text('✅ Taklif mijozga yuborildi. Javobni kuting.', reply_markup=admin_panel_kb())
-                        persist_orders()
-                    except Exception as e:
-                        await query.answer('Foydalanuvchiga yuborilmadi', show_alert=True); log.warning(f"Taklif yuborishda xato: {e}")
-                    return
 
-                # cancel
-                if parts[1] == 'cancel':
-                    try: order_num = int(parts[2])
-                    except Exception: await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
-                    order = find_order(order_num)
-                    if not order: await query.answer('Buyurtma topilmadi', show_alert=True); return
-                    # remove proposed fields
-                    order.pop('proposed_items', None); order.pop('proposed_total', None); order.pop('proposed_by_admin', None)
-                    ae_msg = order.get('admin_edit_msg')
-                    try:
-                        if ae_msg:
-                            await context.bot.edit_message_text(chat_id=ae_msg['chat_id'], message_id=ae_msg['message_id'], text='Tahrirlash bekor qilindi.')
-                    except Exception:
-                        pass
-                    persist_orders()
-                    await query.answer('Tahrirlash bekor qilindi')
-                    return
+active_broadcast: Optional[asyncio.Task] = None
+# media_group_id -> album being collected from the admin before the job starts
+broadcast_albums: dict[str, dict] = {}
+BROADCAST_ALBUM_WAIT = 1.5
 
-    # --- Yetkazib beruvchi (courier) funksiyalari ---
-    # Qabul qilish: faqat couriers ro'yxatidagi foydalanuvchilar qila oladi
-    if data.startswith("accept_"):
-        try: order_num = int(data.split("_")[-1])
-        except (ValueError, IndexError): await query.answer("Noto'g'ri buyruq", show_alert=True); return
 
-        order = find_order(order_num)
-        if not order: await query.answer("Buyurtma topilmadi", show_alert=True); return
-        if order.get('status') != 'Kanalda': await query.answer("Bu buyurtma qabul qilish uchun mavjud emas.", show_alert=True); return
+def start_broadcast(job: BroadcastJob, bot) -> asyncio.Task:
+    global active_broadcast
+    active_broadcast = asyncio.create_task(job.run(bot))
+    return active_broadcast
 
-        if uid not in couriers:
-            await query.answer("Siz yetkazib beruvchi emassiz.", show_alert=True); return
 
-        # Belgilash: kuryer buyurtmani qabul qilganda status "Qabul qilingan" ga o'zgaradi
-        order['status'] = "Qabul qilingan"
-        # delete the user's confirmation message to avoid chat clutter
+async def launch_broadcast(message, bot, admin_id: int, payload: dict, segment: str):
+    """Create the job for a segment, post the progress message and start sending."""
+    if active_broadcast and not active_broadcast.done():
         try:
-            if order.get('user_msg'):
-                um = order.pop('user_msg', None)
-                if um:
-                    try:
-                        await context.bot.delete_message(chat_id=um['chat_id'], message_id=um['message_id'])
-                    except Exception:
-                        pass
+            await message.reply_text("⏳ Oldingi xabar hali yuborilmoqda, tugashini kuting.", reply_markup=admin_panel_kb())
         except Exception:
             pass
-        order['courier_id'] = uid
-        order['courier_name'] = update.effective_user.full_name
-        persist_orders()
+        return
+    if segment not in BROADCAST_SEGMENTS:
+        segment = 'all'
+    job = BroadcastJob.create(admin_id, payload, broadcast_audience(segment, exclude=admin_id), segment)
+    try:
+        pm = await message.reply_text(job.progress_text())
+        job.state['progress_msg'] = {'chat_id': pm.chat_id, 'message_id': pm.message_id}
+    except Exception:
+        pass
+    await job.checkpoint()
+    # sending runs in the background so the admin's session stays responsive
+    start_broadcast(job, bot)
 
-        # Kanaldagi xabarni o'chirish (agar mavjud bo'lsa)
-        for am in list(order.get('admin_msgs', [])):
-            try:
-                if am.get('chat_id') == BUYURTMALAR_CHANNEL_ID:
-                    # avvalo o'chirishga harakat qilamiz
-                    try:
-                        await context.bot.delete_message(chat_id=am['chat_id'], message_id=am['message_id'])
-                        # Qabul qilindi deb yangi xabar yuborish
-                        await context.bot.send_message(chat_id=BUYURTMALAR_CHANNEL_ID, text=f"✅ Buyurtma #{order_num} qabul qilindi yetkazib beruvchi: {update.effective_user.full_name}")
-                    except Exception as e:
-                        # Agar o'chira olmasak (bot kanal admin emas yoki ruxsat yo'q), xabarni tahrirlab 'qabul qilindi' deb belgilaymiz
-                        log.warning(f"Kanal xabarini o'chirish muvaffaqiyatsiz ({am.get('chat_id')}:{am.get('message_id')}): {e}")
-                        try:
-                            await context.bot.edit_message_text(chat_id=am['chat_id'], message_id=am['message_id'], text=f"✅ Buyurtma #{order_num} qabul qilindi yetkazib beruvchi: {update.effective_user.full_name}")
-                        except Exception as e2:
-                            log.warning(f"Kanal xabarini tahrirlashda xato: {e2}")
-            except Exception:
-                # umumiy himoya: agar admin_msgs ichida noo'rin format bo'lsa davom etamiz
-                continue
-        # Tozalash va faqat courier uchun yuborish (telefon link bilan)
-        # Prefer explicit user fields if present, otherwise fall back to order['user'] string
-        u_name = order.get('user_name') or order.get('user') or 'Noma\'lum'
-        u_username = order.get('user_username') or ''
-        username_display = f"@{u_username}" if u_username else '—'
-        order_phone = order.get('phone') or ''
-        profile_phone = users_info.get(order.get('user_id'), {}).get('phone') if order.get('user_id') in users_info else None
-        # Build phone lines: show both order phone and profile phone if both exist and differ
-        phone_lines = []
-        if order_phone:
-            phone_lines.append(f"Buyurtma telefoni: {phone_html_link(order_phone)}")
-        if profile_phone and profile_phone != order_phone:
-            phone_lines.append(f"Profil telefoni: {phone_html_link(profile_phone)}")
-        if not phone_lines:
-            phone_lines_text = "Tel: Noma'lum"
-        else:
-            phone_lines_text = "\n".join(phone_lines)
-        courier_text = (
-            f"🚚 Siz #{order_num} buyurtmani qabul qildingiz.\n\n"
-            f"{html.escape(order.get('original_text',''))}\n\n"
-            f"Ism: {html.escape(u_name)}\n"
-            f"Username: {html.escape(username_display)}\n"
-            f"{phone_lines_text}\n"
-            f"Manzil: https://www.google.com/maps/search/?api=1&query={html.escape(order.get('loc'))}"
-        )
-        # include payment type info for courier so they know how to collect/verify payment
-        try:
-            pay_type = order.get('payment', '—')
-            paid_flag = " (to'lov onlayn amalga oshirilgan)" if order.get('paid') else ''
-            courier_text = courier_text + f"\n\nTo'lov turi: {pay_type}{paid_flag}\n"
-            if pay_type == 'card':
-                courier_text = courier_text + "\n⚠️ Mijoz onlayn to'lovni tanlagan. Yetkazib berishda mijozdan to'lov kvitansiyasini (screenshot yoki bank ilovasidagi chek) so'rang va shu chatga rasm sifatida yuboring. Cheksiz yetkazilgan deb belgilash mumkin emas.\n"
-        except Exception:
-            pass
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton('✅ Yetkazildi', callback_data=f'delivered_{order_num}'), InlineKeyboardButton('🔄 Qaytarish', callback_data=f'return_{order_num}')]])
-        try:
-            msg = await context.bot.send_message(chat_id=uid, text=courier_text, reply_markup=kb, parse_mode="HTML")
-            order['courier_msg'] = {'chat_id': msg.chat_id, 'message_id': msg.message_id}
-        except Exception as e: log.warning(f"Yetkazib beruvchiga buyurtma yuborishda xato: {e}")
-        persist_orders()
-        # Report accept action to super-admin channel
-        try:
-            sa_text = (
-                f"[QABUL QILINDI] {datetime.now(timezone.utc).isoformat()}\n"
-                f"Yetkazib beruvchi: {uid} ({update.effective_user.full_name})\n"
-                f"Qabul qilingan buyurtma: #{order_num}\n"
-                f"Mijoz: {order.get('user')} (id: {order.get('user_id')})\n"
-                f"Telefon: {phone_html_link(order.get('phone'))}\n"
-                f"Jami: {order.get('total')} so'm\n"
-                f"Mahsulotlar: {', '.join(order.get('items', []))}\n"
-                f"Manzil: https://www.google.com/maps/search/?api=1&query={order.get('loc')}"
-            )
-            await report_superadmin(context.bot, sa_text)
-        except Exception as e:
-            log.warning(f"Superadminga accept hisobotini yuborishda xato: {e}")
 
-        await query.answer('Buyurtma sizga biriktirildi.')
-        return
+async def collect_broadcast_album(message, bot, admin_id: int, segment: str):
+    """Album parts arrive as separate updates; gather them until BROADCAST_ALBUM_WAIT
+    passes without a new part, then broadcast them as one send_media_group."""
+    album = broadcast_albums.setdefault(message.media_group_id, {'admin_id': admin_id, 'segment': segment, 'items': [], 'task': None})
+    item = broadcast_payload(message)
+    if item.get('type') in _ALBUM_MEDIA:
+        album['items'].append({'type': item['type'], 'file_id': item['file_id'], 'caption': item.get('caption')})
+    if album['task']:
+        album['task'].cancel()
 
-    if data.startswith('delivered_'):
-        try: order_num = int(data.split('_')[-1])
-        except (ValueError, IndexError): await query.answer("Noto'g'ri buyruq", show_alert=True); return
-        order = find_order(order_num)
-        if not order: await query.answer('Buyurtma topilmadi', show_alert=True); return
-        if order.get('courier_id') != uid: await query.answer('Bu buyurtma sizga tegishli emas', show_alert=True); return
-        # If payment was cash, require OTP confirmation from courier before finalizing
-        if order.get('payment') == 'cash':
-            context.user_data['expecting_otp_for'] = order_num
-            await context.bot.send_message(chat_id=uid, text=f"Iltimos, mijozdan olgan OTP kodini kiriting (Buyurtma #{order_num}).")
-            await query.answer('OTP kodini kiriting...')
-            return
-        # If payment was card, first require OTP confirmation, then ask for receipt photo
-        if order.get('payment') == 'card':
-            context.user_data['expecting_otp_for'] = order_num
-            try:
-                await context.bot.send_message(chat_id=uid, text=f"⚠️ Mijoz onlayn to'lovni tanlagan. Avvalo mijozdan OTP kodni oling va quyidagi ko'rsatmaga asosan tasdiqlang. OTP tasdiqlangandan so'ng sizdan chek rasmini yuborishingiz so'raladi.")
-            except Exception:
-                pass
-            await query.answer('OTP kodini kiriting...')
-            return
+    async def _finish():
+        await asyncio.sleep(BROADCAST_ALBUM_WAIT)
+        broadcast_albums.pop(message.media_group_id, None)
+        await launch_broadcast(message, bot, album['admin_id'], {'type': 'album', 'items': album['items']}, album['segment'])
 
-        # other non-cash (no verification required): finalize immediately
-        order['status'] = 'Yetkazib berildi'
-        persist_orders()
-        # notify user
-        try: await context.bot.send_message(chat_id=order['user_id'], text=f"✅ Sizning #{order_num} buyurtmangiz yetkazib berildi.")
-        except Exception as e: log.warning(f"Foydalanuvchiga yetkazildi xabarida xato: {e}")
-        # edit courier message
-        try: await context.bot.edit_message_text(chat_id=order['courier_msg']['chat_id'], message_id=order['courier_msg']['message_id'], text="✅ Yetkazildi")
-        except Exception: pass
-        # Report delivered action to super-admin
-        try:
-            sa_text = (
-                f"[YETKAZILDI] {datetime.now(timezone.utc).isoformat()}\n"
-                f"Yetkazib beruvchi: {uid} ({update.effective_user.full_name})\n"
-                f"Yetkazilgan buyurtma: #{order_num}\n"
-                f"Mijoz: {order.get('user')} (id: {order.get('user_id')})\n"
-                f"Telefon: {phone_html_link(order.get('phone'))}\n"
-                f"Jami: {order.get('total')} so'm\n"
-                f"Mahsulotlar: {', '.join(order.get('items', []))}"
-            )
-            await report_superadmin(context.bot, sa_text)
-        except Exception as e:
-            log.warning(f"Superadminga delivered hisobotini yuborishda xato: {e}")
-        await query.answer('Buyurtma yetkazildi sifatida belgilandi.')
-        return
+    album['task'] = asyncio.create_task(_finish())
 
-    if data.startswith('return_'):
-        try: order_num = int(data.split('_')[-1])
-        except (ValueError, IndexError): await query.answer("Noto'g'ri buyruq", show_alert=True); return
-        order = find_order(order_num)
-        if not order: await query.answer('Buyurtma topilmadi', show_alert=True); return
-        if order.get('courier_id') != uid: await query.answer('Bu buyurtma sizga tegishli emas', show_alert=True); return
-        # qaytarish: kuryer buyurtmani qaytarsa, uning statusi kanalga e'lon qilingan ('Kanalda') ga qaytadi
-        # va buyurtma qaytarilganligi belgilanadi — qaytarilganlar soni oshiriladi
-        order['status'] = 'Kanalda'
-        # increase returned counter and store last return info
-        order['returned_count'] = order.get('returned_count', 0) + 1
-        order['last_returned_by'] = uid
-        order['last_returned_at'] = datetime.now(timezone.utc).isoformat()
-        # remove courier assignment
-        order.pop('courier_id', None); order.pop('courier_name', None)
-        # repost to channel
-        # mark returned status visibly in channel post to avoid double-prep
-        returned_note = ""
-        if order.get('returned_count', 0) > 0:
-            returned_note = f"\n⚠️ DIQQAT: Bu buyurtma {order.get('returned_count')} marta qaytarilgan. So'nggi qaytarish: {order.get('last_returned_at')}\nYetkazib beruvchi ID: {order.get('last_returned_by')}"
-        kanal_text = (
-            f"🆕 Yangi buyurtma #{order_num}!\n\n{order.get('original_text','')}\n\n"
-            f"👤 Mijoz: {order.get('user')}\n📞 {normalize_phone(order.get('phone'))}\n"
-            f"📍 https://www.google.com/maps/search/?api=1&query={order.get('loc')}"
-            f"{returned_note}"
-        )
-        try:
-            msg = await context.bot.send_message(chat_id=BUYURTMALAR_CHANNEL_ID, text=kanal_text, reply_markup=generate_admin_order_kb(order, show_cancel=False))
-            order['admin_msgs'] = [{'admin_id': BUYURTMALAR_CHANNEL_ID, 'chat_id': msg.chat_id, 'message_id': msg.message_id, 'text': order.get('original_text','')}]
-        except Exception as e: log.warning(f"Kanalga qaytarishda xato: {e}")
-        # remove courier message
-        try: await context.bot.delete_message(chat_id=order['courier_msg']['chat_id'], message_id=order['courier_msg']['message_id'])
-        except Exception: pass
-        order.pop('courier_msg', None)
-        persist_orders()
-        # Report return action to super-admin
-        try:
-            sa_text = (
-                f"[QAYTARILDI] {datetime.now(timezone.utc).isoformat()}\n"
-                f"Yetkazib beruvchi: {uid} ({update.effective_user.full_name})\n"
-                f"Buyurtma kanalga qaytarildi: #{order_num}\n"
-                f"Mijoz: {order.get('user')} (id: {order.get('user_id')})\n"
-                f"Telefon: {phone_html_link(order.get('phone'))}\n"
-                f"Jami: {order.get('total')} so'm\n"
-                f"Mahsulotlar: {', '.join(order.get('items', []))}\n"
-                f"Manzil: https://www.google.com/maps/search/?api=1&query={order.get('loc')}"
-            )
-            await report_superadmin(context.bot, sa_text)
-        except Exception as e:
-            log.warning(f"Superadminga return hisobotini yuborishda xato: {e}")
-        await query.answer('Buyurtma kanalga qaytarildi.')
-        return
 
-    # FOYDALANUVCHI FUNKSIONALI (o'zgarishsiz)
-    # --- Qayta buyurtma (reorder) ---
-    if data.startswith('reorder_'):
-        try:
-            order_num = int(data.split('_')[-1])
-        except Exception:
-            await query.answer("Noto'g'ri buyruq", show_alert=True); return
-        order = find_order(order_num)
-        if not order:
-            await query.answer('Buyurtma topilmadi', show_alert=True); return
-        # ensure only the original user can reorder their own order
-        if uid != order.get('user_id'):
-            await query.answer('Bu buyurtma sizga tegishli emas', show_alert=True); return
-        # build cart from previous order items (items are like 'Name xN')
-        new_cart = {}
-        for it in order.get('items', []):
-            if ' x' in it:
-                name, qty_s = it.rsplit(' x', 1)
-                try: qty = int(qty_s)
-                except Exception: qty = 1
-            else:
-                name = it; qty = 1
-            new_cart[name] = new_cart.get(name, 0) + qty
-        ud = context.user_data
-        ud['cart'] = new_cart
-        # start checkout: ask for phone (same as the normal checkout flow)
-        ud['checkout_state'] = 'ask_phone'
-        prompt = "Iltimos, bog'lanish mumkin bo'lgan raqamni kiriting (masalan: +998901234567):"
-        try:
-            sent = await context.bot.send_message(chat_id=uid, text=prompt)
-            ud['last_prompt_msg'] = {'chat_id': sent.chat_id, 'message_id': sent.message_id}
-        except Exception:
+# ========== HANDLERLAR ==========
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Old messages are collected during the reset and deleted in the background
+    # only after the new panel/greeting has been sent.
+    with message_cleaner.deferred():
+        await send_start_panel(update, context)
+
+
+async def send_start_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Start handler: ensure admins see only the admin panel (no extra greetings/messages)
+    user = update.effective_user; user_id = user.id; first_name = user.first_name or "Foydalanuvchi"
+    if user_id not in users:
+        users.add(user_id); persist_users(user_id)
+    ud = context.user_data
+    # Determine role early for correct cleanup ordering
+    is_admin = user_id in admins
+    # Best-effort: delete any prior bot messages/prompts for a clean start
+    try:
+        # For admins, clear admin prompts first (before wiping user_data)
+        if is_admin:
             try:
-                await query.message.reply_text(prompt)
+                await clear_admin_session(user_id, context, ud)
             except Exception:
                 pass
+        # Clear user session messages (menus, history, prompts)
         try:
-            await query.answer('✅ Savat yangilandi — to‘lov uchun telefon kiriting')
+            await clear_user_session(user_id, context, ud)
         except Exception:
             pass
-        return
-    if data.startswith("cat_"):
-        cat = data.split("_", 1)[1]
+        # Delete ANY bot-sent messages recorded for this chat (photos, texts, keyboards, etc.)
         try:
-            await query.edit_message_text(f"📋 {cat} menyusi:", reply_markup=product_list_kb(cat))
-            # remember last category view for this chat so we can update it when availability changes
-            try:
-                last_category_messages[(query.message.chat_id, cat)] = query.message.message_id
-            except Exception:
-                # if we can't access message fields, ignore
-                pass
+            await _delete_all_bot_messages_for_chat(context, user_id)
         except Exception:
             pass
-    elif data == "back_categories":
+        # Also delete any cached category-view messages for this chat
         try:
-            await query.edit_message_text("Kategoriya tanlang:", reply_markup=category_menu_kb())
-        except BadRequest as e:
-            # This can happen if the current message has no editable text (e.g. a photo message).
-            # Fall back: send a new message with the category keyboard and try to delete the old message.
-            try:
-                await context.bot.send_message(chat_id=query.message.chat_id, text="Kategoriya tanlang:", reply_markup=category_menu_kb())
-                try:
-                    await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
-                except Exception:
-                    pass
-            except Exception:
-                # last-resort: ignore
-                pass
-    elif data.startswith("prod_"):
-        _, rest = data.split("_", 1); cat, prod = rest.split("|")
-        ud.update({"current_cat": cat, "current_prod": prod, "current_qty": 1})
-        info = menu_data[cat][prod]
-        text = f"🍽 {prod}\n\n💰 Narxi: {info.get('price',0)} so‘m\n\n{info.get('desc','')}"
-        # If product has a photo saved (file_id), send photo view; otherwise edit text
-        photo = info.get('photo')
-        if photo:
-            try:
-                # send photo message with caption + keyboard, then delete the previous message
-                sent = await context.bot.send_photo(chat_id=query.message.chat_id, photo=photo, caption=text, reply_markup=quantity_kb(cat, prod, 1))
-                try:
-                    await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
-                except Exception:
-                    pass
-            except Exception:
-                # fallback to text if sending photo fails
-                try:
-                    await query.edit_message_text(text, reply_markup=quantity_kb(cat, prod, 1))
-                except Exception:
-                    pass
-        else:
-            try:
-                await query.edit_message_text(text, reply_markup=quantity_kb(cat, prod, 1))
-            except Exception:
-                pass
-    elif data.startswith("qty_"):
-        _, rest = data.split("_", 1); cat, prod, op = rest.split("|")
-        qty = ud.get("current_qty", 1); qty = max(1, qty - 1) if op == "dec" else qty + 1
-        ud["current_qty"] = qty; await query.edit_message_reply_markup(reply_markup=quantity_kb(cat, prod, qty))
-    elif data.startswith("add_"):
-        _, rest = data.split("_", 1); prod, qty_str = rest.split("|"); qty = int(qty_str)
-        cart = ud["cart"]; cart[prod] = cart.get(prod, 0) + qty
-        text, _ = cart_text_and_total(cart)
-        msg_text = f"✅ {prod} x{qty} savatga qo‘shildi.\n\n{text}"
+            stale = [key for key in last_category_messages if key[0] == user_id]
+            message_cleaner.schedule(context.bot, user_id, [last_category_messages.pop(key) for key in stale])
+        except Exception:
+            pass
+        # Optionally delete the user's /start command message to keep chat clean
+        try:
+            if update.message:
+                message_cleaner.schedule(context.bot, update.message.chat_id, [update.message.message_id])
+        except Exception:
+            pass
+    except Exception:
+        pass
+    # Now reset per-user state
+    ud.clear(); ud["cart"] = {}
+
+    # Admins: send only the admin panel and nothing else
+    if is_admin:
+        # Admin panel after cleanup
         try:
-            await query.edit_message_text(msg_text, reply_markup=cart_menu_kb(bool(cart)))
-        except BadRequest:
-            # If the current message is a media (photo) message, edit_message_text will fail.
-            # Fallback: send a new message with the cart text and delete the old message to avoid duplicates.
+            await context.bot.send_message(chat_id=user_id, text="🔑 Admin panelga xush kelibsiz!", reply_markup=admin_panel_kb())
+        except Exception as e:
+            log.warning(f"Admin panelni yuborishda xato: {e}")
+        return
+
+    # For non-admins, show user greeting/menu as before
+    try:
+        await context.bot.send_message(chat_id=user_id, text=f"Salom, {first_name}! 👋\nSizning Telegram ID raqamingiz: `{user_id}`", parse_mode="Markdown")
+    except Exception as e:
+        log.warning(f"ID xabarini yuborishda xato: {e}")
+
+    # Couriers see courier panel instead of regular user menu
+    if user_id in couriers:
+        await context.bot.send_message(chat_id=user_id, text="🚚 Yetkazib beruvchi paneli:", reply_markup=courier_panel_kb())
+        return
+
+    # Regular users: show a simple reply-keyboard with top-level actions (not categories)
+    try:
+        # If we don't have stored profile info for this user, start a short questionnaire
+        if user_id not in users_info:
+            # ask for full name first
+            ud = context.user_data
+            set_state(ud, 'profile_setup', 'name')
             try:
-                sent = await context.bot.send_message(chat_id=query.message.chat_id, text=msg_text, reply_markup=cart_menu_kb(bool(cart)))
-                try:
-                    await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
-                except Exception:
-                    pass
+                await context.bot.send_message(chat_id=user_id, text="Assalomu alaykum! Iltimos, to'liq ismingizni kiriting:")
             except Exception:
-                # if even sending fails, ignore to avoid crashing
                 pass
-    elif data == "view_cart": text, _ = cart_text_and_total(ud["cart"]); await query.edit_message_text(text, reply_markup=cart_menu_kb(bool(ud["cart"])))
-    elif data == "clear_cart": ud["cart"] = {}; await query.edit_message_text("🧹 Savat tozalandi.", reply_markup=cart_menu_kb(False))
-    elif data == "checkout":
-        if not ud.get("cart"): await query.edit_message_text("🛒 Savat bo‘sh.", reply_markup=category_menu_kb()); return
-        # Ask for phone as plain text (user types it) rather than using request_contact.
-        ud["checkout_state"] = "ask_phone"
-        prompt = "Iltimos, bog'lanish mumkin bo'lgan raqamni kiriting (masalan: +998901234567):"
-        # send phone prompt and remember its message id so we can delete it later
+            return
+
+        user_kb = ReplyKeyboardMarkup([
+            [KeyboardButton("🍔 Menyu"), KeyboardButton("Taklif va shikoyatlar")],
+            [KeyboardButton("🧾 Buyurtmalar tarixi")]
+        ], resize_keyboard=True, one_time_keyboard=False)
         try:
-            sent = await query.message.reply_text(prompt)
-            ud['last_prompt_msg'] = {'chat_id': sent.chat_id, 'message_id': sent.message_id}
-        except Exception:
+            sent_w = await context.bot.send_message(chat_id=user_id, text="🍔 Fast Food botiga xush kelibsiz! Quyidagi tugmalardan foydalaning:", reply_markup=user_kb)
+            # store welcome message id so we can delete/restore it when entering/exiting menu
             try:
-                # fallback: send directly to user
-                sent = await context.bot.send_message(chat_id=update.effective_user.id, text=prompt)
-                ud['last_prompt_msg'] = {'chat_id': sent.chat_id, 'message_id': sent.message_id}
+                ud['welcome_msg'] = {'chat_id': sent_w.chat_id, 'message_id': sent_w.message_id, 'text': "🍔 Fast Food botiga xush kelibsiz! Quyidagi tugmalardan foydalaning:"}
             except Exception:
                 pass
-        try:
-            await query.delete_message()
-        except Exception:
-            pass
+        except Exception as e:
+            log.warning(f"Foydalanuvchi uchun boshlang'ich klaviatura yuborishda xato: {e}")
+    except Exception as e:
+        log.warning(f"Foydalanuvchi uchun boshlang'ich klaviatura yuborishda xato: {e}")
 
-    # --- Kuryer uchun callbacklar (alohida funktsiyalar) ---
-    if uid in couriers:
-        if data == "courier_my_orders":
-            my_orders = [o for o in orders if o.get('courier_id') == uid]
-            if not my_orders:
-                await query.edit_message_text("🚚 Sizga biriktirilgan buyurtmangiz yo'q.")
-                return
-            for o in reversed(my_orders):
-                dt_str = datetime.fromisoformat(o.get('dt')).strftime('%Y-%m-%d %H:%M')
-                text = (
-                    f"#{o['order_number']} — {o.get('status')}\n"
-                    f"Mijoz: {o.get('user')}\n"
-                    f"Tel: {o.get('phone')}\n"
-                    f"Mahsulotlar: {', '.join(o.get('items', []))}\n"
-                    f"Jami: {o.get('total')} so'm\n"
-                    f"Manzil: https://www.google.com/maps/search/?api=1&query={o.get('loc')}\n"
-                    f"Vaqt: {dt_str}"
-                )
-                await context.bot.send_message(chat_id=uid, text=text)
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE): await update.message.reply_text("Buyruqlar:\n/start — Boshlash\n/help — Yordam")
+
+class CallbackRouter:
+    """Dispatch table for callback_data.
+
+    Routes are registered for exact strings or for prefixes. Prefixes live in a
+    character trie, so resolving `data` walks at most len(data) nodes; exact
+    matches win, then the longest registered prefix. A route may declare a role
+    ('admin', 'courier'): callers without it are ignored, as the old
+    `if uid in admins:` blocks did. Handlers get the data with the matched
+    prefix stripped as `arg`, and can be awaited (or benchmarked) on their own.
+    `order_lock` routes carry an order number at the start of `arg` and run under
+    that order's lock, so e.g. two couriers pressing "accept" are serialized.
+    """
+
+    ROLES = {
+        'admin': lambda uid: uid in admins,
+        'courier': lambda uid: uid in couriers,
+    }
+
+    def __init__(self):
+        self._exact: dict[str, tuple] = {}
+        # char -> child node; the None key holds the (handler, role) ending there
+        self._trie: dict = {}
+
+    def route(self, *exact: str, prefix=(), role: Optional[str] = None, order_lock: bool = False):
+        prefixes = (prefix,) if isinstance(prefix, str) else tuple(prefix)
+
+        def register(handler):
+            entry = (handler, role, order_lock)
+            for key in exact:
+                self._exact[key] = entry
+            for pfx in prefixes:
+                node = self._trie
+                for ch in pfx:
+                    node = node.setdefault(ch, {})
+                node[None] = entry
+            return handler
+        return register
+
+    def resolve(self, data: str):
+        """Return (handler, role, order_lock, arg) for `data`, or None if no route matches."""
+        entry = self._exact.get(data)
+        if entry is not None:
+            return entry + ('',)
+        node, best, depth = self._trie, None, 0
+        for i, ch in enumerate(data):
+            node = node.get(ch)
+            if node is None:
+                break
+            if None in node:
+                best, depth = node[None], i + 1
+        if best is None:
+            return None
+        return best + (data[depth:],)
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict):
+        found = self.resolve(data)
+        if found is None:
+            log.debug(f"Callback uchun route topilmadi: {data!r}")
             return
-    
-    # BUYURTMANI BEKOR QILISH (YANGILANGAN)
-    elif data.startswith("cancel_order_"):
-        try: order_num = int(data.split("_")[-1])
-        except (ValueError, IndexError): await query.answer("Noto'g'ri buyruq", show_alert=True); return
-
-        order_index = -1
-        for i, o in enumerate(orders):
-            if o.get("order_number") == order_num:
-                order_index = i; break
-        
-        if order_index == -1: await query.answer("Buyurtma topilmadi", show_alert=True); return
-        order = orders[order_index]
-        # Ruxsat tekshiruvi: faqat buyurtma egasi yoki admin bekor qila oladi
-        is_user_canceling = (uid == order["user_id"])
-        is_admin_canceling = (uid in admins)
-        if not (is_user_canceling or is_admin_canceling):
-            await query.answer("❌ Siz bu buyurtmani bekor qila olmaysiz.", show_alert=True)
+        handler, role, order_lock, arg = found
+        if role and not self.ROLES[role](uid):
             return
+        order_num = order_number_in(arg) if order_lock else None
+        if order_num is None:
+            await handler(update, context, query, data, uid, ud, arg)
+            return
+        async with order_locks.hold(order_num):
+            await handler(update, context, query, data, uid, ud, arg)
 
-        # Foydalanuvchi faqat "Kutilyapti" holatidagi buyurtmani bekor qilishi mumkin
-        if is_user_canceling and order['status'] != 'Kutilyapti':
-            await query.answer("⏳ Faqat 'Kutilyapti' holatidagi buyurtmani bekor qila olasiz!", show_alert=True); return
 
-        # Admin esa allaqachon yetkazilgan buyurtmani bekor qila olmaydi
-        if is_admin_canceling and order['status'] == 'Yetkazib berildi':
-            await query.answer("Bu buyurtma allaqachon yetkazilgan.", show_alert=True); return
+callback_router = CallbackRouter()
 
-        # Vazifani to'xtatish
-        t = expiry_tasks.pop(order_num, None)
-        if t: t.cancel()
 
-        # Admin xabarlarini tahrirlash/o'chirish
-        for am in order.get("admin_msgs", []):
-            try: await context.bot.edit_message_text(f"❌ Buyurtma #{order_num} bekor qilindi.", chat_id=am["chat_id"], message_id=am["message_id"])
-            except BadRequest: pass
+async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query; await query.answer(); data = query.data or ""; uid = update.effective_user.id
+    ud = context.user_data; ud.setdefault("cart", {})
+    await callback_router.dispatch(update, context, query, data, uid, ud)
 
-        # Foydalanuvchi xabarini tahrirlash
-        try: await query.edit_message_text(f"❌ Buyurtma #{order_num} bekor qilindi.")
-        except BadRequest: pass
-        
-        # Admin bekor qilsa, foydalanuvchiga xabar berish
-        if is_admin_canceling and not is_user_canceling:
-            try: await context.bot.send_message(chat_id=order["user_id"], text=f"⚠️ Sizning #{order_num} buyurtmangiz admin tomonidan bekor qilindi.")
-            except Exception as e: log.warning(f"Foydalanuvchiga bekor qilish haqida yuborishda xato: {e}")
 
-        # Report cancel action to super-admin
-        try:
-            canceller = update.effective_user
-            sa_text = (
-                f"[BEKOR QILINDI] {datetime.now(timezone.utc).isoformat()}\n"
-                f"Bekor qilgan: {canceller.id} ({canceller.full_name})\n"
-                f"Buyurtma: #{order_num}\n"
-                f"Mijoz: {order.get('user')} (id: {order.get('user_id')})\n"
-                f"Telefon: {phone_html_link(order.get('phone'))}\n"
-                f"Jami: {order.get('total')} so'm\n"
-                f"Mahsulotlar: {', '.join(order.get('items', []))}"
-            )
-            await report_superadmin(context.bot, sa_text)
-        except Exception as e:
-            log.warning(f"Superadminga cancel hisobotini yuborishda xato: {e}")
-
-        # Mark the order as canceled instead of deleting it so we keep a record.
-        # This prevents accidental loss of all orders when UI exit/cleanup flows run.
-        order['status'] = 'Bekor qilindi'
-        order['canceled_by'] = update.effective_user.id
-        order['canceled_at'] = datetime.now(timezone.utc).isoformat()
-        persist_orders()
-        return
+# ADMIN FUNKSIONALI
+@callback_router.route('admin_panel', role='admin')
+async def cb_admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    # Cleanup any transient admin prompts and states when returning to the panel
+    try:
+        await clear_admin_session(uid, context, ud)
+    except Exception:
+        pass
+    try:
+        await query.edit_message_text("🔑 Admin panelga xush kelibsiz!", reply_markup=admin_panel_kb())
+    except Exception:
+        pass
+    return
 
-    # Admin: exit from active-orders view and cleanup messages
-    if data == 'admin_orders_exit' and uid in admins:
-        # delete all messages and transient prompts for this admin's session
-        try:
-            await clear_admin_session(uid, context, ud)
-        except Exception:
-            pass
-        # Restore admin panel on the original query message
+
+# Admin reply-to-suggestion button pressed: set up reply state
+@callback_router.route(prefix='reply_sug_', role='admin')
+async def cb_reply_sug(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    # format: reply_sug_<user_id>_<channel_msg_id>
+    parts = arg.split('_')
+    try:
+        target_user = int(parts[0])
+        channel_msg_id = int(parts[1]) if len(parts) > 1 else None
+    except Exception:
+        await query.answer('Noto‘g‘ri parametrlar', show_alert=True); return
+    # set admin's user_data so their next message will be forwarded to target_user
+    set_state(ud, 'want_reply_to', {'target_user': target_user, 'channel_msg_id': channel_msg_id})
+    # prompt admin to type the reply
+    try:
+        exit_kb = ReplyKeyboardMarkup([[KeyboardButton('🔙 Chiqish')]], resize_keyboard=True, one_time_keyboard=True)
+        prompt = await context.bot.send_message(chat_id=uid, text=f"Mijoz (id: {target_user}) ga yuboriladigan javob matnini yoki media-xabarni yuboring.\n(Yuborilgach, men xabaringizni mijozga jo‘nataman.)", reply_markup=exit_kb)
+        # record prompt so we can clear it on exit
+        admin_orders_sessions[uid] = admin_orders_sessions.get(uid, []) + [{'chat_id': prompt.chat_id, 'message_id': prompt.message_id}]
+        # forward the original suggestion message from the suggestions channel into admin private chat
         try:
-            await query.edit_message_text("🔑 Admin panelga xush kelibsiz!", reply_markup=admin_panel_kb())
+            if channel_msg_id:
+                fwd = await context.bot.forward_message(chat_id=uid, from_chat_id=SUGGESTIONS_CHANNEL_ID, message_id=channel_msg_id)
+                admin_orders_sessions[uid] = admin_orders_sessions.get(uid, []) + [{'chat_id': fwd.chat_id, 'message_id': fwd.message_id}]
         except Exception:
             pass
-        await query.answer()
-        return
+    except Exception:
+        pass
+    try:
+        await query.answer('Iltimos javobni yozing...')
+    except Exception:
+        pass
+    return
 
-    # --- User confirmation for admin-proposed edit ---
-    if data.startswith('ae_user_confirm_'):
-        # format: ae_user_confirm_<order>_approve|reject
-        parts = data.split('_')
-        try: order_num = int(parts[3]); action = parts[4]
+
+@callback_router.route('admin_orders', role='admin')
+async def cb_admin_orders(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    # Faol (admin tomonidan boshqariladigan) buyurtmalar: faqat kanalga e'lon qilinganlar
+    published = orders.by_status("Kanalda")
+    if not published:
+        await query.edit_message_text("📭 Hozir kanalda e'lon qilingan buyurtmalar yo'q.", reply_markup=admin_panel_kb())
+        return
+    # Replace admin panel buttons with a reply keyboard exit button while listing orders
+    try:
+        await query.edit_message_text("📣 Kanalda e'lon qilingan buyurtmalar:")
+    except Exception:
+        pass
+    exit_kb = ReplyKeyboardMarkup([[KeyboardButton("🔙 Chiqish")]], resize_keyboard=True, one_time_keyboard=True)
+    # We'll collect all messages we send here (header, prompt and individual order messages)
+    sent_msgs = []
+    # include the edited header message (so it can be deleted later) —
+    # only record messages that were actually sent to the admin's private chat
+    try:
+        if query.message.chat_id == uid:
+            sent_msgs.append({'chat_id': query.message.chat_id, 'message_id': query.message.message_id})
+    except Exception:
+        pass
+    try:
+        prompt_msg = await context.bot.send_message(chat_id=uid, text="🔙 Chiqish tugmasini bosing:", reply_markup=exit_kb)
+        sent_msgs.append({'chat_id': prompt_msg.chat_id, 'message_id': prompt_msg.message_id})
+    except Exception:
+        pass
+    for o in reversed(published):
+        dt_str = datetime.fromisoformat(o.get("dt")).strftime('%Y-%m-%d %H:%M')
+        order_text = (
+            f"#{o['order_number']} — **{o['status'].upper()}**\n"
+            f"👤 {o['user']}\n📞 {normalize_phone(o.get('phone'))}\n"
+            f"🛒 {items_text(o.get('items', []))}\n💰 {o['total']} so‘m\n"
+            f"📍 https://www.google.com/maps/search/?api=1&query={o['loc']}\n"
+            f"🕒 {dt_str}"
+        )
+        try:
+            msg = await context.bot.send_message(chat_id=uid, text=order_text, reply_markup=generate_admin_order_kb(o, show_cancel=True, include_accept=False), parse_mode="Markdown")
+            sent_msgs.append({'chat_id': msg.chat_id, 'message_id': msg.message_id})
         except Exception:
-            await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
-        order = find_order(order_num)
-        if not order:
-            await query.answer('Buyurtma topilmadi', show_alert=True); return
-        uid = update.effective_user.id
-        if uid != order.get('user_id'):
-            await query.answer('Bu tasdiq sizga tegishli emas', show_alert=True); return
-        if action == 'approve':
-            # apply proposed
-            if 'proposed_items' not in order:
-                await query.answer('Hech qanday taklif topilmadi', show_alert=True); return
-            order['items'] = list(order['proposed_items'])
-            order['total'] = order.get('proposed_total', order.get('total', 0))
-            # cleanup
-            order.pop('proposed_items', None); order.pop('proposed_total', None)
-            prop_by = order.pop('proposed_by_admin', None)
-            persist_orders()
-            # update channel/admin msgs
-            for am in order.get('admin_msgs', []):
-                try:
-                    await context.bot.edit_message_text(chat_id=am['chat_id'], message_id=am['message_id'], text=order.get('original_text',''))
-                except Exception:
-                    pass
-            # update superadmin message
-            sam = order.get('superadmin_msg')
-            if sam:
-                try:
-                    await context.bot.edit_message_text(chat_id=sam['chat_id'], message_id=sam['message_id'], text=build_superadmin_order_text(order), reply_markup=build_superadmin_kb(order), parse_mode='HTML')
-                except Exception:
-                    pass
-            # notify admin who proposed
-            if prop_by:
-                try:
-                    await context.bot.send_message(chat_id=prop_by, text=f"✅ Mijoz buyurtma #{order_num} tahririni qabul qildi.")
-                except Exception:
-                    pass
-            await query.edit_message_text('✅ Sizning o\'zgartirishlaringiz qabul qilindi. Rahmat!')
-            return
-        else:
-            # rejected
-            order.pop('proposed_items', None); order.pop('proposed_total', None); prop_by = order.pop('proposed_by_admin', None)
-            persist_orders()
-            if prop_by:
-                try: await context.bot.send_message(chat_id=prop_by, text=f"❌ Mijoz buyurtma #{order_num} tahririni rad etdi.")
-                except Exception: pass
-            await query.edit_message_text('❌ Siz o\'zgartirishni rad qildingiz.')
-            return
+            # If sending fails, continue
+            continue
+    # store session so we can delete these messages when admin exits
+    admin_orders_sessions[uid] = sent_msgs
+    return
+
+
+# Note: 'clear all orders' function removed per admin request
+@callback_router.route(prefix='set_status_', role='admin', order_lock=True)
+async def cb_set_status(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    # format: set_status_<order>_<expected>_<new>; the expected state is the one the button was rendered from
+    try: order_num_str, expected, new_status = arg.split("_"); order_num = int(order_num_str)
+    except (ValueError, IndexError): await query.answer("Tugma eskirgan yoki noto'g'ri", show_alert=True); return
+    if (expected, new_status) not in ADMIN_STATUS_EDGES:
+        await query.answer(f"\"{new_status}\" holatini bu tugma orqali o'rnatib bo'lmaydi.", show_alert=True); return
+    order = find_order(order_num)
+    if not order: await query.answer("Buyurtma topilmadi", show_alert=True); return
+
+    fields = {'publish_job': {'created': time.time(), 'attempts': 0}} if new_status == 'Kanalda' else {}
+    if not orders.transition(order_num, expected, new_status, by=uid, **fields):
+        await query.answer(f"Holatni \"{order.get('status')}\" dan \"{new_status}\" ga o'zgartirib bo'lmaydi.", show_alert=True); return
+    persist_orders(order, critical=True)
+    if new_status == 'Kanalda':
+        expiry_scheduler.cancel(order_num)
+        publication_outbox.enqueue(order_num)
+
+    await query.edit_message_text(query.message.text + f"\n\n✅ Status \"{new_status}\" ga o'zgartirildi.", reply_markup=generate_admin_order_kb(order))
 
-# ========== XABAR HANDLERLARI ==========
-async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # ... (o'zgarishsiz)
-    uid = update.effective_user.id; text = (update.message.text or "").strip(); ud = context.user_data; ud.setdefault("cart", {})
-    # Courier receipt photo flow: if courier is expected to submit a payment receipt image
-    try:
-        if uid in couriers and ud.get('expecting_receipt_for') and update.message.photo:
-            order_num = int(ud.get('expecting_receipt_for'))
-            order = find_order(order_num)
-            if not order:
-                await update.message.reply_text('Buyurtma topilmadi.'); ud.pop('expecting_receipt_for', None); return
-            # save highest-resolution photo file_id as receipt proof
-            file_id = update.message.photo[-1].file_id
-            order['receipt_photo'] = file_id
-            # finalize delivery
-            order['status'] = 'Yetkazib berildi'
-            order['collected_amount'] = order.get('total')
-            cid = uid
-            rec = earnings.get(cid, {'total': 0, 'deliveries': []})
-            rec['total'] = rec.get('total', 0) + order.get('total', 0)
-            rec.setdefault('deliveries', []).append(order_num)
-            earnings[cid] = rec
-            persist_earnings()
-            persist_orders()
-            # notify user with friendly message
-            try:
-                await context.bot.send_message(chat_id=order['user_id'], text=f"✅ Sizning #{order_num} buyurtmangiz yetkazib berildi. Yoqimli ishtaha! 🍽️")
+    try:
+        await context.bot.send_message(chat_id=order['user_id'], text=f"🔔 Sizning #{order_num} buyurtmangizning holati \"{new_status}\" ga o'zgardi.")
+    except Exception as e:
+        log.warning(f"Foydalanuvchiga status o'zgarishi haqida yuborishda xato: {e}")
+
+    # Report to super-admin channel about status change
+    try:
+        sa_text = (
+            f"[HOLAT] {datetime.now(timezone.utc).isoformat()}\n"
+            f"Admin: {uid} ({update.effective_user.full_name})\n"
+            f"Buyurtma: #{order_num} — Holat: {new_status}\n"
+            f"Mijoz: {order.get('user')} (id: {order.get('user_id')})\n"
+            f"Telefon: {phone_html_link(order.get('phone'))}\n"
+            f"Jami: {order.get('total')} so'm\n"
+            f"Mahsulotlar: {items_text(order.get('items', []))}\n"
+            f"Manzil: https://www.google.com/maps/search/?api=1&query={order.get('loc')}"
+        )
+        await report_superadmin(context.bot, 'HOLAT', order_num, sa_text)
+    except Exception as e:
+        log.warning(f"Superadminga status hisobotini yuborishda xato: {e}")
+
+    return
+
+
+# ... (broadcast, add/remove admin o'zgarishsiz)
+@callback_router.route('admin_broadcast', role='admin')
+async def cb_admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    # pick the audience first; the message itself is asked for next
+    try:
+        await query.edit_message_text("📢 Xabar kimlarga yuborilsin?", reply_markup=broadcast_segment_kb())
+    except Exception:
+        pass
+    return
+
+
+@callback_router.route(prefix='bc_seg_', role='admin')
+async def cb_bc_seg(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    segment = arg
+    if segment not in BROADCAST_SEGMENTS:
+        segment = 'all'
+    set_state(ud, 'want_broadcast', segment)
+    # Edit the panel message and send a prompt with an exit keyboard so admin can cancel
+    try:
+        await query.edit_message_text("📢 Yuboriladigan xabarni yozing:")
+    except Exception:
+        pass
+    exit_kb = ReplyKeyboardMarkup([[KeyboardButton("🔙 Chiqish")]], resize_keyboard=True, one_time_keyboard=True)
+    try:
+        prompt_msg = await context.bot.send_message(chat_id=uid, text="📢 Yuboriladigan xabarni yozing:", reply_markup=exit_kb)
+        # store only the prompt message for cleanup
+        admin_orders_sessions[uid] = [{'chat_id': prompt_msg.chat_id, 'message_id': prompt_msg.message_id}]
+        # delete the original inline admin message to avoid duplicate text
+        try:
+            await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
+        except Exception:
+            pass
+    except Exception:
+        pass
+    return
+
+
+@callback_router.route('admin_add', role='admin')
+async def cb_admin_add(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    set_state(ud, 'want_add_admin')
+    # Prompt admin to enter new admin ID with an exit button (like broadcast flow)
+    try:
+        await query.edit_message_text("➕ Yangi admin ID raqamini kiriting:")
+    except Exception:
+        pass
+    exit_kb = ReplyKeyboardMarkup([[KeyboardButton("🔙 Chiqish")]], resize_keyboard=True, one_time_keyboard=True)
+    try:
+        prompt_msg = await context.bot.send_message(chat_id=uid, text="➕ Yangi admin ID raqamini kiriting:", reply_markup=exit_kb)
+        # store only the prompt message for cleanup on exit
+        admin_orders_sessions[uid] = [{'chat_id': prompt_msg.chat_id, 'message_id': prompt_msg.message_id}]
+        # delete the original inline admin message to avoid duplicate text
+        try:
+            await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
+        except Exception:
+            pass
+    except Exception:
+        pass
+    return
+
+
+@callback_router.route('admin_remove', role='admin')
+async def cb_admin_remove(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    set_state(ud, 'want_remove_admin')
+    try:
+        await query.edit_message_text("❌ O'chiriladigan admin ID raqamini kiriting:")
+    except Exception:
+        pass
+    exit_kb = ReplyKeyboardMarkup([[KeyboardButton("🔙 Chiqish")]], resize_keyboard=True, one_time_keyboard=True)
+    try:
+        prompt_msg = await context.bot.send_message(chat_id=uid, text="❌ O'chiriladigan admin ID raqamini kiriting:", reply_markup=exit_kb)
+        admin_orders_sessions[uid] = [{'chat_id': prompt_msg.chat_id, 'message_id': prompt_msg.message_id}]
+        try:
+            await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
+        except Exception:
+            pass
+    except Exception:
+        pass
+    return
+
+
+@callback_router.route('admin_add_courier', role='admin')
+async def cb_admin_add_courier(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    set_state(ud, 'want_add_courier')
+    try:
+        await query.edit_message_text("➕ Yetkazib beruvchi ID raqamini kiriting:")
+    except Exception:
+        pass
+    exit_kb = ReplyKeyboardMarkup([[KeyboardButton("🔙 Chiqish")]], resize_keyboard=True, one_time_keyboard=True)
+    try:
+        prompt_msg = await context.bot.send_message(chat_id=uid, text="➕ Yetkazib beruvchi ID raqamini kiriting:", reply_markup=exit_kb)
+        admin_orders_sessions[uid] = [{'chat_id': prompt_msg.chat_id, 'message_id': prompt_msg.message_id}]
+        try:
+            await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
+        except Exception:
+            pass
+    except Exception:
+        pass
+    return
+
+
+@callback_router.route('admin_remove_courier', role='admin')
+async def cb_admin_remove_courier(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    set_state(ud, 'want_remove_courier')
+    try:
+        await query.edit_message_text("❌ O'chiriladigan yetkazib beruvchi ID raqamini kiriting:")
+    except Exception:
+        pass
+    exit_kb = ReplyKeyboardMarkup([[KeyboardButton("🔙 Chiqish")]], resize_keyboard=True, one_time_keyboard=True)
+    try:
+        prompt_msg = await context.bot.send_message(chat_id=uid, text="❌ O'chiriladigan yetkazib beruvchi ID raqamini kiriting:", reply_markup=exit_kb)
+        admin_orders_sessions[uid] = [{'chat_id': prompt_msg.chat_id, 'message_id': prompt_msg.message_id}]
+        try:
+            await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
+        except Exception:
+            pass
+    except Exception:
+        pass
+    return
+
+
+# Admin: mark a product as out-of-stock / back-in-stock
+@callback_router.route('admin_mark_product', role='admin')
+async def cb_admin_mark_product(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    # show categories (admin view — includes all products and their availability)
+    rows = [[InlineKeyboardButton(cat, callback_data=f"amark_cat_{cat}")] for cat in menu_data.keys()]
+    rows.append([InlineKeyboardButton('◀️ Bekor', callback_data='admin_panel')])
+    try:
+        await query.edit_message_text('Kategoriya tanlang (mahsulotni tugadi/bor qilib belgilash):', reply_markup=InlineKeyboardMarkup(rows))
+    except Exception:
+        pass
+    await query.answer(); return
+
+
+# Admin: Menyuni tahrirlash -- open categories and product editor
+@callback_router.route('admin_edit_menu', role='admin')
+async def cb_admin_edit_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    rows = []
+    for cat in menu_data.keys():
+        rows.append([
+            InlineKeyboardButton(cat, callback_data=f"amenu_cat_{cat}"),
+            InlineKeyboardButton("🗑️", callback_data=f"amenu_delete_cat_{cat}")
+        ])
+    rows.append([InlineKeyboardButton("➕ Kategoriya qo'shish", callback_data="amenu_add_category")])
+    rows.append([InlineKeyboardButton('◀️ Bekor', callback_data='admin_panel')])
+    try:
+        await query.edit_message_text('Menyuni tahrirlash — kategoriya tanlang:', reply_markup=InlineKeyboardMarkup(rows))
+    except Exception:
+        pass
+    await query.answer(); return
+
+
+@callback_router.route(prefix='amenu_cat_', role='admin')
+async def cb_amenu_cat(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    cat = arg
+    rows = [[InlineKeyboardButton(f"{name} — {info.get('price',0)} so'm", callback_data=f"amenu_prod_{cat}|{name}")] for name, info in menu_data.get(cat, {}).items()]
+    rows.append([InlineKeyboardButton("➕ Mahsulot qo'shish", callback_data=f"amenu_add_product_{cat}")])
+    rows.append([InlineKeyboardButton('◀️ Orqaga', callback_data='admin_edit_menu'), InlineKeyboardButton('🔙 Admin panel', callback_data='admin_panel')])
+    try:
+        await query.edit_message_text(f"{cat} — mahsulotlarni tanlang:", reply_markup=InlineKeyboardMarkup(rows))
+    except Exception:
+        pass
+    await query.answer(); return
+
+
+@callback_router.route(prefix='amenu_prod_', role='admin')
+async def cb_amenu_prod(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    rest = arg
+    if '|' not in rest:
+        await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
+    cat, prod = rest.split('|', 1)
+    info = menu_data.get(cat, {}).get(prod)
+    if not info:
+        await query.answer('Mahsulot topilmadi', show_alert=True); return
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("✏️ Narxni tahrirlash", callback_data=f"amenu_edit_price_{cat}|{prod}"), InlineKeyboardButton("✏️ Tavsifni tahrirlash", callback_data=f"amenu_edit_desc_{cat}|{prod}")],
+        [InlineKeyboardButton("🖼️ Rasmni tahrirlash", callback_data=f"amenu_edit_photo_{cat}|{prod}" )],
+        [InlineKeyboardButton("🗑️ O'chirish", callback_data=f"amenu_delete_{cat}|{prod}"), InlineKeyboardButton('◀️ Orqaga', callback_data=f'amenu_cat_{cat}')]
+    ])
+    text = f"{prod}\n\nNarx: {info.get('price',0)} so'm\n\n{info.get('desc','')}"
+    try:
+        await query.edit_message_text(text, reply_markup=kb)
+    except Exception:
+        pass
+    await query.answer(); return
+
+
+@callback_router.route(prefix='amenu_delete_', role='admin')
+async def cb_amenu_delete(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    rest = arg
+    if '|' not in rest:
+        await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
+    cat, prod = rest.split('|',1)
+    if cat in menu_data and prod in menu_data[cat]:
+        try:
+            del menu_data[cat][prod]
+            persist_menu()
+        except Exception:
+            pass
+        try:
+            refresh_category_views(context, cat)
+        except Exception:
+            pass
+        try:
+            await query.edit_message_text(f"✅ '{prod}' o'chirildi.", reply_markup=admin_panel_kb())
+        except Exception:
+            pass
+        await query.answer(); return
+    else:
+        await query.answer('Mahsulot topilmadi', show_alert=True); return
+
+
+@callback_router.route(prefix='amenu_delete_cat_', role='admin')
+async def cb_amenu_delete_cat(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    # Show confirmation prompt before deleting a category
+    cat_to_delete = arg
+    kb = InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("✅ Ha, o'chirish", callback_data=f"amenu_confirm_delete_cat_{cat_to_delete}_yes"),
+            InlineKeyboardButton("❌ Yo'q, bekor", callback_data=f"amenu_confirm_delete_cat_{cat_to_delete}_no"),
+        ]
+    ])
+    try:
+        await query.edit_message_text(
+            f"Kategoriya '{cat_to_delete}' va ichidagi barcha mahsulotlar o'chirilsinmi?",
+            reply_markup=kb,
+        )
+    except Exception:
+        pass
+    await query.answer(); return
+
+
+@callback_router.route(prefix='amenu_confirm_delete_cat_', role='admin')
+async def cb_amenu_confirm_delete_cat(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    # Handle confirmation for deleting a category: yes/no
+    rest = arg
+    try:
+        cat_name, decision = rest.rsplit('_', 1)
+    except Exception:
+        await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
+
+    def _render_category_list_kb():
+        rows_local = []
+        for cat in menu_data.keys():
+            rows_local.append([
+                InlineKeyboardButton(cat, callback_data=f"amenu_cat_{cat}"),
+                InlineKeyboardButton("🗑️", callback_data=f"amenu_delete_cat_{cat}")
+            ])
+        rows_local.append([InlineKeyboardButton("➕ Kategoriya qo'shish", callback_data="amenu_add_category")])
+        rows_local.append([InlineKeyboardButton('◀️ Bekor', callback_data='admin_panel')])
+        return InlineKeyboardMarkup(rows_local)
+
+    if decision == 'yes':
+        if cat_name in menu_data:
+            try:
+                del menu_data[cat_name]
+                persist_menu()
             except Exception as e:
-                log.warning(f"Foydalanuvchiga yetkazildi xabarida xato: {e}")
-            # edit courier message to indicate delivered and attach note
+                log.warning(f"Kategoriyani o'chirishda xato: {e}")
+                await query.answer('Kategoriyani o\'chirishda xatolik', show_alert=True)
+                return
+            # Try refresh user category views tied to this category
             try:
-                await context.bot.edit_message_text(chat_id=order['courier_msg']['chat_id'], message_id=order['courier_msg']['message_id'], text="✅ Yetkazildi (Onlayn to'lov, chek yuklandi)")
+                refresh_category_views(context, cat_name)
             except Exception:
                 pass
-            # send receipt photo to payments channel for records
+            # Delete confirmation message and send fresh list
             try:
-                await context.bot.send_photo(chat_id=PAYMENTS_CHANNEL_ID, photo=file_id, caption=f"[CHEK] Buyurtma #{order_num} — Yetkazib beruvchi: {cid} — Mijoz: {order.get('user')} — Jami: {order.get('total')} so'm")
+                await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
             except Exception:
                 pass
-            ud.pop('expecting_receipt_for', None)
-            await update.message.reply_text('✅ Chek qabul qilindi, buyurtma yetkazildi va yozildi. Rahmat!')
-            return
-    except Exception as e:
-        log.warning(f"Receipt photo handling error: {e}")
-    # Courier OTP flow: if courier was asked to provide OTP for an order
-    if uid in couriers and ud.get('expecting_otp_for'):
-        try:
-            order_num = int(ud.get('expecting_otp_for'))
-            order = find_order(order_num)
-            if not order:
-                await update.message.reply_text('Buyurtma topilmadi.'); ud.pop('expecting_otp_for', None); return
-            # compare OTP
-            if text == str(order.get('otp')):
-                # OTP correct
-                # If payment was cash -> finalize immediately
-                if order.get('payment') == 'cash':
-                    order['status'] = 'Yetkazib berildi'
-                    order['collected_amount'] = order.get('total')
-                    # update courier earnings
-                    cid = uid
-                    rec = earnings.get(cid, {'total': 0, 'deliveries': []})
-                    rec['total'] = rec.get('total', 0) + order.get('total', 0)
-                    rec.setdefault('deliveries', []).append(order_num)
-                    earnings[cid] = rec
-                    persist_earnings()
-                    persist_orders()
-                    # notify user
-                    try: await context.bot.send_message(chat_id=order['user_id'], text=f"✅ Sizning #{order_num} buyurtmangiz yetkazib berildi. (Naqd to'lov qabul qilindi)")
-                    except Exception as e: log.warning(f"Foydalanuvchiga yetkazildi xabarida xato: {e}")
-                    # edit courier message
-                    try: await context.bot.edit_message_text(chat_id=order['courier_msg']['chat_id'], message_id=order['courier_msg']['message_id'], text="✅ Yetkazildi (Naqd to'lov)")
-                    except Exception: pass
-                    # report to superadmin
-                    try:
-                        sa_text = (
-                            f"[YETKAZILDI-NAQD] {datetime.now(timezone.utc).isoformat()}\n"
-                            f"Yetkazib beruvchi: {cid} ({update.effective_user.full_name})\n"
-                            f"Buyurtma: #{order_num}\n"
-                            f"Mijoz: {order.get('user')} (id: {order.get('user_id')})\n"
-                            f"Telefon: {phone_html_link(order.get('phone'))}\n"
-                            f"Jami: {order.get('total')} so'm\n"
-                            f"Naqd qabul qilindi: {order.get('total')} so'm"
-                        )
-                        await report_superadmin(context.bot, sa_text)
-                    except Exception as e:
-                        log.warning(f"Superadminga cash delivered hisobotini yuborishda xato: {e}")
-                    ud.pop('expecting_otp_for', None)
-                    await update.message.reply_text('✅ OTP tekshirildi, buyurtma yetkazildi.')
-                    return
-                # If payment was card -> ask courier to upload receipt photo
-                elif order.get('payment') == 'card':
-                    ud.pop('expecting_otp_for', None)
-                    context.user_data['expecting_receipt_for'] = order_num
-                    try:
-                        await context.bot.send_message(chat_id=uid, text=f"✅ OTP tasdiqlandi. Endi iltimos mijozdan chekni (screenshot yoki bank ilovasidagi kvitansiya) so'rang va shu chatga rasm sifatida yuboring. Cheksiz buyurtma tasdiqlanmaydi.")
-                    except Exception:
-                        pass
-                    await update.message.reply_text('Iltimos, chek rasmini yuboring...')
-                    return
-                else:
-                    # fallback finalize
-                    order['status'] = 'Yetkazib berildi'
-                    persist_orders()
-                    try: await context.bot.send_message(chat_id=order['user_id'], text=f"✅ Sizning #{order_num} buyurtmangiz yetkazib berildi.")
-                    except Exception as e: log.warning(f"Foydalanuvchiga yetkazildi xabarida xato: {e}")
-                    try: await context.bot.edit_message_text(chat_id=order['courier_msg']['chat_id'], message_id=order['courier_msg']['message_id'], text="✅ Yetkazildi")
-                    except Exception: pass
-                    ud.pop('expecting_otp_for', None)
-                    await update.message.reply_text('✅ OTP tekshirildi, buyurtma yetkazildi.')
-                    return
-            else:
-                await update.message.reply_text('❌ Noto‘g‘ri OTP. Iltimos qayta urinib ko‘ring.')
-                return
-        except Exception as e:
-            log.warning(f"OTP flow error: {e}")
-            ud.pop('expecting_otp_for', None)
-            return
-        # If user pressed exit while viewing a user session (history/menu/etc.), clear session messages
-        if text == "🔙 Chiqish" and (ud.get('history_messages') or ud.get('menu_messages') or ud.get('suggest_prompt') or ud.get('last_prompt_msg')):
             try:
+                await context.bot.send_message(chat_id=uid, text="Menyuni tahrirlash — kategoriya tanlang:", reply_markup=_render_category_list_kb())
+            except Exception:
+                # fallback: edit same message if delete failed
                 try:
-                    await update.message.delete()
+                    await query.edit_message_text("Menyuni tahrirlash — kategoriya tanlang:", reply_markup=_render_category_list_kb())
                 except Exception:
                     pass
-                # Use centralized helper to clear recorded user session messages
+            await query.answer('✅ Kategoriya o\'chirildi')
+            return
+        else:
+            await query.answer('Kategoriya topilmadi', show_alert=True)
+            return
+    elif decision == 'no':
+        # Delete confirmation message and return to list without changes
+        try:
+            await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
+        except Exception:
+            pass
+        try:
+            await context.bot.send_message(chat_id=uid, text="Menyuni tahrirlash — kategoriya tanlang:", reply_markup=_render_category_list_kb())
+        except Exception:
+            # fallback to editing
+            try:
+                await query.edit_message_text("Menyuni tahrirlash — kategoriya tanlang:", reply_markup=_render_category_list_kb())
+            except Exception:
+                pass
+        await query.answer('Bekor qilindi')
+        return
+    else:
+        await query.answer('Noto\'g\'ri tanlov', show_alert=True)
+        return
+
+
+@callback_router.route('amenu_add_category', role='admin')
+async def cb_amenu_add_category(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    set_state(ud, 'amenu_adding_category')
+    try:
+        # remember this inline prompt so we can delete it when the admin finishes/cancels
+        ud['amenu_last_prompt'] = {'chat_id': query.message.chat_id, 'message_id': query.message.message_id}
+        await query.edit_message_text('Yangi kategoriya nomini yuboring: (masalan: Ichimliklar)')
+    except Exception:
+        pass
+    await query.answer(); return
+
+
+@callback_router.route(prefix='amenu_add_product_', role='admin')
+async def cb_amenu_add_product(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    cat = arg
+    # Start step-by-step product creation: ask for name first
+    set_state(ud, 'amenu_add_product_step', 'name')
+    ud['amenu_add_product_cat'] = cat
+    # record the prompt message so we can delete/edit it later
+    try:
+        # store the message we will edit (query.message) as last prompt
+        ud['amenu_last_prompt'] = {'chat_id': query.message.chat_id, 'message_id': query.message.message_id}
+        await query.edit_message_text("Iltimos, mahsulot nomini yuboring:")
+    except Exception:
+        pass
+    await query.answer(); return
+
+
+@callback_router.route(prefix='amenu_edit_price_', role='admin')
+async def cb_amenu_edit_price(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    rest = arg
+    if '|' not in rest:
+        await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
+    cat, prod = rest.split('|',1)
+    set_state(ud, 'amenu_edit_price', (cat, prod))
+    try:
+        ud['amenu_last_prompt'] = {'chat_id': query.message.chat_id, 'message_id': query.message.message_id}
+        await query.edit_message_text('Yangi narxni yuboring (son bilan, faqat raqam):')
+    except Exception:
+        pass
+    await query.answer(); return
+
+
+@callback_router.route(prefix='amenu_edit_desc_', role='admin')
+async def cb_amenu_edit_desc(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    rest = arg
+    if '|' not in rest:
+        await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
+    cat, prod = rest.split('|',1)
+    set_state(ud, 'amenu_edit_desc', (cat, prod))
+    try:
+        ud['amenu_last_prompt'] = {'chat_id': query.message.chat_id, 'message_id': query.message.message_id}
+        await query.edit_message_text('Yangi tavsif matnini yuboring:')
+    except Exception:
+        pass
+    await query.answer(); return
+
+
+@callback_router.route(prefix='amenu_edit_photo_', role='admin')
+async def cb_amenu_edit_photo(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    rest = arg
+    if '|' not in rest:
+        await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
+    cat, prod = rest.split('|',1)
+    # set state so text_handler (photo) will handle next photo message
+    set_state(ud, 'amenu_edit_photo', (cat, prod))
+    try:
+        ud['amenu_last_prompt'] = {'chat_id': query.message.chat_id, 'message_id': query.message.message_id}
+        await query.edit_message_text('Iltimos, yangi rasmini yuboring (rasm yuboring):')
+    except Exception:
+        try:
+            # fallback: send prompt
+            sent = await context.bot.send_message(chat_id=uid, text='Iltimos, yangi rasmini yuboring (rasm yuboring):')
+            ud['amenu_last_prompt'] = {'chat_id': sent.chat_id, 'message_id': sent.message_id}
+        except Exception:
+            pass
+    await query.answer(); return
+
+
+@callback_router.route(prefix='amark_cat_', role='admin')
+async def cb_amark_cat(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    # pick category -> show all products (including unavailable) with status
+    cat = arg
+    rows = []
+    for name, info in menu_data.get(cat, {}).items():
+        status = "(Tugadi)" if not info.get('available', True) else "(Bor)"
+        rows.append([InlineKeyboardButton(f"{name} {status}", callback_data=f"amark_prod_{cat}|{name}")])
+    rows.append([InlineKeyboardButton('◀️ Orqaga', callback_data='admin_mark_product'), InlineKeyboardButton('🔙 Admin panel', callback_data='admin_panel')])
+    try:
+        await query.edit_message_text(f"{cat} — mahsulotlarni tanlang:", reply_markup=InlineKeyboardMarkup(rows))
+    except Exception:
+        pass
+    await query.answer(); return
+
+
+@callback_router.route(prefix='amark_prod_', role='admin')
+async def cb_amark_prod(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    # show product with buttons to mark available/unavailable
+    rest = arg
+    if '|' not in rest:
+        await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
+    cat, prod = rest.split('|',1)
+    if cat not in menu_data or prod not in menu_data[cat]:
+        await query.answer('Mahsulot topilmadi', show_alert=True); return
+    info = menu_data[cat][prod]
+    current_status = "Bor" if info.get('available', True) else "Tugadi"
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton('✅ Bor', callback_data=f'amark_set_{cat}|{prod}_available'), InlineKeyboardButton('❌ Tugadi', callback_data=f'amark_set_{cat}|{prod}_unavailable')],
+        [InlineKeyboardButton('◀️ Orqaga', callback_data=f'amark_cat_{cat}')]
+    ])
+    try:
+        await query.edit_message_text(f"{prod}\n\nJoriy holat: {current_status}\n\nMahsulotni bor yoki tugadi deb belgilang:", reply_markup=kb)
+    except Exception:
+        pass
+    await query.answer(); return
+
+
+@callback_router.route(prefix='amark_set_', role='admin')
+async def cb_amark_set(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    rest = arg
+    action = None
+    if rest.endswith('_available'):
+        action = 'available'; core = rest[:-len('_available')]
+    elif rest.endswith('_unavailable'):
+        action = 'unavailable'; core = rest[:-len('_unavailable')]
+    else:
+        await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
+    if '|' not in core:
+        await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
+    cat, prod = core.split('|',1)
+    if cat not in menu_data or prod not in menu_data[cat]: await query.answer('Mahsulot topilmadi', show_alert=True); return
+    menu_data[cat][prod]['available'] = (action == 'available')
+    persist_menu()
+    # Update any recent category messages we know about so users see the change immediately
+    try:
+        for (chat_id, c), msg_id in list(last_category_messages.items()):
+            if c == cat:
                 try:
-                    prompt_mid = await clear_user_session(uid, context, ud)
+                    await context.bot.edit_message_text(chat_id=chat_id, message_id=msg_id, text=f"📋 {cat} menyusi:", reply_markup=product_list_kb(cat))
                 except Exception:
-                    prompt_mid = None
+                    # ignore failures (message deleted or no permission)
+                    try:
+                        # if editing failed, remove mapping to avoid repeated failures
+                        last_category_messages.pop((chat_id, c), None)
+                    except Exception:
+                        pass
+    except Exception:
+        pass
+    # Notify admin and go back to category view
+    try:
+        state_text = '✅ Mahsulot bor qilib belgilandi.' if action == 'available' else '✅ Mahsulot tugadi deb belgilandi.'
+        await query.edit_message_text(state_text, reply_markup=admin_panel_kb())
+    except Exception:
+        pass
+    await query.answer(); return
 
-                # removed brittle range-based deletion — rely on recorded messages only
 
-                # restore main user reply keyboard
-                user_kb = ReplyKeyboardMarkup([
-                    [KeyboardButton("🍔 Menyu"), KeyboardButton("Taklif va shikoyatlar")],
-                    [KeyboardButton("🧾 Buyurtmalar tarixi")]
-                ], resize_keyboard=True, one_time_keyboard=False)
+# Payment callbacks (user finishing checkout)
+@callback_router.route('pay_cash', 'pay_card')
+async def cb_pay(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    global order_counter
+    is_cash = (data == 'pay_cash')
+    pending = context.user_data.get('pending_order')
+    if not pending:
+        await query.answer("Hech qanday buyurtma topilmadi.", show_alert=True); return
+    migrate_order_items(pending)   # sessions saved before line items
+
+    # If user chose card and we have a provider token, send Telegram Invoice
+    if (not is_cash) and PAYMENT_PROVIDER_TOKEN:
+        try:
+            # server-side invoice: pre-checkout validates against it, successful_payment finalizes it
+            for gone in invoices.prune():
+                persist_invoice(gone)
+            # same amount as before line items: the quoted total in so'm (a sum of int unit
+            # prices from cart_text_and_total; migrate_order_items keeps it as quoted)
+            inv = invoices.create(update.effective_user.id, pending, int(pending['total']), 'UZS')
+            persist_invoice(inv['payload'])
+            payload = inv['payload']
+            prices = [LabeledPrice("Buyurtma", inv['amount'])]
+            await context.bot.send_invoice(
+                chat_id=update.effective_user.id,
+                title=f"Buyurtma — {pending.get('original_text','')[:64]}",
+                description=(pending.get('original_text','') or 'Buyurtma to‘lovi'),
+                payload=payload,
+                provider_token=PAYMENT_PROVIDER_TOKEN,
+                currency=inv['currency'],
+                prices=prices,
+            )
+            try:
+                await query.edit_message_text("✅ To'lov varaqasi yuborildi. Iltimos, to'lovni tugating.")
+                # also provide a reply keyboard with an exit button so user can easily close the flow
                 try:
-                    sent_w = await context.bot.send_message(chat_id=uid, text="🍔 Fast Food botiga xush kelibsiz! Quyidagi tugmalardan foydalaning:", reply_markup=user_kb)
-                    ud['welcome_msg'] = {'chat_id': sent_w.chat_id, 'message_id': sent_w.message_id, 'text': "🍔 Fast Food botiga xush kelibsiz! Quyidagi tugmalardan foydalaning:"}
+                    exit_kb = ReplyKeyboardMarkup([[KeyboardButton('🔙 Chiqish')]], resize_keyboard=True, one_time_keyboard=True)
+                    await context.bot.send_message(chat_id=update.effective_user.id, text="Agar tugatsangiz, '🔙 Chiqish' tugmasini bosing.", reply_markup=exit_kb)
                 except Exception:
                     pass
             except Exception:
                 pass
             return
-    if uid in admins:
-        # Support reply-keyboard exit button from admin orders view
-        # If admin is composing a reply to a suggestion, forward their message to the target user
-        if ud.get('want_reply_to'):
-            try:
-                info = ud.pop('want_reply_to', None)
-                if info:
-                    target = info.get('target_user')
-                    chan_msg_id = info.get('channel_msg_id')
-                    # Forward whatever the admin just sent to the target user (this includes text, media, etc.)
-                    try:
-                        # copy the admin's message to the user so it appears sent by the bot (anonymous)
-                        try:
-                            await context.bot.copy_message(chat_id=target, from_chat_id=uid, message_id=update.message.message_id)
-                        except Exception:
-                            # fallback: if copy_message fails (older clients), send text or media manually
-                            if update.message.text:
-                                await context.bot.send_message(chat_id=target, text=update.message.text)
-                            elif update.message.photo:
-                                # send largest photo
-                                photo = update.message.photo[-1].file_id
-                                await context.bot.send_photo(chat_id=target, photo=photo, caption=update.message.caption or '')
-                            elif update.message.sticker:
-                                await context.bot.send_sticker(chat_id=target, sticker=update.message.sticker.file_id)
-                            elif update.message.document:
-                                await context.bot.send_document(chat_id=target, document=update.message.document.file_id, caption=update.message.caption or '')
-                            else:
-                                # as last resort, send text representation
-                                txt = update.message.text or '[media]'
-                                await context.bot.send_message(chat_id=target, text=txt)
-                        # send a short confirmation to admin (will be deleted shortly)
-                        try:
-                            resp = await context.bot.send_message(chat_id=uid, text='✅ Javob mijozga yuborildi.')
-                            async def _del_later(cid, mid, delay=6):
-                                try:
-                                    await asyncio.sleep(delay)
-                                    await context.bot.delete_message(chat_id=cid, message_id=mid)
-                                except Exception:
-                                    pass
-                            try:
-                                asyncio.create_task(_del_later(resp.chat_id, resp.message_id, 6))
-                            except Exception:
-                                pass
-                        except Exception:
-                            pass
-                    except Exception:
-                        # fallback: send as text if forward failed
-                        try:
-                            if update.message.text:
-                                await context.bot.send_message(chat_id=target, text=update.message.text)
-                                await update.message.reply_text('✅ Javob mijozga yuborildi.')
-                            else:
-                                await update.message.reply_text('❌ Xabar yuborilmadi. Iltimos, matn yoki media yuboring va qayta urinib ko‘ring.')
-                        except Exception:
-                            pass
-                    # Post admin's reply anonymously as a reply to the original suggestion in the suggestions channel,
-                    # and also clean up admin-side forwarded copies and prompts.
-                    try:
-                        if chan_msg_id:
-                            try:
-                                # copy admin's message into the suggestions channel as a reply_to the original message
-                                try:
-                                    await context.bot.copy_message(chat_id=SUGGESTIONS_CHANNEL_ID, from_chat_id=uid, message_id=update.message.message_id, reply_to_message_id=chan_msg_id)
-                                except Exception:
-                                    # fallback: send text or caption as bot reply
-                                    if update.message.text:
-                                        await context.bot.send_message(chat_id=SUGGESTIONS_CHANNEL_ID, text=update.message.text, reply_to_message_id=chan_msg_id)
-                                    elif update.message.photo:
-                                        photo = update.message.photo[-1].file_id
-                                        await context.bot.send_photo(chat_id=SUGGESTIONS_CHANNEL_ID, photo=photo, caption=update.message.caption or '', reply_to_message_id=chan_msg_id)
-                                    else:
-                                        await context.bot.send_message(chat_id=SUGGESTIONS_CHANNEL_ID, text='✅ Javob berildi.', reply_to_message_id=chan_msg_id)
-                            except Exception:
-                                # ignore failures posting into channel
-                                pass
-                    except Exception:
-                        pass
-                    try:
-                        # remove admin's own sent message to avoid clutter
-                        try:
-                            await update.message.delete()
-                        except Exception:
-                            pass
-                        # delete any recorded prompt/forward copies we stored in admin_orders_sessions
-                        try:
-                            sent_prompts = admin_orders_sessions.pop(uid, [])
-                            try:
-                                await _safe_delete_session_messages(context, uid, sent_prompts)
-                            except Exception:
-                                pass
-                        except Exception:
-                            pass
-                    except Exception:
-                        pass
-            except Exception as e:
-                log.warning(f"Admin reply error: {e}")
-            return
-        if text == "🔙 Chiqish":
-            # delete the user's own reply message (the '🔙 Chiqish' text) to avoid leaving it in chat
-            try:
-                await update.message.delete()
-            except Exception:
-                pass
-            # central cleanup of admin session prompts/messages and transient state
+        except Exception as e:
+            log.warning(f"Invoice yuborishda xato: {e}")
+            # fallback to create order as unpaid card order below
+
+    # Fallback / cash flow: create order immediately (existing behavior)
+    # remove pending_order from user_data now that we will persist as an order
+    context.user_data.pop('pending_order', None)
+    order_counter += 1; order_number = order_counter
+    order = {
+        'order_number': order_number,
+        'user_id': update.effective_user.id,
+        'user_name': update.effective_user.full_name,
+        'user_username': update.effective_user.username or '',
+        'user': f"{update.effective_user.full_name} (id: {update.effective_user.id})",
+        'items': pending['items'],
+        'total': pending['total'],
+        'phone': pending['phone'],
+        'loc': pending['loc'],
+        'dt': pending['dt'],
+        'status': 'Kutilyapti',
+        'user_msg': None,
+        'admin_msgs': [],
+        'original_text': pending.get('original_text',''),
+        'payment': 'cash' if is_cash else 'card',
+        'paid': False,
+    }
+    # If cash or card (we require OTP confirmation at delivery), generate OTP
+    if True:
+        otp = generate_otp()
+        order['otp'] = otp
+    order['expires_at'] = time.time() + ORDER_CANCEL_WINDOW
+    orders.add(order)
+
+    cancel_kb = InlineKeyboardMarkup([[InlineKeyboardButton(f"❌ Bekor qilish #{order_number}", callback_data=f"cancel_order_{order_number}")]])
+    sent = await query.message.reply_text(f"✅ Buyurtmangiz #{order_number} qabul qilindi!\n\n{order.get('original_text')}\n\n⏳ Bekor qilish uchun 30 soniyangiz bor.", reply_markup=cancel_kb)
+    order['user_msg'] = {'chat_id': sent.chat_id, 'message_id': sent.message_id}
+    try:
+        await query.edit_message_text("Buyurtma qabul qilindi. Kanalga e'lon qilish 30s ichida amalga oshiriladi.")
+    except Exception:
+        pass
+
+    persist_orders(order)
+    schedule_order_expiry(order)
+
+    # Send OTP to user (for both cash and card flows we generate OTP)
+    try:
+        exit_kb = ReplyKeyboardMarkup([[KeyboardButton('🔙 Chiqish')]], resize_keyboard=True, one_time_keyboard=True)
+        await context.bot.send_message(chat_id=order['user_id'], text=f"Sizning buyurtmangiz uchun tasdiq kodi (OTP): {order['otp']}. Ushbu kodni yetkazib beruvchiga yetkazilganda berishingiz kerak.", reply_markup=exit_kb)
+    except Exception as e:
+        log.warning(f"OTP yuborishda xato: {e}")
+    return
+
+
+# --- Super-admin inline tahrir callbacklari ---
+@callback_router.route(prefix=('sa_inc_', 'sa_dec_', 'sa_add_', 'sa_done_', 'sa_canceledit_'), role='admin', order_lock=True)
+async def cb_sa_edit(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    # format: sa_inc_<order>_<idx>; the action is taken from the matched prefix
+    action = data[len('sa_'):len(data) - len(arg) - 1]
+    parts = arg.split('_')
+    if action in ('inc', 'dec'):
+        try:
+            order_num = int(parts[0]); idx = int(parts[1])
+        except Exception:
+            await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
+        order = find_order(order_num)
+        if not order: await query.answer('Buyurtma topilmadi', show_alert=True); return
+        items = list(order.get('items', []))
+        if idx < 0 or idx >= len(items): await query.answer('Indeks xato', show_alert=True); return
+        qty = items[idx]['qty']
+        items[idx] = dict(items[idx], qty=qty + 1 if action == 'inc' else max(1, qty - 1))
+        set_order_items(order, items)
+        persist_orders(order)
+        # update superadmin message
+        sam = order.get('superadmin_msg')
+        if sam:
             try:
-                await clear_admin_session(uid, context, ud)
+                await context.bot.edit_message_text(chat_id=sam['chat_id'], message_id=sam['message_id'], text=build_superadmin_order_text(order), reply_markup=build_superadmin_kb(order), parse_mode='HTML')
             except Exception:
                 pass
-                # Best-effort: also remove any stored admin_orders_sessions entries (redundant safe-guard)
-                try:
-                    sent_msgs = admin_orders_sessions.pop(uid, [])
-                    try:
-                        await _safe_delete_session_messages(context, uid, sent_msgs)
-                    except Exception:
-                        pass
-                except Exception:
-                    pass
-            # restore admin panel
+        await query.answer('Yangilandi')
+        return
+
+    if action == 'add':
+        try: order_num = int(parts[0])
+        except Exception: await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
+        # prompt admin to send product as: Name | qty
+        set_state(context.user_data, 'sa_adding_order', order_num)
+        await query.answer('Iltimos, mahsulot nomi va miqdorini "Nomi | miqdor" formatida yuboring.')
+        try: await query.edit_message_text('Mahsulot qo\'shish uchun nom va miqdorni yuboring (masalan: Lavash | 1)')
+        except Exception: pass
+        return
+
+    if action == 'done':
+        try: order_num = int(parts[0])
+        except Exception: await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
+        order = find_order(order_num)
+        if not order: await query.answer('Buyurtma topilmadi', show_alert=True); return
+        # post to channel through the publication outbox; an order that is already in
+        # the channel gets its post updated in place instead of a second post
+        if order.get('status') == 'Kanalda':
+            cm = channel_message(order)
+            if cm:
+                try:
+                    await context.bot.edit_message_text(chat_id=cm['chat_id'], message_id=cm['message_id'], text=channel_text(order),
+                                                        reply_markup=generate_admin_order_kb(order, show_cancel=False))
+                except BadRequest as e:
+                    log.info(f"Kanal postini yangilab bo'lmadi (#{order_num}): {e}")
+            else:
+                if not order.get('publish_job'):
+                    orders.update(order, publish_job={'created': time.time(), 'attempts': 0})
+                    persist_orders(order, critical=True)
+                publication_outbox.enqueue(order_num)
+        elif orders.transition(order_num, 'Kutilyapti', 'Kanalda', by=uid,
+                               publish_job={'created': time.time(), 'attempts': 0}):
+            expiry_scheduler.cancel(order_num)
+            persist_orders(order, critical=True)
+            publication_outbox.enqueue(order_num)
+        else:
+            await query.answer(f"Buyurtma holati: {order.get('status')} — kanalga chiqarib bo'lmaydi.", show_alert=True); return
+        # update superadmin message to indicate done
+        sam = order.get('superadmin_msg')
+        if sam:
             try:
-                await context.bot.send_message(chat_id=uid, text="🔑 Admin panelga xush kelibsiz!", reply_markup=admin_panel_kb())
+                await context.bot.edit_message_text(chat_id=sam['chat_id'], message_id=sam['message_id'], text=build_superadmin_order_text(order) + "\n\n✅ Kanalga yuborildi.")
             except Exception:
                 pass
-            return
-        if ud.get("want_broadcast"):
-            # Forward the exact admin message to all users so media + captions are preserved
-            ud.pop("want_broadcast", None)
-            sent, failed = 0, 0
-            from_chat_id = update.message.chat_id
-            msg_id = update.message.message_id
-            for user_id in list(users):
-                # don't forward the broadcast back to the admin who sent it
-                if user_id == uid:
-                    continue
-                try:
-                    await context.bot.forward_message(chat_id=user_id, from_chat_id=from_chat_id, message_id=msg_id)
-                    sent += 1
-                except Exception as e:
-                    failed += 1
-                    log.warning(f"Broadcastda xato ({user_id}): {e}")
+        await query.answer('Buyurtma kanalga yuborildi')
+        return
+
+    if action == 'canceledit':
+        try: order_num = int(parts[0])
+        except Exception: await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
+        order = find_order(order_num)
+        if not order: await query.answer('Buyurtma topilmadi', show_alert=True); return
+        sam = order.get('superadmin_msg')
+        if sam:
             try:
-                await update.message.reply_text(f"✅ Xabar yuborildi.\nMuvaffaqiyatli: {sent}\nXatolik: {failed}", reply_markup=admin_panel_kb())
+                await context.bot.edit_message_text(chat_id=sam['chat_id'], message_id=sam['message_id'], text=build_superadmin_order_text(order) + "\n\n❌ Tahrirlash bekor qilindi.")
             except Exception:
                 pass
-            # cleanup any admin prompt messages (e.g., the 'enter message' prompt)
+        order.pop('superadmin_msg', None)
+        persist_orders(order)
+        await query.answer('Tahrirlash bekor qilindi')
+        return
+
+
+# Admin-triggered item-level edit flow (opens inline editor)
+@callback_router.route(prefix='admin_edit_', role='admin', order_lock=True)
+async def cb_admin_edit(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    try:
+        order_num = int(arg)
+    except Exception:
+        await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
+    order = find_order(order_num)
+    if not order:
+        await query.answer('Buyurtma topilmadi', show_alert=True); return
+    log.info(f"admin_edit callback received for order {order_num} by admin {uid}")
+    # prepare proposed_items copy
+    set_order_items(order, list(order.get('items', [])), proposed=True)
+    order['proposed_by_admin'] = uid
+    persist_orders(order)
+    # send editor to admin
+    try:
+        txt = f"✏️ Buyurtma #{order_num} tahriri (admin tomonidan).\n\nJoriy mahsulotlar:\n" + items_text(order['proposed_items'], "\n") + f"\n\nJami: {order['proposed_total']} so'm"
+        msg = await context.bot.send_message(chat_id=uid, text=txt, reply_markup=build_admin_edit_kb(order))
+        order['admin_edit_msg'] = {'chat_id': msg.chat_id, 'message_id': msg.message_id}
+        persist_orders(order)
+        await query.answer('Tahrirlash oynasi ochildi')
+    except Exception as e:
+        log.warning(f"Admin edit window send failed for order {order_num}: {e}")
+        # fallback: notify admin and show alert
+        try:
+            await context.bot.send_message(chat_id=uid, text=f"Tahrirlash oynasi ochilmadi (order #{order_num}). Iltimos /start ni bosing yoki admin panelni tekshiring.")
+        except Exception:
+            pass
+        await query.answer('Tahrirlash oynasi ochilmadi – adminga xabar yuborildi', show_alert=True)
+    return
+
+
+# --- Admin edit (ae_) callbacks: inc/dec/add/done/cancel and pick product ---
+@callback_router.route(prefix=('ae_inc_', 'ae_dec_', 'ae_add_', 'ae_done_', 'ae_cancel_', 'ae_pick_'), role='admin', order_lock=True)
+async def cb_ae_edit(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    # the action is taken from the matched prefix (ae_<action>_), the rest from arg
+    action = data[len('ae_'):len(data) - len(arg) - 1]
+    parts = arg.split('_')
+    # inc/dec format: ae_inc_<order>_<idx>
+    if action in ('inc','dec'):
+        try:
+            order_num = int(parts[0]); idx = int(parts[1])
+        except Exception:
+            await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
+        order = find_order(order_num)
+        if not order or 'proposed_items' not in order:
+            await query.answer('No edit session', show_alert=True); return
+        items = list(order['proposed_items'])
+        if idx < 0 or idx >= len(items): await query.answer('Indeks xato', show_alert=True); return
+        qty = items[idx]['qty']
+        items[idx] = dict(items[idx], qty=qty + 1 if action == 'inc' else max(1, qty - 1))
+        set_order_items(order, items, proposed=True)
+        persist_orders(order)
+        # update admin edit message
+        ae_msg = order.get('admin_edit_msg')
+        txt = f"✏️ Buyurtma #{order_num} tahriri (admin tomonidan).\n\nJoriy mahsulotlar:\n" + items_text(order['proposed_items'], "\n") + f"\n\nJami: {order['proposed_total']} so'm"
+        try:
+            if ae_msg:
+                await context.bot.edit_message_text(chat_id=ae_msg['chat_id'], message_id=ae_msg['message_id'], text=txt, reply_markup=build_admin_edit_kb(order))
+            else:
+                await query.edit_message_text(txt, reply_markup=build_admin_edit_kb(order))
+        except Exception:
+            pass
+        await query.answer('Yangilandi')
+        return
+
+    # add product -> show categories
+    if action == 'add':
+        try: order_num = int(parts[0])
+        except Exception: await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
+        # build categories kb
+        rows = [[InlineKeyboardButton(cat, callback_data=f"ae_pick_{order_num}_cat_{cat}")] for cat in menu_data.keys()]
+        rows.append([InlineKeyboardButton('◀️ Bekor', callback_data=f'ae_cancel_{order_num}')])
+        try:
+            await query.edit_message_text('Kategoriya tanlang:', reply_markup=InlineKeyboardMarkup(rows))
+        except Exception:
+            pass
+        await query.answer(); return
+
+    # pick callbacks (category -> products, or product select)
+    if action == 'pick':
+        # format: ae_pick_<order>_cat_<cat>  OR ae_pick_<order>_prod_<cat>|<prod>
+        try:
+            order_num = int(parts[0])
+        except Exception:
+            await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
+        sub = parts[1]
+        order = find_order(order_num)
+        if not order: await query.answer('Buyurtma topilmadi', show_alert=True); return
+        if sub == 'cat':
+            cat = '_'.join(parts[2:])
+            # build products list
+            rows = [[InlineKeyboardButton(f"{name} — {info['price']} so'm", callback_data=f"ae_pick_{order_num}_prod_{cat}|{name}")] for name, info in menu_data.get(cat, {}).items()]
+            rows.append([InlineKeyboardButton('◀️ Orqaga', callback_data=f"ae_add_{order_num}")])
+            try: await query.edit_message_text(f"{cat} menyusi:", reply_markup=InlineKeyboardMarkup(rows))
+            except Exception: pass
+            await query.answer(); return
+        if sub == 'prod':
+            rest = '_'.join(parts[2:])
+            # rest is like <cat>|<name>
+            if '|' not in rest:
+                await query.answer('Noto\'g\'ri format', show_alert=True); return
+            cat, prod = rest.split('|',1)
+            # append product x1
+            items = list(order.get('proposed_items', []))
+            items.append(line_item(prod, 1, price=menu_data.get(cat, {}).get(prod, {}).get('price')))
+            set_order_items(order, items, proposed=True)
+            persist_orders(order)
+            ae_msg = order.get('admin_edit_msg')
+            txt = f"✏️ Buyurtma #{order_num} tahriri (admin tomonidan).\n\nJoriy mahsulotlar:\n" + items_text(order['proposed_items'], "\n") + f"\n\nJami: {order['proposed_total']} so'm"
             try:
-                sent_prompts = admin_orders_sessions.pop(uid, [])
-                try:
-                    await _safe_delete_session_messages(context, uid, sent_prompts)
-                except Exception:
-                    pass
+                if ae_msg:
+                    await context.bot.edit_message_text(chat_id=ae_msg['chat_id'], message_id=ae_msg['message_id'], text=txt, reply_markup=build_admin_edit_kb(order))
+                else:
+                    await query.edit_message_text(txt, reply_markup=build_admin_edit_kb(order))
             except Exception:
                 pass
+            await query.answer('Mahsulot qo\'shildi')
             return
-        if ud.get("want_add_admin"):
-            ud.pop("want_add_admin", None)
-            try:
-                admins.add(int(text))
-                try:
-                    await update.message.delete()
-                except Exception:
-                    pass
-                try:
-                    await context.bot.send_message(chat_id=uid, text=f"✅ {text} admin sifatida qo‘shildi.", reply_markup=admin_panel_kb())
-                except Exception:
-                    pass
-                # cleanup prompt message (only delete messages that were sent into admin's private chat)
+
+    # done -> send confirmation to user
+    if action == 'done':
+        try: order_num = int(parts[0])
+        except Exception: await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
+        order = find_order(order_num)
+        if not order or 'proposed_items' not in order: await query.answer('No edit session', show_alert=True); return
+        # send to user for confirmation
+        user_id = order.get('user_id')
+        confirm_txt = (
+            f"📣 Buyurtmangiz uchun tahrir taklifi mavjud.\n\nOldingi: \n" + items_text(order.get('items', []), "\n") + f"\n\nYangi: \n" + items_text(order['proposed_items'], "\n") + f"\n\nJami: {order['proposed_total']} so'm\n\nAgar rozisiz, 'Qabul qilaman' tugmasini bosing.")
+        kb = InlineKeyboardMarkup([[InlineKeyboardButton('✅ Qabul qilaman', callback_data=f'ae_user_confirm_{order_num}_approve'), InlineKeyboardButton('❌ Rad etaman', callback_data=f'ae_user_confirm_{order_num}_reject')]])
+        try:
+            await context.bot.send_message(chat_id=user_id, text=confirm_txt, reply_markup=kb)
+            await query.edit_message_text('✅ Taklif mijozga yuborildi. Javobni kuting.', reply_markup=admin_panel_kb())
+            persist_orders(order)
+        except Exception as e:
+            await query.answer('Foydalanuvchiga yuborilmadi', show_alert=True); log.warning(f"Taklif yuborishda xato: {e}")
+        return
+
+    # cancel
+    if action == 'cancel':
+        try: order_num = int(parts[0])
+        except Exception: await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
+        order = find_order(order_num)
+        if not order: await query.answer('Buyurtma topilmadi', show_alert=True); return
+        # remove proposed fields
+        order.pop('proposed_items', None); order.pop('proposed_total', None); order.pop('proposed_by_admin', None)
+        ae_msg = order.get('admin_edit_msg')
+        try:
+            if ae_msg:
+                await context.bot.edit_message_text(chat_id=ae_msg['chat_id'], message_id=ae_msg['message_id'], text='Tahrirlash bekor qilindi.')
+        except Exception:
+            pass
+        persist_orders(order)
+        await query.answer('Tahrirlash bekor qilindi')
+        return
+
+
+# --- Yetkazib beruvchi (courier) funksiyalari ---
+# Qabul qilish: faqat couriers ro'yxatidagi foydalanuvchilar qila oladi
+@callback_router.route(prefix='accept_', order_lock=True)
+async def cb_accept(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    try: order_num = int(arg)
+    except (ValueError, IndexError): await query.answer("Noto'g'ri buyruq", show_alert=True); return
+
+    order = find_order(order_num)
+    if not order: await query.answer("Buyurtma topilmadi", show_alert=True); return
+
+    if uid not in couriers:
+        await query.answer("Siz yetkazib beruvchi emassiz.", show_alert=True); return
+
+    # Belgilash: kuryer buyurtmani qabul qilganda status "Qabul qilingan" ga o'zgaradi.
+    # The courier is assigned in the same compare-and-set, so only one courier can win.
+    if not orders.transition(order_num, 'Kanalda', 'Qabul qilingan', by=uid,
+                             courier_id=uid, courier_name=update.effective_user.full_name):
+        await query.answer("Bu buyurtma qabul qilish uchun mavjud emas.", show_alert=True); return
+    withdraw_offers(order, context.bot)
+    persist_orders(order, critical=True)
+    # delete the user's confirmation message to avoid chat clutter
+    try:
+        if order.get('user_msg'):
+            um = order.pop('user_msg', None)
+            if um:
                 try:
-                    sent_prompts = admin_orders_sessions.pop(uid, [])
-                    try:
-                        await _safe_delete_session_messages(context, uid, sent_prompts)
-                    except Exception:
-                        pass
+                    await context.bot.delete_message(chat_id=um['chat_id'], message_id=um['message_id'])
                 except Exception:
                     pass
+    except Exception:
+        pass
+
+    # Kanaldagi xabarni o'chirish (agar mavjud bo'lsa)
+    for am in list(order.get('admin_msgs', [])):
+        try:
+            if am.get('chat_id') == BUYURTMALAR_CHANNEL_ID:
+                # avvalo o'chirishga harakat qilamiz
                 try:
-                    sa_text = (
-                        f"[ADMIN QO'SHILDI] {datetime.now(timezone.utc).isoformat()}\n"
-                        f"Qo'shgan admin: {uid} ({update.effective_user.full_name})\n"
-                        f"Yangi admin: {text}"
-                    )
-                    await report_superadmin(context.bot, sa_text)
+                    await context.bot.delete_message(chat_id=am['chat_id'], message_id=am['message_id'])
+                    # Qabul qilindi deb yangi xabar yuborish
+                    await context.bot.send_message(chat_id=BUYURTMALAR_CHANNEL_ID, text=f"✅ Buyurtma #{order_num} qabul qilindi yetkazib beruvchi: {update.effective_user.full_name}")
                 except Exception as e:
-                    log.warning(f"Superadminga admin add hisobotini yuborishda xato: {e}")
-            except ValueError:
-                resp = None
-                try:
-                    resp = await update.message.reply_text("❌ Xato ID.", reply_markup=admin_panel_kb())
-                except Exception:
-                    pass
-                # delete the admin's input message to avoid clutter
-                try:
-                    await update.message.delete()
-                except Exception:
-                    pass
-                # cleanup prompt messages (only delete messages that were sent into admin's private chat)
-                try:
-                    sent_prompts = admin_orders_sessions.pop(uid, [])
+                    # Agar o'chira olmasak (bot kanal admin emas yoki ruxsat yo'q), xabarni tahrirlab 'qabul qilindi' deb belgilaymiz
+                    log.warning(f"Kanal xabarini o'chirish muvaffaqiyatsiz ({am.get('chat_id')}:{am.get('message_id')}): {e}")
                     try:
-                        await _safe_delete_session_messages(context, uid, sent_prompts)
-                    except Exception:
-                        pass
-                except Exception:
-                    pass
-                # schedule deletion of the bot's error reply after a short delay
-                if resp:
-                    async def _del_later(cid, mid, delay=6):
-                        try:
-                            await asyncio.sleep(delay)
-                            await context.bot.delete_message(chat_id=cid, message_id=mid)
-                        except Exception:
-                            pass
-                    try:
-                        asyncio.create_task(_del_later(resp.chat_id, resp.message_id, 6))
-                    except Exception:
-                        pass
-                return
-        if ud.get("want_remove_admin"):
-            ud.pop("want_remove_admin", None)
+                        await context.bot.edit_message_text(chat_id=am['chat_id'], message_id=am['message_id'], text=f"✅ Buyurtma #{order_num} qabul qilindi yetkazib beruvchi: {update.effective_user.full_name}")
+                    except Exception as e2:
+                        log.warning(f"Kanal xabarini tahrirlashda xato: {e2}")
+        except Exception:
+            # umumiy himoya: agar admin_msgs ichida noo'rin format bo'lsa davom etamiz
+            continue
+    # Tozalash va faqat courier uchun yuborish (telefon link bilan)
+    # Prefer explicit user fields if present, otherwise fall back to order['user'] string
+    u_name = order.get('user_name') or order.get('user') or 'Noma\'lum'
+    u_username = order.get('user_username') or ''
+    username_display = f"@{u_username}" if u_username else '—'
+    order_phone = order.get('phone') or ''
+    profile_phone = users_info.get(order.get('user_id'), {}).get('phone') if order.get('user_id') in users_info else None
+    # Build phone lines: show both order phone and profile phone if both exist and differ
+    phone_lines = []
+    if order_phone:
+        phone_lines.append(f"Buyurtma telefoni: {phone_html_link(order_phone)}")
+    if profile_phone and profile_phone != order_phone:
+        phone_lines.append(f"Profil telefoni: {phone_html_link(profile_phone)}")
+    if not phone_lines:
+        phone_lines_text = "Tel: Noma'lum"
+    else:
+        phone_lines_text = "\n".join(phone_lines)
+    courier_text = (
+        f"🚚 Siz #{order_num} buyurtmani qabul qildingiz.\n\n"
+        f"{html.escape(order.get('original_text',''))}\n\n"
+        f"Ism: {html.escape(u_name)}\n"
+        f"Username: {html.escape(username_display)}\n"
+        f"{phone_lines_text}\n"
+        f"Manzil: https://www.google.com/maps/search/?api=1&query={html.escape(order.get('loc'))}"
+    )
+    # include payment type info for courier so they know how to collect/verify payment
+    try:
+        pay_type = order.get('payment', '—')
+        paid_flag = " (to'lov onlayn amalga oshirilgan)" if order.get('paid') else ''
+        courier_text = courier_text + f"\n\nTo'lov turi: {pay_type}{paid_flag}\n"
+        if pay_type == 'card':
+            courier_text = courier_text + "\n⚠️ Mijoz onlayn to'lovni tanlagan. Yetkazib berishda mijozdan to'lov kvitansiyasini (screenshot yoki bank ilovasidagi chek) so'rang va shu chatga rasm sifatida yuboring. Cheksiz yetkazilgan deb belgilash mumkin emas.\n"
+    except Exception:
+        pass
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton('✅ Yetkazildi', callback_data=f'delivered_{order_num}'), InlineKeyboardButton('🔄 Qaytarish', callback_data=f'return_{order_num}')]])
+    try:
+        msg = await context.bot.send_message(chat_id=uid, text=courier_text, reply_markup=kb, parse_mode="HTML")
+        order['courier_msg'] = {'chat_id': msg.chat_id, 'message_id': msg.message_id}
+    except Exception as e: log.warning(f"Yetkazib beruvchiga buyurtma yuborishda xato: {e}")
+    persist_orders(order)
+    # Report accept action to super-admin channel
+    try:
+        sa_text = (
+            f"[QABUL QILINDI] {datetime.now(timezone.utc).isoformat()}\n"
+            f"Yetkazib beruvchi: {uid} ({update.effective_user.full_name})\n"
+            f"Qabul qilingan buyurtma: #{order_num}\n"
+            f"Mijoz: {order.get('user')} (id: {order.get('user_id')})\n"
+            f"Telefon: {phone_html_link(order.get('phone'))}\n"
+            f"Jami: {order.get('total')} so'm\n"
+            f"Mahsulotlar: {items_text(order.get('items', []))}\n"
+            f"Manzil: https://www.google.com/maps/search/?api=1&query={order.get('loc')}"
+        )
+        await report_superadmin(context.bot, 'QABUL QILINDI', order_num, sa_text)
+    except Exception as e:
+        log.warning(f"Superadminga accept hisobotini yuborishda xato: {e}")
+
+    await query.answer('Buyurtma sizga biriktirildi.')
+    return
+
+
+@callback_router.route(prefix='delivered_', order_lock=True)
+async def cb_delivered(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    try: order_num = int(arg)
+    except (ValueError, IndexError): await query.answer("Noto'g'ri buyruq", show_alert=True); return
+    order = find_order(order_num)
+    if not order: await query.answer('Buyurtma topilmadi', show_alert=True); return
+    if order.get('courier_id') != uid: await query.answer('Bu buyurtma sizga tegishli emas', show_alert=True); return
+    # If payment was cash, require OTP confirmation from courier before finalizing
+    if order.get('payment') == 'cash':
+        set_state(context.user_data, 'expecting_otp_for', order_num)
+        await context.bot.send_message(chat_id=uid, text=f"Iltimos, mijozdan olgan OTP kodini kiriting (Buyurtma #{order_num}).")
+        await query.answer('OTP kodini kiriting...')
+        return
+    # If payment was card, first require OTP confirmation, then ask for receipt photo
+    if order.get('payment') == 'card':
+        set_state(context.user_data, 'expecting_otp_for', order_num)
+        try:
+            await context.bot.send_message(chat_id=uid, text=f"⚠️ Mijoz onlayn to'lovni tanlagan. Avvalo mijozdan OTP kodni oling va quyidagi ko'rsatmaga asosan tasdiqlang. OTP tasdiqlangandan so'ng sizdan chek rasmini yuborishingiz so'raladi.")
+        except Exception:
+            pass
+        await query.answer('OTP kodini kiriting...')
+        return
+
+    # other non-cash (no verification required): finalize immediately
+    if not orders.transition(order_num, 'Qabul qilingan', 'Yetkazib berildi', by=uid):
+        await query.answer(f"Buyurtma holati: {order.get('status')}", show_alert=True); return
+    persist_orders(order, critical=True)
+    # notify user
+    try: await context.bot.send_message(chat_id=order['user_id'], text=f"✅ Sizning #{order_num} buyurtmangiz yetkazib berildi.")
+    except Exception as e: log.warning(f"Foydalanuvchiga yetkazildi xabarida xato: {e}")
+    # edit courier message
+    try: await context.bot.edit_message_text(chat_id=order['courier_msg']['chat_id'], message_id=order['courier_msg']['message_id'], text="✅ Yetkazildi")
+    except Exception: pass
+    # Report delivered action to super-admin
+    try:
+        sa_text = (
+            f"[YETKAZILDI] {datetime.now(timezone.utc).isoformat()}\n"
+            f"Yetkazib beruvchi: {uid} ({update.effective_user.full_name})\n"
+            f"Yetkazilgan buyurtma: #{order_num}\n"
+            f"Mijoz: {order.get('user')} (id: {order.get('user_id')})\n"
+            f"Telefon: {phone_html_link(order.get('phone'))}\n"
+            f"Jami: {order.get('total')} so'm\n"
+            f"Mahsulotlar: {items_text(order.get('items', []))}"
+        )
+        await report_superadmin(context.bot, 'YETKAZILDI', order_num, sa_text)
+    except Exception as e:
+        log.warning(f"Superadminga delivered hisobotini yuborishda xato: {e}")
+    await query.answer('Buyurtma yetkazildi sifatida belgilandi.')
+    return
+
+
+@callback_router.route(prefix='return_', order_lock=True)
+async def cb_return(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    try: order_num = int(arg)
+    except (ValueError, IndexError): await query.answer("Noto'g'ri buyruq", show_alert=True); return
+    order = find_order(order_num)
+    if not order: await query.answer('Buyurtma topilmadi', show_alert=True); return
+    if order.get('courier_id') != uid: await query.answer('Bu buyurtma sizga tegishli emas', show_alert=True); return
+    # qaytarish: kuryer buyurtmani qaytarsa, uning statusi kanalga e'lon qilingan ('Kanalda') ga qaytadi
+    # va buyurtma qaytarilganligi belgilanadi — qaytarilganlar soni oshiriladi; kuryer biriktiruvi olib tashlanadi
+    # the repost goes through the publication outbox (retried, at most one post); the
+    # old channel post was removed on accept, so its reference is dropped here
+    if not orders.transition(order_num, 'Qabul qilingan', 'Kanalda', by=uid, courier_id=None, courier_name=None,
+                             returned_count=order.get('returned_count', 0) + 1, last_returned_by=uid,
+                             last_returned_at=datetime.now(timezone.utc).isoformat(),
+                             admin_msgs=[m for m in order.get('admin_msgs') or [] if m.get('admin_id') != BUYURTMALAR_CHANNEL_ID],
+                             publish_job={'created': time.time(), 'attempts': 0, 'reason': 'return'}):
+        await query.answer(f"Buyurtma holati: {order.get('status')} — qaytarib bo'lmaydi.", show_alert=True); return
+    # remove courier message
+    try: await context.bot.delete_message(chat_id=order['courier_msg']['chat_id'], message_id=order['courier_msg']['message_id'])
+    except Exception: pass
+    order.pop('courier_msg', None)
+    persist_orders(order, critical=True)
+    publication_outbox.enqueue(order_num)
+    # Report return action to super-admin
+    try:
+        sa_text = (
+            f"[QAYTARILDI] {datetime.now(timezone.utc).isoformat()}\n"
+            f"Yetkazib beruvchi: {uid} ({update.effective_user.full_name})\n"
+            f"Buyurtma kanalga qaytarildi: #{order_num}\n"
+            f"Mijoz: {order.get('user')} (id: {order.get('user_id')})\n"
+            f"Telefon: {phone_html_link(order.get('phone'))}\n"
+            f"Jami: {order.get('total')} so'm\n"
+            f"Mahsulotlar: {items_text(order.get('items', []))}\n"
+            f"Manzil: https://www.google.com/maps/search/?api=1&query={order.get('loc')}"
+        )
+        await report_superadmin(context.bot, 'QAYTARILDI', order_num, sa_text)
+    except Exception as e:
+        log.warning(f"Superadminga return hisobotini yuborishda xato: {e}")
+    await query.answer('Buyurtma kanalga qaytarildi.')
+    return
+
+
+# FOYDALANUVCHI FUNKSIONALI (o'zgarishsiz)
+# --- Qayta buyurtma (reorder) ---
+@callback_router.route(prefix='reorder_')
+async def cb_reorder(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    try:
+        order_num = int(arg)
+    except Exception:
+        await query.answer("Noto'g'ri buyruq", show_alert=True); return
+    order = find_order(order_num)
+    if not order:
+        await query.answer('Buyurtma topilmadi', show_alert=True); return
+    # ensure only the original user can reorder their own order
+    if uid != order.get('user_id'):
+        await query.answer('Bu buyurtma sizga tegishli emas', show_alert=True); return
+    # build cart from previous order items (priced again at checkout)
+    new_cart = {}
+    for it in order.get('items', []):
+        new_cart[it['product']] = new_cart.get(it['product'], 0) + it['qty']
+    ud = context.user_data
+    ud['cart'] = new_cart
+    # start checkout: ask for phone (same as the normal checkout flow)
+    set_state(ud, 'checkout_state', 'ask_phone')
+    prompt = "Iltimos, bog'lanish mumkin bo'lgan raqamni kiriting (masalan: +998901234567):"
+    try:
+        sent = await context.bot.send_message(chat_id=uid, text=prompt)
+        ud['last_prompt_msg'] = {'chat_id': sent.chat_id, 'message_id': sent.message_id}
+    except Exception:
+        try:
+            await query.message.reply_text(prompt)
+        except Exception:
+            pass
+    try:
+        await query.answer('✅ Savat yangilandi — to‘lov uchun telefon kiriting')
+    except Exception:
+        pass
+    return
+
+
+@callback_router.route(prefix='cat_')
+async def cb_cat(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    cat = arg
+    try:
+        await query.edit_message_text(f"📋 {cat} menyusi:", reply_markup=product_list_kb(cat))
+        # remember last category view for this chat so we can update it when availability changes
+        try:
+            last_category_messages[(query.message.chat_id, cat)] = query.message.message_id
+        except Exception:
+            # if we can't access message fields, ignore
+            pass
+    except Exception:
+        pass
+
+
+@callback_router.route('back_categories')
+async def cb_back_categories(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    try:
+        await query.edit_message_text("Kategoriya tanlang:", reply_markup=category_menu_kb())
+    except BadRequest as e:
+        # This can happen if the current message has no editable text (e.g. a photo message).
+        # Fall back: send a new message with the category keyboard and try to delete the old message.
+        try:
+            await context.bot.send_message(chat_id=query.message.chat_id, text="Kategoriya tanlang:", reply_markup=category_menu_kb())
             try:
-                rem_id = int(text)
-                if rem_id == ADMIN_ID:
-                    resp = None
-                    try:
-                        resp = await update.message.reply_text("⚠️ Asosiy adminni o‘chira olmaysiz.", reply_markup=admin_panel_kb())
-                    except Exception:
-                        pass
-                    # delete admin's own input
-                    try:
-                        await update.message.delete()
-                    except Exception:
-                        pass
-                    # cleanup prompt
-                    try:
-                        sent_prompts = admin_orders_sessions.pop(uid, [])
-                        try:
-                            await _safe_delete_session_messages(context, uid, sent_prompts)
-                        except Exception:
-                            pass
-                    except Exception:
-                        pass
-                    # schedule deletion of the info reply
-                    if resp:
-                        async def _del_later(cid, mid, delay=6):
-                            try:
-                                await asyncio.sleep(delay)
-                                await context.bot.delete_message(chat_id=cid, message_id=mid)
-                            except Exception:
-                                pass
-                        try:
-                            asyncio.create_task(_del_later(resp.chat_id, resp.message_id, 6))
-                        except Exception:
-                            pass
-                elif rem_id in admins:
-                    # remove admin and delete admin's input to avoid clutter
-                    try:
-                        await update.message.delete()
-                    except Exception:
-                        pass
-                    admins.discard(rem_id)
-                    try:
-                        await update.message.reply_text(f"✅ {rem_id} adminlikdan olib tashlandi.", reply_markup=admin_panel_kb())
-                    except Exception:
-                        pass
-                    # cleanup prompt
-                    try:
-                        sent_prompts = admin_orders_sessions.pop(uid, [])
-                        try:
-                            await _safe_delete_session_messages(context, uid, sent_prompts)
-                        except Exception:
-                            pass
-                    except Exception:
-                        pass
-                    try:
-                        sa_text = (
-                            f"[ADMIN O'CHIRILDI] {datetime.now(timezone.utc).isoformat()}\n"
-                            f"O'chirgan admin: {uid} ({update.effective_user.full_name})\n"
-                            f"O'chirilgan admin: {rem_id}"
-                        )
-                        await report_superadmin(context.bot, sa_text)
-                    except Exception as e:
-                        log.warning(f"Superadminga admin remove hisobotini yuborishda xato: {e}")
-                else:
-                    resp = None
-                    try:
-                        resp = await update.message.reply_text("ℹ️ Bu ID adminlar ro‘yxatida yo‘q.", reply_markup=admin_panel_kb())
-                    except Exception:
-                        pass
-                    try:
-                        await update.message.delete()
-                    except Exception:
-                        pass
-                    # cleanup prompt
-                    try:
-                        sent_prompts = admin_orders_sessions.pop(uid, [])
-                        try:
-                            await _safe_delete_session_messages(context, uid, sent_prompts)
-                        except Exception:
-                            pass
-                    except Exception:
-                        pass
-                    if resp:
-                        async def _del_later(cid, mid, delay=6):
-                            try:
-                                await asyncio.sleep(delay)
-                                await context.bot.delete_message(chat_id=cid, message_id=mid)
-                            except Exception:
-                                pass
-                        try:
-                            asyncio.create_task(_del_later(resp.chat_id, resp.message_id, 6))
-                        except Exception:
-                            pass
-            except ValueError:
-                resp = None
-                try:
-                    resp = await update.message.reply_text("❌ Xato ID.", reply_markup=admin_panel_kb())
-                except Exception:
-                    pass
-                try:
-                    await update.message.delete()
-                except Exception:
-                    pass
-                try:
-                    sent_prompts = admin_orders_sessions.pop(uid, [])
-                    try:
-                        await _safe_delete_session_messages(context, uid, sent_prompts)
-                    except Exception:
-                        pass
-                except Exception:
-                    pass
-                if resp:
-                    async def _del_later(cid, mid, delay=6):
-                        try:
-                            await asyncio.sleep(delay)
-                            await context.bot.delete_message(chat_id=cid, message_id=mid)
-                        except Exception:
-                            pass
-                    try:
-                        asyncio.create_task(_del_later(resp.chat_id, resp.message_id, 6))
-                    except Exception:
-                        pass
-                return
-        if ud.get("want_add_courier"):
-            ud.pop("want_add_courier", None)
+                await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
+            except Exception:
+                pass
+        except Exception:
+            # last-resort: ignore
+            pass
+
+
+@callback_router.route(prefix='prod_')
+async def cb_prod(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    cat, prod = arg.split("|")
+    ud.update({"current_cat": cat, "current_prod": prod, "current_qty": 1})
+    info = menu_data[cat][prod]
+    text = f"🍽 {prod}\n\n💰 Narxi: {info.get('price',0)} so‘m\n\n{info.get('desc','')}"
+    # If product has a photo saved (file_id), send photo view; otherwise edit text
+    photo = info.get('photo')
+    if photo:
+        try:
+            # send photo message with caption + keyboard, then delete the previous message
+            await context.bot.send_photo(chat_id=query.message.chat_id, photo=photo, caption=text, reply_markup=quantity_kb(cat, prod, 1))
+            try:
+                await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
+            except Exception:
+                pass
+        except Exception:
+            # fallback to text if sending photo fails
+            try:
+                await query.edit_message_text(text, reply_markup=quantity_kb(cat, prod, 1))
+            except Exception:
+                pass
+    else:
+        try:
+            await query.edit_message_text(text, reply_markup=quantity_kb(cat, prod, 1))
+        except Exception:
+            pass
+
+
+@callback_router.route(prefix='qty_')
+async def cb_qty(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    cat, prod, op = arg.split("|")
+    qty = ud.get("current_qty", 1); qty = max(1, qty - 1) if op == "dec" else qty + 1
+    ud["current_qty"] = qty; await query.edit_message_reply_markup(reply_markup=quantity_kb(cat, prod, qty))
+
+
+@callback_router.route(prefix='add_')
+async def cb_add(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    prod, qty_str = arg.split("|"); qty = int(qty_str)
+    cart = ud["cart"]; cart[prod] = cart.get(prod, 0) + qty
+    text, _ = cart_text_and_total(cart)
+    msg_text = f"✅ {prod} x{qty} savatga qo‘shildi.\n\n{text}"
+    try:
+        await query.edit_message_text(msg_text, reply_markup=cart_menu_kb(bool(cart)))
+    except BadRequest:
+        # If the current message is a media (photo) message, edit_message_text will fail.
+        # Fallback: send a new message with the cart text and delete the old message to avoid duplicates.
+        try:
+            await context.bot.send_message(chat_id=query.message.chat_id, text=msg_text, reply_markup=cart_menu_kb(bool(cart)))
+            try:
+                await context.bot.delete_message(chat_id=query.message.chat_id, message_id=query.message.message_id)
+            except Exception:
+                pass
+        except Exception:
+            # if even sending fails, ignore to avoid crashing
+            pass
+
+
+@callback_router.route('view_cart')
+async def cb_view_cart(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    text, _ = cart_text_and_total(ud["cart"]); await query.edit_message_text(text, reply_markup=cart_menu_kb(bool(ud["cart"])))
+
+
+@callback_router.route('clear_cart')
+async def cb_clear_cart(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    ud["cart"] = {}; await query.edit_message_text("🧹 Savat tozalandi.", reply_markup=cart_menu_kb(False))
+
+
+@callback_router.route('checkout')
+async def cb_checkout(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    if not ud.get("cart"): await query.edit_message_text("🛒 Savat bo‘sh.", reply_markup=category_menu_kb()); return
+    # Ask for phone as plain text (user types it) rather than using request_contact.
+    set_state(ud, 'checkout_state', "ask_phone")
+    prompt = "Iltimos, bog'lanish mumkin bo'lgan raqamni kiriting (masalan: +998901234567):"
+    # send phone prompt and remember its message id so we can delete it later
+    try:
+        sent = await query.message.reply_text(prompt)
+        ud['last_prompt_msg'] = {'chat_id': sent.chat_id, 'message_id': sent.message_id}
+    except Exception:
+        try:
+            # fallback: send directly to user
+            sent = await context.bot.send_message(chat_id=update.effective_user.id, text=prompt)
+            ud['last_prompt_msg'] = {'chat_id': sent.chat_id, 'message_id': sent.message_id}
+        except Exception:
+            pass
+    try:
+        await query.delete_message()
+    except Exception:
+        pass
+
+
+# --- Kuryer uchun callbacklar (alohida funktsiyalar) ---
+@callback_router.route('courier_my_orders', role='courier')
+async def cb_courier_my_orders(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    my_orders = orders.by_courier(uid)
+    if not my_orders:
+        await query.edit_message_text("🚚 Sizga biriktirilgan buyurtmangiz yo'q.")
+        return
+    for o in reversed(my_orders):
+        dt_str = datetime.fromisoformat(o.get('dt')).strftime('%Y-%m-%d %H:%M')
+        text = (
+            f"#{o['order_number']} — {o.get('status')}\n"
+            f"Mijoz: {o.get('user')}\n"
+            f"Tel: {o.get('phone')}\n"
+            f"Mahsulotlar: {items_text(o.get('items', []))}\n"
+            f"Jami: {o.get('total')} so'm\n"
+            f"Manzil: https://www.google.com/maps/search/?api=1&query={o.get('loc')}\n"
+            f"Vaqt: {dt_str}"
+        )
+        await context.bot.send_message(chat_id=uid, text=text)
+    return
+
+
+# BUYURTMANI BEKOR QILISH (YANGILANGAN)
+@callback_router.route(prefix='cancel_order_', order_lock=True)
+async def cb_cancel_order(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    try: order_num = int(arg)
+    except (ValueError, IndexError): await query.answer("Noto'g'ri buyruq", show_alert=True); return
+
+    order = find_order(order_num)
+    if not order: await query.answer("Buyurtma topilmadi", show_alert=True); return
+    # Ruxsat tekshiruvi: faqat buyurtma egasi yoki admin bekor qila oladi
+    is_user_canceling = (uid == order["user_id"])
+    is_admin_canceling = (uid in admins)
+    if not (is_user_canceling or is_admin_canceling):
+        await query.answer("❌ Siz bu buyurtmani bekor qila olmaysiz.", show_alert=True)
+        return
+
+    # Foydalanuvchi faqat "Kutilyapti" holatidagi buyurtmani bekor qilishi mumkin
+    if is_user_canceling and order['status'] != 'Kutilyapti':
+        await query.answer("⏳ Faqat 'Kutilyapti' holatidagi buyurtmani bekor qila olasiz!", show_alert=True); return
+
+    # Admin esa allaqachon yetkazilgan buyurtmani bekor qila olmaydi
+    if is_admin_canceling and order['status'] == 'Yetkazib berildi':
+        await query.answer("Bu buyurtma allaqachon yetkazilgan.", show_alert=True); return
+
+    # Mark the order as canceled instead of deleting it so we keep a record.
+    # This prevents accidental loss of all orders when UI exit/cleanup flows run.
+    expected = ('Kutilyapti', 'Kanalda', 'Qabul qilingan') if is_admin_canceling else 'Kutilyapti'
+    if not orders.transition(order_num, expected, 'Bekor qilindi', by=uid, canceled_by=uid,
+                             canceled_at=datetime.now(timezone.utc).isoformat()):
+        await query.answer(f"Buyurtma holati: {order.get('status')} — bekor qilib bo'lmaydi.", show_alert=True); return
+    # a 'Kanalda' order may still be offered privately to nearby couriers
+    withdraw_offers(order, context.bot)
+    persist_orders(order, critical=True)
+
+    # Vazifani to'xtatish
+    expiry_scheduler.cancel(order_num)
+
+    # Admin xabarlarini tahrirlash/o'chirish
+    for am in order.get("admin_msgs", []):
+        try: await context.bot.edit_message_text(f"❌ Buyurtma #{order_num} bekor qilindi.", chat_id=am["chat_id"], message_id=am["message_id"])
+        except BadRequest: pass
+
+    # Foydalanuvchi xabarini tahrirlash
+    try: await query.edit_message_text(f"❌ Buyurtma #{order_num} bekor qilindi.")
+    except BadRequest: pass
+
+    # Admin bekor qilsa, foydalanuvchiga xabar berish
+    if is_admin_canceling and not is_user_canceling:
+        try: await context.bot.send_message(chat_id=order["user_id"], text=f"⚠️ Sizning #{order_num} buyurtmangiz admin tomonidan bekor qilindi.")
+        except Exception as e: log.warning(f"Foydalanuvchiga bekor qilish haqida yuborishda xato: {e}")
+
+    # Report cancel action to super-admin
+    try:
+        canceller = update.effective_user
+        sa_text = (
+            f"[BEKOR QILINDI] {datetime.now(timezone.utc).isoformat()}\n"
+            f"Bekor qilgan: {canceller.id} ({canceller.full_name})\n"
+            f"Buyurtma: #{order_num}\n"
+            f"Mijoz: {order.get('user')} (id: {order.get('user_id')})\n"
+            f"Telefon: {phone_html_link(order.get('phone'))}\n"
+            f"Jami: {order.get('total')} so'm\n"
+            f"Mahsulotlar: {items_text(order.get('items', []))}"
+        )
+        await report_superadmin(context.bot, 'BEKOR QILINDI', order_num, sa_text)
+    except Exception as e:
+        log.warning(f"Superadminga cancel hisobotini yuborishda xato: {e}")
+    return
+
+
+# Admin: exit from active-orders view and cleanup messages
+@callback_router.route('admin_orders_exit', role='admin')
+async def cb_admin_orders_exit(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    # delete all messages and transient prompts for this admin's session
+    try:
+        await clear_admin_session(uid, context, ud)
+    except Exception:
+        pass
+    # Restore admin panel on the original query message
+    try:
+        await query.edit_message_text("🔑 Admin panelga xush kelibsiz!", reply_markup=admin_panel_kb())
+    except Exception:
+        pass
+    await query.answer()
+    return
+
+
+# --- User confirmation for admin-proposed edit ---
+@callback_router.route(prefix='ae_user_confirm_', order_lock=True)
+async def cb_ae_user_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, query, data: str, uid: int, ud: dict, arg: str):
+    # format: ae_user_confirm_<order>_approve|reject
+    try: order_num_str, action = arg.split('_'); order_num = int(order_num_str)
+    except Exception:
+        await query.answer('Noto\'g\'ri buyruq', show_alert=True); return
+    order = find_order(order_num)
+    if not order:
+        await query.answer('Buyurtma topilmadi', show_alert=True); return
+    uid = update.effective_user.id
+    if uid != order.get('user_id'):
+        await query.answer('Bu tasdiq sizga tegishli emas', show_alert=True); return
+    if action == 'approve':
+        # apply proposed
+        if 'proposed_items' not in order:
+            await query.answer('Hech qanday taklif topilmadi', show_alert=True); return
+        set_order_items(order, list(order['proposed_items']))
+        # cleanup
+        order.pop('proposed_items', None); order.pop('proposed_total', None)
+        prop_by = order.pop('proposed_by_admin', None)
+        persist_orders(order)
+        # update channel/admin msgs
+        for am in order.get('admin_msgs', []):
+            try:
+                await context.bot.edit_message_text(chat_id=am['chat_id'], message_id=am['message_id'], text=order.get('original_text',''))
+            except Exception:
+                pass
+        # update superadmin message
+        sam = order.get('superadmin_msg')
+        if sam:
             try:
-                cid = int(text)
-                # delete admin input to avoid clutter
-                try:
-                    await update.message.delete()
-                except Exception:
-                    pass
-                couriers.add(cid); persist_couriers()
-                try:
-                    await context.bot.send_message(chat_id=uid, text=f"✅ {cid} yetkazib beruvchi sifatida qo‘shildi.", reply_markup=admin_panel_kb())
-                except Exception:
-                    pass
-                # cleanup prompt (only delete messages that were sent into admin's private chat)
-                try:
-                    sent_prompts = admin_orders_sessions.pop(uid, [])
-                    try:
-                        await _safe_delete_session_messages(context, uid, sent_prompts)
-                    except Exception:
-                        pass
-                except Exception:
-                    pass
-                # report to super-admin
+                await context.bot.edit_message_text(chat_id=sam['chat_id'], message_id=sam['message_id'], text=build_superadmin_order_text(order), reply_markup=build_superadmin_kb(order), parse_mode='HTML')
+            except Exception:
+                pass
+        # notify admin who proposed
+        if prop_by:
+            try:
+                await context.bot.send_message(chat_id=prop_by, text=f"✅ Mijoz buyurtma #{order_num} tahririni qabul qildi.")
+            except Exception:
+                pass
+        await query.edit_message_text('✅ Sizning o\'zgartirishlaringiz qabul qilindi. Rahmat!')
+        return
+    else:
+        # rejected
+        order.pop('proposed_items', None); order.pop('proposed_total', None); prop_by = order.pop('proposed_by_admin', None)
+        persist_orders(order)
+        if prop_by:
+            try: await context.bot.send_message(chat_id=prop_by, text=f"❌ Mijoz buyurtma #{order_num} tahririni rad etdi.")
+            except Exception: pass
+        await query.edit_message_text('❌ Siz o\'zgartirishni rad qildingiz.')
+        return
+
+
+# ========== XABAR HANDLERLARI ==========
+async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id; text = (update.message.text or "").strip(); ud = context.user_data; ud.setdefault("cart", {})
+    # later parts of a broadcast album arrive after the state has been consumed
+    mgid = update.message.media_group_id
+    if uid in admins and mgid and mgid in broadcast_albums:
+        await collect_broadcast_album(update.message, context.bot, uid, None)
+        return
+    if await conversation.dispatch(update, context, uid, text, ud):
+        return
+    await start(update, context)
+
+
+# Courier receipt photo flow: if courier is expected to submit a payment receipt image
+@conversation.state('expecting_receipt_for', role='courier', sticky=True, order_lock=True)
+async def st_expecting_receipt_for(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, text: str, ud: dict, data):
+    if not update.message.photo:
+        return False
+    try:
+        order_num = int(state_data(ud, 'expecting_receipt_for'))
+        order = find_order(order_num)
+        if not order:
+            await update.message.reply_text('Buyurtma topilmadi.'); clear_state(ud, 'expecting_receipt_for'); return
+        # save highest-resolution photo file_id as receipt proof and finalize delivery
+        file_id = update.message.photo[-1].file_id
+        if not orders.transition(order_num, 'Qabul qilingan', 'Yetkazib berildi', by=uid,
+                                 receipt_photo=file_id, collected_amount=order.get('total')):
+            clear_state(ud, 'expecting_receipt_for')
+            await update.message.reply_text(f"Buyurtma holati: {order.get('status')} — yetkazildi deb belgilab bo'lmaydi."); return
+        cid = uid
+        rec = earnings.get(cid, {'total': 0, 'deliveries': []})
+        rec['total'] = rec.get('total', 0) + order.get('total', 0)
+        rec.setdefault('deliveries', []).append(order_num)
+        earnings[cid] = rec
+        persist_earnings(cid)
+        persist_orders(order, critical=True)
+        # notify user with friendly message
+        try:
+            await context.bot.send_message(chat_id=order['user_id'], text=f"✅ Sizning #{order_num} buyurtmangiz yetkazib berildi. Yoqimli ishtaha! 🍽️")
+        except Exception as e:
+            log.warning(f"Foydalanuvchiga yetkazildi xabarida xato: {e}")
+        # edit courier message to indicate delivered and attach note
+        try:
+            await context.bot.edit_message_text(chat_id=order['courier_msg']['chat_id'], message_id=order['courier_msg']['message_id'], text="✅ Yetkazildi (Onlayn to'lov, chek yuklandi)")
+        except Exception:
+            pass
+        # send receipt photo to payments channel for records
+        try:
+            await context.bot.send_photo(chat_id=PAYMENTS_CHANNEL_ID, photo=file_id, caption=f"[CHEK] Buyurtma #{order_num} — Yetkazib beruvchi: {cid} — Mijoz: {order.get('user')} — Jami: {order.get('total')} so'm")
+        except Exception:
+            pass
+        clear_state(ud, 'expecting_receipt_for')
+        await update.message.reply_text('✅ Chek qabul qilindi, buyurtma yetkazildi va yozildi. Rahmat!')
+        return
+    except Exception as e:
+        log.warning(f"Receipt photo handling error: {e}")
+
+
+# Courier OTP flow: if courier was asked to provide OTP for an order
+@conversation.state('expecting_otp_for', role='courier', sticky=True, order_lock=True)
+async def st_expecting_otp_for(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, text: str, ud: dict, data):
+    try:
+        order_num = int(state_data(ud, 'expecting_otp_for'))
+        order = find_order(order_num)
+        if not order:
+            await update.message.reply_text('Buyurtma topilmadi.'); clear_state(ud, 'expecting_otp_for'); return
+        # compare OTP
+        if text == str(order.get('otp')):
+            # OTP correct
+            # If payment was cash -> finalize immediately
+            if order.get('payment') == 'cash':
+                if not orders.transition(order_num, 'Qabul qilingan', 'Yetkazib berildi', by=uid, collected_amount=order.get('total')):
+                    clear_state(ud, 'expecting_otp_for')
+                    await update.message.reply_text(f"Buyurtma holati: {order.get('status')} — yetkazildi deb belgilab bo'lmaydi."); return
+                # update courier earnings
+                cid = uid
+                rec = earnings.get(cid, {'total': 0, 'deliveries': []})
+                rec['total'] = rec.get('total', 0) + order.get('total', 0)
+                rec.setdefault('deliveries', []).append(order_num)
+                earnings[cid] = rec
+                persist_earnings(cid)
+                persist_orders(order, critical=True)
+                # notify user
+                try: await context.bot.send_message(chat_id=order['user_id'], text=f"✅ Sizning #{order_num} buyurtmangiz yetkazib berildi. (Naqd to'lov qabul qilindi)")
+                except Exception as e: log.warning(f"Foydalanuvchiga yetkazildi xabarida xato: {e}")
+                # edit courier message
+                try: await context.bot.edit_message_text(chat_id=order['courier_msg']['chat_id'], message_id=order['courier_msg']['message_id'], text="✅ Yetkazildi (Naqd to'lov)")
+                except Exception: pass
+                # report to superadmin
                 try:
                     sa_text = (
-                        f"[YETKAZIB BERUVCHI QO'SHILDI] {datetime.now(timezone.utc).isoformat()}\n"
-                        f"Qo'shgan admin: {uid} ({update.effective_user.full_name})\n"
-                        f"Yangi yetkazib beruvchi: {cid}"
+                        f"[YETKAZILDI-NAQD] {datetime.now(timezone.utc).isoformat()}\n"
+                        f"Yetkazib beruvchi: {cid} ({update.effective_user.full_name})\n"
+                        f"Buyurtma: #{order_num}\n"
+                        f"Mijoz: {order.get('user')} (id: {order.get('user_id')})\n"
+                        f"Telefon: {phone_html_link(order.get('phone'))}\n"
+                        f"Jami: {order.get('total')} so'm\n"
+                        f"Naqd qabul qilindi: {order.get('total')} so'm"
                     )
-                    await report_superadmin(context.bot, sa_text)
+                    await report_superadmin(context.bot, 'YETKAZILDI-NAQD', order_num, sa_text)
                 except Exception as e:
-                    log.warning(f"Superadminga courier add hisobotini yuborishda xato: {e}")
-            except ValueError:
-                resp = None
+                    log.warning(f"Superadminga cash delivered hisobotini yuborishda xato: {e}")
+                clear_state(ud, 'expecting_otp_for')
+                await update.message.reply_text('✅ OTP tekshirildi, buyurtma yetkazildi.')
+                return
+            # If payment was card -> ask courier to upload receipt photo
+            elif order.get('payment') == 'card':
+                clear_state(ud, 'expecting_otp_for')
+                set_state(context.user_data, 'expecting_receipt_for', order_num)
                 try:
-                    resp = await update.message.reply_text("❌ Xato ID.", reply_markup=admin_panel_kb())
+                    await context.bot.send_message(chat_id=uid, text=f"✅ OTP tasdiqlandi. Endi iltimos mijozdan chekni (screenshot yoki bank ilovasidagi kvitansiya) so'rang va shu chatga rasm sifatida yuboring. Cheksiz buyurtma tasdiqlanmaydi.")
                 except Exception:
                     pass
+                await update.message.reply_text('Iltimos, chek rasmini yuboring...')
+                return
+            else:
+                # fallback finalize
+                if not orders.transition(order_num, 'Qabul qilingan', 'Yetkazib berildi', by=uid):
+                    clear_state(ud, 'expecting_otp_for')
+                    await update.message.reply_text(f"Buyurtma holati: {order.get('status')} — yetkazildi deb belgilab bo'lmaydi."); return
+                persist_orders(order, critical=True)
+                try: await context.bot.send_message(chat_id=order['user_id'], text=f"✅ Sizning #{order_num} buyurtmangiz yetkazib berildi.")
+                except Exception as e: log.warning(f"Foydalanuvchiga yetkazildi xabarida xato: {e}")
+                try: await context.bot.edit_message_text(chat_id=order['courier_msg']['chat_id'], message_id=order['courier_msg']['message_id'], text="✅ Yetkazildi")
+                except Exception: pass
+                clear_state(ud, 'expecting_otp_for')
+                await update.message.reply_text('✅ OTP tekshirildi, buyurtma yetkazildi.')
+                return
+        else:
+            await update.message.reply_text('❌ Noto‘g‘ri OTP. Iltimos qayta urinib ko‘ring.')
+            return
+    except Exception as e:
+        log.warning(f"OTP flow error: {e}")
+        clear_state(ud, 'expecting_otp_for')
+        return
+
+
+# If admin is composing a reply to a suggestion, forward their message to the target user
+@conversation.state('want_reply_to', role='admin', sticky=True)
+async def st_want_reply_to(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, text: str, ud: dict, data):
+    try:
+        info = clear_state(ud, 'want_reply_to')
+        if info:
+            target = info.get('target_user')
+            chan_msg_id = info.get('channel_msg_id')
+            # Forward whatever the admin just sent to the target user (this includes text, media, etc.)
+            try:
+                # copy the admin's message to the user so it appears sent by the bot (anonymous)
                 try:
-                    await update.message.delete()
+                    await context.bot.copy_message(chat_id=target, from_chat_id=uid, message_id=update.message.message_id)
                 except Exception:
-                    pass
+                    # fallback: if copy_message fails (older clients), send text or media manually
+                    if update.message.text:
+                        await context.bot.send_message(chat_id=target, text=update.message.text)
+                    elif update.message.photo:
+                        # send largest photo
+                        photo = update.message.photo[-1].file_id
+                        await context.bot.send_photo(chat_id=target, photo=photo, caption=update.message.caption or '')
+                    elif update.message.sticker:
+                        await context.bot.send_sticker(chat_id=target, sticker=update.message.sticker.file_id)
+                    elif update.message.document:
+                        await context.bot.send_document(chat_id=target, document=update.message.document.file_id, caption=update.message.caption or '')
+                    else:
+                        # as last resort, send text representation
+                        txt = update.message.text or '[media]'
+                        await context.bot.send_message(chat_id=target, text=txt)
+                # send a short confirmation to admin (will be deleted shortly)
                 try:
-                    sent_prompts = admin_orders_sessions.pop(uid, [])
-                    try:
-                        await _safe_delete_session_messages(context, uid, sent_prompts)
-                    except Exception:
-                        pass
-                except Exception:
-                    pass
-                if resp:
+                    resp = await context.bot.send_message(chat_id=uid, text='✅ Javob mijozga yuborildi.')
                     async def _del_later(cid, mid, delay=6):
                         try:
                             await asyncio.sleep(delay)
@@ -2826,79 +4985,47 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         asyncio.create_task(_del_later(resp.chat_id, resp.message_id, 6))
                     except Exception:
                         pass
-                return
-        if ud.get("want_remove_courier"):
-            ud.pop("want_remove_courier", None)
+                except Exception:
+                    pass
+            except Exception:
+                # fallback: send as text if forward failed
+                try:
+                    if update.message.text:
+                        await context.bot.send_message(chat_id=target, text=update.message.text)
+                        await update.message.reply_text('✅ Javob mijozga yuborildi.')
+                    else:
+                        await update.message.reply_text('❌ Xabar yuborilmadi. Iltimos, matn yoki media yuboring va qayta urinib ko‘ring.')
+                except Exception:
+                    pass
+            # Post admin's reply anonymously as a reply to the original suggestion in the suggestions channel,
+            # and also clean up admin-side forwarded copies and prompts.
             try:
-                rcid = int(text)
-                if rcid in couriers:
-                    try:
-                        await update.message.delete()
-                    except Exception:
-                        pass
-                    couriers.discard(rcid); persist_couriers()
-                    try:
-                        await context.bot.send_message(chat_id=uid, text=f"✅ {rcid} yetkazib beruvchi ro'yxatidan olib tashlandi.", reply_markup=admin_panel_kb())
-                    except Exception:
-                        pass
-                    # cleanup prompt (only delete messages that were sent into admin's private chat)
-                    try:
-                        sent_prompts = admin_orders_sessions.pop(uid, [])
-                        try:
-                            await _safe_delete_session_messages(context, uid, sent_prompts)
-                        except Exception:
-                            pass
-                    except Exception:
-                        pass
-                    try:
-                        sa_text = (
-                            f"[YETKAZIB BERUVCHI O'CHIRILDI] {datetime.now(timezone.utc).isoformat()}\n"
-                            f"O'chirgan admin: {uid} ({update.effective_user.full_name})\n"
-                            f"O'chirilgan yetkazib beruvchi: {rcid}"
-                        )
-                        await report_superadmin(context.bot, sa_text)
-                    except Exception as e:
-                        log.warning(f"Superadminga courier remove hisobotini yuborishda xato: {e}")
-                else:
-                    resp = None
+                if chan_msg_id:
                     try:
-                        resp = await update.message.reply_text("ℹ️ Bu ID yetkazib beruvchilar ro‘yxatida yo‘q.", reply_markup=admin_panel_kb())
-                    except Exception:
-                        pass
-                    try:
-                        await update.message.delete()
-                    except Exception:
-                        pass
-                    # cleanup prompt
-                    try:
-                        sent_prompts = admin_orders_sessions.pop(uid, [])
+                        # copy admin's message into the suggestions channel as a reply_to the original message
                         try:
-                            await _safe_delete_session_messages(context, uid, sent_prompts)
+                            await context.bot.copy_message(chat_id=SUGGESTIONS_CHANNEL_ID, from_chat_id=uid, message_id=update.message.message_id, reply_to_message_id=chan_msg_id)
                         except Exception:
-                            pass
+                            # fallback: send text or caption as bot reply
+                            if update.message.text:
+                                await context.bot.send_message(chat_id=SUGGESTIONS_CHANNEL_ID, text=update.message.text, reply_to_message_id=chan_msg_id)
+                            elif update.message.photo:
+                                photo = update.message.photo[-1].file_id
+                                await context.bot.send_photo(chat_id=SUGGESTIONS_CHANNEL_ID, photo=photo, caption=update.message.caption or '', reply_to_message_id=chan_msg_id)
+                            else:
+                                await context.bot.send_message(chat_id=SUGGESTIONS_CHANNEL_ID, text='✅ Javob berildi.', reply_to_message_id=chan_msg_id)
                     except Exception:
+                        # ignore failures posting into channel
                         pass
-                    if resp:
-                        async def _del_later(cid, mid, delay=6):
-                            try:
-                                await asyncio.sleep(delay)
-                                await context.bot.delete_message(chat_id=cid, message_id=mid)
-                            except Exception:
-                                pass
-                        try:
-                            asyncio.create_task(_del_later(resp.chat_id, resp.message_id, 6))
-                        except Exception:
-                            pass
-            except ValueError:
-                resp = None
-                try:
-                    resp = await update.message.reply_text("❌ Xato ID.", reply_markup=admin_panel_kb())
-                except Exception:
-                    pass
+            except Exception:
+                pass
+            try:
+                # remove admin's own sent message to avoid clutter
                 try:
                     await update.message.delete()
                 except Exception:
                     pass
+                # delete any recorded prompt/forward copies we stored in admin_orders_sessions
                 try:
                     sent_prompts = admin_orders_sessions.pop(uid, [])
                     try:
@@ -2907,372 +5034,834 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         pass
                 except Exception:
                     pass
-                if resp:
-                    async def _del_later(cid, mid, delay=6):
-                        try:
-                            await asyncio.sleep(delay)
-                            await context.bot.delete_message(chat_id=cid, message_id=mid)
-                        except Exception:
-                            pass
-                    try:
-                        asyncio.create_task(_del_later(resp.chat_id, resp.message_id, 6))
-                    except Exception:
-                        pass
-                return
-        # Admin: menu-edit text flows
-        if ud.get('amenu_adding_category'):
-            ud.pop('amenu_adding_category', None)
-            cat_name = text.strip()
-            if not cat_name:
-                # cleanup admin input and prompts
+            except Exception:
+                pass
+    except Exception as e:
+        log.warning(f"Admin reply error: {e}")
+    return
+
+
+# Support reply-keyboard exit button from admin orders view
+@conversation.button('🔙 Chiqish', role='admin')
+async def btn_admin_exit(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, text: str, ud: dict):
+    # delete the user's own reply message (the '🔙 Chiqish' text) to avoid leaving it in chat
+    try:
+        await update.message.delete()
+    except Exception:
+        pass
+    # central cleanup of admin session prompts/messages and transient state
+    try:
+        await clear_admin_session(uid, context, ud)
+    except Exception:
+        pass
+        # Best-effort: also remove any stored admin_orders_sessions entries (redundant safe-guard)
+        try:
+            sent_msgs = admin_orders_sessions.pop(uid, [])
+            try:
+                await _safe_delete_session_messages(context, uid, sent_msgs)
+            except Exception:
+                pass
+        except Exception:
+            pass
+    # restore admin panel
+    try:
+        await context.bot.send_message(chat_id=uid, text="🔑 Admin panelga xush kelibsiz!", reply_markup=admin_panel_kb())
+    except Exception:
+        pass
+    return
+
+
+@conversation.state('want_broadcast', role='admin')
+async def st_want_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, text: str, ud: dict, data):
+    # Re-send the admin message by file_id/text so media + captions are preserved
+    segment = clear_state(ud, "want_broadcast")
+    if update.message.media_group_id:
+        await collect_broadcast_album(update.message, context.bot, uid, segment)
+    else:
+        await launch_broadcast(update.message, context.bot, uid, broadcast_payload(update.message), segment)
+    # cleanup any admin prompt messages (e.g., the 'enter message' prompt)
+    try:
+        sent_prompts = admin_orders_sessions.pop(uid, [])
+        try:
+            await _safe_delete_session_messages(context, uid, sent_prompts)
+        except Exception:
+            pass
+    except Exception:
+        pass
+    return
+
+
+@conversation.state('want_add_admin', role='admin')
+async def st_want_add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, text: str, ud: dict, data):
+    clear_state(ud, 'want_add_admin')
+    try:
+        admins.add(int(text))
+        try:
+            await update.message.delete()
+        except Exception:
+            pass
+        try:
+            await context.bot.send_message(chat_id=uid, text=f"✅ {text} admin sifatida qo‘shildi.", reply_markup=admin_panel_kb())
+        except Exception:
+            pass
+        # cleanup prompt message (only delete messages that were sent into admin's private chat)
+        try:
+            sent_prompts = admin_orders_sessions.pop(uid, [])
+            try:
+                await _safe_delete_session_messages(context, uid, sent_prompts)
+            except Exception:
+                pass
+        except Exception:
+            pass
+        try:
+            sa_text = (
+                f"[ADMIN QO'SHILDI] {datetime.now(timezone.utc).isoformat()}\n"
+                f"Qo'shgan admin: {uid} ({update.effective_user.full_name})\n"
+                f"Yangi admin: {text}"
+            )
+            await report_superadmin(context.bot, "ADMIN QO'SHILDI", None, sa_text)
+        except Exception as e:
+            log.warning(f"Superadminga admin add hisobotini yuborishda xato: {e}")
+    except ValueError:
+        resp = None
+        try:
+            resp = await update.message.reply_text("❌ Xato ID.", reply_markup=admin_panel_kb())
+        except Exception:
+            pass
+        # delete the admin's input message to avoid clutter
+        try:
+            await update.message.delete()
+        except Exception:
+            pass
+        # cleanup prompt messages (only delete messages that were sent into admin's private chat)
+        try:
+            sent_prompts = admin_orders_sessions.pop(uid, [])
+            try:
+                await _safe_delete_session_messages(context, uid, sent_prompts)
+            except Exception:
+                pass
+        except Exception:
+            pass
+        # schedule deletion of the bot's error reply after a short delay
+        if resp:
+            async def _del_later(cid, mid, delay=6):
                 try:
-                    await update.message.delete()
+                    await asyncio.sleep(delay)
+                    await context.bot.delete_message(chat_id=cid, message_id=mid)
                 except Exception:
                     pass
+            try:
+                asyncio.create_task(_del_later(resp.chat_id, resp.message_id, 6))
+            except Exception:
+                pass
+        return
+
+
+@conversation.state('want_remove_admin', role='admin')
+async def st_want_remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, text: str, ud: dict, data):
+    clear_state(ud, 'want_remove_admin')
+    try:
+        rem_id = int(text)
+        if rem_id == ADMIN_ID:
+            resp = None
+            try:
+                resp = await update.message.reply_text("⚠️ Asosiy adminni o‘chira olmaysiz.", reply_markup=admin_panel_kb())
+            except Exception:
+                pass
+            # delete admin's own input
+            try:
+                await update.message.delete()
+            except Exception:
+                pass
+            # cleanup prompt
+            try:
+                sent_prompts = admin_orders_sessions.pop(uid, [])
                 try:
-                    lp = ud.pop('amenu_last_prompt', None)
-                    if lp:
-                        try:
-                            await context.bot.delete_message(chat_id=lp.get('chat_id'), message_id=lp.get('message_id'))
-                        except Exception:
-                            pass
+                    await _safe_delete_session_messages(context, uid, sent_prompts)
                 except Exception:
                     pass
-                try:
-                    sent = admin_orders_sessions.pop(uid, [])
+            except Exception:
+                pass
+            # schedule deletion of the info reply
+            if resp:
+                async def _del_later(cid, mid, delay=6):
                     try:
-                        await _safe_delete_session_messages(context, uid, sent)
+                        await asyncio.sleep(delay)
+                        await context.bot.delete_message(chat_id=cid, message_id=mid)
                     except Exception:
                         pass
-                except Exception:
-                    pass
-                await context.bot.send_message(chat_id=uid, text="❌ Bo'sh nom qabul qilinmaydi.", reply_markup=admin_panel_kb())
-                return
-            if cat_name in menu_data:
                 try:
-                    await update.message.delete()
-                except Exception:
-                    pass
-                try:
-                    lp = ud.pop('amenu_last_prompt', None)
-                    if lp:
-                        try:
-                            await context.bot.delete_message(chat_id=lp.get('chat_id'), message_id=lp.get('message_id'))
-                        except Exception:
-                            pass
+                    asyncio.create_task(_del_later(resp.chat_id, resp.message_id, 6))
                 except Exception:
                     pass
+        elif rem_id in admins:
+            # remove admin and delete admin's input to avoid clutter
+            try:
+                await update.message.delete()
+            except Exception:
+                pass
+            admins.discard(rem_id)
+            try:
+                await update.message.reply_text(f"✅ {rem_id} adminlikdan olib tashlandi.", reply_markup=admin_panel_kb())
+            except Exception:
+                pass
+            # cleanup prompt
+            try:
+                sent_prompts = admin_orders_sessions.pop(uid, [])
                 try:
-                    sent = admin_orders_sessions.pop(uid, [])
-                    try:
-                        await _safe_delete_session_messages(context, uid, sent)
-                    except Exception:
-                        pass
+                    await _safe_delete_session_messages(context, uid, sent_prompts)
                 except Exception:
                     pass
-                await context.bot.send_message(chat_id=uid, text="ℹ️ Bunday kategoriya allaqachon mavjud.", reply_markup=admin_panel_kb())
-                return
-            menu_data[cat_name] = {}
-            persist_menu()
-            # try to delete the admin's input to avoid clutter
+            except Exception:
+                pass
             try:
-                await update.message.delete()
+                sa_text = (
+                    f"[ADMIN O'CHIRILDI] {datetime.now(timezone.utc).isoformat()}\n"
+                    f"O'chirgan admin: {uid} ({update.effective_user.full_name})\n"
+                    f"O'chirilgan admin: {rem_id}"
+                )
+                await report_superadmin(context.bot, "ADMIN O'CHIRILDI", None, sa_text)
+            except Exception as e:
+                log.warning(f"Superadminga admin remove hisobotini yuborishda xato: {e}")
+        else:
+            resp = None
+            try:
+                resp = await update.message.reply_text("ℹ️ Bu ID adminlar ro‘yxatida yo‘q.", reply_markup=admin_panel_kb())
             except Exception:
                 pass
-            # cleanup prompts/sessions and return updated menu view
             try:
-                lp = ud.pop('amenu_last_prompt', None)
-                if lp:
-                    try:
-                        await context.bot.delete_message(chat_id=lp.get('chat_id'), message_id=lp.get('message_id'))
-                    except Exception:
-                        pass
+                await update.message.delete()
             except Exception:
                 pass
+            # cleanup prompt
             try:
-                sent = admin_orders_sessions.pop(uid, [])
+                sent_prompts = admin_orders_sessions.pop(uid, [])
                 try:
-                    await _safe_delete_session_messages(context, uid, sent)
+                    await _safe_delete_session_messages(context, uid, sent_prompts)
                 except Exception:
                     pass
             except Exception:
                 pass
-            # send updated categories list (return to admin edit menu)
-            try:
-                rows = [[InlineKeyboardButton(cat, callback_data=f"amenu_cat_{cat}")] for cat in menu_data.keys()]
-                rows.append([InlineKeyboardButton("➕ Kategoriya qo'shish", callback_data="amenu_add_category")])
-                rows.append([InlineKeyboardButton('◀️ Bekor', callback_data='admin_panel')])
-                await context.bot.send_message(chat_id=uid, text='Menyuni tahrirlash — kategoriya tanlang:', reply_markup=InlineKeyboardMarkup(rows))
-            except Exception:
-                # fallback: show admin panel
-                try:
-                    await context.bot.send_message(chat_id=uid, text=f"✅ '{cat_name}' nomli kategoriya qo'shildi.", reply_markup=admin_panel_kb())
-                except Exception:
-                    pass
-            return
-        # Admin: step-by-step product creation flow
-        if ud.get('amenu_add_product_step'):
-            step = ud.get('amenu_add_product_step')
-            cat = ud.get('amenu_add_product_cat')
-            # Helper: delete last bot prompt if present
-            async def _cleanup_last_prompt():
-                lp = ud.pop('amenu_last_prompt', None)
-                if lp:
+            if resp:
+                async def _del_later(cid, mid, delay=6):
                     try:
-                        await context.bot.delete_message(chat_id=lp['chat_id'], message_id=lp['message_id'])
+                        await asyncio.sleep(delay)
+                        await context.bot.delete_message(chat_id=cid, message_id=mid)
                     except Exception:
                         pass
-
-            # If admin sent a photo (for photo step)
-            if step == 'photo' and update.message.photo:
-                # save photo file_id
-                file_id = update.message.photo[-1].file_id
-                ud['amenu_new_photo'] = file_id
-                # cleanup previous messages
-                try:
-                    await update.message.delete()
-                except Exception:
-                    pass
-                await _cleanup_last_prompt()
-                # finalize product
-                name = ud.pop('amenu_new_name', None)
-                price = ud.pop('amenu_new_price', None)
-                desc = ud.pop('amenu_new_desc', '')
-                photo = ud.pop('amenu_new_photo', None)
-                ud.pop('amenu_add_product_step', None); ud.pop('amenu_add_product_cat', None)
-                if not name or price is None:
-                    await context.bot.send_message(chat_id=uid, text='❌ Mahsulot nomi yoki narxi topilmadi. Qayta urinib ko\'ring.', reply_markup=admin_panel_kb())
-                    return
-                if cat not in menu_data: menu_data[cat] = {}
-                entry = {'price': price, 'desc': desc, 'available': True}
-                if photo: entry['photo'] = photo
-                menu_data[cat][name] = entry
-                persist_menu()
-                # send updated category view
                 try:
-                    rows = [[InlineKeyboardButton(f"{n} — {i.get('price',0)} so'm", callback_data=f"amenu_prod_{cat}|{n}")] for n,i in menu_data.get(cat,{}).items()]
-                    rows.append([InlineKeyboardButton('◀️ Orqaga', callback_data='admin_edit_menu'), InlineKeyboardButton('🔙 Admin panel', callback_data='admin_panel')])
-                    await context.bot.send_message(chat_id=uid, text=f"{cat} — mahsulotlarni tanlang:", reply_markup=InlineKeyboardMarkup(rows))
-                    # cleanup any stored admin session prompts
-                    try:
-                        sent = admin_orders_sessions.pop(uid, [])
-                        try:
-                            await _safe_delete_session_messages(context, uid, sent)
-                        except Exception:
-                            pass
-                    except Exception:
-                        pass
+                    asyncio.create_task(_del_later(resp.chat_id, resp.message_id, 6))
                 except Exception:
                     pass
+    except ValueError:
+        resp = None
+        try:
+            resp = await update.message.reply_text("❌ Xato ID.", reply_markup=admin_panel_kb())
+        except Exception:
+            pass
+        try:
+            await update.message.delete()
+        except Exception:
+            pass
+        try:
+            sent_prompts = admin_orders_sessions.pop(uid, [])
+            try:
+                await _safe_delete_session_messages(context, uid, sent_prompts)
+            except Exception:
+                pass
+        except Exception:
+            pass
+        if resp:
+            async def _del_later(cid, mid, delay=6):
                 try:
-                    refresh_category_views(context, cat)
+                    await asyncio.sleep(delay)
+                    await context.bot.delete_message(chat_id=cid, message_id=mid)
                 except Exception:
                     pass
-                return
+            try:
+                asyncio.create_task(_del_later(resp.chat_id, resp.message_id, 6))
+            except Exception:
+                pass
+        return
 
-            # Otherwise handle text steps
-            if step == 'name' and text:
-                ud['amenu_new_name'] = text.strip()
-                # delete admin's text to avoid clutter
-                try:
-                    await update.message.delete()
-                except Exception:
-                    pass
-                # delete last bot prompt
-                await (lambda: _cleanup_last_prompt())()
-                # ask for price
-                try:
-                    sent = await context.bot.send_message(chat_id=uid, text='Iltimos, mahsulot narxini kiriting (faqat raqam):')
-                    ud['amenu_last_prompt'] = {'chat_id': sent.chat_id, 'message_id': sent.message_id}
-                except Exception:
-                    pass
-                ud['amenu_add_product_step'] = 'price'
-                return
 
-            if step == 'price' and text:
-                try:
-                    price = int(text.strip())
-                except Exception:
-                    await update.message.reply_text('Narx butun son bo\'lishi kerak. Iltimos faqat raqam yuboring.')
-                    return
-                ud['amenu_new_price'] = price
-                try:
-                    await update.message.delete()
-                except Exception:
-                    pass
-                await (lambda: _cleanup_last_prompt())()
-                # ask for description
+@conversation.state('want_add_courier', role='admin')
+async def st_want_add_courier(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, text: str, ud: dict, data):
+    clear_state(ud, 'want_add_courier')
+    try:
+        cid = int(text)
+        # delete admin input to avoid clutter
+        try:
+            await update.message.delete()
+        except Exception:
+            pass
+        couriers.add(cid); persist_couriers(cid)
+        try:
+            await context.bot.send_message(chat_id=uid, text=f"✅ {cid} yetkazib beruvchi sifatida qo‘shildi.", reply_markup=admin_panel_kb())
+        except Exception:
+            pass
+        # cleanup prompt (only delete messages that were sent into admin's private chat)
+        try:
+            sent_prompts = admin_orders_sessions.pop(uid, [])
+            try:
+                await _safe_delete_session_messages(context, uid, sent_prompts)
+            except Exception:
+                pass
+        except Exception:
+            pass
+        # report to super-admin
+        try:
+            sa_text = (
+                f"[YETKAZIB BERUVCHI QO'SHILDI] {datetime.now(timezone.utc).isoformat()}\n"
+                f"Qo'shgan admin: {uid} ({update.effective_user.full_name})\n"
+                f"Yangi yetkazib beruvchi: {cid}"
+            )
+            await report_superadmin(context.bot, "YETKAZIB BERUVCHI QO'SHILDI", None, sa_text)
+        except Exception as e:
+            log.warning(f"Superadminga courier add hisobotini yuborishda xato: {e}")
+    except ValueError:
+        resp = None
+        try:
+            resp = await update.message.reply_text("❌ Xato ID.", reply_markup=admin_panel_kb())
+        except Exception:
+            pass
+        try:
+            await update.message.delete()
+        except Exception:
+            pass
+        try:
+            sent_prompts = admin_orders_sessions.pop(uid, [])
+            try:
+                await _safe_delete_session_messages(context, uid, sent_prompts)
+            except Exception:
+                pass
+        except Exception:
+            pass
+        if resp:
+            async def _del_later(cid, mid, delay=6):
                 try:
-                    sent = await context.bot.send_message(chat_id=uid, text='Mahsulot tavsifini yuboring:')
-                    ud['amenu_last_prompt'] = {'chat_id': sent.chat_id, 'message_id': sent.message_id}
+                    await asyncio.sleep(delay)
+                    await context.bot.delete_message(chat_id=cid, message_id=mid)
                 except Exception:
                     pass
-                ud['amenu_add_product_step'] = 'desc'
-                return
+            try:
+                asyncio.create_task(_del_later(resp.chat_id, resp.message_id, 6))
+            except Exception:
+                pass
+        return
 
-            if step == 'desc' and text is not None:
-                ud['amenu_new_desc'] = text.strip()
-                try:
-                    await update.message.delete()
-                except Exception:
-                    pass
-                await (lambda: _cleanup_last_prompt())()
-                # ask for photo (optional)
+
+@conversation.state('want_remove_courier', role='admin')
+async def st_want_remove_courier(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, text: str, ud: dict, data):
+    clear_state(ud, 'want_remove_courier')
+    try:
+        rcid = int(text)
+        if rcid in couriers:
+            try:
+                await update.message.delete()
+            except Exception:
+                pass
+            couriers.discard(rcid); persist_couriers(rcid)
+            try:
+                await context.bot.send_message(chat_id=uid, text=f"✅ {rcid} yetkazib beruvchi ro'yxatidan olib tashlandi.", reply_markup=admin_panel_kb())
+            except Exception:
+                pass
+            # cleanup prompt (only delete messages that were sent into admin's private chat)
+            try:
+                sent_prompts = admin_orders_sessions.pop(uid, [])
                 try:
-                    sent = await context.bot.send_message(chat_id=uid, text="Iltimos, mahsulot rasmini yuboring (yubormasangiz 'skip' deb yozing):")
-                    ud['amenu_last_prompt'] = {'chat_id': sent.chat_id, 'message_id': sent.message_id}
+                    await _safe_delete_session_messages(context, uid, sent_prompts)
                 except Exception:
                     pass
-                ud['amenu_add_product_step'] = 'photo'
-                return
-
-            # allow skipping photo by sending 'skip'
-            if step == 'photo' and text.lower() in ('skip','/skip'):
-                # finalize without photo
-                await (lambda: _cleanup_last_prompt())()
+            except Exception:
+                pass
+            try:
+                sa_text = (
+                    f"[YETKAZIB BERUVCHI O'CHIRILDI] {datetime.now(timezone.utc).isoformat()}\n"
+                    f"O'chirgan admin: {uid} ({update.effective_user.full_name})\n"
+                    f"O'chirilgan yetkazib beruvchi: {rcid}"
+                )
+                await report_superadmin(context.bot, "YETKAZIB BERUVCHI O'CHIRILDI", None, sa_text)
+            except Exception as e:
+                log.warning(f"Superadminga courier remove hisobotini yuborishda xato: {e}")
+        else:
+            resp = None
+            try:
+                resp = await update.message.reply_text("ℹ️ Bu ID yetkazib beruvchilar ro‘yxatida yo‘q.", reply_markup=admin_panel_kb())
+            except Exception:
+                pass
+            try:
+                await update.message.delete()
+            except Exception:
+                pass
+            # cleanup prompt
+            try:
+                sent_prompts = admin_orders_sessions.pop(uid, [])
                 try:
-                    await update.message.delete()
+                    await _safe_delete_session_messages(context, uid, sent_prompts)
                 except Exception:
                     pass
-                name = ud.pop('amenu_new_name', None)
-                price = ud.pop('amenu_new_price', None)
-                desc = ud.pop('amenu_new_desc', '')
-                ud.pop('amenu_add_product_step', None); ud.pop('amenu_add_product_cat', None)
-                if not name or price is None:
-                    await context.bot.send_message(chat_id=uid, text='❌ Ma\'lumot yetarli emas, qayta urinib ko\'ring.', reply_markup=admin_panel_kb())
-                    return
-                if cat not in menu_data: menu_data[cat] = {}
-                menu_data[cat][name] = {'price': price, 'desc': desc, 'available': True}
-                persist_menu()
-                try:
-                    rows = [[InlineKeyboardButton(f"{n} — {i.get('price',0)} so'm", callback_data=f"amenu_prod_{cat}|{n}")] for n,i in menu_data.get(cat,{}).items()]
-                    rows.append([InlineKeyboardButton('◀️ Orqaga', callback_data='admin_edit_menu'), InlineKeyboardButton('🔙 Admin panel', callback_data='admin_panel')])
-                    await context.bot.send_message(chat_id=uid, text=f"{cat} — mahsulotlarni tanlang:", reply_markup=InlineKeyboardMarkup(rows))
-                    # cleanup any stored admin session prompts
+            except Exception:
+                pass
+            if resp:
+                async def _del_later(cid, mid, delay=6):
                     try:
-                        sent = admin_orders_sessions.pop(uid, [])
-                        try:
-                            await _safe_delete_session_messages(context, uid, sent)
-                        except Exception:
-                            pass
+                        await asyncio.sleep(delay)
+                        await context.bot.delete_message(chat_id=cid, message_id=mid)
                     except Exception:
                         pass
+                try:
+                    asyncio.create_task(_del_later(resp.chat_id, resp.message_id, 6))
                 except Exception:
                     pass
-                return
-        if ud.get('amenu_edit_price'):
-            cat_prod = ud.pop('amenu_edit_price', None)
-            if not cat_prod:
-                await update.message.reply_text('Noto\'g\'ri holat.'); return
-            cat, prod = cat_prod
+    except ValueError:
+        resp = None
+        try:
+            resp = await update.message.reply_text("❌ Xato ID.", reply_markup=admin_panel_kb())
+        except Exception:
+            pass
+        try:
+            await update.message.delete()
+        except Exception:
+            pass
+        try:
+            sent_prompts = admin_orders_sessions.pop(uid, [])
             try:
-                new_price = int(text.strip())
+                await _safe_delete_session_messages(context, uid, sent_prompts)
             except Exception:
-                await update.message.reply_text('Narx butun son bo\'lishi kerak.'); return
-            if cat in menu_data and prod in menu_data[cat]:
-                menu_data[cat][prod]['price'] = new_price
-                persist_menu()
-                try:
-                    refresh_category_views(context, cat)
-                except Exception:
-                    pass
-                # delete admin input and any stored prompts/sessions to avoid leftovers
-                try:
-                    await update.message.delete()
-                except Exception:
-                    pass
-                try:
-                    lp = ud.pop('amenu_last_prompt', None)
-                    if lp:
-                        try:
-                            await context.bot.delete_message(chat_id=lp.get('chat_id'), message_id=lp.get('message_id'))
-                        except Exception:
-                            pass
-                except Exception:
-                    pass
+                pass
+        except Exception:
+            pass
+        if resp:
+            async def _del_later(cid, mid, delay=6):
                 try:
-                    sent = admin_orders_sessions.pop(uid, [])
-                    try:
-                        await _safe_delete_session_messages(context, uid, sent)
-                    except Exception:
-                        pass
+                    await asyncio.sleep(delay)
+                    await context.bot.delete_message(chat_id=cid, message_id=mid)
                 except Exception:
                     pass
-                await context.bot.send_message(chat_id=uid, text=f"✅ '{prod}' narxi yangilandi: {new_price} so'm", reply_markup=admin_panel_kb())
-            else:
+            try:
+                asyncio.create_task(_del_later(resp.chat_id, resp.message_id, 6))
+            except Exception:
+                pass
+        return
+
+
+# Admin: menu-edit text flows
+@conversation.state('amenu_adding_category', role='admin')
+async def st_amenu_adding_category(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, text: str, ud: dict, data):
+    clear_state(ud, 'amenu_adding_category')
+    cat_name = text.strip()
+    if not cat_name:
+        # cleanup admin input and prompts
+        try:
+            await update.message.delete()
+        except Exception:
+            pass
+        try:
+            lp = ud.pop('amenu_last_prompt', None)
+            if lp:
                 try:
-                    await update.message.delete()
+                    await context.bot.delete_message(chat_id=lp.get('chat_id'), message_id=lp.get('message_id'))
                 except Exception:
                     pass
+        except Exception:
+            pass
+        try:
+            sent = admin_orders_sessions.pop(uid, [])
+            try:
+                await _safe_delete_session_messages(context, uid, sent)
+            except Exception:
+                pass
+        except Exception:
+            pass
+        await context.bot.send_message(chat_id=uid, text="❌ Bo'sh nom qabul qilinmaydi.", reply_markup=admin_panel_kb())
+        return
+    if cat_name in menu_data:
+        try:
+            await update.message.delete()
+        except Exception:
+            pass
+        try:
+            lp = ud.pop('amenu_last_prompt', None)
+            if lp:
                 try:
-                    lp = ud.pop('amenu_last_prompt', None)
-                    if lp:
-                        try:
-                            await context.bot.delete_message(chat_id=lp.get('chat_id'), message_id=lp.get('message_id'))
-                        except Exception:
-                            pass
+                    await context.bot.delete_message(chat_id=lp.get('chat_id'), message_id=lp.get('message_id'))
                 except Exception:
                     pass
-                try:
-                    sent = admin_orders_sessions.pop(uid, [])
-                    try:
-                        await _safe_delete_session_messages(context, uid, sent)
-                    except Exception:
-                        pass
+        except Exception:
+            pass
+        try:
+            sent = admin_orders_sessions.pop(uid, [])
+            try:
+                await _safe_delete_session_messages(context, uid, sent)
+            except Exception:
+                pass
+        except Exception:
+            pass
+        await context.bot.send_message(chat_id=uid, text="ℹ️ Bunday kategoriya allaqachon mavjud.", reply_markup=admin_panel_kb())
+        return
+    menu_data[cat_name] = {}
+    persist_menu()
+    # try to delete the admin's input to avoid clutter
+    try:
+        await update.message.delete()
+    except Exception:
+        pass
+    # cleanup prompts/sessions and return updated menu view
+    try:
+        lp = ud.pop('amenu_last_prompt', None)
+        if lp:
+            try:
+                await context.bot.delete_message(chat_id=lp.get('chat_id'), message_id=lp.get('message_id'))
+            except Exception:
+                pass
+    except Exception:
+        pass
+    try:
+        sent = admin_orders_sessions.pop(uid, [])
+        try:
+            await _safe_delete_session_messages(context, uid, sent)
+        except Exception:
+            pass
+    except Exception:
+        pass
+    # send updated categories list (return to admin edit menu)
+    try:
+        rows = [[InlineKeyboardButton(cat, callback_data=f"amenu_cat_{cat}")] for cat in menu_data.keys()]
+        rows.append([InlineKeyboardButton("➕ Kategoriya qo'shish", callback_data="amenu_add_category")])
+        rows.append([InlineKeyboardButton('◀️ Bekor', callback_data='admin_panel')])
+        await context.bot.send_message(chat_id=uid, text='Menyuni tahrirlash — kategoriya tanlang:', reply_markup=InlineKeyboardMarkup(rows))
+    except Exception:
+        # fallback: show admin panel
+        try:
+            await context.bot.send_message(chat_id=uid, text=f"✅ '{cat_name}' nomli kategoriya qo'shildi.", reply_markup=admin_panel_kb())
+        except Exception:
+            pass
+    return
+
+
+# Admin: step-by-step product creation flow
+@conversation.state('amenu_add_product_step', role='admin')
+async def st_amenu_add_product_step(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, text: str, ud: dict, data):
+    step = state_data(ud, 'amenu_add_product_step')
+    cat = ud.get('amenu_add_product_cat')
+    # Helper: delete last bot prompt if present
+    async def _cleanup_last_prompt():
+        lp = ud.pop('amenu_last_prompt', None)
+        if lp:
+            try:
+                await context.bot.delete_message(chat_id=lp['chat_id'], message_id=lp['message_id'])
+            except Exception:
+                pass
+
+    # If admin sent a photo (for photo step)
+    if step == 'photo' and update.message.photo:
+        # save photo file_id
+        file_id = update.message.photo[-1].file_id
+        ud['amenu_new_photo'] = file_id
+        # cleanup previous messages
+        try:
+            await update.message.delete()
+        except Exception:
+            pass
+        await _cleanup_last_prompt()
+        # finalize product
+        name = ud.pop('amenu_new_name', None)
+        price = ud.pop('amenu_new_price', None)
+        desc = ud.pop('amenu_new_desc', '')
+        photo = ud.pop('amenu_new_photo', None)
+        clear_state(ud, 'amenu_add_product_step'); ud.pop('amenu_add_product_cat', None)
+        if not name or price is None:
+            await context.bot.send_message(chat_id=uid, text='❌ Mahsulot nomi yoki narxi topilmadi. Qayta urinib ko\'ring.', reply_markup=admin_panel_kb())
+            return
+        if cat not in menu_data: menu_data[cat] = {}
+        entry = {'price': price, 'desc': desc, 'available': True}
+        if photo: entry['photo'] = photo
+        menu_data[cat][name] = entry
+        persist_menu()
+        # send updated category view
+        try:
+            rows = [[InlineKeyboardButton(f"{n} — {i.get('price',0)} so'm", callback_data=f"amenu_prod_{cat}|{n}")] for n,i in menu_data.get(cat,{}).items()]
+            rows.append([InlineKeyboardButton('◀️ Orqaga', callback_data='admin_edit_menu'), InlineKeyboardButton('🔙 Admin panel', callback_data='admin_panel')])
+            await context.bot.send_message(chat_id=uid, text=f"{cat} — mahsulotlarni tanlang:", reply_markup=InlineKeyboardMarkup(rows))
+            # cleanup any stored admin session prompts
+            try:
+                sent = admin_orders_sessions.pop(uid, [])
+                try:
+                    await _safe_delete_session_messages(context, uid, sent)
                 except Exception:
                     pass
-                await context.bot.send_message(chat_id=uid, text='Mahsulot topilmadi', reply_markup=admin_panel_kb())
+            except Exception:
+                pass
+        except Exception:
+            pass
+        try:
+            refresh_category_views(context, cat)
+        except Exception:
+            pass
+        return
+
+    # Otherwise handle text steps
+    if step == 'name' and text:
+        ud['amenu_new_name'] = text.strip()
+        # delete admin's text to avoid clutter
+        try:
+            await update.message.delete()
+        except Exception:
+            pass
+        # delete last bot prompt
+        await (lambda: _cleanup_last_prompt())()
+        # ask for price
+        try:
+            sent = await context.bot.send_message(chat_id=uid, text='Iltimos, mahsulot narxini kiriting (faqat raqam):')
+            ud['amenu_last_prompt'] = {'chat_id': sent.chat_id, 'message_id': sent.message_id}
+        except Exception:
+            pass
+        set_state(ud, 'amenu_add_product_step', 'price')
+        return
+
+    if step == 'price' and text:
+        try:
+            price = int(text.strip())
+        except Exception:
+            await update.message.reply_text('Narx butun son bo\'lishi kerak. Iltimos faqat raqam yuboring.')
             return
-        if ud.get('amenu_edit_desc'):
-            cat_prod = ud.pop('amenu_edit_desc', None)
-            if not cat_prod:
-                await update.message.reply_text('Noto\'g\'ri holat.'); return
-            cat, prod = cat_prod
-            new_desc = text.strip()
-            if cat in menu_data and prod in menu_data[cat]:
-                menu_data[cat][prod]['desc'] = new_desc
-                persist_menu()
+        ud['amenu_new_price'] = price
+        try:
+            await update.message.delete()
+        except Exception:
+            pass
+        await (lambda: _cleanup_last_prompt())()
+        # ask for description
+        try:
+            sent = await context.bot.send_message(chat_id=uid, text='Mahsulot tavsifini yuboring:')
+            ud['amenu_last_prompt'] = {'chat_id': sent.chat_id, 'message_id': sent.message_id}
+        except Exception:
+            pass
+        set_state(ud, 'amenu_add_product_step', 'desc')
+        return
+
+    if step == 'desc' and text is not None:
+        ud['amenu_new_desc'] = text.strip()
+        try:
+            await update.message.delete()
+        except Exception:
+            pass
+        await (lambda: _cleanup_last_prompt())()
+        # ask for photo (optional)
+        try:
+            sent = await context.bot.send_message(chat_id=uid, text="Iltimos, mahsulot rasmini yuboring (yubormasangiz 'skip' deb yozing):")
+            ud['amenu_last_prompt'] = {'chat_id': sent.chat_id, 'message_id': sent.message_id}
+        except Exception:
+            pass
+        set_state(ud, 'amenu_add_product_step', 'photo')
+        return
+
+    # allow skipping photo by sending 'skip'
+    if step == 'photo' and text.lower() in ('skip','/skip'):
+        # finalize without photo
+        await (lambda: _cleanup_last_prompt())()
+        try:
+            await update.message.delete()
+        except Exception:
+            pass
+        name = ud.pop('amenu_new_name', None)
+        price = ud.pop('amenu_new_price', None)
+        desc = ud.pop('amenu_new_desc', '')
+        clear_state(ud, 'amenu_add_product_step'); ud.pop('amenu_add_product_cat', None)
+        if not name or price is None:
+            await context.bot.send_message(chat_id=uid, text='❌ Ma\'lumot yetarli emas, qayta urinib ko\'ring.', reply_markup=admin_panel_kb())
+            return
+        if cat not in menu_data: menu_data[cat] = {}
+        menu_data[cat][name] = {'price': price, 'desc': desc, 'available': True}
+        persist_menu()
+        try:
+            rows = [[InlineKeyboardButton(f"{n} — {i.get('price',0)} so'm", callback_data=f"amenu_prod_{cat}|{n}")] for n,i in menu_data.get(cat,{}).items()]
+            rows.append([InlineKeyboardButton('◀️ Orqaga', callback_data='admin_edit_menu'), InlineKeyboardButton('🔙 Admin panel', callback_data='admin_panel')])
+            await context.bot.send_message(chat_id=uid, text=f"{cat} — mahsulotlarni tanlang:", reply_markup=InlineKeyboardMarkup(rows))
+            # cleanup any stored admin session prompts
+            try:
+                sent = admin_orders_sessions.pop(uid, [])
                 try:
-                    refresh_category_views(context, cat)
+                    await _safe_delete_session_messages(context, uid, sent)
                 except Exception:
                     pass
-                # cleanup admin input and prompts
+            except Exception:
+                pass
+        except Exception:
+            pass
+        return
+
+
+@conversation.state('amenu_edit_price', role='admin')
+async def st_amenu_edit_price(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, text: str, ud: dict, data):
+    cat_prod = clear_state(ud, 'amenu_edit_price')
+    if not cat_prod:
+        await update.message.reply_text('Noto\'g\'ri holat.'); return
+    cat, prod = cat_prod
+    try:
+        new_price = int(text.strip())
+    except Exception:
+        await update.message.reply_text('Narx butun son bo\'lishi kerak.'); return
+    if cat in menu_data and prod in menu_data[cat]:
+        menu_data[cat][prod]['price'] = new_price
+        persist_menu()
+        try:
+            refresh_category_views(context, cat)
+        except Exception:
+            pass
+        # delete admin input and any stored prompts/sessions to avoid leftovers
+        try:
+            await update.message.delete()
+        except Exception:
+            pass
+        try:
+            lp = ud.pop('amenu_last_prompt', None)
+            if lp:
                 try:
-                    await update.message.delete()
+                    await context.bot.delete_message(chat_id=lp.get('chat_id'), message_id=lp.get('message_id'))
                 except Exception:
                     pass
+        except Exception:
+            pass
+        try:
+            sent = admin_orders_sessions.pop(uid, [])
+            try:
+                await _safe_delete_session_messages(context, uid, sent)
+            except Exception:
+                pass
+        except Exception:
+            pass
+        await context.bot.send_message(chat_id=uid, text=f"✅ '{prod}' narxi yangilandi: {new_price} so'm", reply_markup=admin_panel_kb())
+    else:
+        try:
+            await update.message.delete()
+        except Exception:
+            pass
+        try:
+            lp = ud.pop('amenu_last_prompt', None)
+            if lp:
                 try:
-                    lp = ud.pop('amenu_last_prompt', None)
-                    if lp:
-                        try:
-                            await context.bot.delete_message(chat_id=lp.get('chat_id'), message_id=lp.get('message_id'))
-                        except Exception:
-                            pass
+                    await context.bot.delete_message(chat_id=lp.get('chat_id'), message_id=lp.get('message_id'))
                 except Exception:
                     pass
+        except Exception:
+            pass
+        try:
+            sent = admin_orders_sessions.pop(uid, [])
+            try:
+                await _safe_delete_session_messages(context, uid, sent)
+            except Exception:
+                pass
+        except Exception:
+            pass
+        await context.bot.send_message(chat_id=uid, text='Mahsulot topilmadi', reply_markup=admin_panel_kb())
+    return
+
+
+@conversation.state('amenu_edit_desc', role='admin')
+async def st_amenu_edit_desc(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, text: str, ud: dict, data):
+    cat_prod = clear_state(ud, 'amenu_edit_desc')
+    if not cat_prod:
+        await update.message.reply_text('Noto\'g\'ri holat.'); return
+    cat, prod = cat_prod
+    new_desc = text.strip()
+    if cat in menu_data and prod in menu_data[cat]:
+        menu_data[cat][prod]['desc'] = new_desc
+        persist_menu()
+        try:
+            refresh_category_views(context, cat)
+        except Exception:
+            pass
+        # cleanup admin input and prompts
+        try:
+            await update.message.delete()
+        except Exception:
+            pass
+        try:
+            lp = ud.pop('amenu_last_prompt', None)
+            if lp:
                 try:
-                    sent = admin_orders_sessions.pop(uid, [])
-                    try:
-                        await _safe_delete_session_messages(context, uid, sent)
-                    except Exception:
-                        pass
+                    await context.bot.delete_message(chat_id=lp.get('chat_id'), message_id=lp.get('message_id'))
                 except Exception:
                     pass
-                await context.bot.send_message(chat_id=uid, text=f"✅ '{prod}' tavsifi yangilandi.", reply_markup=admin_panel_kb())
-            else:
+        except Exception:
+            pass
+        try:
+            sent = admin_orders_sessions.pop(uid, [])
+            try:
+                await _safe_delete_session_messages(context, uid, sent)
+            except Exception:
+                pass
+        except Exception:
+            pass
+        await context.bot.send_message(chat_id=uid, text=f"✅ '{prod}' tavsifi yangilandi.", reply_markup=admin_panel_kb())
+    else:
+        try:
+            await update.message.delete()
+        except Exception:
+            pass
+        try:
+            lp = ud.pop('amenu_last_prompt', None)
+            if lp:
                 try:
-                    await update.message.delete()
+                    await context.bot.delete_message(chat_id=lp.get('chat_id'), message_id=lp.get('message_id'))
                 except Exception:
                     pass
+        except Exception:
+            pass
+        try:
+            sent = admin_orders_sessions.pop(uid, [])
+            try:
+                await _safe_delete_session_messages(context, uid, sent)
+            except Exception:
+                pass
+        except Exception:
+            pass
+        await context.bot.send_message(chat_id=uid, text='Mahsulot topilmadi', reply_markup=admin_panel_kb())
+    return
+
+
+# Admin: handle photo upload for editing product image
+@conversation.state('amenu_edit_photo', role='admin')
+async def st_amenu_edit_photo(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, text: str, ud: dict, data):
+    # expecting a photo message from admin
+    if update.message.photo:
+        cat, prod = clear_state(ud, 'amenu_edit_photo', (None, None))
+        # take highest-resolution photo file_id
+        file_id = update.message.photo[-1].file_id
+        # cleanup admin message and last prompt
+        try:
+            await update.message.delete()
+        except Exception:
+            pass
+        try:
+            lp = ud.pop('amenu_last_prompt', None)
+            if lp:
                 try:
-                    lp = ud.pop('amenu_last_prompt', None)
-                    if lp:
-                        try:
-                            await context.bot.delete_message(chat_id=lp.get('chat_id'), message_id=lp.get('message_id'))
-                        except Exception:
-                            pass
+                    await context.bot.delete_message(chat_id=lp['chat_id'], message_id=lp['message_id'])
                 except Exception:
                     pass
+        except Exception:
+            pass
+        if not cat or not prod:
+            try:
+                await context.bot.send_message(chat_id=uid, text='Noto\'g\'ri holat — qayta urinib ko\'ring.', reply_markup=admin_panel_kb())
+            except Exception:
+                pass
+            return
+        # save to menu_data
+        try:
+            if cat not in menu_data:
+                menu_data[cat] = {}
+            menu_data[cat].setdefault(prod, {})['photo'] = file_id
+            persist_menu()
+            try:
+                refresh_category_views(context, cat)
+            except Exception:
+                pass
+            try:
+                # cleanup any stored admin session prompts
                 try:
                     sent = admin_orders_sessions.pop(uid, [])
                     try:
@@ -3281,532 +5870,425 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         pass
                 except Exception:
                     pass
-                await context.bot.send_message(chat_id=uid, text='Mahsulot topilmadi', reply_markup=admin_panel_kb())
-            return
-        # Admin: handle photo upload for editing product image
-        if ud.get('amenu_edit_photo'):
-            # expecting a photo message from admin
-            if update.message.photo:
-                cat, prod = ud.pop('amenu_edit_photo', (None, None))
-                # take highest-resolution photo file_id
-                file_id = update.message.photo[-1].file_id
-                # cleanup admin message and last prompt
-                try:
-                    await update.message.delete()
-                except Exception:
-                    pass
-                try:
-                    lp = ud.pop('amenu_last_prompt', None)
-                    if lp:
-                        try:
-                            await context.bot.delete_message(chat_id=lp['chat_id'], message_id=lp['message_id'])
-                        except Exception:
-                            pass
-                except Exception:
-                    pass
-                if not cat or not prod:
-                    try:
-                        await context.bot.send_message(chat_id=uid, text='Noto\'g\'ri holat — qayta urinib ko\'ring.', reply_markup=admin_panel_kb())
-                    except Exception:
-                        pass
-                    return
-                # save to menu_data
-                try:
-                    if cat not in menu_data:
-                        menu_data[cat] = {}
-                    menu_data[cat].setdefault(prod, {})['photo'] = file_id
-                    persist_menu()
-                    try:
-                        refresh_category_views(context, cat)
-                    except Exception:
-                        pass
-                    try:
-                        # cleanup any stored admin session prompts
-                        try:
-                            sent = admin_orders_sessions.pop(uid, [])
-                            try:
-                                await _safe_delete_session_messages(context, uid, sent)
-                            except Exception:
-                                pass
-                        except Exception:
-                            pass
-                        await context.bot.send_message(chat_id=uid, text=f"✅ '{prod}' uchun yangi rasm saqlandi.", reply_markup=admin_panel_kb())
-                    except Exception:
-                        pass
-                except Exception as e:
-                    log.warning(f"Rasmni saqlashda xato: {e}")
-                return
-            else:
-                # if admin sent non-photo, prompt again
-                await update.message.reply_text('Iltimos, faqat rasm yuboring yoki /cancel bilan bekor qiling.')
-                return
-    # Admin adding product via super-admin add flow
-    if uid in admins and ud.get('sa_adding_order'):
-        try:
-            order_num = int(ud.pop('sa_adding_order'))
-        except Exception:
-            await update.message.reply_text('Noto\'g\'ri buyruq yoki vaqt tugadi.'); return
-        order = find_order(order_num)
-        if not order:
-            await update.message.reply_text('Buyurtma topilmadi.'); return
-        # expect text like: Name | qty
-        if '|' not in text:
-            await update.message.reply_text('Format: Nomi | miqdor (masalan: Lavash | 1)'); return
-        name_part, qty_part = text.split('|', 1)
-        name = name_part.strip()
-        try: qty = int(qty_part.strip())
-        except Exception:
-            await update.message.reply_text('Miqdor butun son bo\'lishi kerak.'); return
-        items = list(order.get('items', []))
-        items.append(f"{name} x{qty}")
-        # recompute total
-        total = 0
-        for it in items:
-            if ' x' in it:
-                nm, q = it.rsplit(' x', 1); q = int(q)
-            else:
-                nm = it; q = 1
-            total += product_price(nm) * q
-        order['items'] = items
-        order['total'] = total
-        persist_orders()
-        # update superadmin message if exists
-        sam = order.get('superadmin_msg')
-        if sam:
-            try:
-                await context.bot.edit_message_text(chat_id=sam['chat_id'], message_id=sam['message_id'], text=build_superadmin_order_text(order), reply_markup=build_superadmin_kb(order), parse_mode='HTML')
+                await context.bot.send_message(chat_id=uid, text=f"✅ '{prod}' uchun yangi rasm saqlandi.", reply_markup=admin_panel_kb())
             except Exception:
                 pass
-        await update.message.reply_text('✅ Mahsulot qo\'shildi va super-admin oynasi yangilandi.')
+        except Exception as e:
+            log.warning(f"Rasmni saqlashda xato: {e}")
         return
-    # (previous simple text-edit flow removed; admin uses item-level editor now)
+    else:
+        # if admin sent non-photo, prompt again
+        await update.message.reply_text('Iltimos, faqat rasm yuboring yoki /cancel bilan bekor qiling.')
+        return
+
 
-    # --- Quick reply handlers for regular users (reply-keyboard buttons) ---
-    # If user is in profile setup (first-start questionnaire), handle that first
-    if uid not in admins and ud.get('profile_setup') == 'name':
-        # Capture the user's provided full name, save to users_info and finish onboarding
-        name = text.strip()
-        if not name:
+# Admin adding product via super-admin add flow
+@conversation.state('sa_adding_order', role='admin', order_lock=True)
+async def st_sa_adding_order(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, text: str, ud: dict, data):
+    try:
+        order_num = int(clear_state(ud, 'sa_adding_order'))
+    except Exception:
+        await update.message.reply_text('Noto\'g\'ri buyruq yoki vaqt tugadi.'); return
+    order = find_order(order_num)
+    if not order:
+        await update.message.reply_text('Buyurtma topilmadi.'); return
+    # expect text like: Name | qty
+    if '|' not in text:
+        await update.message.reply_text('Format: Nomi | miqdor (masalan: Lavash | 1)'); return
+    name_part, qty_part = text.split('|', 1)
+    name = name_part.strip()
+    try: qty = int(qty_part.strip())
+    except Exception:
+        await update.message.reply_text('Miqdor butun son bo\'lishi kerak.'); return
+    items = list(order.get('items', []))
+    items.append(line_item(name, qty))
+    set_order_items(order, items)
+    persist_orders(order)
+    # update superadmin message if exists
+    sam = order.get('superadmin_msg')
+    if sam:
+        try:
+            await context.bot.edit_message_text(chat_id=sam['chat_id'], message_id=sam['message_id'], text=build_superadmin_order_text(order), reply_markup=build_superadmin_kb(order), parse_mode='HTML')
+        except Exception:
+            pass
+    await update.message.reply_text('✅ Mahsulot qo\'shildi va super-admin oynasi yangilandi.')
+    return
+
+
+# (previous simple text-edit flow removed; admin uses item-level editor now)
+# --- Quick reply handlers for regular users (reply-keyboard buttons) ---
+# If user is in profile setup (first-start questionnaire), handle that first
+@conversation.state('profile_setup', role='user', sticky=True)
+async def st_profile_setup(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, text: str, ud: dict, data):
+    if data != 'name':
+        return False
+    # Capture the user's provided full name, save to users_info and finish onboarding
+    name = text.strip()
+    if not name:
+        try:
+            await update.message.reply_text("Iltimos, ismingizni yozing:")
+        except Exception:
+            pass
+        return
+    # persist name in users_info (phone will be collected during checkout)
+    try:
+        users_info[uid] = {'name': name, 'phone': '', 'username': update.effective_user.username or ''}
+        persist_users_info(uid)
+    except Exception:
+        pass
+    # cleanup and show main keyboard
+    try:
+        await update.message.delete()
+    except Exception:
+        pass
+    clear_state(ud, 'profile_setup')
+    try:
+        user_kb = ReplyKeyboardMarkup([
+            [KeyboardButton("🍔 Menyu"), KeyboardButton("Taklif va shikoyatlar")],
+            [KeyboardButton("🧾 Buyurtmalar tarixi")]
+        ], resize_keyboard=True, one_time_keyboard=False)
+        await context.bot.send_message(chat_id=uid, text=f"✅ Profilingiz saqlandi. Salom, {name}!", reply_markup=user_kb)
+    except Exception:
+        pass
+    return
+
+
+# If the user pressed the exit button while viewing menu, restore main keyboard
+@conversation.button('🔙 Chiqish', 'Bekor qilish', '❌ Bekor qilish', role='user')
+async def btn_exit(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, text: str, ud: dict):
+    # the old messages are deleted in bulk in the background, after the main keyboard is sent
+    with message_cleaner.deferred():
+        await _exit_to_main_keyboard(update, context, uid, ud)
+
+
+async def _exit_to_main_keyboard(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, ud: dict):
+    # the exit button itself, stored menu messages (exit button, category message, remove message),
+    # history messages ('Buyurtmalar tarixi') and, if the user was in the suggestions/complaints
+    # flow, the suggestions sent to the channel and the suggest prompt
+    refs = [{'chat_id': update.message.chat_id, 'message_id': update.message.message_id}] if update.message else []
+    refs += ud.pop('menu_messages', None) or []
+    refs += ud.pop('history_messages', None) or []
+    refs += ud.pop('sent_suggestions', None) or []
+    refs.append(ud.pop('suggest_prompt', None))
+    message_cleaner.schedule_refs(context.bot, refs)
+    clear_state(ud, 'contact_admin')
+    try:
+        user_kb = ReplyKeyboardMarkup([
+            [KeyboardButton("🍔 Menyu"), KeyboardButton("Taklif va shikoyatlar")],
+            [KeyboardButton("🧾 Buyurtmalar tarixi")]
+        ], resize_keyboard=True, one_time_keyboard=False)
+        try:
+            sent_w = await context.bot.send_message(chat_id=uid, text="🍔 Fast Food botiga xush kelibsiz! Quyidagi tugmalardan foydalaning:", reply_markup=user_kb)
+            # store welcome message id so it can be deleted next time menu is opened
             try:
-                await update.message.reply_text("Iltimos, ismingizni yozing:")
+                ud['welcome_msg'] = {'chat_id': sent_w.chat_id, 'message_id': sent_w.message_id, 'text': "🍔 Fast Food botiga xush kelibsiz! Quyidagi tugmalardan foydalaning:"}
             except Exception:
                 pass
-            return
-        # persist name in users_info (phone will be collected during checkout)
+        except Exception:
+            pass
+    except Exception:
+        pass
+    return
+
+
+# Show categories when user presses the reply 'Menyu' button
+@conversation.button('🍔 Menyu', role='user')
+async def btn_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, text: str, ud: dict):
+    try:
+        # delete the welcome message (if stored) so it doesn't remain while in-menu
+        try:
+            wm = ud.pop('welcome_msg', None)
+            if wm:
+                try:
+                    await context.bot.delete_message(chat_id=wm.get('chat_id'), message_id=wm.get('message_id'))
+                except Exception:
+                    pass
+        except Exception:
+            pass
+        # Remove the main reply keyboard first so the original buttons disappear,
+        # then send a single-button reply keyboard with only '🔙 Chiqish'.
+        menu_msgs = []
         try:
-            users_info[uid] = {'name': name, 'phone': '', 'username': update.effective_user.username or ''}
-            persist_users_info()
+            sent_rm = await context.bot.send_message(chat_id=uid, text='\u200b', reply_markup=ReplyKeyboardRemove())
+            menu_msgs.append({'chat_id': sent_rm.chat_id, 'message_id': sent_rm.message_id})
         except Exception:
             pass
-        # cleanup and show main keyboard
         try:
-            await update.message.delete()
+            exit_kb = ReplyKeyboardMarkup([[KeyboardButton('🔙 Chiqish')]], resize_keyboard=True, one_time_keyboard=True)
+            sent_exit = await context.bot.send_message(chat_id=uid, text='chiqish uchun:', reply_markup=exit_kb)
+            menu_msgs.append({'chat_id': sent_exit.chat_id, 'message_id': sent_exit.message_id})
         except Exception:
             pass
-        ud.pop('profile_setup', None)
+        # Show the inline category menu (categories use inline keyboard)
         try:
-            user_kb = ReplyKeyboardMarkup([
-                [KeyboardButton("🍔 Menyu"), KeyboardButton("Taklif va shikoyatlar")],
-                [KeyboardButton("🧾 Buyurtmalar tarixi")]
-            ], resize_keyboard=True, one_time_keyboard=False)
-            await context.bot.send_message(chat_id=uid, text=f"✅ Profilingiz saqlandi. Salom, {name}!", reply_markup=user_kb)
+            sent_cat = await context.bot.send_message(chat_id=uid, text="Kategoriya tanlang:", reply_markup=category_menu_kb())
+            menu_msgs.append({'chat_id': sent_cat.chat_id, 'message_id': sent_cat.message_id})
         except Exception:
             pass
-        return
+        # store message ids so we can delete them when user exits the menu 
+        if menu_msgs:
+            ud['menu_messages'] = menu_msgs
+    except Exception:
+        pass
+    try:
+        await update.message.delete()
+    except Exception:
+        pass
+    return
 
-    if uid not in admins:
-        # If the user pressed the exit button while viewing menu, restore main keyboard
-        if text in ('🔙 Chiqish', 'Bekor qilish', '❌ Bekor qilish'):
-            try:
-                await update.message.delete()
-            except Exception:
-                pass
-            # delete stored menu messages (exit button, category message, remove message)
-            try:
-                menu_msgs = ud.pop('menu_messages', None)
-                if menu_msgs:
-                    for m in menu_msgs:
-                        try:
-                            await context.bot.delete_message(chat_id=m.get('chat_id'), message_id=m.get('message_id'))
-                        except Exception:
-                            pass
-            except Exception:
-                pass
-            # delete stored history messages if present (messages shown by 'Buyurtmalar tarixi')
+
+# Show order history
+@conversation.button('🧾 Buyurtmalar tarixi', role='user')
+async def btn_history(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, text: str, ud: dict):
+    with message_cleaner.deferred():
+        await _show_history(update, context, uid, ud)
+
+
+async def _show_history(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, ud: dict):
+    try:
+        # Instead of removing the reply keyboard permanently, show a one-time
+        # exit reply-button so the user can go back and restore the main keyboard.
+        try:
+            # Stored welcome/menu messages that still carry a reply keyboard are removed
+            # in bulk in the background, once this handler has sent the history
+            message_cleaner.schedule_refs(context.bot, [ud.pop('welcome_msg', None)] + (ud.pop('menu_messages', None) or []))
+            # Send an exit reply keyboard so the client keeps showing a button to return
+            exit_kb = ReplyKeyboardMarkup([[KeyboardButton('🔙 Chiqish')]], resize_keyboard=True, one_time_keyboard=True)
+            history_msgs = []
             try:
-                history_msgs = ud.pop('history_messages', None)
-                if history_msgs:
-                    for m in history_msgs:
-                        try:
-                            await context.bot.delete_message(chat_id=m.get('chat_id'), message_id=m.get('message_id'))
-                        except Exception:
-                            pass
+                prompt_msg = await context.bot.send_message(chat_id=uid, text='🔙 Chiqish tugmasini bosing:', reply_markup=exit_kb)
+                history_msgs.append({'chat_id': prompt_msg.chat_id, 'message_id': prompt_msg.message_id})
             except Exception:
                 pass
-            # If the user was in the suggestions/complaints flow, cancel it and delete any previously sent suggestion messages and the suggest prompt
+        except Exception:
+            pass
+        user_orders = orders.by_user(uid)
+        if not user_orders:
+            await update.message.reply_text("Siz hali buyurtma bermagansiz.")
+            try: await update.message.delete()
+            except Exception: pass
+            return
+        for o in reversed(user_orders):
+            dt_str = datetime.fromisoformat(o.get('dt')).strftime('%Y-%m-%d %H:%M')
+            parts = (
+                f"#{o['order_number']} — {o.get('status')}\n"
+                f"🛒 {items_text(o.get('items', []))}\n"
+                f"💰 {o.get('total')} so'm\n"
+                f"🕒 {dt_str}"
+            )
             try:
-                # delete suggestion messages in suggestions channel that we stored earlier
-                try:
-                    sent_sugs = ud.pop('sent_suggestions', [])
-                    for m in sent_sugs:
-                        try:
-                            await context.bot.delete_message(chat_id=m.get('chat_id'), message_id=m.get('message_id'))
-                        except Exception:
-                            pass
-                except Exception:
-                    pass
-                # delete the bot's suggest prompt message (if we stored it)
+                # add a "Qayta buyurtma" button under each order
+                kb = InlineKeyboardMarkup([[InlineKeyboardButton('🔁 Qayta buyurtma', callback_data=f"reorder_{o['order_number']}")]])
+                sent = await context.bot.send_message(chat_id=uid, text=parts, reply_markup=kb)
                 try:
-                    sp = ud.pop('suggest_prompt', None)
-                    if sp:
-                        try:
-                            await context.bot.delete_message(chat_id=sp.get('chat_id'), message_id=sp.get('message_id'))
-                        except Exception:
-                            pass
+                    history_msgs.append({'chat_id': sent.chat_id, 'message_id': sent.message_id})
                 except Exception:
                     pass
-                ud.pop('contact_admin', None)
             except Exception:
-                pass
-            try:
-                user_kb = ReplyKeyboardMarkup([
-                    [KeyboardButton("🍔 Menyu"), KeyboardButton("Taklif va shikoyatlar")],
-                    [KeyboardButton("🧾 Buyurtmalar tarixi")]
-                ], resize_keyboard=True, one_time_keyboard=False)
                 try:
-                    sent_w = await context.bot.send_message(chat_id=uid, text="🍔 Fast Food botiga xush kelibsiz! Quyidagi tugmalardan foydalaning:", reply_markup=user_kb)
-                    # store welcome message id so it can be deleted next time menu is opened
+                    sent = await context.bot.send_message(chat_id=uid, text=parts)
                     try:
-                        ud['welcome_msg'] = {'chat_id': sent_w.chat_id, 'message_id': sent_w.message_id, 'text': "🍔 Fast Food botiga xush kelibsiz! Quyidagi tugmalardan foydalaning:"}
+                        history_msgs.append({'chat_id': sent.chat_id, 'message_id': sent.message_id})
                     except Exception:
                         pass
                 except Exception:
                     pass
-            except Exception:
-                pass
-            return
+        try: await update.message.delete()
+        except Exception: pass
+        # persist history message ids in user_data so we can delete them when user exits
+        try:
+            if history_msgs:
+                ud['history_messages'] = history_msgs
+        except Exception:
+            pass
+    except Exception:
+        pass
+    return
+
 
-        # Show categories when user presses the reply 'Menyu' button
-        if text == "🍔 Menyu":
+# (Personal data button removed) — no direct profile button on main keyboard
+# Send a message to admins (customer suggestions/complaints)
+@conversation.button('Taklif va shikoyatlar', role='user')
+async def btn_suggestions(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, text: str, ud: dict):
+    set_state(ud, 'contact_admin')
+    with message_cleaner.deferred():
+        await _show_suggestion_prompt(update, context, uid, ud)
+
+
+async def _show_suggestion_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, ud: dict):
+    try:
+        # Explicitly remove any reply keyboard first to clear client state
+        try:
+            sent_rm = await context.bot.send_message(chat_id=uid, text='\u200b', reply_markup=ReplyKeyboardRemove())
             try:
-                # delete the welcome message (if stored) so it doesn't remain while in-menu
-                try:
-                    wm = ud.pop('welcome_msg', None)
-                    if wm:
-                        try:
-                            await context.bot.delete_message(chat_id=wm.get('chat_id'), message_id=wm.get('message_id'))
-                        except Exception:
-                            pass
-                except Exception:
-                    pass
-                # Remove the main reply keyboard first so the original buttons disappear,
-                # then send a single-button reply keyboard with only '🔙 Chiqish'.
-                menu_msgs = []
-                try:
-                    sent_rm = await context.bot.send_message(chat_id=uid, text='\u200b', reply_markup=ReplyKeyboardRemove())
-                    menu_msgs.append({'chat_id': sent_rm.chat_id, 'message_id': sent_rm.message_id})
-                except Exception:
-                    pass
-                try:
-                    exit_kb = ReplyKeyboardMarkup([[KeyboardButton('🔙 Chiqish')]], resize_keyboard=True, one_time_keyboard=True)
-                    sent_exit = await context.bot.send_message(chat_id=uid, text='chiqish uchun:', reply_markup=exit_kb)
-                    menu_msgs.append({'chat_id': sent_exit.chat_id, 'message_id': sent_exit.message_id})
-                except Exception:
-                    pass
-                # Show the inline category menu (categories use inline keyboard)
-                try:
-                    sent_cat = await context.bot.send_message(chat_id=uid, text="Kategoriya tanlang:", reply_markup=category_menu_kb())
-                    menu_msgs.append({'chat_id': sent_cat.chat_id, 'message_id': sent_cat.message_id})
-                except Exception:
-                    pass
-                # store message ids so we can delete them when user exits the menu 
-                if menu_msgs:
-                    ud['menu_messages'] = menu_msgs
+                await context.bot.delete_message(chat_id=sent_rm.chat_id, message_id=sent_rm.message_id)
             except Exception:
                 pass
+        except Exception:
+            pass
+        # Previously sent suggestion messages (in suggestions channel, so the user starts fresh),
+        # stored menu messages (exit keyboard) and the welcome message are deleted in bulk
+        # in the background, once the prompt below has been sent
+        refs = list(ud.pop('sent_suggestions', None) or [])
+        refs += ud.pop('menu_messages', None) or []
+        refs.append(ud.pop('welcome_msg', None))
+        message_cleaner.schedule_refs(context.bot, refs)
+        # Show a one-time cancel button so the user can abort the contact flow and store the prompt so we can delete it if user cancels
+        try:
+            cancel_kb = ReplyKeyboardMarkup([[KeyboardButton('Bekor qilish')]], resize_keyboard=True, one_time_keyboard=True)
+            sent_prompt = await context.bot.send_message(chat_id=uid, text="Iltimos, taklif yoki shikoyatingizni yozib qoldiring:", reply_markup=cancel_kb)
             try:
-                await update.message.delete()
+                ud['suggest_prompt'] = {'chat_id': sent_prompt.chat_id, 'message_id': sent_prompt.message_id}
             except Exception:
                 pass
-            return
-
-        # Show order history
-        if text == "🧾 Buyurtmalar tarixi":
+        except Exception:
             try:
-                # Instead of removing the reply keyboard permanently, show a one-time
-                # exit reply-button so the user can go back and restore the main keyboard.
-                try:
-                    # First try to delete any stored welcome/menu messages that still carry a reply keyboard
-                    try:
-                        wm = ud.pop('welcome_msg', None)
-                        if wm:
-                            try:
-                                await context.bot.delete_message(chat_id=wm.get('chat_id'), message_id=wm.get('message_id'))
-                            except Exception:
-                                pass
-                    except Exception:
-                        pass
-                    # Also remove any lingering menu prompts
-                    try:
-                        menu_msgs = ud.pop('menu_messages', None)
-                        if menu_msgs:
-                            for m in menu_msgs:
-                                try:
-                                    await context.bot.delete_message(chat_id=m.get('chat_id'), message_id=m.get('message_id'))
-                                except Exception:
-                                    pass
-                    except Exception:
-                        pass
-                    # Send an exit reply keyboard so the client keeps showing a button to return
-                    exit_kb = ReplyKeyboardMarkup([[KeyboardButton('🔙 Chiqish')]], resize_keyboard=True, one_time_keyboard=True)
-                    history_msgs = []
-                    try:
-                        prompt_msg = await context.bot.send_message(chat_id=uid, text='🔙 Chiqish tugmasini bosing:', reply_markup=exit_kb)
-                        history_msgs.append({'chat_id': prompt_msg.chat_id, 'message_id': prompt_msg.message_id})
-                    except Exception:
-                        pass
-                except Exception:
-                    pass
-                user_orders = [o for o in orders if o.get('user_id') == uid]
-                if not user_orders:
-                    await update.message.reply_text("Siz hali buyurtma bermagansiz.")
-                    try: await update.message.delete()
-                    except Exception: pass
-                    return
-                for o in reversed(user_orders):
-                    dt_str = datetime.fromisoformat(o.get('dt')).strftime('%Y-%m-%d %H:%M')
-                    parts = (
-                        f"#{o['order_number']} — {o.get('status')}\n"
-                        f"🛒 {', '.join(o.get('items', []))}\n"
-                        f"💰 {o.get('total')} so'm\n"
-                        f"🕒 {dt_str}"
-                    )
-                    try:
-                        # add a "Qayta buyurtma" button under each order
-                        kb = InlineKeyboardMarkup([[InlineKeyboardButton('🔁 Qayta buyurtma', callback_data=f"reorder_{o['order_number']}")]])
-                        sent = await context.bot.send_message(chat_id=uid, text=parts, reply_markup=kb)
-                        try:
-                            history_msgs.append({'chat_id': sent.chat_id, 'message_id': sent.message_id})
-                        except Exception:
-                            pass
-                    except Exception:
-                        try:
-                            sent = await context.bot.send_message(chat_id=uid, text=parts)
-                            try:
-                                history_msgs.append({'chat_id': sent.chat_id, 'message_id': sent.message_id})
-                            except Exception:
-                                pass
-                        except Exception:
-                            pass
-                try: await update.message.delete()
-                except Exception: pass
-                # persist history message ids in user_data so we can delete them when user exits
+                sent_prompt = await context.bot.send_message(chat_id=uid, text="Iltimos, taklif yoki shikoyatingizni yozib qoldiring:")
                 try:
-                    if history_msgs:
-                        ud['history_messages'] = history_msgs
+                    ud['suggest_prompt'] = {'chat_id': sent_prompt.chat_id, 'message_id': sent_prompt.message_id}
                 except Exception:
                     pass
             except Exception:
                 pass
-            return
+    except Exception:
+        pass
+    try:
+        await update.message.delete()
+    except Exception:
+        pass
+    return
 
-        # (Personal data button removed) — no direct profile button on main keyboard
 
-        # Send a message to admins (customer suggestions/complaints)
-        if text == "Taklif va shikoyatlar":
-            ud['contact_admin'] = True
+# If user is sending a message intended for admins (contact flow)
+@conversation.state('contact_admin')
+async def st_contact_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, text: str, ud: dict, data):
+    try:
+        msg = text
+        clear_state(ud, 'contact_admin')
+        try:
+            # Compose enriched suggestion containing username, stored or full name, and phone if available
+            tg_un = update.effective_user.username or ''
+            username_display = f"@{tg_un}" if tg_un else "—"
+            prof = users_info.get(uid, {})
+            saved_name = prof.get('name') or update.effective_user.full_name
+            phone_val = prof.get('phone') or ud.get('phone') or "Noma'lum"
+            send_text = (
+                f"[Mijoz xabari]\n"
+                f"Ism: {html.escape(saved_name)}\n"
+                f"Username: {html.escape(username_display)}\n"
+                f"ID: {uid}\n"
+                f"Telefon: {html.escape(phone_val)}\n\n"
+                f"{html.escape(msg)}"
+            )
+            # send suggestion/complaint to the dedicated suggestions channel
             try:
-                # Explicitly remove any reply keyboard first to clear client state
+                # add a reply button so admins can reply directly to this user
+                kb = InlineKeyboardMarkup([[InlineKeyboardButton('↩️ Javob berish', callback_data=f'reply_sug_{uid}_{str(uid)}')]])
+                # Note: we'll include target user id in callback_data; message_id appended after send for reference
+                sent_msg = await context.bot.send_message(chat_id=SUGGESTIONS_CHANNEL_ID, text=send_text, parse_mode="HTML", reply_markup=kb, disable_web_page_preview=True)
+                # update callback_data to include the actual channel message id (so callback carries both user_id and channel_msg_id)
                 try:
-                    sent_rm = await context.bot.send_message(chat_id=uid, text='\u200b', reply_markup=ReplyKeyboardRemove())
-                    try:
-                        await context.bot.delete_message(chat_id=sent_rm.chat_id, message_id=sent_rm.message_id)
-                    except Exception:
-                        pass
-                except Exception:
-                    pass
-                # Delete any previously sent suggestion messages (in suggestions channel) so the user starts fresh
-                try:
-                    sent_sugs = ud.pop('sent_suggestions', [])
-                    for m in sent_sugs:
-                        try:
-                            await context.bot.delete_message(chat_id=m.get('chat_id'), message_id=m.get('message_id'))
-                        except Exception:
-                            pass
+                    await context.bot.edit_message_reply_markup(chat_id=SUGGESTIONS_CHANNEL_ID, message_id=sent_msg.message_id, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton('↩️ Javob berish', callback_data=f'reply_sug_{uid}_{sent_msg.message_id}')]]))
                 except Exception:
                     pass
-                # If there are stored menu messages (exit keyboard), delete them so they don't persist
+                # record sent suggestion so it can be removed later if user cancels
                 try:
-                    menu_msgs = ud.pop('menu_messages', None)
-                    if menu_msgs:
-                        for m in menu_msgs:
-                            try:
-                                await context.bot.delete_message(chat_id=m.get('chat_id'), message_id=m.get('message_id'))
-                            except Exception:
-                                pass
+                    ud.setdefault('sent_suggestions', []).append({'chat_id': sent_msg.chat_id, 'message_id': sent_msg.message_id})
                 except Exception:
                     pass
-                # Remove any stored welcome message to avoid duplicates
+                # remove the suggest prompt (we already delivered the content)
                 try:
-                    wm = ud.pop('welcome_msg', None)
-                    if wm:
+                    sp = ud.pop('suggest_prompt', None)
+                    if sp:
                         try:
-                            await context.bot.delete_message(chat_id=wm.get('chat_id'), message_id=wm.get('message_id'))
+                            await context.bot.delete_message(chat_id=sp.get('chat_id'), message_id=sp.get('message_id'))
                         except Exception:
                             pass
                 except Exception:
                     pass
-                # Show a one-time cancel button so the user can abort the contact flow and store the prompt so we can delete it if user cancels
-                try:
-                    cancel_kb = ReplyKeyboardMarkup([[KeyboardButton('Bekor qilish')]], resize_keyboard=True, one_time_keyboard=True)
-                    sent_prompt = await context.bot.send_message(chat_id=uid, text="Iltimos, taklif yoki shikoyatingizni yozib qoldiring:", reply_markup=cancel_kb)
-                    try:
-                        ud['suggest_prompt'] = {'chat_id': sent_prompt.chat_id, 'message_id': sent_prompt.message_id}
-                    except Exception:
-                        pass
-                except Exception:
-                    try:
-                        sent_prompt = await context.bot.send_message(chat_id=uid, text="Iltimos, taklif yoki shikoyatingizni yozib qoldiring:")
-                        try:
-                            ud['suggest_prompt'] = {'chat_id': sent_prompt.chat_id, 'message_id': sent_prompt.message_id}
-                        except Exception:
-                            pass
-                    except Exception:
-                        pass
-            except Exception:
-                pass
-            try:
-                await update.message.delete()
-            except Exception:
-                pass
-            return
-
-    # If user is sending a message intended for admins (contact flow)
-    if ud.get('contact_admin'):
-        try:
-            msg = text
-            ud.pop('contact_admin', None)
-            try:
-                # Compose enriched suggestion containing username, stored or full name, and phone if available
-                tg_un = update.effective_user.username or ''
-                username_display = f"@{tg_un}" if tg_un else "—"
-                prof = users_info.get(uid, {})
-                saved_name = prof.get('name') or update.effective_user.full_name
-                phone_val = prof.get('phone') or ud.get('phone') or "Noma'lum"
-                send_text = (
-                    f"[Mijoz xabari]\n"
-                    f"Ism: {html.escape(saved_name)}\n"
-                    f"Username: {html.escape(username_display)}\n"
-                    f"ID: {uid}\n"
-                    f"Telefon: {html.escape(phone_val)}\n\n"
-                    f"{html.escape(msg)}"
-                )
-                # send suggestion/complaint to the dedicated suggestions channel
-                try:
-                    # add a reply button so admins can reply directly to this user
-                    kb = InlineKeyboardMarkup([[InlineKeyboardButton('↩️ Javob berish', callback_data=f'reply_sug_{uid}_{str(uid)}')]])
-                    # Note: we'll include target user id in callback_data; message_id appended after send for reference
-                    sent_msg = await context.bot.send_message(chat_id=SUGGESTIONS_CHANNEL_ID, text=send_text, parse_mode="HTML", reply_markup=kb, disable_web_page_preview=True)
-                    # update callback_data to include the actual channel message id (so callback carries both user_id and channel_msg_id)
-                    try:
-                        await context.bot.edit_message_reply_markup(chat_id=SUGGESTIONS_CHANNEL_ID, message_id=sent_msg.message_id, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton('↩️ Javob berish', callback_data=f'reply_sug_{uid}_{sent_msg.message_id}')]]))
-                    except Exception:
-                        pass
-                    # record sent suggestion so it can be removed later if user cancels
-                    try:
-                        ud.setdefault('sent_suggestions', []).append({'chat_id': sent_msg.chat_id, 'message_id': sent_msg.message_id})
-                    except Exception:
-                        pass
-                    # remove the suggest prompt (we already delivered the content)
-                    try:
-                        sp = ud.pop('suggest_prompt', None)
-                        if sp:
-                            try:
-                                await context.bot.delete_message(chat_id=sp.get('chat_id'), message_id=sp.get('message_id'))
-                            except Exception:
-                                pass
-                    except Exception:
-                        pass
-                except Exception:
-                    # fallback to superadmin report if suggestions channel fails
-                    try:
-                        await report_superadmin(context.bot, send_text)
-                    except Exception:
-                        pass
             except Exception:
-                pass
-            try:
-                # send confirmation and restore main keyboard so user returns to the app flow
-                user_kb = ReplyKeyboardMarkup([
-                    [KeyboardButton("🍔 Menyu"), KeyboardButton("Taklif va shikoyatlar")],
-                    [KeyboardButton("🧾 Buyurtmalar tarixi")]
-                ], resize_keyboard=True, one_time_keyboard=False)
-                sent = await context.bot.send_message(chat_id=uid, text="✅ Xabaringiz adminga yuborildi. Tez orada javob olasiz.", reply_markup=user_kb)
-                # remember welcome message so we can clean it up later
+                # fallback to superadmin report if suggestions channel fails
                 try:
-                    context.user_data['welcome_msg'] = {'chat_id': sent.chat_id, 'message_id': sent.message_id, 'text': "🍔 Fast Food botiga xush kelibsiz! Quyidagi tugmalardan foydalaning:"}
+                    await report_superadmin(context.bot, 'Mijoz xabari', None, send_text)
                 except Exception:
                     pass
-            except Exception:
-                pass
-            try:
-                await update.message.delete()
-            except Exception:
-                pass
         except Exception:
             pass
-        return
-    if ud.get("checkout_state") == "ask_phone" and text:
-        # user typed their phone as plain text — normalize and validate
-        norm = normalize_phone(text)
-        # simple digits count validation (require at least 9 digits)
-        digits_only = re.sub(r"\D", "", norm)
-        if len(digits_only) < 9:
+        try:
+            # send confirmation and restore main keyboard so user returns to the app flow
+            user_kb = ReplyKeyboardMarkup([
+                [KeyboardButton("🍔 Menyu"), KeyboardButton("Taklif va shikoyatlar")],
+                [KeyboardButton("🧾 Buyurtmalar tarixi")]
+            ], resize_keyboard=True, one_time_keyboard=False)
+            sent = await context.bot.send_message(chat_id=uid, text="✅ Xabaringiz adminga yuborildi. Tez orada javob olasiz.", reply_markup=user_kb)
+            # remember welcome message so we can clean it up later
             try:
-                await update.message.reply_text("Noto'g'ri telefon formati. Iltimos, quyidagi formatda kiriting: +998901234567")
+                context.user_data['welcome_msg'] = {'chat_id': sent.chat_id, 'message_id': sent.message_id, 'text': "🍔 Fast Food botiga xush kelibsiz! Quyidagi tugmalardan foydalaning:"}
             except Exception:
                 pass
-            return
-        ud["phone"] = norm
-        ud["checkout_state"] = "ask_location"
-        # delete previous bot prompt (phone ask) if stored
+        except Exception:
+            pass
         try:
-            lp = ud.pop('last_prompt_msg', None)
-            if lp:
-                try:
-                    await context.bot.delete_message(chat_id=lp['chat_id'], message_id=lp['message_id'])
-                except Exception:
-                    pass
+            await update.message.delete()
         except Exception:
             pass
-        kb = ReplyKeyboardMarkup([[KeyboardButton("📍 Lokatsiyani ulashish", request_location=True)]], resize_keyboard=True, one_time_keyboard=True)
-        # send location prompt and remember it
+    except Exception:
+        pass
+    return
+
+
+@conversation.state('checkout_state')
+async def st_checkout_state(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int, text: str, ud: dict, data):
+    if data != 'ask_phone' or not text:
+        return False
+    # user typed their phone as plain text — normalize and validate
+    norm = normalize_phone(text)
+    # simple digits count validation (require at least 9 digits)
+    digits_only = re.sub(r"\D", "", norm)
+    if len(digits_only) < 9:
         try:
-            sent = await context.bot.send_message(chat_id=update.effective_user.id, text="📍 Iltimos, manzilingizni yuboring:", reply_markup=kb)
-            ud['last_prompt_msg'] = {'chat_id': sent.chat_id, 'message_id': sent.message_id}
+            await update.message.reply_text("Noto'g'ri telefon formati. Iltimos, quyidagi formatda kiriting: +998901234567")
         except Exception:
+            pass
+        return
+    ud["phone"] = norm
+    set_state(ud, 'checkout_state', "ask_location")
+    # delete previous bot prompt (phone ask) if stored
+    try:
+        lp = ud.pop('last_prompt_msg', None)
+        if lp:
             try:
-                await update.message.reply_text("📍 Iltimos, manzilingizni yuboring:", reply_markup=kb)
+                await context.bot.delete_message(chat_id=lp['chat_id'], message_id=lp['message_id'])
             except Exception:
                 pass
-        # delete the user's phone text message to avoid leaving it in chat
+    except Exception:
+        pass
+    kb = ReplyKeyboardMarkup([[KeyboardButton("📍 Lokatsiyani ulashish", request_location=True)]], resize_keyboard=True, one_time_keyboard=True)
+    # send location prompt and remember it
+    try:
+        sent = await context.bot.send_message(chat_id=update.effective_user.id, text="📍 Iltimos, manzilingizni yuboring:", reply_markup=kb)
+        ud['last_prompt_msg'] = {'chat_id': sent.chat_id, 'message_id': sent.message_id}
+    except Exception:
         try:
-            await update.message.delete()
+            await update.message.reply_text("📍 Iltimos, manzilingizni yuboring:", reply_markup=kb)
         except Exception:
             pass
-        return
-    await start(update, context)
-
+    # delete the user's phone text message to avoid leaving it in chat
+    try:
+        await update.message.delete()
+    except Exception:
+        pass
+    return
 
 
 
 async def contact_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ud = context.user_data
     # If this contact was shared as part of checkout flow
-    if ud.get("checkout_state") == "ask_phone" and update.message.contact:
+    if state_data(ud, 'checkout_state') == "ask_phone" and update.message.contact:
         # store normalized phone from shared contact
         ud["phone"] = normalize_phone(update.message.contact.phone_number)
-        ud["checkout_state"] = "ask_location"
+        set_state(ud, 'checkout_state', "ask_location")
         # delete the previous bot prompt (phone ask) if we stored it
         try:
             lp = ud.pop('last_prompt_msg', None)
@@ -3835,13 +6317,13 @@ async def contact_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # If this contact was shared as part of profile setup (first-start)
-    if ud.get('profile_setup') == 'phone' and update.message.contact:
+    if state_data(ud, 'profile_setup') == 'phone' and update.message.contact:
         name = ud.pop('profile_name', None) or update.effective_user.full_name
         phone = normalize_phone(update.message.contact.phone_number)
         # persist to users_info
         users_info[update.effective_user.id] = {'name': name, 'phone': phone, 'username': update.effective_user.username or ''}
         try:
-            persist_users_info()
+            persist_users_info(update.effective_user.id)
         except Exception:
             pass
         # cleanup any prompt we stored for profile
@@ -3854,7 +6336,7 @@ async def contact_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     pass
         except Exception:
             pass
-        ud.pop('profile_setup', None)
+        clear_state(ud, 'profile_setup')
         ud.pop('profile_name', None)
         # send confirmation and show main keyboard
         try:
@@ -3886,14 +6368,18 @@ async def contact_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def location_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     global order_counter
     ud = context.user_data
-    if ud.get("checkout_state") == "ask_location" and update.message.location:
-        loc: Location = update.message.location; ud["checkout_state"] = None
+    if update.effective_user and update.effective_user.id in couriers and state_data(ud, 'checkout_state') != "ask_location":
+        await courier_location_handler(update, context); return
+    # edited live-location updates carry no update.message
+    msg = update.effective_message
+    if state_data(ud, 'checkout_state') == "ask_location" and msg is not None and msg.location:
+        loc: Location = msg.location; clear_state(ud, 'checkout_state')
         cart = ud.get("cart", {}); cart_summary, total = cart_text_and_total(cart)
         # Saqlab qo'yamiz va foydalanuvchidan to'lov turini so'raymiz (Naqd yoki Kart)
         # prefer phone collected during this checkout; fall back to saved profile phone if available
         phone_val = ud.get('phone') or users_info.get(update.effective_user.id, {}).get('phone') or "Noma'lum"
         ud['pending_order'] = {
-            'items': [f"{k} x{v}" for k, v in cart.items()],
+            'items': cart_items(cart),
             'total': total,
             'phone': phone_val,
             'loc': f"{loc.latitude:.5f},{loc.longitude:.5f}",
@@ -3913,7 +6399,7 @@ async def location_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass
         # delete the user's location message to avoid leaving it in chat
         try:
-            await update.message.delete()
+            await msg.delete()
         except Exception:
             pass
         # payment choice keyboard
@@ -3927,25 +6413,134 @@ async def location_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await context.bot.send_message(chat_id=update.effective_user.id, text="To'lov turini tanlang:", reply_markup=pay_kb)
         except Exception:
             try:
-                await update.message.reply_text("To'lov turini tanlang:", reply_markup=pay_kb)
+                await msg.reply_text("To'lov turini tanlang:", reply_markup=pay_kb)
             except Exception:
                 pass
         return
 
+# ========== WEBHOOK ==========
+class WebhookServer:
+    """aiohttp server that feeds Telegram webhook updates into `app.update_queue`.
+
+    - `POST <path>`: one Update as JSON. The `X-Telegram-Bot-Api-Secret-Token`
+      header must equal `secret_token` (always set), otherwise 403. The update is
+      queued and answered with 200 right away; handling happens in the
+      application's update processor.
+    - `GET /health`: JSON with uptime, queue length and outbound limiter counters.
+
+    aiohttp is only imported when the server starts, so polling mode does not need
+    it. Recorded updates can be replayed locally:
+    `curl -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" -H 'Content-Type: application/json' -d @update.json http://127.0.0.1:8443/webhook`.
+    """
+
+    MAX_BODY = 1 << 20
+
+    def __init__(self, app, host: str, port: int, path: str, secret_token: str, health_path: str = '/health'):
+        if not secret_token:
+            raise ValueError("Webhook secret_token bo'sh bo'lmasligi kerak")
+        self.app = app
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.health_path = health_path
+        self._web = None
+        self._runner = None
+        self._started = time.monotonic()
+        self.metrics = {'received': 0, 'rejected': 0, 'invalid': 0}
+
+    async def start(self):
+        from aiohttp import web
+        self._web = web
+        self._started = time.monotonic()
+        webapp = web.Application(client_max_size=self.MAX_BODY)
+        webapp.router.add_post(self.path, self._handle_update)
+        webapp.router.add_get(self.health_path, self._handle_health)
+        self._runner = web.AppRunner(webapp, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        log.info(f"Webhook server {self.host}:{self.port}{self.path} da tinglamoqda")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        log.info(f"Webhook statistikasi: {self.metrics}")
+
+    def health(self) -> dict:
+        return {
+            'ok': True,
+            'uptime': round(time.monotonic() - self._started, 1),
+            'webhook': dict(self.metrics),
+            'update_queue': self.app.update_queue.qsize(),
+            'outbound': outbound_limiter.snapshot(),
+        }
+
+    async def _handle_health(self, request):
+        return self._web.json_response(self.health())
+
+    async def _handle_update(self, request):
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not secrets.compare_digest(token.encode(), self.secret_token.encode()):
+            self.metrics['rejected'] += 1
+            return self._web.json_response({'ok': False}, status=403)
+        try:
+            update = Update.de_json(await request.json(), self.app.bot)
+        except Exception as e:
+            self.metrics['invalid'] += 1
+            log.warning(f"Webhook: noto'g'ri update: {e}")
+            return self._web.json_response({'ok': False}, status=400)
+        self.metrics['received'] += 1
+        await self.app.update_queue.put(update)
+        return self._web.json_response({'ok': True})
+
+
+def webhook_path() -> str:
+    return (urlparse(WEBHOOK_URL).path if WEBHOOK_URL else '') or '/webhook'
+
+
 # ========== ASOSIY FUNKSIYA ==========
 def main():
+    migrate_stored_items()
+
     async def startup_reschedule(app):
         global order_counter
-        if orders: order_counter = max((o.get("order_number", 0) for o in orders), default=0)
-        for o in list(orders):
-            if o.get("status") == "Kutilyapti":
-                created = datetime.fromisoformat(o["dt"])
-                if (datetime.now(timezone.utc) - created).total_seconds() < 60: 
-                    task = asyncio.create_task(handle_order_expiry(o["order_number"], app.bot))
-                    expiry_tasks[o["order_number"]] = task
+        if orders: order_counter = orders.max_number()
+        # every pending order is rescheduled; ones already past their due time fire right away
+        for o in orders.by_status("Kutilyapti"):
+            schedule_order_expiry(o)
+        expiry_scheduler.start(lambda n: handle_order_expiry(n, app.bot))
+        # publication jobs left behind by a crash or a failed send
+        for o in orders.by_status("Kanalda"):
+            if o.get('publish_job'):
+                publication_outbox.enqueue(o['order_number'], max(0.0, o['publish_job'].get('not_before', 0) - time.time()))
+        publication_outbox.start(app.bot)
+        for gone in invoices.prune():
+            persist_invoice(gone)
+        audit_queue.start(app.bot)
+        # resume a broadcast interrupted by a restart
+        state = load_json(BROADCAST_CHECKPOINT_FILE, None)
+        if isinstance(state, dict) and state.get('targets') is not None:
+            log.info(f"E'lon davom ettirilmoqda: {state.get('cursor')}/{len(state['targets'])}")
+            start_broadcast(BroadcastJob(state), app.bot)
 
     async def _run():
-        app = ApplicationBuilder().token(BOT_TOKEN).post_init(startup_reschedule).build()
+        webhook_mode = bool(WEBHOOK_URL or WEBHOOK_PORT)
+        # different users are handled in parallel, each user's updates in order
+        # bot-sent private messages are recorded for /start cleanup inside the bot itself
+        bot = RecordingBot(BOT_TOKEN, rate_limiter=outbound_limiter, record_messages=TRACK_MESSAGES)
+        builder = ApplicationBuilder().bot(bot).concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY))
+        if webhook_mode:
+            # updates arrive over HTTP instead of getUpdates
+            builder = builder.updater(None)
+        app = builder.build()
+        webhook = None
+        if TRACK_MESSAGES_FILE:
+            message_tracker.load(TRACK_MESSAGES_FILE)
+        # user_data is restored per user on first contact and saved after every update
+        user_sessions.bind(app)
+        app.add_handler(TypeHandler(Update, user_sessions.load), group=-1)
+        app.add_handler(TypeHandler(Update, user_sessions.touch), group=100)
         app.add_handler(CommandHandler("start", start)); app.add_handler(CommandHandler("help", help_command))
         app.add_handler(CallbackQueryHandler(callback_handler))
         # Telegram Payments handlers
@@ -3956,99 +6551,24 @@ def main():
         app.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, text_handler))
         # Explicit initialization to avoid ExtBot initialization errors
         await app.initialize()
-        # Wrap common send methods to record bot-sent messages for cleanup
-        try:
-            bot = app.bot
-            # send_message
-            _orig_send_message = bot.send_message
-            async def _wrapped_send_message(*args, **kwargs):
-                msg = await _orig_send_message(*args, **kwargs)
-                try:
-                    if getattr(msg.chat, 'type', None) == 'private':
-                        _record_bot_message(msg.chat_id, msg.message_id)
-                except Exception:
-                    pass
-                return msg
-            bot.send_message = _wrapped_send_message  # type: ignore
-
-            # send_photo
-            _orig_send_photo = bot.send_photo
-            async def _wrapped_send_photo(*args, **kwargs):
-                msg = await _orig_send_photo(*args, **kwargs)
-                try:
-                    if getattr(msg.chat, 'type', None) == 'private':
-                        _record_bot_message(msg.chat_id, msg.message_id)
-                except Exception:
-                    pass
-                return msg
-            bot.send_photo = _wrapped_send_photo  # type: ignore
-
-            # send_document
-            _orig_send_document = bot.send_document
-            async def _wrapped_send_document(*args, **kwargs):
-                msg = await _orig_send_document(*args, **kwargs)
-                try:
-                    if getattr(msg.chat, 'type', None) == 'private':
-                        _record_bot_message(msg.chat_id, msg.message_id)
-                except Exception:
-                    pass
-                return msg
-            bot.send_document = _wrapped_send_document  # type: ignore
-
-            # send_sticker
-            _orig_send_sticker = bot.send_sticker
-            async def _wrapped_send_sticker(*args, **kwargs):
-                msg = await _orig_send_sticker(*args, **kwargs)
-                try:
-                    if getattr(msg.chat, 'type', None) == 'private':
-                        _record_bot_message(msg.chat_id, msg.message_id)
-                except Exception:
-                    pass
-                return msg
-            bot.send_sticker = _wrapped_send_sticker  # type: ignore
-
-            # forward_message
-            _orig_forward_message = bot.forward_message
-            async def _wrapped_forward_message(*args, **kwargs):
-                msg = await _orig_forward_message(*args, **kwargs)
-                try:
-                    if getattr(msg.chat, 'type', None) == 'private':
-                        _record_bot_message(msg.chat_id, msg.message_id)
-                except Exception:
-                    pass
-                return msg
-            bot.forward_message = _wrapped_forward_message  # type: ignore
-
-            # send_media_group (returns list of Messages)
-            _orig_send_media_group = bot.send_media_group
-            async def _wrapped_send_media_group(*args, **kwargs):
-                msgs = await _orig_send_media_group(*args, **kwargs)
-                try:
-                    for m in msgs or []:
-                        if getattr(m.chat, 'type', None) == 'private':
-                            _record_bot_message(m.chat_id, m.message_id)
-                except Exception:
-                    pass
-                return msgs
-            bot.send_media_group = _wrapped_send_media_group  # type: ignore
-
-            # send_invoice
-            _orig_send_invoice = bot.send_invoice
-            async def _wrapped_send_invoice(*args, **kwargs):
-                msg = await _orig_send_invoice(*args, **kwargs)
-                try:
-                    if getattr(msg.chat, 'type', None) == 'private':
-                        _record_bot_message(msg.chat_id, msg.message_id)
-                except Exception:
-                    pass
-                return msg
-            bot.send_invoice = _wrapped_send_invoice  # type: ignore
-        except Exception as e:
-            log.warning(f"Bot send wrappers init failed: {e}")
+        persistence.start()
         try:
             await app.start()
+            # post_init only runs under run_polling(), so reschedule explicitly
+            await startup_reschedule(app)
             log.info("Bot ishga tushdi.")
-            await app.updater.start_polling()
+            if webhook_mode:
+                # every POST must carry the secret; without WEBHOOK_SECRET a random one is used per start
+                secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+                webhook = WebhookServer(app, WEBHOOK_LISTEN, WEBHOOK_PORT or 8443, webhook_path(), secret)
+                await webhook.start()
+                if WEBHOOK_URL:
+                    await app.bot.set_webhook(url=WEBHOOK_URL, secret_token=secret, allowed_updates=Update.ALL_TYPES)
+                else:
+                    log.info("WEBHOOK_URL berilmagan: setWebhook chaqirilmadi (lokal sinov rejimi)"
+                             + ("" if WEBHOOK_SECRET else "; update'larni yuborish uchun WEBHOOK_SECRET ni o'rnating"))
+            else:
+                await app.updater.start_polling()
             # Keep the application running
             stop_event = asyncio.Event()
             try:
@@ -4057,17 +6577,40 @@ def main():
                 pass
         finally:
             try:
-                # Ensure polling stops before shutdown
+                await expiry_scheduler.stop()
+                await publication_outbox.stop()
+                await audit_queue.stop()
+                await message_cleaner.stop()
+                if TRACK_MESSAGES_FILE:
+                    message_tracker.save(TRACK_MESSAGES_FILE)
+                log.info(f"Kuzatilayotgan xabarlar: {message_tracker.stats()}")
+                if active_broadcast and not active_broadcast.done():
+                    active_broadcast.cancel()
+                    try:
+                        await active_broadcast
+                    except asyncio.CancelledError:
+                        pass
+                # Ensure polling / the webhook server stops before shutdown
                 try:
-                    await app.updater.stop()
+                    if webhook is not None:
+                        await webhook.stop()
+                    if app.updater is not None:
+                        await app.updater.stop()
                 except Exception:
                     pass
                 await app.stop()
             finally:
                 await app.shutdown()
+                # write out whatever is still queued, then fsync/close the backend
+                persistence.stop()
+                storage.close()
 
     # Run the async runner
     asyncio.run(_run())
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate-json":
+        # python bot.py migrate-json [sqlite:///delivery_bot.db]
+        migrate_json_to_sqlite(sys.argv[2] if len(sys.argv) > 2 else (DATABASE_URL or "sqlite:///delivery_bot.db"))
+    else:
+        main()
\ No newline at end of file
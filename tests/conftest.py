@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# bot.py reads (and may write) its data files in the working directory when it is
+# imported; keep the tests away from the real ones.
+os.chdir(tempfile.mkdtemp(prefix="bot-tests-"))
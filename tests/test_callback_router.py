@@ -0,0 +1,58 @@
+import asyncio
+
+import bot
+
+
+async def h_exact(*a): pass
+async def h_short(*a): pass
+async def h_long(*a): pass
+
+
+def make_router():
+    r = bot.CallbackRouter()
+    r.route('amenu_add_category')(h_exact)
+    r.route(prefix='amenu_')(h_short)
+    r.route(prefix=('amenu_delete_', 'amenu_delete_cat_'))(h_long)
+    return r
+
+
+def test_exact_match_wins_with_empty_arg():
+    assert make_router().resolve('amenu_add_category') == (h_exact, None, False, '')
+
+
+def test_longest_prefix_wins_and_is_stripped():
+    r = make_router()
+    assert r.resolve('amenu_delete_cat_Ichimliklar')[::3] == (h_long, 'Ichimliklar')
+    assert r.resolve('amenu_delete_Burger')[::3] == (h_long, 'Burger')
+    assert r.resolve('amenu_cat_Taomlar')[::3] == (h_short, 'cat_Taomlar')
+    # an exact route is not a prefix
+    assert r.resolve('amenu_add_categoryX')[::3] == (h_short, 'add_categoryX')
+
+
+def test_no_route():
+    r = make_router()
+    assert r.resolve('unknown_1') is None
+    assert r.resolve('amenu') is None
+    assert r.resolve('') is None
+
+
+def test_dispatch_checks_role_and_passes_arg(monkeypatch):
+    monkeypatch.setattr(bot, 'admins', {1})
+    r = bot.CallbackRouter()
+    calls = []
+
+    @r.route(prefix='set_status_', role='admin', order_lock=True)
+    async def handler(update, context, query, data, uid, ud, arg):
+        calls.append((uid, arg))
+
+    async def main():
+        await r.dispatch(None, None, None, 'set_status_7_Kutilyapti_Kanalda', 2, {})
+        await r.dispatch(None, None, None, 'set_status_7_Kutilyapti_Kanalda', 1, {})
+    asyncio.run(main())
+    assert calls == [(1, '7_Kutilyapti_Kanalda')]
+
+
+def test_order_number_in():
+    assert bot.order_number_in('12') == 12
+    assert bot.order_number_in('12_Kanalda') == 12
+    assert bot.order_number_in('x12') is None
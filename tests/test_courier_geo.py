@@ -0,0 +1,51 @@
+import random
+
+import bot
+
+
+def brute_force(positions, lat, lon, k, radius_km, accept=None):
+    found = sorted(
+        (bot.distance_km(lat, lon, c_lat, c_lon), cid)
+        for cid, (c_lat, c_lon) in positions.items()
+        if accept is None or accept(cid)
+    )
+    return [(d, cid) for d, cid in found if d <= radius_km][:k]
+
+
+def test_nearest_matches_brute_force():
+    rng = random.Random(42)
+    idx = bot.CourierGeoIndex(ttl=900)
+    positions = {}
+    for cid in range(300):
+        lat, lon = 41.2 + rng.random() * 0.2, 69.1 + rng.random() * 0.3
+        positions[cid] = (lat, lon)
+        idx.update(cid, lat, lon, now=1000.0)
+    for _ in range(50):
+        lat, lon = 41.2 + rng.random() * 0.2, 69.1 + rng.random() * 0.3
+        k, radius = rng.choice([1, 3, 10]), rng.choice([0.5, 2.0, 10.0])
+        got = idx.nearest(lat, lon, k, radius, now=1000.0)
+        want = brute_force(positions, lat, lon, k, radius)
+        assert [cid for _, cid in got] == [cid for _, cid in want]
+
+
+def test_accept_filter_and_radius():
+    idx = bot.CourierGeoIndex()
+    idx.update(1, 41.300, 69.240, now=0)
+    idx.update(2, 41.301, 69.241, now=0)
+    idx.update(3, 41.400, 69.240, now=0)     # ~11 km north
+    assert [c for _, c in idx.nearest(41.3, 69.24, 3, 5.0, now=1)] == [1, 2]
+    assert [c for _, c in idx.nearest(41.3, 69.24, 3, 5.0, accept=lambda c: c != 1, now=1)] == [2]
+    assert [c for _, c in idx.nearest(41.3, 69.24, 3, 20.0, now=1)] == [1, 2, 3]
+
+
+def test_moving_and_stale_couriers():
+    idx = bot.CourierGeoIndex(ttl=60)
+    idx.update(1, 41.3, 69.24, now=0)
+    idx.update(1, 41.5, 69.24, now=10)       # moved ~22 km away
+    assert len(idx) == 1
+    assert idx.nearest(41.3, 69.24, 1, 5.0, now=20) == []
+    idx.update(2, 41.3, 69.24, now=0)
+    # courier 2 stopped sharing its location: skipped and dropped
+    assert idx.nearest(41.3, 69.24, 5, 50.0, now=65)[0][1] == 1
+    assert idx.nearest(41.3, 69.24, 5, 50.0, now=100) == []
+    assert len(idx) == 0
@@ -0,0 +1,31 @@
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+
+def test_outbox_withdraws_offers_of_a_cancelled_order(monkeypatch):
+    offer = {'chat_id': 11, 'message_id': 5}
+    store = bot.OrderStore([{
+        'order_number': 1, 'user_id': 10, 'status': 'Kanalda',
+        'publish_job': {'created': 0, 'attempts': 0, 'not_before': 60},
+        'dispatch': {'offered': [{'courier_id': 11, 'km': 0.4}], 'messages': [offer], 'until': 60},
+    }])
+    cleaned, published = [], []
+    monkeypatch.setattr(bot, 'orders', store)
+    monkeypatch.setattr(bot, 'persist_orders', lambda o=None, critical=False: None)
+    monkeypatch.setattr(bot, 'message_cleaner', SimpleNamespace(schedule_refs=lambda b, refs: cleaned.extend(refs)))
+
+    async def publish(order, b):
+        published.append(order['order_number'])
+    outbox = bot.PublicationOutbox(publish)
+    outbox._bot = object()
+
+    store.transition(1, 'Kanalda', 'Bekor qilindi')       # admin cancels during the offer window
+    asyncio.run(outbox._attempt(1))
+
+    order = store.get(1)
+    assert published == []
+    assert 'publish_job' not in order
+    assert cleaned == [offer]
+    assert order['dispatch']['messages'] == []
@@ -0,0 +1,49 @@
+import bot
+
+
+def test_parse_legacy_strings():
+    assert bot.parse_item("Burger x2") == {'product': 'Burger', 'name': 'Burger', 'price': 25000, 'qty': 2}
+    # only the last " x" separates the quantity
+    assert bot.parse_item("Box xl x3")['name'] == "Box xl"
+    assert bot.parse_item("Box xl x3")['qty'] == 3
+    assert bot.parse_item("Palov") == {'product': 'Palov', 'name': 'Palov', 'price': 35000, 'qty': 1}
+    item = {'product': 'Fanta', 'name': 'Fanta', 'price': 6000, 'qty': 1}
+    assert bot.parse_item(item) is item
+
+
+def test_migrate_stored_items(monkeypatch):
+    legacy = {'order_number': 1, 'user_id': 5, 'status': 'Kanalda', 'items': ["Burger x2", "Fanta x1"],
+              'proposed_items': ["Burger x1"], 'total': 50000}
+    current = {'order_number': 2, 'user_id': 5, 'status': 'Kanalda', 'items': [bot.line_item("Palov", 1)], 'total': 35000}
+    store = bot.OrderStore([legacy, current])
+    invoices = bot.InvoiceStore([])
+    inv = invoices.create(5, {'items': ["Manti x2"], 'total': 60000}, 60000, 'UZS')
+    persisted, invoiced = [], []
+    monkeypatch.setattr(bot, 'orders', store)
+    monkeypatch.setattr(bot, 'invoices', invoices)
+    monkeypatch.setattr(bot, 'persist_orders', lambda o=None, critical=False: persisted.append(o['order_number']))
+    monkeypatch.setattr(bot, 'persist_invoice', lambda payload=None: invoiced.append(payload))
+
+    bot.migrate_stored_items()
+
+    assert persisted == [1] and invoiced == [inv['payload']]
+    assert legacy['items'] == [bot.line_item("Burger", 2), bot.line_item("Fanta", 1)]
+    assert legacy['proposed_items'] == [bot.line_item("Burger", 1)]
+    # the quoted total is kept, even if the menu price changed since
+    assert legacy['total'] == 50000
+    assert inv['pending_order']['items'] == [bot.line_item("Manti", 2)]
+
+    # a second pass has nothing left to convert
+    bot.migrate_stored_items()
+    assert persisted == [1] and invoiced == [inv['payload']]
+
+
+def test_invoice_amount_is_the_quoted_total_in_som():
+    cart = {"Burger": 2, "Coca Cola 0.5l": 1}
+    _, total = bot.cart_text_and_total(cart)
+    assert total == 2 * 25000 + 8000
+    assert bot.items_total(bot.cart_items(cart)) == total
+    inv = bot.InvoiceStore([]).create(5, {'items': bot.cart_items(cart), 'total': total}, int(total), 'UZS')
+    assert inv['amount'] == 58000
+    assert bot.invoice_problem(inv, 5, 58000, 'UZS') is None
+    assert bot.invoice_problem(inv, 5, 5800000, 'UZS') is not None
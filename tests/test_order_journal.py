@@ -0,0 +1,53 @@
+import json
+
+import bot
+
+
+def make_journal(tmp_path, **kw):
+    return bot.OrderJournal(str(tmp_path / "orders.json"), str(tmp_path / "orders.journal"), **kw)
+
+
+def test_replay_over_snapshot_last_write_wins(tmp_path):
+    (tmp_path / "orders.json").write_text(json.dumps([
+        {"order_number": 1, "status": "Kutilyapti"},
+        {"order_number": 2, "status": "Kutilyapti"},
+    ]), encoding="utf-8")
+    j = make_journal(tmp_path)
+    j.append({"order_number": 2, "status": "Kanalda"})
+    j.append({"order_number": 3, "status": "Kutilyapti"})
+    j.append({"order_number": 2, "status": "Qabul qilingan"})
+    j.close()
+
+    loaded = {o["order_number"]: o["status"] for o in make_journal(tmp_path).load()}
+    assert loaded == {1: "Kutilyapti", 2: "Qabul qilingan", 3: "Kutilyapti"}
+
+
+def test_torn_line_stops_replay(tmp_path):
+    j = make_journal(tmp_path)
+    j.append({"order_number": 1, "status": "Kanalda"})
+    j.close()
+    with open(tmp_path / "orders.journal", "a", encoding="utf-8") as f:
+        f.write('{"order_number": 1, "status": "Yetka')      # crash mid-write
+        f.write('\n{"order_number": 2, "status": "Kanalda"}\n')
+
+    j = make_journal(tmp_path)
+    loaded = j.load()
+    assert [(o["order_number"], o["status"]) for o in loaded] == [(1, "Kanalda")]
+    assert j._entries == 1
+
+
+def test_compaction_folds_journal_into_snapshot(tmp_path):
+    j = make_journal(tmp_path, compact_every=2)
+    j.append({"order_number": 1, "status": "Kutilyapti"})
+    assert not j.needs_compaction()
+    j.append({"order_number": 1, "status": "Kanalda"})
+    assert j.needs_compaction()
+
+    j.compact(j.load())
+    assert (tmp_path / "orders.journal").read_text(encoding="utf-8") == ""
+    assert not j.needs_compaction()
+    assert make_journal(tmp_path).load() == [{"order_number": 1, "status": "Kanalda"}]
+
+
+def test_missing_files_load_empty(tmp_path):
+    assert make_journal(tmp_path).load() == []
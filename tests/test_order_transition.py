@@ -0,0 +1,58 @@
+import bot
+
+
+def make_store():
+    return bot.OrderStore([
+        {'order_number': 1, 'user_id': 10, 'status': 'Kutilyapti'},
+        {'order_number': 2, 'user_id': 10, 'status': 'Kanalda'},
+    ])
+
+
+def test_transition_sets_status_fields_and_history():
+    store = make_store()
+    order = store.transition(2, 'Kanalda', 'Qabul qilingan', by=7, courier_id=7)
+    assert order is store.get(2)
+    assert order['status'] == 'Qabul qilingan' and order['courier_id'] == 7
+    [entry] = order['status_history']
+    assert (entry['from'], entry['to'], entry['by']) == ('Kanalda', 'Qabul qilingan', 7)
+    # the indexes follow the change
+    assert store.by_status('Kanalda') == []
+    assert store.by_courier(7) == [order]
+    assert store.couriers_in('Qabul qilingan') == {7}
+
+
+def test_stale_expected_state_is_rejected():
+    store = make_store()
+    assert store.transition(2, 'Kanalda', 'Qabul qilingan', courier_id=7)
+    # a second courier pressing the same (now stale) button loses
+    assert store.transition(2, 'Kanalda', 'Qabul qilingan', courier_id=8) is None
+    assert store.get(2)['courier_id'] == 7
+    assert len(store.get(2)['status_history']) == 1
+
+
+def test_expected_tuple_and_any():
+    store = make_store()
+    assert store.transition(1, ('Kutilyapti', 'Kanalda'), 'Bekor qilindi')
+    assert store.transition(2, None, 'Bekor qilindi')
+
+
+def test_disallowed_edges_are_rejected():
+    store = make_store()
+    assert store.transition(1, 'Kutilyapti', 'Yetkazib berildi') is None
+    # no repost edge: republishing goes through the outbox
+    assert store.transition(2, 'Kanalda', 'Kanalda') is None
+    assert store.transition(1, 'Kutilyapti', 'Bekor qilindi')
+    assert store.transition(1, 'Bekor qilindi', 'Kanalda') is None
+    assert store.get(1)['status'] == 'Bekor qilindi'
+
+
+def test_unknown_order():
+    assert make_store().transition(99, None, 'Kanalda') is None
+
+
+def test_none_field_removes_it():
+    store = make_store()
+    store.transition(2, 'Kanalda', 'Qabul qilingan', courier_id=7)
+    store.transition(2, 'Qabul qilingan', 'Kanalda', courier_id=None)
+    assert 'courier_id' not in store.get(2)
+    assert store.by_courier(7) == []
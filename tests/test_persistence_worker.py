@@ -0,0 +1,89 @@
+import asyncio
+import threading
+
+import bot
+
+
+class Recorder:
+    """Writer for one collection: records the `changed` keys it was asked to
+    serialize and the thread each write ran on."""
+
+    def __init__(self):
+        self.serialized = []
+        self.written = []
+
+    def __call__(self, changed):
+        self.serialized.append(None if changed is None else sorted(changed))
+        return lambda: self.written.append(threading.current_thread().name)
+
+
+def test_repeated_marks_coalesce_into_one_write():
+    rec = Recorder()
+    worker = bot.PersistenceWorker({'orders': rec}, interval=0.1)
+
+    async def main():
+        worker.start()
+        for key in (1, 2, 1, 3, 2):
+            worker.mark('orders', key)
+        await asyncio.sleep(0.4)
+        worker.stop()
+    asyncio.run(main())
+
+    assert rec.serialized == [[1, 2, 3]]
+    assert rec.written == ['persistence']
+    assert worker.stats()['orders'] == {'requested': 5, 'written': 1, 'pending': 0, 'avoided': 4}
+
+
+def test_whole_collection_mark_wins_over_keys():
+    rec = Recorder()
+    worker = bot.PersistenceWorker({'users': rec}, interval=0.1)
+
+    async def main():
+        worker.start()
+        worker.mark('users', 5)
+        worker.mark('users')
+        worker.mark('users', 6)
+        await asyncio.sleep(0.4)
+        worker.stop()
+    asyncio.run(main())
+    assert rec.serialized == [None]
+
+
+def test_stop_writes_everything_pending():
+    orders, menu = Recorder(), Recorder()
+    worker = bot.PersistenceWorker({'orders': orders, 'menu': menu}, interval=60)
+
+    async def main():
+        worker.start()
+        worker.mark('orders', 1)
+        worker.mark('orders', 2)
+        worker.mark('menu')
+        await asyncio.sleep(0.05)
+        assert orders.written == [] and menu.written == []    # still inside the window
+        worker.stop()
+    asyncio.run(main())
+
+    assert orders.serialized == [[1, 2]] and menu.serialized == [None]
+    assert len(orders.written) == 1 and len(menu.written) == 1
+    assert worker.stats()['orders']['pending'] == 0
+
+
+def test_critical_mark_skips_the_window():
+    rec = Recorder()
+    worker = bot.PersistenceWorker({'invoices': rec}, interval=60)
+
+    async def main():
+        worker.start()
+        worker.mark('invoices', 'inv_1', critical=True)
+        await asyncio.sleep(0.2)
+        written = list(rec.written)
+        worker.stop()
+        return written
+    assert asyncio.run(main()) == ['persistence']
+
+
+def test_marks_are_written_synchronously_before_start():
+    rec = Recorder()
+    worker = bot.PersistenceWorker({'users': rec}, interval=60)
+    worker.mark('users', 1)
+    assert rec.serialized == [[1]] and rec.written == [threading.current_thread().name]
@@ -0,0 +1,106 @@
+import json
+
+import bot
+
+
+def open_db(tmp_path):
+    return bot.SqliteStorage(str(tmp_path / "bot.db"))
+
+
+ORDERS = [
+    {'order_number': 1, 'user_id': 10, 'status': 'Yetkazib berildi', 'courier_id': 7, 'dt': '2026-01-01T10:00:00+00:00',
+     'items': [{'product': 'Burger', 'name': 'Burger', 'price': 25000, 'qty': 2}], 'total': 50000},
+    {'order_number': 2, 'user_id': 11, 'status': 'Kanalda', 'dt': '2026-01-02T10:00:00+00:00',
+     'items': [], 'total': 0, 'original_text': "Palov — o‘zbek taomi"},
+]
+
+
+def test_orders_round_trip_and_row_upsert(tmp_path):
+    db = open_db(tmp_path)
+    db.dump_orders(ORDERS)()
+    changed = dict(ORDERS[1], status='Qabul qilingan', courier_id=8)
+    db.dump_orders(None, [changed])()
+    db.close()
+
+    db = open_db(tmp_path)
+    assert db.load_orders() == [ORDERS[0], changed]
+    assert db._select("SELECT courier_id, status FROM orders WHERE order_number = 2") == [(8, 'Qabul qilingan')]
+    db.close()
+
+
+def test_user_data_round_trip(tmp_path):
+    db = open_db(tmp_path)
+    db.save_user_data({5: json.dumps({'cart': {'Fanta': 2}}), 6: json.dumps({'state': {'name': 'x'}})})
+    assert db.load_user_data(5) == {'cart': {'Fanta': 2}}
+    assert db.load_user_data(99) is None
+    # an empty session deletes the row
+    db.save_user_data({6: ''})
+    assert dict(db.iter_user_data()) == {5: {'cart': {'Fanta': 2}}}
+    db.close()
+
+
+def test_invoices_round_trip_and_delete(tmp_path):
+    invoices = bot.InvoiceStore([])
+    a = invoices.create(5, {'items': [], 'total': 8000}, 8000, 'UZS')
+    b = invoices.create(6, {'items': [], 'total': 9000}, 9000, 'UZS')
+    db = open_db(tmp_path)
+    db.dump_invoices(invoices.items())()
+    invoices.mark_paid(a, 'charge-1', 3)
+    del invoices.items()[b['payload']]
+    db.dump_invoices(invoices.items(), [a['payload'], b['payload']])()
+    db.close()
+
+    db = open_db(tmp_path)
+    loaded = db.load_invoices()
+    assert loaded == [a]
+    assert bot.InvoiceStore(loaded).by_charge('charge-1') == a
+    db.close()
+
+
+def test_id_sets_keyed_rows_and_menu(tmp_path):
+    db = open_db(tmp_path)
+    db.dump_users({1, 2, 3})()
+    db.dump_users({1, 3, 4}, [2, 4])()
+    db.dump_earnings({7: {'total': 10000}}, None)()
+    db.dump_users_info({5: {'name': 'Ali', 'phone': '+998'}}, [5])()
+    menu = {'Taomlar': {'Palov': {'price': 35000}, 'Manti': {'price': 30000}}, 'Ichimliklar': {'Fanta': {'price': 7000}}}
+    db.dump_menu(menu)()
+    assert db.load_users() == {1, 3, 4}
+    assert db.load_earnings() == {7: {'total': 10000}}
+    assert db.load_users_info() == {5: {'name': 'Ali', 'phone': '+998'}}
+    loaded = db.load_menu()
+    assert loaded == menu and list(loaded) == list(menu) and list(loaded['Taomlar']) == ['Palov', 'Manti']
+    db.close()
+
+
+def test_migrate_json_to_sqlite(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    snapshot = [ORDERS[0], dict(ORDERS[1], status='Kutilyapti')]
+    files = {
+        bot.USERS_FILE: [10, 11, 12],
+        bot.COURIERS_FILE: [7],
+        bot.EARNINGS_FILE: {'7': {'total': 50000}},
+        bot.USERS_INFO_FILE: {'10': {'name': 'Ali'}},
+        bot.MENU_FILE: {'Fast Food': {'Burger': {'price': 25000}}},
+        bot.INVOICES_FILE: [{'payload': 'inv_10_1', 'user_id': 10, 'status': 'pending', 'amount': 8000}],
+        bot.ORDERS_FILE: snapshot,
+    }
+    for name, data in files.items():
+        (tmp_path / name).write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+    src = bot.JsonStorage()
+    src.orders_journal.append(ORDERS[1])          # a change not compacted yet
+    src.save_user_data({10: json.dumps({'cart': {'Burger': 1}})})
+    src.close()
+
+    bot.migrate_json_to_sqlite("sqlite:///migrated.db")
+
+    db = bot.SqliteStorage("migrated.db")
+    assert db.load_users() == {10, 11, 12}
+    assert db.load_couriers() == {7}
+    assert db.load_earnings() == {7: {'total': 50000}}
+    assert db.load_users_info() == {10: {'name': 'Ali'}}
+    assert db.load_menu() == files[bot.MENU_FILE]
+    assert db.load_invoices() == files[bot.INVOICES_FILE]
+    assert db.load_orders() == ORDERS
+    assert db.load_user_data(10) == {'cart': {'Burger': 1}}
+    db.close()
@@ -0,0 +1,58 @@
+import asyncio
+import time
+
+import bot
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_burst_up_to_capacity_is_immediate():
+    async def main():
+        b = bot.TokenBucket(rate=10, capacity=5)
+        start = time.monotonic()
+        for _ in range(5):
+            await b.acquire()
+        return time.monotonic() - start
+    assert run(main()) < 0.05
+
+
+def test_refill_limits_rate():
+    async def main():
+        b = bot.TokenBucket(rate=50, capacity=1)
+        start = time.monotonic()
+        for _ in range(6):
+            await b.acquire()
+        return time.monotonic() - start
+    # the first token is free, the other five arrive at 50/s
+    elapsed = run(main())
+    assert 0.09 <= elapsed < 0.5
+
+
+def test_pause_blocks_and_empties_bucket():
+    async def main():
+        b = bot.TokenBucket(rate=1000, capacity=10)
+        b.pause(0.1)
+        start = time.monotonic()
+        await b.acquire()
+        return time.monotonic() - start
+    assert run(main()) >= 0.09
+
+
+def test_waiters_are_served_in_order():
+    async def main():
+        b = bot.TokenBucket(rate=100, capacity=1)
+        served = []
+
+        async def take(i):
+            await b.acquire()
+            served.append(i)
+        await asyncio.gather(*(take(i) for i in range(5)))
+        return served
+    assert run(main()) == [0, 1, 2, 3, 4]
+
+
+def test_default_capacity():
+    assert bot.TokenBucket(rate=25).capacity == 25
+    assert bot.TokenBucket(rate=0.5).capacity == 1.0
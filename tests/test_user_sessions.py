@@ -0,0 +1,68 @@
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+
+class FakeStorage:
+    def __init__(self, stored):
+        self.stored = stored
+        self.fail = False
+
+    def load_user_data(self, user_id):
+        if self.fail:
+            raise OSError("disk error")
+        return self.stored.get(user_id)
+
+
+def make_sessions(monkeypatch, stored):
+    storage = FakeStorage(stored)
+    marks = []
+    monkeypatch.setattr(bot, 'storage', storage)
+    monkeypatch.setattr(bot, 'persistence', SimpleNamespace(mark=lambda name, key=None, critical=False: marks.append((name, key))))
+    sessions = bot.UserSessions()
+    data = {}
+    sessions.bind(SimpleNamespace(user_data=data))
+    return sessions, storage, data, marks
+
+
+def update_for(uid, data):
+    ud = data.setdefault(uid, {})
+    return SimpleNamespace(effective_user=SimpleNamespace(id=uid)), SimpleNamespace(user_data=ud)
+
+
+def test_stored_session_is_merged_and_not_rewritten(monkeypatch):
+    sessions, _, data, marks = make_sessions(monkeypatch, {7: {'cart': {'Burger': 1}, 'pending_invoice': 'inv_1'}})
+    update, context = update_for(7, data)
+    context.user_data['cart'] = {}
+    asyncio.run(sessions.load(update, context))
+    # values already set by this update win over the stored ones
+    assert context.user_data == {'cart': {}, 'pending_invoice': 'inv_1'}
+    asyncio.run(sessions.touch(update, context))
+    assert marks == [('user_data', 7)]
+    rows = {}
+    bot.storage.save_user_data = rows.update
+    sessions.dump([7])()
+    assert rows[7] != '' and 'inv_1' in rows[7]
+
+
+def test_failed_load_never_overwrites_and_is_retried(monkeypatch):
+    sessions, storage, data, marks = make_sessions(monkeypatch, {7: {'pending_invoice': 'inv_1', 'state': 'checkout'}})
+    storage.fail = True
+    update, context = update_for(7, data)
+    asyncio.run(sessions.load(update, context))
+    context.user_data['cart'] = {'Fanta': 1}          # the handler still runs
+    asyncio.run(sessions.touch(update, context))
+    assert marks == []
+    written = []
+    bot.storage.save_user_data = written.append
+    sessions.dump([7])()
+    sessions.dump()()
+    assert written == []
+
+    # the next update loads the stored session again
+    storage.fail = False
+    asyncio.run(sessions.load(update, context))
+    assert context.user_data == {'cart': {'Fanta': 1}, 'pending_invoice': 'inv_1', 'state': 'checkout'}
+    asyncio.run(sessions.touch(update, context))
+    assert marks == [('user_data', 7)]